@@ -5,8 +5,10 @@
 """remote.Provider reads configs from a remote config service."""
 
 import base64
+import collections
 import datetime
 import logging
+import threading
 import urllib
 
 # Config component is using google.protobuf package, it requires some python
@@ -29,6 +31,12 @@ MEMCACHE_PREFIX = 'components.config/v1/'
 CONFIG_MAX_TIME_SINCE_LAST_ACCESS = datetime.timedelta(days=7)
 # Update LastGoodConfig.last_access_ts if it will be deleted next day.
 UPDATE_LAST_ACCESS_TIME_FREQUENCY = datetime.timedelta(days=1)
+# Maximum total size of config contents kept in the instance memory.
+CONTENT_STORE_SIZE = 16 * 1024 * 1024
+# Maximum number of content hashes sent as known_hashes. Each one adds about 60
+# bytes to the URL; above this, only the hashes are requested to stay well
+# within the URL length limits.
+MAX_KNOWN_HASHES = 50
 
 
 class LastGoodConfig(ndb.Model):
@@ -47,6 +55,58 @@ class LastGoodConfig(ndb.Model):
   last_access_ts = ndb.DateTimeProperty()
 
 
+class _ContentStore(object):
+  """Thread-safe in-process LRU store of config contents by content hash.
+
+  A content hash always maps to the same content, so entries never expire,
+  they are only evicted.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._size = 0
+    self._lock = threading.Lock()
+    # content_hash -> content
+    self._items = collections.OrderedDict()
+
+  def __contains__(self, content_hash):
+    with self._lock:
+      return content_hash in self._items
+
+  def get(self, content_hash):
+    """Returns the content or None if it is not stored."""
+    with self._lock:
+      content = self._items.pop(content_hash, None)
+      if content is not None:
+        # Move it to the most recently used position.
+        self._items[content_hash] = content
+      return content
+
+  def set(self, content_hash, content):
+    if len(content) > self.max_size:
+      return
+    with self._lock:
+      if content_hash in self._items:
+        return
+      self._items[content_hash] = content
+      self._size += len(content)
+      while self._size > self.max_size:
+        _, evicted = self._items.popitem(last=False)
+        self._size -= len(evicted)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self._size = 0
+
+
+_content_store = _ContentStore(CONTENT_STORE_SIZE)
+
+# url_path -> content hashes returned by the last multi config request, used
+# as known_hashes by the next one.
+_multi_config_hashes = {}
+
+
 class Provider(object):
   """Configuration provider that fethes configs from a config service.
 
@@ -78,16 +138,20 @@ class Provider(object):
   def get_config_by_hash_async(self, content_hash):
     """Returns a config blob by its hash. Optionally memcaches results."""
     assert content_hash
-    cache_key = '%sconfig_by_hash/%s' % (MEMCACHE_PREFIX, content_hash)
-    ctx = ndb.get_context()
-    content = yield ctx.memcache_get(cache_key)
+    content = _content_store.get(content_hash)
     if content is not None:
       raise ndb.Return(content)
 
-    res = yield self._api_call_async('config/%s' % content_hash)
-    content = base64.b64decode(res.get('content')) if res else None
+    cache_key = '%sconfig_by_hash/%s' % (MEMCACHE_PREFIX, content_hash)
+    ctx = ndb.get_context()
+    content = yield ctx.memcache_get(cache_key)
+    if content is None:
+      res = yield self._api_call_async('config/%s' % content_hash)
+      content = base64.b64decode(res.get('content')) if res else None
+      if content is not None:
+        yield ctx.memcache_set(cache_key, content)
     if content is not None:
-      yield ctx.memcache_set(cache_key, content)
+      _content_store.set(content_hash, content)
     raise ndb.Return(content)
 
   @ndb.tasklet
@@ -125,6 +189,26 @@ class Provider(object):
               cache_key, (revision, content_hash), time=60 if get_latest else 0)
     raise ndb.Return(revision, content_hash)
 
+  @ndb.tasklet
+  def _get_config_if_changed_async(self, config_set, path, known_hash):
+    """Returns tuple (revision, content_hash, content) of the latest config.
+
+    content is None if content_hash is |known_hash|, so an unchanged config is
+    not downloaded again.
+    """
+    url_path = format_url('config_sets/%s/config/%s', config_set, path)
+    params = {}
+    if known_hash:
+      params['known_hash'] = known_hash
+    res = yield self._api_call_async(url_path, params=params)
+    if not res:
+      raise ndb.Return(None, None, None)
+    content = None
+    if res.get('content') is not None:
+      content = base64.b64decode(res['content'])
+      _content_store.set(res['content_hash'], content)
+    raise ndb.Return(res['revision'], res['content_hash'], content)
+
   @ndb.tasklet
   def get_async(
       self, config_set, path, revision=None, dest_type=None,
@@ -152,17 +236,37 @@ class Provider(object):
 
   @ndb.tasklet
   def _get_configs_multi(self, url_path):
-    """Returns a map config_set -> (revision, content)."""
+    """Returns a map config_set -> (revision, content).
+
+    If this instance already holds the contents returned by the previous call,
+    their hashes are sent as known_hashes and only the changed contents are
+    downloaded. Otherwise, or if there are more than MAX_KNOWN_HASHES of them,
+    only the hashes are requested and the contents are loaded by hash, mostly
+    from memcache.
+    """
     assert url_path
 
+    known_hashes = sorted(
+        h for h in _multi_config_hashes.get(url_path, ())
+        if h in _content_store)
+    if 0 < len(known_hashes) <= MAX_KNOWN_HASHES:
+      params = {'known_hashes': known_hashes}
+    else:
+      params = {'hashes_only': True}
+
     # Response must return a dict with 'configs' key which is a list of configs.
-    # Each config has keys 'config_set', 'revision' and 'content_hash'.
+    # Each config has keys 'config_set', 'revision' and 'content_hash' and
+    # 'content' if it was requested and its hash is not known.
     res = yield self._api_call_async(
-        url_path, params={'hashes_only': True}, allow_not_found=False)
+        url_path, params=params, allow_not_found=False)
 
-    # Load config contents. Most of them will come from memcache.
     for cfg in res['configs']:
       cfg['project_id'] = cfg['config_set'].split('/', 1)[1]
+      if cfg.get('content') is not None:
+        content = base64.b64decode(cfg['content'])
+        _content_store.set(cfg['content_hash'], content)
+      # Load the other config contents. Most of them will come from the
+      # in-process store or memcache.
       cfg['get_content_future'] = self.get_config_by_hash_async(
           cfg['content_hash'])
 
@@ -173,6 +277,9 @@ class Provider(object):
             'Config content for %s was not loaded by hash %r',
             cfg['config_set'], cfg['content_hash'])
 
+    _multi_config_hashes[url_path] = [
+      cfg['content_hash'] for cfg in res['configs'] if cfg['content']
+    ]
     raise ndb.Return({
       cfg['config_set']: (cfg['revision'], cfg['content'])
       for cfg in res['configs']
@@ -228,8 +335,9 @@ class Provider(object):
       return
 
     config_set, path = config_key.id().split(':', 1)
-    revision, content_hash = yield self.get_config_hash_async(
-        config_set, path, use_memcache=False)
+    # The content is downloaded only if it changed.
+    revision, content_hash, content = yield self._get_config_if_changed_async(
+        config_set, path, current.content_hash)
     if not revision:
       logging.warning(
           'Could not fetch hash of latest %s', config_key.id())
@@ -241,9 +349,11 @@ class Provider(object):
       assert current.content_hash == content_hash
       return
 
-    content = None
-    if current.content_hash != content_hash:
-      content = yield self.get_config_by_hash_async(content_hash)
+    if current.content_hash == content_hash:
+      content = None
+    else:
+      if content is None:
+        content = yield self.get_config_by_hash_async(content_hash)
       if content is None:
         logging.warning(
             'Could not fetch config content %s by hash %s',
@@ -33,23 +33,30 @@ class RemoteTestCase(test_case.TestCase):
     provider_future = ndb.Future()
     provider_future.set_result(self.provider)
     self.mock(remote, 'get_provider_async', lambda: provider_future)
+    remote._content_store.clear()
+    remote._multi_config_hashes.clear()
+
+  @staticmethod
+  def config_response(params, content_hash, content):
+    res = {
+      'content_hash': content_hash,
+      'revision': 'aaaabbbb',
+    }
+    if (not params.get('hash_only') and
+        params.get('known_hash') != content_hash):
+      res['content'] = base64.b64encode(content)
+    return res
 
   @ndb.tasklet
   def json_request_async(self, url, **kwargs):
     assert kwargs['scopes']
     URL_PREFIX = 'https://luci-config.appspot.com/_ah/api/config/v1/'
     if url == URL_PREFIX + 'config_sets/services%2Ffoo/config/bar.cfg':
-      assert kwargs['params']['hash_only']
-      raise ndb.Return({
-        'content_hash': 'deadbeef',
-        'revision': 'aaaabbbb',
-      })
+      raise ndb.Return(
+          self.config_response(kwargs['params'], 'deadbeef', 'a config'))
     if url == URL_PREFIX + 'config_sets/services%2Ffoo/config/baz.cfg':
-      assert kwargs['params']['hash_only']
-      raise ndb.Return({
-        'content_hash': 'badcoffee',
-        'revision': 'aaaabbbb',
-      })
+      raise ndb.Return(
+          self.config_response(kwargs['params'], 'badcoffee', 'param: "qux"'))
 
     if url == URL_PREFIX + 'config/deadbeef':
       raise ndb.Return({
@@ -175,6 +182,86 @@ class RemoteTestCase(test_case.TestCase):
 
     self.assertEqual(configs, {'projects/chromium': ('aaaaaaaa', 'a config')})
 
+  def test_get_project_configs_async_known_hashes(self):
+    self.mock(net, 'json_request_async', mock.Mock())
+    net.json_request_async.return_value = ndb.Future()
+    net.json_request_async.return_value.set_result({
+      'configs': [
+        {
+          'config_set': 'projects/chromium',
+          'content_hash': 'deadbeef',
+          'revision': 'aaaaaaaa',
+        },
+      ]
+    })
+    remote._content_store.set('deadbeef', 'a config')
+    configs = self.provider.get_project_configs_async('cfg').get_result()
+    self.assertEqual(configs, {'projects/chromium': ('aaaaaaaa', 'a config')})
+    net.json_request_async.assert_called_once_with(
+        'https://luci-config.appspot.com/_ah/api/config/v1/'
+        'configs/projects/cfg',
+        params={'hashes_only': True},
+        scopes=net.EMAIL_SCOPE)
+
+    # The next call sends the hash it holds and gets only the changed config.
+    net.json_request_async.reset_mock()
+    net.json_request_async.return_value = ndb.Future()
+    net.json_request_async.return_value.set_result({
+      'configs': [
+        {
+          'config_set': 'projects/chromium',
+          'content_hash': 'deadbeef',
+          'revision': 'aaaaaaaa',
+        },
+        {
+          'config_set': 'projects/v8',
+          'content': base64.b64encode('v8 config'),
+          'content_hash': 'badcoffee',
+          'revision': 'bbbbbbbb',
+        },
+      ]
+    })
+    configs = self.provider.get_project_configs_async('cfg').get_result()
+    self.assertEqual(
+        configs,
+        {
+          'projects/chromium': ('aaaaaaaa', 'a config'),
+          'projects/v8': ('bbbbbbbb', 'v8 config'),
+        })
+    net.json_request_async.assert_called_once_with(
+        'https://luci-config.appspot.com/_ah/api/config/v1/'
+        'configs/projects/cfg',
+        params={'known_hashes': ['deadbeef']},
+        scopes=net.EMAIL_SCOPE)
+    self.assertEqual('v8 config', remote._content_store.get('badcoffee'))
+
+    # Too many known hashes for the URL, only the hashes are requested.
+    self.mock(remote, 'MAX_KNOWN_HASHES', 1)
+    net.json_request_async.reset_mock()
+    configs = self.provider.get_project_configs_async('cfg').get_result()
+    self.assertEqual(
+        configs,
+        {
+          'projects/chromium': ('aaaaaaaa', 'a config'),
+          'projects/v8': ('bbbbbbbb', 'v8 config'),
+        })
+    net.json_request_async.assert_called_once_with(
+        'https://luci-config.appspot.com/_ah/api/config/v1/'
+        'configs/projects/cfg',
+        params={'hashes_only': True},
+        scopes=net.EMAIL_SCOPE)
+
+  def test_content_store(self):
+    store = remote._ContentStore(10)
+    store.set('a', 'aaaa')
+    store.set('b', 'bbbb')
+    self.assertEqual('aaaa', store.get('a'))
+    # 'b' is the least recently used.
+    store.set('c', 'cccc')
+    self.assertNotIn('b', store)
+    self.assertIn('a', store)
+    self.assertEqual('cccc', store.get('c'))
+
   def test_get_config_set_location_async(self):
     self.mock(net, 'json_request_async', mock.Mock())
     net.json_request_async.return_value = ndb.Future()
@@ -227,6 +314,27 @@ class RemoteTestCase(test_case.TestCase):
 
     self.assertIsNone(old_cfg.key.get())
 
+  def test_cron_update_last_good_configs_unchanged(self):
+    remote.LastGoodConfig(
+        id='services/foo:bar.cfg',
+        content='a config',
+        content_hash='deadbeef',
+        revision='aaaaaaaa',
+        last_access_ts=datetime.datetime(2010, 1, 1)).put()
+    self.mock_now(datetime.datetime(2010, 1, 2))
+
+    remote.cron_update_last_good_configs()
+
+    # The content was not downloaded again.
+    net.json_request_async.assert_called_once_with(
+        'https://luci-config.appspot.com/_ah/api/config/v1/'
+        'config_sets/services%2Ffoo/config/bar.cfg',
+        params={'known_hash': 'deadbeef'},
+        scopes=net.EMAIL_SCOPE)
+    cfg = remote.LastGoodConfig.get_by_id('services/foo:bar.cfg')
+    self.assertEqual('aaaabbbb', cfg.revision)
+    self.assertEqual('a config', cfg.content)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
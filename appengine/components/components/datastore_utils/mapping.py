@@ -4,41 +4,120 @@
 
 """Queries for incremental mapping."""
 
+import collections
+import logging
+
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
+from components import utils
+
 
 __all__ = [
+  'MapStats',
   'incremental_map',
   'page_queries',
+  'parallel_map',
   'pop_future_done',
+  'split_query',
 ]
 
 
 ### Private stuff.
 
 
-def _process_chunk_of_items(
-    map_fn, action_futures, items_to_process, max_inflight, map_page_size):
-  """Maps as many items as possible and throttles down to 'max_inflight'.
+class _InflightWindow(object):
+  """Bounded FIFO window of outstanding ndb.Future.
 
-  |action_futures| is modified in-place.
-  Remaining items_to_process is returned.
+  Done futures are discarded from the head of the window, so adding a future
+  is amortized O(1) instead of scanning the whole list.
   """
-  # First, throttle.
-  pop_future_done(action_futures)
-  while len(action_futures) > max_inflight:
-    ndb.Future.wait_any(action_futures)
-    pop_future_done(action_futures)
 
-  # Then, map. map_fn() may return None so "or []" to not throw an exception. It
-  # just means there no async operation to wait on.
-  action_futures.extend(map_fn(items_to_process[:map_page_size]) or [])
-  return items_to_process[map_page_size:]
+  def __init__(self, max_inflight):
+    self._max_inflight = max_inflight
+    self._futures = collections.deque()
+
+  def __len__(self):
+    return len(self._futures)
+
+  def extend(self, futures):
+    """Adds futures then throttles down to max_inflight."""
+    self._futures.extend(futures)
+    while self._futures and self._futures[0].done():
+      self._futures.popleft()
+    while len(self._futures) > self._max_inflight:
+      # Waiting on the oldest one is good enough to bound the window; the
+      # following ones are likely done by then.
+      self._futures.popleft().wait()
+      while self._futures and self._futures[0].done():
+        self._futures.popleft()
+
+  def wait_all(self):
+    ndb.Future.wait_all(self._futures)
+    self._futures.clear()
+
+
+class _Mapper(object):
+  """Buffers filtered items and hands them to map_fn page by page."""
+
+  def __init__(self, map_fn, filter_fn, max_inflight, map_page_size, stats):
+    self._map_fn = map_fn
+    self._filter_fn = filter_fn
+    self._map_page_size = map_page_size
+    self._items = collections.deque()
+    self._window = _InflightWindow(max_inflight)
+    self._stats = stats
+
+  def add(self, items):
+    self._stats.fetched += len(items)
+    filter_fn = self._filter_fn
+    self._items.extend(i for i in items if not filter_fn or filter_fn(i))
+    while len(self._items) >= self._map_page_size:
+      self._map_one_page()
+
+  def flush(self):
+    while self._items:
+      self._map_one_page()
+    self._window.wait_all()
+
+  def _map_one_page(self):
+    popleft = self._items.popleft
+    count = min(self._map_page_size, len(self._items))
+    page = [popleft() for _ in xrange(count)]
+    self._stats.mapped += len(page)
+    # map_fn() may return None so "or []" to not throw an exception. It just
+    # means there no async operation to wait on.
+    self._window.extend(self._map_fn(page) or [])
 
 
 ### Public API.
 
 
+class MapStats(object):
+  """Throughput statistics of a parallel_map() run."""
+
+  def __init__(self):
+    self.fetched = 0
+    self.mapped = 0
+    self.pages = 0
+    self.start = utils.time_time()
+    self.end = None
+
+  @property
+  def duration(self):
+    return (self.end or utils.time_time()) - self.start
+
+  @property
+  def throughput(self):
+    """Number of items fetched per second."""
+    duration = self.duration
+    return self.fetched / duration if duration > 0 else 0.
+
+  def __str__(self):
+    return '%d items (%d mapped) in %d pages; %.1fs; %.1f items/s' % (
+        self.fetched, self.mapped, self.pages, self.duration, self.throughput)
+
+
 def pop_future_done(futures):
   """Removes the currently done futures."""
   for i in xrange(len(futures) - 1, -1, -1):
@@ -86,18 +165,123 @@ def incremental_map(
     map_page_size: number of items to pass to |map_fn| at a time.
     fetch_page_size: number of items to retrieve from |queries| at a time.
   """
-  items_to_process = []
-  action_futures = []
-
+  mapper = _Mapper(map_fn, filter_fn, max_inflight, map_page_size, MapStats())
   for items in page_queries(queries, fetch_page_size=fetch_page_size):
-    items_to_process.extend(i for i in items if not filter_fn or filter_fn(i))
-    while len(items_to_process) >= map_page_size:
-      items_to_process = _process_chunk_of_items(
-          map_fn, action_futures, items_to_process, max_inflight, map_page_size)
+    mapper.add(items)
+  mapper.flush()
+
+
+def split_query(query, shard_count):
+  """Splits a query into up to |shard_count| queries over disjoint key ranges.
 
-  while items_to_process:
-    items_to_process = _process_chunk_of_items(
-        map_fn, action_futures, items_to_process, max_inflight, map_page_size)
+  Uses the __scatter__ special property to find split points, like the
+  mapreduce library does. The query must not have an inequality filter nor a
+  sort order since key range filters are added to it.
 
-  ndb.Future.wait_all(action_futures)
+  Returns:
+    list of ndb.Query. It may contain less than |shard_count| queries when the
+    kind has too few entities to be split.
+  """
+  if shard_count <= 1:
+    return [query]
+  # Oversample to get more evenly distributed split points.
+  oversampling = 32
+  scatter = ndb.Query(
+      kind=query.kind, namespace=query.namespace, ancestor=query.ancestor,
+      app=query.app).order(ndb.GenericProperty('__scatter__'))
+  keys = sorted(scatter.fetch(shard_count * oversampling, keys_only=True))
+  if not keys:
+    return [query]
+  stride = max(len(keys) / shard_count, 1)
+  splits = keys[stride-1::stride][:shard_count-1]
+  out = []
+  start = None
+  for end in splits + [None]:
+    q = query
+    if start is not None:
+      q = q.filter(ndb.Model._key >= start)
+    if end is not None:
+      q = q.filter(ndb.Model._key < end)
+    out.append(q)
+    start = end
+  return out
+
+
+def parallel_map(
+    queries, map_fn, filter_fn=None, max_inflight=100, map_page_size=20,
+    fetch_page_size=100, cursors=None, deadline=None):
+  """Applies |map_fn| to objects in a list of queries, with checkpointing.
+
+  Each query is a shard that is fetched concurrently with the others; use
+  split_query() to split a single large query. The outstanding futures
+  returned by |map_fn| are bounded by |max_inflight|.
+
+  When |deadline| is reached, no new page is fetched, all the fetched items are
+  mapped and the cursors to resume the work are returned. They are strings so
+  they can be passed as-is as a task queue payload to a continuation task,
+  which calls parallel_map() again with the same queries.
+
+  Arguments:
+    queries: list of ndb.Query to process.
+    map_fn: callback that accepts a list of objects to map and optionally
+            returns a list of ndb.Future.
+    filter_fn: optional callback that can filter out items when returning
+               False.
+    max_inflight: maximum limit of number of outstanding futures returned by
+                  |map_fn|.
+    map_page_size: number of items to pass to |map_fn| at a time.
+    fetch_page_size: number of items to retrieve from each query at a time.
+    cursors: list of str as returned by a previous call, one per query. None
+             for a query that is completed.
+    deadline: optional utils.time_time() value after which the work is
+              checkpointed.
+
+  Returns:
+    tuple(list of str cursors or None if all the queries are completed,
+          MapStats).
+  """
+  if cursors is None:
+    cursors = [''] * len(queries)
+  if len(cursors) != len(queries):
+    raise ValueError(
+        'Expected %d cursors, got %d' % (len(queries), len(cursors)))
+
+  stats = MapStats()
+  mapper = _Mapper(map_fn, filter_fn, max_inflight, map_page_size, stats)
+  # Shard index -> ndb.Future of the page being fetched.
+  futures = {}
+  def fetch(i, cursor):
+    futures[i] = queries[i].fetch_page_async(
+        fetch_page_size, start_cursor=cursor)
+
+  out = cursors[:]
+  for i, c in enumerate(cursors):
+    if c is not None:
+      fetch(i, datastore_query.Cursor(urlsafe=c) if c else None)
+
+  timed_out = False
+  while futures:
+    shards = futures.keys()
+    f = ndb.Future.wait_any([futures[i] for i in shards])
+    i = next(i for i in shards if futures[i] is f)
+    del futures[i]
+    items, cursor, more = f.get_result()
+    stats.pages += 1
+    mapper.add(items)
+    if not more:
+      out[i] = None
+    elif deadline and utils.time_time() >= deadline:
+      timed_out = True
+      out[i] = cursor.urlsafe()
+    else:
+      out[i] = cursor.urlsafe()
+      fetch(i, cursor)
 
+  mapper.flush()
+  stats.end = utils.time_time()
+  logging.info(
+      'parallel_map(%d shards): %s%s',
+      len(queries), stats, '; checkpointed' if timed_out else '')
+  if all(c is None for c in out):
+    return None, stats
+  return out, stats
@@ -122,6 +122,64 @@ class MappingTest(test_case.TestCase):
     actual.sort(key=lambda x: (x.key.id, x.to_dict()))
     self.assertEqual(expected, actual)
 
+  def test_parallel_map(self):
+    for i in range(40):
+      EntityX(id=i+1, a=i%4).put()
+    queries = [
+      EntityX.query(EntityX.a == 1),
+      EntityX.query(EntityX.a == 2),
+    ]
+    actual = []
+    cursors, stats = mapping.parallel_map(
+        queries, actual.extend, map_page_size=3, fetch_page_size=4)
+    self.assertEqual(None, cursors)
+    self.assertEqual(20, stats.fetched)
+    self.assertEqual(20, stats.mapped)
+    expected = sorted(i+1 for i in xrange(40) if i%4 in (1, 2))
+    self.assertEqual(expected, sorted(e.key.id() for e in actual))
+
+  def test_parallel_map_checkpoint(self):
+    for i in range(40):
+      EntityX(id=i+1, a=i%4).put()
+    queries = [
+      EntityX.query(EntityX.a == 1),
+      EntityX.query(EntityX.a == 2),
+    ]
+    actual = []
+    # The deadline is already reached, so only one page per shard is fetched.
+    cursors, stats = mapping.parallel_map(
+        queries, actual.extend, fetch_page_size=4, deadline=1)
+    self.assertEqual(2, len(cursors))
+    self.assertTrue(all(isinstance(c, str) for c in cursors))
+    self.assertEqual(8, stats.fetched)
+    self.assertEqual(8, len(actual))
+
+    # Resume from the checkpoint.
+    cursors, stats = mapping.parallel_map(
+        queries, actual.extend, fetch_page_size=4, cursors=cursors)
+    self.assertEqual(None, cursors)
+    self.assertEqual(12, stats.fetched)
+    expected = sorted(i+1 for i in xrange(40) if i%4 in (1, 2))
+    self.assertEqual(expected, sorted(e.key.id() for e in actual))
+
+  def test_parallel_map_bad_cursors(self):
+    with self.assertRaises(ValueError):
+      mapping.parallel_map([EntityX.query()], lambda _: None, cursors=[])
+
+  def test_split_query(self):
+    for i in range(200):
+      EntityX(id=i+1, a=i%4).put()
+    queries = mapping.split_query(EntityX.query(), 4)
+    self.assertTrue(1 <= len(queries) <= 4)
+    keys = sum((q.fetch(keys_only=True) for q in queries), [])
+    # Each entity is returned exactly once.
+    self.assertEqual(200, len(keys))
+    self.assertEqual(200, len(set(keys)))
+
+  def test_split_query_single(self):
+    q = EntityX.query()
+    self.assertEqual([q], mapping.split_query(q, 1))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
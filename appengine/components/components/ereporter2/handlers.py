@@ -204,6 +204,15 @@ class CronEreporter2Mail(webapp2.RequestHandler):
       self.response.write('Failed.')
 
 
+class CronEreporter2FlushCounters(webapp2.RequestHandler):
+  """Adds the errors logged recently to the error counters."""
+  @decorators.require_cronjob
+  def get(self):
+    out = logscraper.flush_error_counters(deadline=utils.time_time() + 50)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.write(str(out))
+
+
 class CronEreporter2Cleanup(webapp2.RequestHandler):
   """Deletes old error reports."""
   @decorators.require_cronjob
@@ -213,6 +222,10 @@ class CronEreporter2Cleanup(webapp2.RequestHandler):
         models.Error.created_ts < old_cutoff,
         default_options=ndb.QueryOptions(keys_only=True))
     out = len(ndb.delete_multi(items))
+    counters = models.ErrorCounter.query(
+        models.ErrorCounter.bucket_ts < old_cutoff,
+        default_options=ndb.QueryOptions(keys_only=True))
+    out += len(ndb.delete_multi(counters))
     self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
     self.response.write(str(out))
 
@@ -299,6 +312,9 @@ def get_backend_routes():
   return [
     webapp2.Route(
         r'/internal/cron/ereporter2/cleanup', CronEreporter2Cleanup),
+    webapp2.Route(
+        r'/internal/cron/ereporter2/flush_counters',
+        CronEreporter2FlushCounters),
     webapp2.Route(
         r'/internal/cron/ereporter2/mail', CronEreporter2Mail),
   ]
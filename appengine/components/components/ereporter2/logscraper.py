@@ -5,14 +5,21 @@
 """Backend functions to gather error reports."""
 
 import collections
+import datetime
 import hashlib
+import json
 import logging
 import os
 import re
+import threading
 
 import webob
 
 from google.appengine.api import logservice
+from google.appengine.api import modules
+from google.appengine.api import taskqueue
+from google.appengine.api.logservice import logsutil
+from google.appengine.ext import ndb
 
 from components import utils
 
@@ -24,6 +31,11 @@ from . import models
 SOFT_MEMORY = u'Exceeded soft private memory limit'
 
 
+# Pull queue where ErrorCountingHandler enqueues the errors to count. It must be
+# declared in queue.yaml.
+COUNTER_QUEUE = 'ereporter2-errors'
+
+
 ### Private constants.
 
 
@@ -31,6 +43,34 @@ SOFT_MEMORY = u'Exceeded soft private memory limit'
 _STACK_TRACE_MARKER = u'Traceback (most recent call last):'
 
 
+_RE_STACK_TRACE_FILE = re.compile(formatter.RE_STACK_TRACE_FILE)
+
+
+# Duration of the time buckets of models.ErrorCounter.
+_COUNTER_BUCKET = datetime.timedelta(minutes=5)
+
+
+# Number of request ids kept per models.ErrorCounter to fetch sample stack
+# traces.
+_COUNTER_REQUEST_IDS = 3
+
+
+# Errors logged by the runtime itself instead of the python logging module,
+# so they are not counted by ErrorCountingHandler. These are still found by
+# scanning the logs.
+_RUNTIME_ERRORS = (
+  SOFT_MEMORY,
+  u'A problem was encountered with the process that handled this request',
+  u'Process terminated because the request deadline was exceeded',
+  u'Request was aborted after waiting too long',
+)
+
+
+# When the errors are counted, scrape_logs_for_errors() stops scanning the logs
+# for _RUNTIME_ERRORS after this number of seconds.
+_RUNTIME_ERRORS_SCAN_DURATION = 2*60
+
+
 # Number of first error records to show in the category error list.
 _ERROR_LIST_HEAD_SIZE = 10
 # Number of last error records to show in the category error list.
@@ -228,10 +268,10 @@ def _signature_from_message(message):
   stacktrace = []
   index = lines.index(_STACK_TRACE_MARKER) + 1
   while index < len(lines):
-    if not re.match(formatter.RE_STACK_TRACE_FILE, lines[index]):
+    if not _RE_STACK_TRACE_FILE.match(lines[index]):
       break
     if (len(lines) > index + 1 and
-        re.match(formatter.RE_STACK_TRACE_FILE, lines[index+1])):
+        _RE_STACK_TRACE_FILE.match(lines[index+1])):
       # It happens occasionally with jinja2 templates.
       stacktrace.append(lines[index])
       index += 1
@@ -262,7 +302,7 @@ def _signature_from_message(message):
   path = None
   line_no = -1
   for l in reversed(stacktrace):
-    m = re.match(formatter.RE_STACK_TRACE_FILE, l)
+    m = _RE_STACK_TRACE_FILE.match(l)
     if m:
       if not path:
         path = os.path.basename(m.group('file'))
@@ -278,6 +318,47 @@ def _signature_from_message(message):
   return _shorten(signature), ex_type
 
 
+def _error_record_from_entry(entry):
+  """Returns an _ErrorRecord for a logservice.RequestLog."""
+  # Merge all error messages. The main reason to do this is that sometimes
+  # a single logging.error() 'Traceback' is split on each line as an
+  # individual log_line entry.
+  msgs = []
+  log_time = None
+  for log_line in entry.app_logs:
+    # TODO(maruel): Specifically handle:
+    # 'Request was aborted after waiting too long to attempt to service your
+    # request.'
+    # For an unknown reason, it is logged at level info (!?)
+    if log_line.level < logservice.LOG_LEVEL_ERROR:
+      continue
+    msg = log_line.message.strip('\n')
+    if not msg.strip():
+      continue
+    # The message here is assumed to be utf-8 encoded but that is not
+    # guaranteed. The dashboard does prints out utf-8 log entries properly.
+    msgs.append(_to_unicode(msg))
+    log_time = log_time or log_line.time
+
+  return _ErrorRecord(
+      entry.request_id,
+      entry.start_time, log_time, entry.latency, entry.mcycles,
+      entry.ip, entry.nickname, entry.referrer, entry.user_agent,
+      entry.host, entry.resource, entry.method, entry.task_queue_name,
+      entry.was_loading_request, entry.version_id, entry.module_id,
+      entry.url_map_entry, entry.app_engine_release, entry.instance_key,
+      entry.status, '\n'.join(msgs))
+
+
+def _to_unicode(msg):
+  if isinstance(msg, unicode):
+    return msg
+  try:
+    return msg.decode('utf-8')
+  except UnicodeDecodeError:
+    return msg.decode('ascii', 'replace')
+
+
 def _extract_exceptions_from_logs(start_time, end_time, module_versions):
   """Yields _ErrorRecord objects from the logs.
 
@@ -299,44 +380,118 @@ def _extract_exceptions_from_logs(start_time, end_time, module_versions):
         include_incomplete=True,
         include_app_logs=True,
         module_versions=module_versions):
-      # Merge all error messages. The main reason to do this is that sometimes
-      # a single logging.error() 'Traceback' is split on each line as an
-      # individual log_line entry.
-      msgs = []
-      log_time = None
-      for log_line in entry.app_logs:
-        # TODO(maruel): Specifically handle:
-        # 'Request was aborted after waiting too long to attempt to service your
-        # request.'
-        # For an unknown reason, it is logged at level info (!?)
-        if log_line.level < logservice.LOG_LEVEL_ERROR:
-          continue
-        msg = log_line.message.strip('\n')
-        if not msg.strip():
-          continue
-        # The message here is assumed to be utf-8 encoded but that is not
-        # guaranteed. The dashboard does prints out utf-8 log entries properly.
-        try:
-          msg = msg.decode('utf-8')
-        except UnicodeDecodeError:
-          msg = msg.decode('ascii', 'replace')
-        msgs.append(msg)
-        log_time = log_time or log_line.time
-
-      yield _ErrorRecord(
-          entry.request_id,
-          entry.start_time, log_time, entry.latency, entry.mcycles,
-          entry.ip, entry.nickname, entry.referrer, entry.user_agent,
-          entry.host, entry.resource, entry.method, entry.task_queue_name,
-          entry.was_loading_request, entry.version_id, entry.module_id,
-          entry.url_map_entry, entry.app_engine_release, entry.instance_key,
-          entry.status, '\n'.join(msgs))
+      yield _error_record_from_entry(entry)
   except logservice.Error as e:
     # It's not worth generating an error log when logservice is temporarily
     # down. Retrying is not worth either.
     logging.warning('Failed to scrape log:\n%s', e)
 
 
+def _get_counter_bucket(when):
+  """Returns the start of the models.ErrorCounter time bucket for |when|."""
+  seconds = int((when - utils.EPOCH).total_seconds())
+  step = int(_COUNTER_BUCKET.total_seconds())
+  return utils.EPOCH + datetime.timedelta(seconds=seconds - seconds % step)
+
+
+def _get_counter_key(bucket_ts, module, version, signature):
+  h = hashlib.sha1(
+      u'\n'.join((module, version, signature)).encode('utf-8')).hexdigest()
+  return ndb.Key(
+      models.ErrorCounter,
+      '%d:%s' % ((bucket_ts - utils.EPOCH).total_seconds(), h))
+
+
+def _enqueue_error(
+    bucket_ts, module, version, signature, exception_type, request_id):
+  """Enqueues an error to be counted by flush_error_counters()."""
+  task = taskqueue.Task(
+      method='PULL',
+      payload=json.dumps({
+        'bucket_ts': (bucket_ts - utils.EPOCH).total_seconds(),
+        'exception_type': exception_type,
+        'module': module,
+        'request_id': request_id,
+        'signature': signature,
+        'version': version,
+      }))
+  taskqueue.Queue(COUNTER_QUEUE).add(task)
+
+
+@ndb.transactional_tasklet
+def _add_to_counter_async(key, bucket_ts, error, count, request_ids):
+  """Adds |count| errors to a models.ErrorCounter."""
+  counter = (yield key.get_async()) or models.ErrorCounter(
+      key=key, bucket_ts=bucket_ts, signature=error['signature'],
+      exception_type=error['exception_type'], module=error['module'],
+      version=error['version'])
+  counter.count += count
+  for request_id in request_ids:
+    if len(counter.request_ids) >= _COUNTER_REQUEST_IDS:
+      break
+    if request_id not in counter.request_ids:
+      counter.request_ids.append(request_id)
+  yield counter.put_async()
+
+
+def _extract_categories_from_counters(start_time, end_time, module_versions):
+  """Returns the _ErrorCategory for the errors counted by ErrorCountingHandler.
+
+  Sample stack traces are fetched from logservice for a few request ids per
+  category.
+
+  Returns:
+    dict(signature: _ErrorCategory) or None if no error was counted.
+  """
+  start = _get_counter_bucket(
+      utils.timestamp_to_datetime(int((start_time or 0) * 1e6)))
+  end = utils.timestamp_to_datetime(int(end_time * 1e6)) if end_time else None
+  q = models.ErrorCounter.query(models.ErrorCounter.bucket_ts >= start)
+  if end:
+    q = q.filter(models.ErrorCounter.bucket_ts < end)
+  wanted = set(module_versions or [])
+  counts = {}
+  exception_types = {}
+  request_ids = {}
+  for counter in q:
+    if wanted and (counter.module, counter.version) not in wanted:
+      continue
+    signature = counter.signature
+    counts[signature] = counts.get(signature, 0) + counter.count
+    exception_types.setdefault(signature, counter.exception_type)
+    ids = request_ids.setdefault(signature, [])
+    for request_id in counter.request_ids:
+      if request_id not in ids and len(ids) < _ERROR_LIST_HEAD_SIZE:
+        ids.append(request_id)
+  if not counts:
+    return None
+
+  # Fetch the sample stack traces in one go.
+  samples = {}
+  all_ids = sorted(set(i for ids in request_ids.itervalues() for i in ids))
+  if all_ids:
+    try:
+      for entry in logservice.fetch(
+          include_incomplete=True, include_app_logs=True,
+          request_ids=all_ids):
+        samples[entry.request_id] = _error_record_from_entry(entry)
+    except logservice.Error as e:
+      logging.warning('Failed to fetch sample logs:\n%s', e)
+
+  buckets = {}
+  for signature, count in counts.iteritems():
+    category = _ErrorCategory(signature)
+    category._exception_type = exception_types[signature]
+    for request_id in request_ids[signature]:
+      record = samples.get(request_id)
+      if record:
+        category.events.append(record)
+    # The samples are only a subset of the errors.
+    category.events.total_count = max(count, len(category.events))
+    buckets[signature] = category
+  return buckets
+
+
 def _should_ignore_error_category(monitoring, error_category):
   """Returns True if an _ErrorCategory should be ignored."""
   if not monitoring:
@@ -363,16 +518,104 @@ def _log_request_id(request_id):
   return request[0]
 
 
+class ErrorCountingHandler(logging.Handler):
+  """Counts the errors logged by signature in models.ErrorCounter.
+
+  This lets scrape_logs_for_errors() generate the report without scanning all
+  the logs. Use on_error.register_error_counter() to install it.
+
+  To not slow down the request logging the error, the errors are only enqueued
+  in the COUNTER_QUEUE pull queue. They are added to the counters by
+  flush_error_counters().
+  """
+
+  def __init__(self):
+    super(ErrorCountingHandler, self).__init__(level=logging.ERROR)
+    # Compute the signature on the same text as the one logged.
+    self.setFormatter(formatter._Formatter(logging.Formatter()))
+    self._local = threading.local()
+
+  def emit(self, record):
+    # Errors logged while counting an error are not counted.
+    if getattr(self._local, 'busy', False):
+      return
+    self._local.busy = True
+    try:
+      message = _to_unicode(self.format(record).strip('\n'))
+      signature, exception_type = _signature_from_message(message)
+      _enqueue_error(
+          _get_counter_bucket(utils.utcnow()),
+          modules.get_current_module_name() or u'default',
+          modules.get_current_version_name() or u'N/A',
+          unicode(signature or exception_type or u''),
+          exception_type,
+          logsutil.RequestID())
+    except Exception as e:  # pylint: disable=broad-except
+      # Do not log at error level to not recurse.
+      logging.warning('Failed to count error: %s', e)
+    finally:
+      self._local.busy = False
+
+
+def _is_runtime_error(error_record):
+  """Returns True if an _ErrorRecord was logged by the runtime itself."""
+  return any(
+      l.startswith(_RUNTIME_ERRORS) for l in error_record.message.splitlines())
+
+
 ### Public API.
 
 
-def scrape_logs_for_errors(start_time, end_time, module_versions):
+def flush_error_counters(lease_seconds=60, deadline=None):
+  """Adds the errors enqueued by ErrorCountingHandler to models.ErrorCounter.
+
+  The errors are aggregated by counter, so each counter is updated once per
+  batch of errors.
+
+  Arguments:
+    lease_seconds: lease duration of the enqueued errors.
+    deadline: optional time.time() value after which no new batch is leased.
+
+  Returns:
+    Number of errors counted.
+  """
+  queue = taskqueue.Queue(COUNTER_QUEUE)
+  total = 0
+  while not deadline or utils.time_time() < deadline:
+    tasks = queue.lease_tasks(lease_seconds, 1000)
+    if not tasks:
+      break
+    # key -> [bucket_ts, error, count, request_ids]
+    counters = {}
+    for task in tasks:
+      error = json.loads(task.payload)
+      bucket_ts = utils.EPOCH + datetime.timedelta(seconds=error['bucket_ts'])
+      key = _get_counter_key(
+          bucket_ts, error['module'], error['version'], error['signature'])
+      counter = counters.setdefault(key, [bucket_ts, error, 0, []])
+      counter[2] += 1
+      if error['request_id'] and error['request_id'] not in counter[3]:
+        counter[3].append(error['request_id'])
+    ndb.Future.wait_all([
+      _add_to_counter_async(key, *counter)
+      for key, counter in counters.iteritems()
+    ])
+    queue.delete_tasks(tasks)
+    total += len(tasks)
+  return total
+
+
+def scrape_logs_for_errors(
+    start_time, end_time, module_versions, use_counters=True):
   """Returns a list of _ErrorCategory to generate a report.
 
   Arguments:
     start_time: time to look for report, defaults to last email sent.
     end_time: time to end the search for error, defaults to now.
     module_versions: list of tuple of module-version to gather info about.
+    use_counters: use the models.ErrorCounter recorded by ErrorCountingHandler
+        if any, instead of scanning all the logs. The counters have a 5 minutes
+        resolution.
 
   Returns:
     tuple of 3 items:
@@ -391,17 +634,44 @@ def scrape_logs_for_errors(start_time, end_time, module_versions):
     e.key.string_id(): e for e in models.ErrorReportingMonitoring.query()
   }
 
-  # Gather all the error categories.
-  buckets = {}
-  for error_record in _extract_exceptions_from_logs(
-      start_time, end_time, module_versions):
-    bucket = buckets.setdefault(
-        error_record.signature, _ErrorCategory(error_record.signature))
-    bucket.append_error(error_record)
-    # Abort, there's too much logs.
-    if (utils.time_time() - start) >= 9*60:
-      end_time = error_record.start_time
-      break
+  # Gather all the error categories. Prefer the counters, only scan the logs
+  # when no error was counted, e.g. ErrorCountingHandler is not installed.
+  buckets = None
+  if use_counters:
+    try:
+      flush_error_counters(deadline=start + 60)
+    except taskqueue.Error as e:
+      # E.g. COUNTER_QUEUE is not declared since the counters are not used.
+      logging.info('Failed to flush the error counters: %s', e)
+    buckets = _extract_categories_from_counters(
+        start_time, end_time, module_versions)
+  if buckets is not None:
+    # The errors logged by the runtime are not counted, scan the logs for them
+    # for a bounded amount of time. They replace the counted ones, if any.
+    runtime_buckets = {}
+    for error_record in _extract_exceptions_from_logs(
+        start_time, end_time, module_versions):
+      if _is_runtime_error(error_record):
+        bucket = runtime_buckets.setdefault(
+            error_record.signature, _ErrorCategory(error_record.signature))
+        bucket.append_error(error_record)
+      if (utils.time_time() - start) >= _RUNTIME_ERRORS_SCAN_DURATION:
+        logging.warning(
+            'Stopped scanning the logs for runtime errors at %s',
+            error_record.start_time)
+        break
+    buckets.update(runtime_buckets)
+  else:
+    buckets = {}
+    for error_record in _extract_exceptions_from_logs(
+        start_time, end_time, module_versions):
+      bucket = buckets.setdefault(
+          error_record.signature, _ErrorCategory(error_record.signature))
+      bucket.append_error(error_record)
+      # Abort, there's too much logs.
+      if (utils.time_time() - start) >= 9*60:
+        end_time = error_record.start_time
+        break
 
   # Filter them.
   categories = []
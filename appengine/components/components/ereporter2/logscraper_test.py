@@ -6,7 +6,10 @@
 
 import datetime
 import logging
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 from test_support import test_env
@@ -31,12 +34,49 @@ class ErrorRecordStub(object):
     self.version = version
 
 
+def ErrorRecord(**kwargs):
+  """Returns an ErrorRecord filled with default dummy values."""
+  default_values = {
+      'request_id': 'a',
+      'start_time': None,
+      'exception_time': None,
+      'latency': 0,
+      'mcycles': 0,
+      'ip': '0.0.1.0',
+      'nickname': None,
+      'referrer': None,
+      'user_agent': 'Comodore64',
+      'host': 'localhost',
+      'resource': '/foo',
+      'method': 'GET',
+      'task_queue_name': None,
+      'was_loading_request': False,
+      'version': 'v1',
+      'module': 'default',
+      'handler_module': 'main.app',
+      'gae_version': '1.9.0',
+      'instance': '123',
+      'status': 500,
+      'message': u'Failed',
+  }
+  default_values.update(kwargs)
+  return logscraper._ErrorRecord(**default_values)
+
+
 class Ereporter2LogscraperTest(test_case.TestCase):
   def setUp(self):
     super(Ereporter2LogscraperTest, self).setUp()
     self._now = datetime.datetime(2014, 6, 24, 20, 19, 42, 653775)
     self.mock_now(self._now, 0)
 
+  def mock_pull_queue(self):
+    # The pull queue must be declared in queue.yaml.
+    root_dir = tempfile.mkdtemp(prefix='ereporter2')
+    self.addCleanup(shutil.rmtree, root_dir)
+    with open(os.path.join(root_dir, 'queue.yaml'), 'w') as f:
+      f.write('queue:\n- name: %s\n  mode: pull\n' % logscraper.COUNTER_QUEUE)
+    self._taskqueue_stub._root_path = root_dir
+
   def test_signatures(self):
     messages = [
       (
@@ -210,6 +250,85 @@ class Ereporter2LogscraperTest(test_case.TestCase):
     self.assertEqual(range(5), l.head)
     self.assertEqual(range(6, 16), list(l.tail))
 
+  def test_error_counting_handler(self):
+    self.mock_pull_queue()
+    self.mock(logscraper.modules, 'get_current_module_name', lambda: u'default')
+    self.mock(logscraper.modules, 'get_current_version_name', lambda: u'v1')
+    self.mock(logscraper.logsutil, 'RequestID', lambda: 'deadbeef')
+    handler = logscraper.ErrorCountingHandler()
+    record = logging.LogRecord(
+        'root', logging.ERROR, __file__, 1, 'Oh no', None, None)
+    handler.handle(record)
+    handler.handle(record)
+    # Not counted.
+    handler.handle(logging.LogRecord(
+        'root', logging.WARNING, __file__, 1, 'Meh', None, None))
+
+    # Nothing is written until the errors are flushed.
+    self.assertEqual([], models.ErrorCounter.query().fetch())
+    self.assertEqual(2, logscraper.flush_error_counters())
+    self.assertEqual(0, logscraper.flush_error_counters())
+
+    counters = models.ErrorCounter.query().fetch()
+    self.assertEqual(1, len(counters))
+    self.assertEqual(2, counters[0].count)
+    self.assertEqual(u'Oh no', counters[0].signature)
+    self.assertEqual(['deadbeef'], counters[0].request_ids)
+    self.assertEqual(
+        datetime.datetime(2014, 6, 24, 20, 15), counters[0].bucket_ts)
+
+  def test_extract_categories_from_counters(self):
+    bucket = datetime.datetime(2014, 6, 24, 20, 10)
+    next_bucket = bucket + datetime.timedelta(minutes=5)
+    for bucket_ts, module, version, count in [
+        (bucket, u'default', u'v1', 3), (next_bucket, u'default', u'v1', 2),
+        (bucket, u'default', u'v2', 7)]:
+      models.ErrorCounter(
+          key=logscraper._get_counter_key(
+              bucket_ts, module, version, u'Boom@foo'),
+          bucket_ts=bucket_ts, signature=u'Boom@foo', exception_type=u'Boom',
+          module=module, version=version, count=count).put()
+    start = (bucket - datetime.datetime(1970, 1, 1)).total_seconds()
+    buckets = logscraper._extract_categories_from_counters(
+        start, None, [(u'default', u'v1')])
+    self.assertEqual([u'Boom@foo'], buckets.keys())
+    self.assertEqual(5, buckets[u'Boom@foo'].events.total_count)
+    self.assertEqual(u'Boom', buckets[u'Boom@foo'].exception_type)
+
+    # Out of the time range.
+    self.assertEqual(
+        None,
+        logscraper._extract_categories_from_counters(
+            start + 600, None, [(u'default', u'v1')]))
+
+  def test_scrape_logs_for_errors_runtime_errors(self):
+    bucket = datetime.datetime(2014, 6, 24, 20, 15)
+    models.ErrorCounter(
+        key=logscraper._get_counter_key(bucket, u'default', u'v1', u'Boom@foo'),
+        bucket_ts=bucket, signature=u'Boom@foo', exception_type=u'Boom',
+        module=u'default', version=u'v1', count=4).put()
+    data = [
+      # Already counted.
+      ErrorRecord(message=u'Boom'),
+      ErrorRecord(message=logscraper.SOFT_MEMORY + u' of 128 MB'),
+      ErrorRecord(
+          message=u'Process terminated because the request deadline was '
+                  u'exceeded. (Error code 123)'),
+    ]
+    self.mock(logscraper, '_extract_exceptions_from_logs', lambda *_: data)
+    start = (bucket - datetime.datetime(1970, 1, 1)).total_seconds()
+    categories, ignored, _ = logscraper.scrape_logs_for_errors(
+        start, None, [(u'default', u'v1')])
+    self.assertEqual([], ignored)
+    self.assertEqual(
+        {
+          u'Boom@foo': 4,
+          logscraper.SOFT_MEMORY: 1,
+          u'Process terminated because the request deadline was exceeded. '
+              u'(Error code 123)': 1,
+        },
+        dict((c.signature, c.events.total_count) for c in categories))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -54,6 +54,28 @@ class ErrorReportingMonitoring(ndb.Model):
     return ndb.Key(cls, cls.error_to_key_id(error))
 
 
+class ErrorCounter(ndb.Model):
+  """Counter of the errors logged with the same signature.
+
+  The errors are enqueued by logscraper.ErrorCountingHandler at the time they
+  are logged and added by logscraper.flush_error_counters(), so the report
+  doesn't have to scan all the logs.
+
+  Key id is '<bucket timestamp>:<hash of module, version and signature>'.
+  """
+  # Start of the time bucket the errors were logged in.
+  bucket_ts = ndb.DateTimeProperty()
+
+  signature = ndb.StringProperty(indexed=False)
+  exception_type = ndb.StringProperty(indexed=False)
+  module = ndb.StringProperty(indexed=False)
+  version = ndb.StringProperty(indexed=False)
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+  # A few request ids to fetch sample stack traces from logservice.
+  request_ids = ndb.StringProperty(repeated=True, indexed=False)
+
+
 class Error(ndb.Model):
   """Represents an error logged either by the server itself or by a client of
   the service.
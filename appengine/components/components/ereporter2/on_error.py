@@ -22,6 +22,7 @@ from components import auth
 from components import utils
 
 from . import formatter
+from . import logscraper
 from . import models
 
 
@@ -35,6 +36,18 @@ VALID_ERROR_KEYS = frozenset(models.Error._properties) - frozenset(
     ['created_ts', 'identity'])
 
 
+def register_error_counter():
+  """Registers a logging handler that counts the errors by signature.
+
+  The counts are used by the report instead of scanning all the logs. The stack
+  traces in the report are still fetched from the logs, for a few samples.
+  """
+  root = logging.getLogger()
+  if not any(
+      isinstance(h, logscraper.ErrorCountingHandler) for h in root.handlers):
+    root.addHandler(logscraper.ErrorCountingHandler())
+
+
 def log(**kwargs):
   """Adds an error. This will indirectly notify the admins.
 
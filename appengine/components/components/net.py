@@ -89,6 +89,7 @@ def request_async(
     method: HTTP method to use, e.g. GET, POST, PUT.
     payload: raw data to put in the request body.
     params: dict with query GET parameters (i.e. ?key=value&key=value).
+      A list value is sent as a repeated parameter.
     headers: additional request headers.
     scopes: OAuth2 scopes for the access token (ok skip auth if None).
     service_account_key: auth.ServiceAccountKey with credentials.
@@ -113,7 +114,7 @@ def request_async(
     protocols = ('https://',)
   assert url.startswith(protocols) and '?' not in url, url
   if params:
-    url += '?' + urllib.urlencode(params)
+    url += '?' + urllib.urlencode(params, doseq=True)
 
   headers = (headers or {}).copy()
 
@@ -7,9 +7,13 @@
 import base64
 import contextlib
 import copy
+import json
 import logging
 import re
+import time
 
+from google.appengine import runtime
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 import webapp2
 
@@ -27,6 +31,16 @@ from components import net
 _NAME_RE = re.compile(r'^[A-Za-z][A-Za-z0-9\-_\.~\+%]{2,254}$')
 
 
+# Maximum number of messages sent in a single publish call by
+# flush_publish_queue(). Pub/Sub accepts up to 1000 messages per call.
+_PUBLISH_BATCH_SIZE = 1000
+
+
+# Number of times a message enqueued with enqueue_publish_async() is retried on
+# transient errors before being dropped.
+_MAX_PUBLISH_RETRIES = 20
+
+
 class Error(Exception):
   """Raised on fatal errors."""
   def __init__(self, inner):
@@ -170,15 +184,17 @@ def publish_multi(topic, messages):
   Args:
     topic: Full name of the topic to publish to.
     messages: Content of the message to publish mapped to any attributes to
-      send with the message.
+      send with the message, or list of tuple(message, attributes).
 
   Raises:
     Error or TransientError.
   """
   assert validate_full_name(topic, 'topics'), topic
+  if isinstance(messages, dict):
+    messages = messages.iteritems()
   messages = [
       {'attributes': attributes or {}, 'data': base64.b64encode(message)}
-      for message, attributes in messages.iteritems()
+      for message, attributes in messages
   ]
 
   def call_publish():
@@ -201,6 +217,114 @@ def publish(topic, message, attributes):
   publish_multi(topic, {message: attributes})
 
 
+@ndb.tasklet
+def enqueue_publish_async(
+    queue_name, topic, message, attributes, transactional=False):
+  """Enqueues a message to be published by flush_publish_queue().
+
+  Messages are stored as tasks in the pull queue |queue_name|, tagged by topic,
+  so that flush_publish_queue() can publish them in batches. It is safe to call
+  within a transaction with transactional=True.
+
+  Args:
+    queue_name: Name of a pull queue.
+    topic: Full name of the topic to publish to.
+    message: Content of the message to publish.
+    attributes: Any attributes to send with the message.
+    transactional: True to enqueue the message as part of the transaction.
+
+  Returns:
+    True if the message was enqueued, False otherwise.
+  """
+  assert validate_full_name(topic, 'topics'), topic
+  task = taskqueue.Task(
+      method='PULL',
+      tag=topic,
+      payload=json.dumps({
+        'attributes': attributes or {},
+        'data': base64.b64encode(message),
+      }))
+  try:
+    yield taskqueue.Queue(queue_name).add_async(
+        task, transactional=transactional)
+    raise ndb.Return(True)
+  except (
+      taskqueue.Error,
+      runtime.DeadlineExceededError,
+      runtime.apiproxy_errors.CancelledError,
+      runtime.apiproxy_errors.DeadlineExceededError,
+      runtime.apiproxy_errors.OverQuotaError) as e:
+    logging.warning(
+        'Problem adding message for %r to pull queue %r (%s): %s',
+        topic, queue_name, e.__class__.__name__, e)
+    raise ndb.Return(False)
+
+
+def enqueue_publish(*args, **kwargs):
+  """Blocking version of enqueue_publish_async."""
+  return enqueue_publish_async(*args, **kwargs).get_result()
+
+
+def flush_publish_queue(queue_name, lease_seconds=60, deadline=None):
+  """Publishes the messages enqueued with enqueue_publish_async().
+
+  Leases the messages of one topic at a time and publishes them in a single
+  call. On transient errors, the leases are released so the messages can be
+  retried right away by the next call, e.g. the retry of the push task calling
+  this function. Messages failing with a fatal error or too many times are
+  logged and dropped.
+
+  Args:
+    queue_name: Name of the pull queue passed to enqueue_publish_async().
+    lease_seconds: Lease duration, the delay before a retry if this function
+        dies while publishing.
+    deadline: optional time.time() value after which no new batch is leased.
+
+  Returns:
+    Number of messages published.
+
+  Raises:
+    TransientError if some messages need to be retried.
+  """
+  queue = taskqueue.Queue(queue_name)
+  published = 0
+  while not deadline or time.time() < deadline:
+    tasks = queue.lease_tasks_by_tag(lease_seconds, _PUBLISH_BATCH_SIZE)
+    if not tasks:
+      break
+    topic = tasks[0].tag
+    messages = []
+    dropped = []
+    for task in tasks:
+      if task.retry_count > _MAX_PUBLISH_RETRIES:
+        logging.error(
+            'Dropping message for %s after %d retries', topic, task.retry_count)
+        dropped.append(task)
+        continue
+      data = json.loads(task.payload)
+      messages.append((base64.b64decode(data['data']), data['attributes']))
+    try:
+      if messages:
+        publish_multi(topic, messages)
+      published += len(messages)
+    except TransientError:
+      logging.warning(
+          'Transient error when publishing %d messages to %s',
+          len(messages), topic)
+      if dropped:
+        queue.delete_tasks(dropped)
+      for task in tasks:
+        if task not in dropped:
+          queue.modify_task_lease(task, 0)
+      raise
+    except Error:
+      logging.exception(
+          'Fatal error when publishing %d messages to %s; dropping them',
+          len(messages), topic)
+    queue.delete_tasks(tasks)
+  return published
+
+
 def modify_ack_deadline_async(subscription, deadline, *ack_ids):
   """Modifies acknowledgement deadline of messages.
 
@@ -3,7 +3,10 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 from test_support import test_env
@@ -38,6 +41,14 @@ class PubSubTest(test_case.TestCase):
     self.mock(net, 'json_request_async', mocked_request)
     return requests
 
+  def mock_pull_queue(self):
+    # The pull queue must be declared in queue.yaml.
+    root_dir = tempfile.mkdtemp(prefix='pubsub')
+    self.addCleanup(shutil.rmtree, root_dir)
+    with open(os.path.join(root_dir, 'queue.yaml'), 'w') as f:
+      f.write('queue:\n- name: pubsub-pull\n  mode: pull\n')
+    self._taskqueue_stub._root_path = root_dir
+
   def test_validate_name(self):
     self.assertTrue(pubsub._validate_name('blah1234-_.~+%'))
     self.assertFalse(pubsub._validate_name('1blah1234-_.~+%'))
@@ -183,6 +194,57 @@ class PubSubTest(test_case.TestCase):
     with pubsub.iam_policy('projects/a/topics/def'):
       pass
 
+  def test_flush_publish_queue(self):
+    self.mock_pull_queue()
+    self.assertTrue(pubsub.enqueue_publish(
+        'pubsub-pull', 'projects/a/topics/def', 'msg', {'a': 1}))
+    self.assertTrue(pubsub.enqueue_publish(
+        'pubsub-pull', 'projects/a/topics/def', 'msg', None))
+    self.mock_requests([
+      {
+        'url': 'https://pubsub.googleapis.com/v1/projects/a/topics/def:publish',
+        'method': 'POST',
+        'payload': {
+          'messages': [
+            {'attributes': {'a': 1}, 'data': 'bXNn'},
+            {'attributes': {}, 'data': 'bXNn'},
+          ],
+        },
+      },
+    ])
+    self.assertEqual(2, pubsub.flush_publish_queue('pubsub-pull'))
+    # Nothing left.
+    self.assertEqual(0, pubsub.flush_publish_queue('pubsub-pull'))
+
+  def test_flush_publish_queue_transient_error(self):
+    self.mock_pull_queue()
+    self.assertTrue(pubsub.enqueue_publish(
+        'pubsub-pull', 'projects/a/topics/def', 'msg', {'a': 1}))
+    self.mock_requests([
+      {
+        'url': 'https://pubsub.googleapis.com/v1/projects/a/topics/def:publish',
+        'method': 'POST',
+        'payload': {
+          'messages': [{'attributes': {'a': 1}, 'data': 'bXNn'}],
+        },
+        'response': net.Error('transient error', 500, ''),
+      },
+    ])
+    with self.assertRaises(pubsub.TransientError):
+      pubsub.flush_publish_queue('pubsub-pull')
+    # The lease was released, so the message is retried right away.
+    self.mock_requests([
+      {
+        'url': 'https://pubsub.googleapis.com/v1/projects/a/topics/def:publish',
+        'method': 'POST',
+        'payload': {
+          'messages': [{'attributes': {'a': 1}, 'data': 'bXNn'}],
+        },
+      },
+    ])
+    self.assertEqual(1, pubsub.flush_publish_queue('pubsub-pull'))
+    self.assertEqual([], self._taskqueue_stub.GetTasks('pubsub-pull'))
+
 
 class IAMPolicyTest(unittest.TestCase):
   def test_add_member(self):
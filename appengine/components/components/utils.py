@@ -10,8 +10,10 @@
 # Disable: 'Method could be a function'. It can't: NDB expects a method.
 # pylint: disable=R0201
 
+import collections
 import datetime
 import functools
+import hashlib
 import inspect
 import json
 import logging
@@ -291,6 +293,65 @@ def clear_cache(func):
   func.__parent_cache__.clear()
 
 
+def _get_key_args_fn(func, key_args):
+  """Returns a function that extracts the values of |key_args| from a call.
+
+  The returned function accepts (args, kwargs) of a call to |func| and returns
+  the list of values of |key_args|, including the default values.
+
+  Raises:
+    NotImplementedError if function uses varargs or kwargs.
+    KeyError if an argument in |key_args| is not a |func| argument.
+  """
+  unwrapped = func
+  while True:
+    deeper = getattr(unwrapped, '__wrapped__', None)
+    if not deeper:
+      break
+    unwrapped = deeper
+
+  argspec = inspect.getargspec(unwrapped)
+  if argspec.varargs:
+    raise NotImplementedError(
+        'varargs in memcached functions are not supported')
+  if argspec.keywords:
+    raise NotImplementedError(
+        'kwargs in memcached functions are not supported')
+
+  # List of arg names and indexes. Has same order as |key_args|.
+  arg_indexes = []
+  for name in key_args:
+    try:
+      i = argspec.args.index(name)
+    except ValueError:
+      raise KeyError(
+          'key_format expects "%s" parameter, but it was not found among '
+          'function parameters' % name)
+    arg_indexes.append((name, i))
+
+  def get_arg_values(args, kwargs):
+    arg_values = []
+    for name, i in arg_indexes:
+      if i < len(args):
+        arg_value = args[i]
+      elif name in kwargs:
+        arg_value = kwargs[name]
+      else:
+        # argspec.defaults contains _last_ default values, so we need to shift
+        # |i| left.
+        default_value_index = i - (
+            len(argspec.args) - len(argspec.defaults or ()))
+        if default_value_index < 0:
+          # Parameter not provided. Call function to cause TypeError
+          func(*args, **kwargs)
+          assert False, 'Function call did not fail'
+        arg_value = argspec.defaults[default_value_index]
+      arg_values.append(arg_value)
+    return arg_values
+
+  return get_arg_values
+
+
 # ignore time parameter warning | pylint: disable=redefined-outer-name
 def memcache_async(key, key_args=None, time=None):
   """Decorator that implements memcache-based cache for a function.
@@ -324,51 +385,12 @@ def memcache_async(key, key_args=None, time=None):
     memcache_set_kwargs['time'] = time
 
   def decorator(func):
-    unwrapped = func
-    while True:
-      deeper = getattr(unwrapped, '__wrapped__', None)
-      if not deeper:
-        break
-      unwrapped = deeper
-
-    argspec = inspect.getargspec(unwrapped)
-    if argspec.varargs:
-      raise NotImplementedError(
-          'varargs in memcached functions are not supported')
-    if argspec.keywords:
-      raise NotImplementedError(
-          'kwargs in memcached functions are not supported')
-
-    # List of arg names and indexes. Has same order as |key_args|.
-    arg_indexes = []
-    for name in key_args:
-      try:
-        i = argspec.args.index(name)
-      except ValueError:
-        raise KeyError(
-            'key_format expects "%s" parameter, but it was not found among '
-            'function parameters' % name)
-      arg_indexes.append((name, i))
+    get_arg_values = _get_key_args_fn(func, key_args)
 
     @functools.wraps(func)
     @ndb.tasklet
     def decorated(*args, **kwargs):
-      arg_values = []
-      for name, i in arg_indexes:
-        if i < len(args):
-          arg_value = args[i]
-        elif name in kwargs:
-          arg_value = kwargs[name]
-        else:
-          # argspec.defaults contains _last_ default values, so we need to shift
-          # |i| left.
-          default_value_index = i - (len(argspec.args) - len(argspec.defaults))
-          if default_value_index < 0:
-            # Parameter not provided. Call function to cause TypeError
-            func(*args, **kwargs)
-            assert False, 'Function call did not fail'
-          arg_value = argspec.defaults[default_value_index]
-        arg_values.append(arg_value)
+      arg_values = get_arg_values(args, kwargs)
 
       # Instead of putting a raw value to memcache, put tuple (value,)
       # so we can distinguish a cached None value and absence of the value.
@@ -403,6 +425,174 @@ def memcache(*args, **kwargs):
   return decorator
 
 
+class _LRUCache(object):
+  """Thread-safe in-process LRU cache with per-entry expiration."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    # key -> (expiration, value)
+    self._items = collections.OrderedDict()
+
+  def get(self, key):
+    """Returns a tuple (value,) or None if absent or expired."""
+    with self._lock:
+      item = self._items.pop(key, None)
+      if item is None:
+        return None
+      if item[0] < time_time():
+        return None
+      # Move it to the most recently used position.
+      self._items[key] = item
+      return (item[1],)
+
+  def set(self, key, value, expiration_sec):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = (time_time() + expiration_sec, value)
+      while len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+
+# Per thread, thus per request, in-flight cache lookups of two_level_cache.
+_two_level_inflight = threading.local()
+
+
+def two_level_cache_async(
+    key, key_args=None, time=60, local_time=10, local_size=1000,
+    negative_time=None, lock_time=10):
+  """Decorator that implements an in-process and memcache cache for a function.
+
+  The lookup order is:
+  - in-process LRU cache, valid for |local_time| seconds;
+  - calls already in flight for the same arguments in this request;
+  - memcache. ndb batches the memcache gets issued by concurrent tasklets into
+    a single get_multi RPC;
+  - the function itself. Only one caller across all the instances computes the
+    value for |lock_time| seconds, the others poll memcache, to protect the
+    function from a cache stampede. If memcache is unavailable, the value is
+    computed right away.
+
+  Unlike memcache_async, the generated cache key is a hash so it is bounded in
+  size.
+
+  Args:
+    key (str): unique string that will be used as a part of cache key.
+    key_args (list of str): list of function argument names to include
+      in the generated cache key.
+    time (int): memcache expiration time.
+    local_time (int): in-process cache expiration time.
+    local_size (int): maximum number of items in the in-process cache.
+    negative_time (int): expiration time for a None value. If None, a None
+      value is cached like any other value. If 0, it is not cached.
+    lock_time (int): maximum time a caller computing the value holds the lock.
+
+  Decorator raises:
+    NotImplementedError if function uses varargs or kwargs.
+  """
+  assert isinstance(key, basestring), key
+  key_args = key_args or []
+  assert isinstance(key_args, list), key_args
+  assert all(isinstance(a, basestring) for a in key_args), key_args
+  assert all(key_args), key_args
+
+  def decorator(func):
+    get_arg_values = _get_key_args_fn(func, key_args)
+    local = _LRUCache(local_size)
+
+    @ndb.tasklet
+    def lookup(cache_key, args, kwargs):
+      ctx = ndb.get_context()
+      # Instead of putting a raw value to memcache, put tuple (value,)
+      # so we can distinguish a cached None value and absence of the value.
+      result = yield ctx.memcache_get(cache_key)
+      if isinstance(result, tuple) and len(result) == 1:
+        raise ndb.Return(result)
+
+      lock_key = cache_key + '/lock'
+      locked = yield ctx.memcache_add(lock_key, True, time=lock_time)
+      # memcache_add() also fails when memcache is unavailable. Only wait while
+      # the lock is seen held by someone else computing the value.
+      holder = None if locked else (yield ctx.memcache_get(lock_key))
+      if holder:
+        deadline = time_time() + lock_time
+        while time_time() < deadline:
+          yield ndb.sleep(0.1)
+          result, holder = yield (
+              ctx.memcache_get(cache_key), ctx.memcache_get(lock_key))
+          if isinstance(result, tuple) and len(result) == 1:
+            raise ndb.Return(result)
+          if not holder:
+            # Released without storing the value.
+            break
+        else:
+          logging.warning('Timed out waiting for %s', cache_key)
+
+      try:
+        result = func(*args, **kwargs)
+        if isinstance(result, ndb.Future):
+          result = yield result
+        expiration = time
+        if result is None and negative_time is not None:
+          expiration = negative_time
+        if expiration != 0:
+          yield ctx.memcache_set(cache_key, (result,), time=expiration)
+      finally:
+        if locked:
+          yield ctx.memcache_delete(lock_key)
+      raise ndb.Return((result,))
+
+    @functools.wraps(func)
+    @ndb.tasklet
+    def decorated(*args, **kwargs):
+      arg_values = get_arg_values(args, kwargs)
+      cache_key = 'utils.two_level_cache/%s/%s/%s' % (
+          get_app_version(), key,
+          hashlib.sha256(repr(arg_values)).hexdigest())
+
+      result = local.get(cache_key)
+      if result:
+        raise ndb.Return(result[0])
+
+      inflight = _two_level_inflight.__dict__.setdefault('futures', {})
+      future = inflight.get(cache_key)
+      if not future:
+        future = lookup(cache_key, args, kwargs)
+        inflight[cache_key] = future
+      try:
+        result = yield future
+      finally:
+        inflight.pop(cache_key, None)
+
+      expiration = local_time
+      if result[0] is None and negative_time is not None:
+        expiration = min(local_time, negative_time)
+      if expiration:
+        local.set(cache_key, result[0], expiration)
+      raise ndb.Return(result[0])
+
+    decorated.__parent_cache__ = local
+    return decorated
+  return decorator
+
+
+def two_level_cache(*args, **kwargs):
+  """Blocking version of two_level_cache_async."""
+  decorator_async = two_level_cache_async(*args, **kwargs)
+  def decorator(func):
+    decorated_async = decorator_async(func)
+    @functools.wraps(func)
+    def decorated(*args, **kwargs):
+      return decorated_async(*args, **kwargs).get_result()
+    decorated.__parent_cache__ = decorated_async.__parent_cache__
+    return decorated
+  return decorator
+
+
 @cache
 def get_app_version():
   """Returns currently running version (not necessary a default one)."""
@@ -318,6 +318,99 @@ class MemcacheTest(test_case.TestCase):
         pass
 
 
+class TwoLevelCacheTest(test_case.TestCase):
+
+  def setUp(self):
+    super(TwoLevelCacheTest, self).setUp()
+    self.calls = []
+    self.now = 1000.
+    self.mock(utils, 'time_time', lambda: self.now)
+
+  def f(self, negative_time=None):
+    @utils.two_level_cache(
+        'f', ['a'], time=60, local_time=10, negative_time=negative_time)
+    def f(a, b=None):
+      self.calls.append((a, b))
+      return a * 2 if a else None
+    return f
+
+  def test_local(self):
+    f = self.f()
+    self.assertEqual(2, f(1))
+    self.assertEqual(2, f(1, 'ignored'))
+    self.assertEqual(4, f(2))
+    self.assertEqual([(1, None), (2, None)], self.calls)
+
+  def test_memcache(self):
+    f = self.f()
+    self.assertEqual(2, f(1))
+    # The in-process cache expired, the value comes from memcache.
+    self.now += 11
+    self.assertEqual(2, f(1))
+    self.assertEqual([(1, None)], self.calls)
+    # Simulates another instance.
+    utils.clear_cache(f)
+    self.assertEqual(2, f(1))
+    self.assertEqual([(1, None)], self.calls)
+
+  def test_negative(self):
+    f = self.f(negative_time=0)
+    self.assertEqual(None, f(0))
+    self.assertEqual(None, f(0))
+    self.assertEqual([(0, None), (0, None)], self.calls)
+
+  def test_concurrent(self):
+    @utils.two_level_cache_async('g', ['a'])
+    def g(a):
+      self.calls.append(a)
+      return a
+
+    @ndb.tasklet
+    def run():
+      res = yield [g(1), g(1), g(2)]
+      raise ndb.Return(res)
+
+    self.assertEqual([1, 1, 2], run().get_result())
+    self.assertEqual([1, 2], sorted(self.calls))
+
+  def test_lock(self):
+    f = self.f()
+    # Another instance is computing the value but never stores it.
+    cache_key = 'utils.two_level_cache/%s/f/%s' % (
+        utils.get_app_version(), utils.hashlib.sha256('[1]').hexdigest())
+    ndb.get_context().memcache_add(cache_key + '/lock', True).get_result()
+    sleeps = []
+    @ndb.tasklet
+    def sleep(t):
+      sleeps.append(t)
+      self.now += 1
+    self.mock(ndb, 'sleep', sleep)
+    self.assertEqual(2, f(1))
+    self.assertEqual(10, len(sleeps))
+    self.assertEqual([(1, None)], self.calls)
+
+  def test_memcache_unavailable(self):
+    f = self.f()
+    @ndb.tasklet
+    def memcache_add(*_args, **_kwargs):
+      raise ndb.Return(False)
+    self.mock(ndb.Context, 'memcache_add', memcache_add)
+    self.mock(ndb, 'sleep', lambda _: self.fail('Waited for the lock'))
+    self.assertEqual(2, f(1))
+    self.assertEqual([(1, None)], self.calls)
+
+  def test_lru(self):
+    c = utils._LRUCache(2)
+    c.set('a', 1, 10)
+    c.set('b', 2, 10)
+    self.assertEqual((1,), c.get('a'))
+    c.set('c', 3, 10)
+    self.assertEqual(None, c.get('b'))
+    self.assertEqual((1,), c.get('a'))
+    self.now += 11
+    self.assertEqual(None, c.get('a'))
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -87,6 +87,9 @@ GET_CONFIG_MULTI_REQUEST_RESOURCE_CONTAINER = endpoints.ResourceContainer(
     path=messages.StringField(1, required=True),
     # If True, response.content will be None.
     hashes_only=messages.BooleanField(2, default=False),
+    # Content hashes the caller already has. The content of configs with one of
+    # these hashes is omitted from the response.
+    known_hashes=messages.StringField(3, repeated=True),
 )
 
 
@@ -95,7 +98,8 @@ class GetConfigMultiResponseMessage(messages.Message):
     config_set = messages.StringField(1, required=True)
     revision = messages.StringField(2, required=True)
     content_hash = messages.StringField(3, required=True)
-    # None if request.hash_only is True
+    # None if request.hash_only is True or content_hash is one of
+    # request.known_hashes.
     content = messages.BytesField(4)
     url = messages.StringField(5)
   configs = messages.MessageField(ConfigEntry, 1, repeated=True)
@@ -212,8 +216,8 @@ class ConfigApi(remote.Service):
   class GetConfigResponseMessage(messages.Message):
     revision = messages.StringField(1, required=True)
     content_hash = messages.StringField(2, required=True)
-    # If request.only_hash is not set to True, the contents of the
-    # config file.
+    # If request.only_hash is not set to True and content_hash is not
+    # request.known_hash, the contents of the config file.
     content = messages.BytesField(3)
 
   @auth.endpoints_method(
@@ -223,6 +227,8 @@ class ConfigApi(remote.Service):
           path=messages.StringField(2, required=True),
           revision=messages.StringField(3),
           hash_only=messages.BooleanField(4),
+          # Content hash the caller already has.
+          known_hash=messages.StringField(5),
       ),
       GetConfigResponseMessage,
       http_method='GET',
@@ -250,7 +256,7 @@ class ConfigApi(remote.Service):
     if not res.content_hash:
       raise_config_not_found()
 
-    if not request.hash_only:
+    if not request.hash_only and request.known_hash != res.content_hash:
       res.content = storage.get_configs_by_hashes_async(
           [res.content_hash]).get_result().get(res.content_hash)
       if not res.content:
@@ -356,7 +362,8 @@ class ConfigApi(remote.Service):
     except ValueError as ex:
       raise endpoints.BadRequestException(ex.message)
 
-    return get_config_multi('projects', request.path, request.hashes_only)
+    return get_config_multi(
+        'projects', request.path, request.hashes_only, request.known_hashes)
 
   ##############################################################################
   # endpoint: get_ref_configs
@@ -374,7 +381,8 @@ class ConfigApi(remote.Service):
     except ValueError as ex:
       raise endpoints.BadRequestException(ex.message)
 
-    return get_config_multi('refs', request.path, request.hashes_only)
+    return get_config_multi(
+        'refs', request.path, request.hashes_only, request.known_hashes)
 
   ##############################################################################
   # endpoint: reimport
@@ -454,21 +462,27 @@ def get_config_sets_from_scope(scope):
         yield 'projects/%s/%s' % (p.id, ref.name)
 
 
-def get_config_multi(scope, path, hashes_only):
+def get_config_multi(scope, path, hashes_only, known_hashes=None):
   """Returns configs at |path| in all config sets.
 
   scope can be 'projects' or 'refs'.
 
+  The content of configs with a hash in |known_hashes| is omitted, only their
+  revision and content hash are returned.
+
   Returns empty config list if requester does not have project access.
   """
   assert scope in ('projects', 'refs'), scope
-  cache_key = (
-    'v2/%s%s:%s' % (scope, ',hashes_only' if hashes_only else '', path))
+  known_hashes = frozenset(known_hashes or ())
+  # Only the content hashes are cached here, the contents are served by
+  # storage from its blob cache. It keeps the value small and cheap to refresh.
+  cache_key = 'v3/%s:%s' % (scope, path)
   configs = memcache.get(cache_key)
   if configs is None:
     config_sets = list(get_config_sets_from_scope(scope))
     cfg_map = storage.get_latest_configs_async(
-        config_sets, path, hashes_only=hashes_only).get_result()
+        config_sets, path,
+        hashes_only=hashes_only or bool(known_hashes)).get_result()
     configs = []
     for cs in config_sets:
       rev, content_hash, content = cfg_map.get(cs, (None, None, None))
@@ -480,27 +494,44 @@ def get_config_multi(scope, path, hashes_only):
         'content_hash': content_hash,
         'content': content,
       })
-      if not hashes_only and content is None:
-        logging.error(
-            'Blob %s referenced from %s:%s:%s was not found',
-            content_hash, cs, rev, path)
-    try:
-      memcache.add(cache_key, configs, time=60)
-    except ValueError:
-      logging.exception('%s:%s configs are too big for memcache', scope, path)
+    memcache.add(
+        cache_key,
+        [
+          {k: v for k, v in c.iteritems() if k != 'content'}
+          for c in configs
+        ],
+        time=60)
+
+  if not hashes_only:
+    missing = [
+      c['content_hash'] for c in configs
+      if c.get('content') is None and c['content_hash'] not in known_hashes
+    ]
+    if missing:
+      contents = storage.get_configs_by_hashes_async(missing).get_result()
+      for config in configs:
+        if config.get('content') is None:
+          config['content'] = contents.get(config['content_hash'])
 
   res = GetConfigMultiResponseMessage()
   can_read = can_read_config_sets([c['config_set'] for c in configs])
   for config in configs:
     if not can_read[config['config_set']]:
       continue
-    if not hashes_only and config.get('content') is None:
-      continue
+    content = None
+    if not hashes_only and config['content_hash'] not in known_hashes:
+      content = config.get('content')
+      if content is None:
+        logging.error(
+            'Blob %s referenced from %s:%s:%s was not found',
+            config['content_hash'], config['config_set'], config['revision'],
+            path)
+        continue
     res.configs.append(res.ConfigEntry(
         config_set=config['config_set'],
         revision=config['revision'],
         content_hash=config['content_hash'],
-        content=config.get('content'),
+        content=content,
         url=config.get('url'),
     ))
   return res
@@ -480,6 +480,26 @@ class ApiTest(test_case.EndpointsTestCase):
     })
     self.assertFalse(storage.get_configs_by_hashes_async.called)
 
+  def test_get_config_known_hash(self):
+    self.mock_config()
+
+    req = {
+      'config_set': 'services/luci-config',
+      'known_hash': 'abc0123',
+      'path': 'my.cfg',
+    }
+    resp = self.call_api('get_config', req).json_body
+
+    self.assertEqual(resp, {
+      'content_hash': 'abc0123',
+      'revision': 'deadbeef',
+    })
+    self.assertFalse(storage.get_configs_by_hashes_async.called)
+
+    req['known_hash'] = 'abc'
+    resp = self.call_api('get_config', req).json_body
+    self.assertEqual(resp['content'], base64.b64encode('config text'))
+
   def test_get_config_blob_not_found(self):
     self.mock_config(mock_content=False)
     req = {
@@ -668,6 +688,47 @@ class ApiTest(test_case.EndpointsTestCase):
       }],
     })
 
+  def test_get_config_multi_cached(self):
+    self.mock(storage, 'get_latest_configs_async', mock.Mock())
+    storage.get_latest_configs_async.return_value = future({
+      'projects/chromium': ('deadbeef', 'abc0123', 'config text'),
+    })
+    req = {'path': 'cq.cfg'}
+    expected = {
+      'configs': [{
+        'config_set': 'projects/chromium',
+        'revision': 'deadbeef',
+        'content_hash': 'abc0123',
+        'content': base64.b64encode('config text'),
+      }],
+    }
+    self.assertEqual(
+        expected, self.call_api('get_project_configs', req).json_body)
+
+    # The content hashes are cached, the content is fetched by hash.
+    storage.get_latest_configs_async.reset_mock()
+    self.mock(storage, 'get_configs_by_hashes_async', mock.Mock())
+    storage.get_configs_by_hashes_async.return_value = future({
+      'abc0123': 'config text',
+    })
+    self.assertEqual(
+        expected, self.call_api('get_project_configs', req).json_body)
+    self.assertFalse(storage.get_latest_configs_async.called)
+    storage.get_configs_by_hashes_async.assert_called_once_with(['abc0123'])
+
+    req = {'path': 'cq.cfg', 'hashes_only': True}
+    resp = self.call_api('get_project_configs', req).json_body
+    self.assertEqual(
+        {
+          'configs': [{
+            'config_set': 'projects/chromium',
+            'revision': 'deadbeef',
+            'content_hash': 'abc0123',
+          }],
+        },
+        resp)
+    self.assertFalse(storage.get_latest_configs_async.called)
+
   def test_get_config_multi_hashes_only(self):
     projects.get_projects.return_value.extend([
       service_config_pb2.Project(id='inconsistent'),
@@ -700,6 +761,39 @@ class ApiTest(test_case.EndpointsTestCase):
       }],
     })
 
+  def test_get_config_multi_known_hashes(self):
+    self.mock(storage, 'get_latest_configs_async', mock.Mock())
+    storage.get_latest_configs_async.return_value = future({
+      'projects/chromium': ('deadbeef', 'abc0123', None),
+      'projects/v8': ('beefdead', 'ccc123', None),
+    })
+    self.mock(storage, 'get_configs_by_hashes_async', mock.Mock())
+    storage.get_configs_by_hashes_async.return_value = future({
+      'ccc123': 'v8 config',
+    })
+
+    req = {'path': 'cq.cfg', 'known_hashes': ['abc0123']}
+    resp = self.call_api('get_project_configs', req).json_body
+
+    self.assertEqual(resp, {
+      'configs': [
+        {
+          'config_set': 'projects/chromium',
+          'revision': 'deadbeef',
+          'content_hash': 'abc0123',
+        },
+        {
+          'config_set': 'projects/v8',
+          'revision': 'beefdead',
+          'content_hash': 'ccc123',
+          'content': base64.b64encode('v8 config'),
+        },
+      ],
+    })
+    storage.get_latest_configs_async.assert_called_once_with(
+        ['projects/chromium', 'projects/v8'], 'cq.cfg', hashes_only=True)
+    storage.get_configs_by_hashes_async.assert_called_once_with(['ccc123'])
+
   ##############################################################################
   # get_ref_configs
 
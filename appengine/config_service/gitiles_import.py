@@ -16,6 +16,7 @@ import contextlib
 import logging
 import os
 import re
+import stat
 import StringIO
 import tarfile
 
@@ -26,6 +27,7 @@ from google.protobuf import text_format
 from components import config
 from components import gitiles
 from components import net
+from components import utils
 from components.config.proto import service_config_pb2
 
 import admin
@@ -46,6 +48,15 @@ DEFAULT_GITILES_IMPORT_CONFIG = service_config_pb2.ImportCfg.Gitiles(
     ref_config_default_path='luci',
 )
 
+# Task queue that imports config sets one by one. Its max_concurrent_requests
+# bounds the number of concurrent imports.
+IMPORT_QUEUE = 'gitiles-import'
+IMPORT_TASK_URL = '/internal/task/luci-config/gitiles_import'
+
+# If more files changed since the previously imported revision, the whole
+# archive is fetched instead of the changed files one by one.
+MAX_INCREMENTAL_IMPORT_FILES = 20
+
 
 class Error(Exception):
   """A config set import-specific error."""
@@ -86,11 +97,14 @@ def get_gitiles_config():
 ## Low level import functions
 
 
-def _import_revision(config_set, base_location, commit):
+def _import_revision(config_set, base_location, commit, prev_revision=None):
   """Imports a referenced Gitiles revision into a config set.
 
   |base_location| will be used to set storage.ConfigSet.location.
 
+  If |prev_revision| is the previously imported revision of the config set,
+  only the files that changed since then are fetched.
+
   Updates last ImportAttempt for the config set.
 
   If Revision entity does not exist, then creates ConfigSet initialized from
@@ -127,18 +141,25 @@ def _import_revision(config_set, base_location, commit):
     storage.Revision(key=rev_key),
   ]
 
-  # Fetch archive outside ConfigSet transaction.
-  archive = location.get_archive(
-      deadline=get_gitiles_config().fetch_archive_deadline)
-  if not archive:
+  # Fetch files outside ConfigSet transaction.
+  read = None
+  if prev_revision:
+    read = _read_and_validate_changed_files(
+        config_set, rev_key, location, prev_revision)
+  if read is None:
+    archive = location.get_archive(
+        deadline=get_gitiles_config().fetch_archive_deadline)
+    if archive:
+      # Extract files and save them to Blobs outside ConfigSet transaction.
+      read = _read_and_validate_archive(config_set, rev_key, archive)
+
+  if read is None:
     logging.warning(
         'Configuration %s does not exist. Probably it was deleted', config_set)
     attempt.success = True
     attempt.message = 'Config directory not found. Imported as empty'
   else:
-    # Extract files and save them to Blobs outside ConfigSet transaction.
-    files, validation_result = _read_and_validate_archive(
-        config_set, rev_key, archive)
+    files, validation_result = read
     if validation_result.has_errors:
       logging.warning('Invalid revision %s@%s', config_set, revision)
       notifications.notify_gitiles_rejection(
@@ -213,6 +234,79 @@ def _read_and_validate_archive(config_set, rev_key, archive):
   return entities, ctx.result()
 
 
+def _read_and_validate_changed_files(
+    config_set, rev_key, location, prev_revision):
+  """Fetches and validates the files that changed since |prev_revision|.
+
+  Git blob ids are the content hashes used by storage, so the recursive tree
+  of the revision tells which files differ from the ones of |prev_revision|
+  without fetching them. Unchanged files keep their Blobs.
+
+  Return:
+      (files, validation_result) tuple like _read_and_validate_archive or None
+      if the archive must be fetched instead.
+  """
+  deadline = get_gitiles_config().fetch_archive_deadline
+  tree = location.get_tree(recursive=True, deadline=deadline)
+  if tree is None:
+    return None
+  hashes = {
+    str(e.name): 'v1:%s' % e.id
+    for e in tree.entries
+    if e.type == 'blob' and stat.S_ISREG(e.mode)
+  }
+  prev_files = storage.File.query(
+      ancestor=ndb.Key(
+          storage.ConfigSet, config_set, storage.Revision, prev_revision)
+  ).fetch()
+  prev_hashes = {f.key.id(): f.content_hash for f in prev_files}
+  changed = sorted(n for n, h in hashes.iteritems() if prev_hashes.get(n) != h)
+  if len(changed) > MAX_INCREMENTAL_IMPORT_FILES:
+    logging.info(
+        '%d files of %s changed, fetching the archive',
+        len(changed), config_set)
+    return None
+  logging.info(
+      '%d of %d files of %s changed', len(changed), len(hashes), config_set)
+
+  # A changed file may have a content imported before, e.g. a reverted file.
+  contents = storage.get_configs_by_hashes_async(
+      [hashes[n] for n in changed]).get_result()
+  file_futures = {
+    n: location.join(n).get_file_content_async(deadline=deadline)
+    for n in changed
+    if contents.get(hashes[n]) is None
+  }
+  ctx = config.validation.Context()
+  new_blobs = {}
+  for name in changed:
+    content_hash = hashes[name]
+    content = contents.get(content_hash)
+    if content is None:
+      content = file_futures[name].get_result()
+      if content is None or storage.compute_hash(content) != content_hash:
+        logging.warning(
+            'Could not fetch %s of %s, fetching the archive', name, config_set)
+        return None
+      new_blobs[content_hash] = content
+    with ctx.prefix(name + ': '):
+      validation.validate_config(config_set, name, content, ctx=ctx)
+
+  if ctx.result().has_errors:
+    return [], ctx.result()
+
+  # Wait for Blobs to be imported before proceeding.
+  ndb.Future.wait_all([
+    storage.import_blob_async(content=content, content_hash=content_hash)
+    for content_hash, content in new_blobs.iteritems()
+  ])
+  entities = [
+    storage.File(id=name, parent=rev_key, content_hash=content_hash)
+    for name, content_hash in sorted(hashes.iteritems())
+  ]
+  return entities, ctx.result()
+
+
 def _import_config_set(config_set, location):
   """Imports the latest version of config set from a Gitiles location.
 
@@ -249,7 +343,10 @@ def _import_config_set(config_set, location):
       logging.debug('Config set %s is up-to-date', config_set)
       return
 
-    _import_revision(config_set, location, commit)
+    _import_revision(
+        config_set, location, commit,
+        prev_revision=(
+            config_set_entity.latest_revision if config_set_entity else None))
   except urlfetch_errors.DeadlineExceededError:
     save_attempt(False, 'Could not import: deadline exceeded')
     raise Error(
@@ -375,8 +472,24 @@ def _log_import_error(cs):
     logging.exception('Could not import %s', cs)
 
 
+def _enqueue_imports(config_sets):
+  """Enqueues one import task per config set.
+
+  Logs errors, does not raise them.
+  """
+  futures = [
+    utils.enqueue_task_async(
+        IMPORT_TASK_URL, IMPORT_QUEUE, params={'config_set': cs})
+    for cs in config_sets
+  ]
+  ndb.Future.wait_all(futures)
+  for cs, f in zip(config_sets, futures):
+    if not f.get_result():
+      logging.error('Could not enqueue import of %s', cs)
+
+
 def import_services(location_root):
-  """Imports all services, assuming they are in Gitiles.
+  """Enqueues import of all services, assuming they are in Gitiles.
 
   Logs errors, does not raise them.
   """
@@ -384,6 +497,7 @@ def import_services(location_root):
   assert location_root
   tree = location_root.get_tree()
 
+  config_sets = []
   for service_entry in tree.entries:
     service_id = service_entry.name
     if service_entry.type != 'tree':
@@ -391,51 +505,36 @@ def import_services(location_root):
     if not config.validation.is_valid_service_id(service_id):
       logging.error('Invalid service id: %s', service_id)
       continue
-    service_location = location_root._replace(
-        path=os.path.join(location_root.path, service_entry.name))
-    cs = 'services/%s' % service_id
-    with _log_import_error(cs):
-      _import_config_set(cs, service_location)
+    config_sets.append('services/%s' % service_id)
+  _enqueue_imports(config_sets)
 
 
 def import_projects():
-  """Imports all project and ref config sets that are stored in Gitiles.
+  """Enqueues import of all project and ref config sets stored in Gitiles.
 
   Logs errors, does not raise them.
   """
-  cfg = get_gitiles_config()
   projs = projects.get_projects()
   refs = projects.get_refs([p.id for p in projs])
+  config_sets = []
   for project in projs:
-    loc = project.config_location
-    if loc.storage_type != GITILES_LOCATION_TYPE:
-      continue
-    try:
-      location = gitiles.Location.parse_resolve(loc.url)
-    except ValueError:
-      logging.exception('Invalid project location: %s', project.config_location)
-      continue
-    except net.AuthError as ex:
-      logging.error(
-          'Could not resolve %s due to permissions: %s',
-          project.config_location, ex.message)
+    if project.config_location.storage_type != GITILES_LOCATION_TYPE:
       continue
+    config_sets.append('projects/%s' % project.id)
+    for ref in refs.get(project.id) or []:
+      assert ref.name
+      assert ref.name.startswith('refs/'), ref.name
+      config_sets.append('projects/%s/%s' % (project.id, ref.name))
+  _enqueue_imports(config_sets)
 
-    with _log_import_error('projects/%s' % project.id):
-      import_project(project.id, location)
 
+def run_import_task(config_set):
+  """Imports a config set enqueued by import_services or import_projects.
 
-    # Import refs of the project
-    for ref in refs[project.id] or []:
-      assert ref.name
-      assert ref.name.startswith('refs/'), ref.name
-      ref_location = location._replace(
-          treeish=ref.name,
-          path=ref.config_path or cfg.ref_config_default_path,
-      )
-      ref_cs = 'projects/%s/%s' % (project.id, ref.name)
-      with _log_import_error(ref_cs):
-        _import_config_set(ref_cs, ref_location)
+  Logs errors, does not raise them.
+  """
+  with _log_import_error(config_set):
+    import_config_set(config_set)
 
 
 def cron_run_import():  # pragma: no cover
@@ -5,6 +5,8 @@
 
 import datetime
 import os
+import StringIO
+import tarfile
 
 from test_env import future
 import test_env
@@ -18,6 +20,7 @@ import mock
 from components import config
 from components import gitiles
 from components import net
+from components import utils
 from components.config.proto import project_config_pb2
 from components.config.proto import service_config_pb2
 from test_support import test_case
@@ -34,6 +37,63 @@ TEST_ARCHIVE_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), 'test_archive.tar.gz')
 
 
+class FakeGitiles(object):
+  """Serves the commits of a single directory like Gitiles does.
+
+  Archives are served as tarballs built on the fly. The requests are recorded
+  in |requests|.
+  """
+
+  def __init__(self, test):
+    # sha -> {path relative to the directory: content}
+    self.commits = {}
+    self.requests = []
+    test.mock(gitiles, 'get_tree', self.get_tree)
+    test.mock(gitiles, 'get_archive', self.get_archive)
+    test.mock(gitiles, 'get_file_content_async', self.get_file_content_async)
+
+  def commit(self, files):
+    sha = '%040x' % (len(self.commits) + 1)
+    self.commits[sha] = files
+    john = gitiles.Contribution(
+        'John Doe', 'john@doe.com', datetime.datetime(2016, 1, 1))
+    return gitiles.Commit(
+        sha=sha, tree=None, parents=[], author=john, committer=john,
+        message=None, tree_diff=None)
+
+  def get_tree(
+      self, _hostname, _project, treeish, path, recursive=False, **_kwargs):
+    assert recursive
+    self.requests.append(('tree', treeish, path))
+    return gitiles.Tree(
+        id='tree',
+        entries=[
+          gitiles.TreeEntry(
+              id=storage.compute_hash(content)[len('v1:'):],
+              name=name,
+              type='blob',
+              mode=0100644)
+          for name, content in sorted(self.commits[treeish].iteritems())
+        ])
+
+  def get_archive(self, _hostname, _project, treeish, path, **_kwargs):
+    self.requests.append(('archive', treeish, path))
+    out = StringIO.StringIO()
+    with tarfile.open(mode='w:gz', fileobj=out) as tar:
+      for name, content in sorted(self.commits[treeish].iteritems()):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO.StringIO(content))
+    return out.getvalue()
+
+  def get_file_content_async(
+      self, _hostname, _project, treeish, path, **_kwargs):
+    self.requests.append(('file', treeish, path))
+    prefix = '/dir/'
+    assert path.startswith(prefix), path
+    return future(self.commits[treeish].get(path[len(prefix):]))
+
+
 class GitilesImportTestCase(test_case.TestCase):
   john = gitiles.Contribution(
       'John Doe', 'john@doe.com', datetime.datetime(2016, 1, 1))
@@ -46,6 +106,10 @@ class GitilesImportTestCase(test_case.TestCase):
       message=None,
       tree_diff=None)
 
+  def setUp(self):
+    super(GitilesImportTestCase, self).setUp()
+    storage._blob_cache.clear()
+
   def assert_attempt(self, success, msg, config_set=None, no_revision=False):
     config_set = config_set or 'config_set'
     attempt = storage.last_import_attempt_key(config_set).get()
@@ -262,13 +326,16 @@ class GitilesImportTestCase(test_case.TestCase):
         ],
     )
 
+    self.mock(gitiles_import, '_enqueue_imports', mock.Mock())
+
     gitiles_import.import_services(
         gitiles.Location.parse('https://localhost/config'))
 
     gitiles.get_tree.assert_called_once_with(
         'localhost', 'config', 'HEAD', '/')
-    gitiles_import._import_config_set.assert_called_once_with(
-        'services/luci-config', 'https://localhost/config/+/HEAD/luci-config')
+    gitiles_import._enqueue_imports.assert_called_once_with(
+        ['services/luci-config'])
+    self.assertFalse(gitiles_import._import_config_set.called)
 
   def test_import_service(self):
     self.mock(gitiles_import, '_import_config_set', mock.Mock())
@@ -314,15 +381,23 @@ class GitilesImportTestCase(test_case.TestCase):
       ],
     }
 
+    self.mock(gitiles_import, '_enqueue_imports', mock.Mock())
+
     gitiles_import.import_projects()
 
-    self.assertEqual(gitiles_import._import_config_set.call_count, 3)
-    gitiles_import._import_config_set.assert_any_call(
-        'projects/chromium', 'https://localhost/chromium/src/+/refs/heads/luci')
-    gitiles_import._import_config_set.assert_any_call(
-        'projects/chromium/refs/heads/master',
-        'https://localhost/chromium/src/+/refs/heads/master/luci')
-    gitiles_import._import_config_set.assert_any_call(
+    gitiles_import._enqueue_imports.assert_called_once_with([
+      'projects/chromium',
+      'projects/chromium/refs/heads/master',
+      'projects/chromium/refs/heads/release42',
+      'projects/bad_location',
+    ])
+    self.assertFalse(gitiles_import._import_config_set.called)
+
+    # Each task imports its config set.
+    self.mock(projects, 'get_project', mock.Mock())
+    projects.get_project.return_value = projects.get_projects.return_value[0]
+    gitiles_import.run_import_task('projects/chromium/refs/heads/release42')
+    gitiles_import._import_config_set.assert_called_once_with(
         'projects/chromium/refs/heads/release42',
         'https://localhost/chromium/src/+/refs/heads/release42/my-configs')
 
@@ -399,6 +474,8 @@ class GitilesImportTestCase(test_case.TestCase):
   def test_import_projects_exception(self):
     self.mock(gitiles_import, 'import_project', mock.Mock())
     gitiles_import.import_project.side_effect = Exception
+    self.mock(utils, 'enqueue_task_async', mock.Mock())
+    utils.enqueue_task_async.side_effect = [future(True), future(False)]
     self.mock(projects, 'get_refs', mock.Mock(return_value={
       'chromium': [],
       'will-fail': [],
@@ -422,8 +499,98 @@ class GitilesImportTestCase(test_case.TestCase):
       )
     ]
 
+    # Enqueue errors are logged.
     gitiles_import.import_projects()
-    self.assertEqual(gitiles_import.import_project.call_count, 2)
+    self.assertEqual(utils.enqueue_task_async.call_count, 2)
+    utils.enqueue_task_async.assert_any_call(
+        gitiles_import.IMPORT_TASK_URL, gitiles_import.IMPORT_QUEUE,
+        params={'config_set': 'projects/will-fail'})
+
+    # Import errors are logged.
+    gitiles_import.run_import_task('projects/will-fail')
+    self.assertEqual(gitiles_import.import_project.call_count, 1)
+
+  ##############################################################################
+  # Incremental import against a fake Gitiles.
+
+  def test_import_revision_incremental(self):
+    fake = FakeGitiles(self)
+    loc = gitiles.Location.parse('https://localhost/project/+/master/dir')
+    commit1 = fake.commit({'a.cfg': 'a', 'b.cfg': 'b', 'sub/c.cfg': 'c'})
+    gitiles_import._import_revision('config_set', loc, commit1)
+    self.assertEqual(['archive'], [r[0] for r in fake.requests])
+
+    # Only the changed files are fetched.
+    fake.requests = []
+    commit2 = fake.commit({
+      'a.cfg': 'a', 'b.cfg': 'b2', 'sub/c.cfg': 'c', 'd.cfg': 'd'})
+    gitiles_import._import_revision(
+        'config_set', loc, commit2, prev_revision=commit1.sha)
+    self.assertEqual(
+        [
+          ('tree', commit2.sha, '/dir'),
+          ('file', commit2.sha, '/dir/b.cfg'),
+          ('file', commit2.sha, '/dir/d.cfg'),
+        ],
+        sorted(fake.requests))
+    self.assertEqual(
+        {'a.cfg': 'a', 'b.cfg': 'b2', 'd.cfg': 'd', 'sub/c.cfg': 'c'},
+        self.get_revision_files('config_set', commit2.sha))
+    self.assertEqual(
+        commit2.sha, storage.ConfigSet.get_by_id('config_set').latest_revision)
+
+    # A file reverted to a content already imported is not fetched.
+    fake.requests = []
+    commit3 = fake.commit({'a.cfg': 'a', 'b.cfg': 'b', 'sub/c.cfg': 'c'})
+    gitiles_import._import_revision(
+        'config_set', loc, commit3, prev_revision=commit2.sha)
+    self.assertEqual([('tree', commit3.sha, '/dir')], fake.requests)
+    self.assertEqual(
+        {'a.cfg': 'a', 'b.cfg': 'b', 'sub/c.cfg': 'c'},
+        self.get_revision_files('config_set', commit3.sha))
+
+  def test_import_revision_incremental_too_many_changes(self):
+    self.mock(gitiles_import, 'MAX_INCREMENTAL_IMPORT_FILES', 1)
+    fake = FakeGitiles(self)
+    loc = gitiles.Location.parse('https://localhost/project/+/master/dir')
+    commit1 = fake.commit({'a.cfg': 'a'})
+    gitiles_import._import_revision('config_set', loc, commit1)
+    fake.requests = []
+    commit2 = fake.commit({'a.cfg': 'a2', 'b.cfg': 'b'})
+    gitiles_import._import_revision(
+        'config_set', loc, commit2, prev_revision=commit1.sha)
+    self.assertEqual(['tree', 'archive'], [r[0] for r in fake.requests])
+    self.assertEqual(
+        {'a.cfg': 'a2', 'b.cfg': 'b'},
+        self.get_revision_files('config_set', commit2.sha))
+
+  def test_import_revision_incremental_invalid(self):
+    self.mock(notifications, 'notify_gitiles_rejection', mock.Mock())
+    def validate_config(config_set, filename, content, ctx):
+      if content == 'bad':
+        ctx.error('bad config!')
+    self.mock(validation, 'validate_config', validate_config)
+    fake = FakeGitiles(self)
+    loc = gitiles.Location.parse('https://localhost/project/+/master/dir')
+    commit1 = fake.commit({'a.cfg': 'a'})
+    gitiles_import._import_revision('config_set', loc, commit1)
+    commit2 = fake.commit({'a.cfg': 'bad'})
+    gitiles_import._import_revision(
+        'config_set', loc, commit2, prev_revision=commit1.sha)
+
+    attempt = storage.last_import_attempt_key('config_set').get()
+    self.assertEqual('Validation errors', attempt.message)
+    self.assertEqual(
+        commit1.sha, storage.ConfigSet.get_by_id('config_set').latest_revision)
+    self.assertIsNone(storage.Blob.get_by_id(storage.compute_hash('bad')))
+
+  def get_revision_files(self, config_set, revision):
+    files = storage.File.query(
+        ancestor=ndb.Key(
+            storage.ConfigSet, config_set, storage.Revision, revision)).fetch()
+    contents = storage.get_configs_by_hashes_async(
+        [f.content_hash for f in files]).get_result()
+    return {f.key.id(): contents[f.content_hash] for f in files}
 
 
 if __name__ == '__main__':
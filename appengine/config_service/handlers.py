@@ -22,6 +22,13 @@ class CronGitilesImport(webapp2.RequestHandler):
     gitiles_import.cron_run_import()
 
 
+class TaskGitilesImport(webapp2.RequestHandler):
+  """Imports a config set from Gitiles."""
+  @decorators.require_taskqueue(gitiles_import.IMPORT_QUEUE)
+  def post(self):
+    gitiles_import.run_import_task(self.request.get('config_set'))
+
+
 class MainPageHandler(webapp2.RequestHandler):
   """Redirects to API Explorer."""
 
@@ -61,4 +68,5 @@ def get_backend_routes():  # pragma: no cover
       webapp2.Route(
           r'/internal/cron/luci-config/gitiles_import',
           CronGitilesImport),
+      webapp2.Route(gitiles_import.IMPORT_TASK_URL, TaskGitilesImport),
   ]
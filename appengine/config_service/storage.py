@@ -4,9 +4,12 @@
 
 """Storage of config files."""
 
+import collections
 import hashlib
+import threading
 
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 from google.protobuf import text_format
@@ -15,6 +18,14 @@ from components import config
 from components import utils
 
 
+# Blobs larger than a memcache value are split in chunks of this size. Leave
+# some room for the pickling overhead.
+BLOB_MEMCACHE_CHUNK_SIZE = memcache.MAX_VALUE_SIZE - 1024
+
+# Maximum total size of blob contents kept in the instance memory.
+BLOB_LOCAL_CACHE_SIZE = 64 * 1024 * 1024
+
+
 class Blob(ndb.Model):
   """Content-addressed blob. Immutable.
 
@@ -187,19 +198,125 @@ def get_config_hashes_async(revs, path):
   })
 
 
+class _BlobCache(object):
+  """Thread-safe in-process LRU cache of blob contents, bounded in bytes.
+
+  Blobs are immutable, so entries never expire, they are only evicted.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._size = 0
+    self._lock = threading.Lock()
+    # content_hash -> content
+    self._items = collections.OrderedDict()
+
+  def get(self, content_hash):
+    """Returns the content or None if it is not cached."""
+    with self._lock:
+      content = self._items.pop(content_hash, None)
+      if content is not None:
+        # Move it to the most recently used position.
+        self._items[content_hash] = content
+      return content
+
+  def set(self, content_hash, content):
+    if len(content) > self.max_size:
+      return
+    with self._lock:
+      if content_hash in self._items:
+        return
+      self._items[content_hash] = content
+      self._size += len(content)
+      while self._size > self.max_size:
+        _, evicted = self._items.popitem(last=False)
+        self._size -= len(evicted)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self._size = 0
+
+
+_blob_cache = _BlobCache(BLOB_LOCAL_CACHE_SIZE)
+
+
+def _blob_memcache_key(content_hash, index=0):
+  key = 'config_blob/%s' % content_hash
+  return '%s/%d' % (key, index) if index else key
+
+
+@ndb.tasklet
+def _get_blob_from_memcache_async(content_hash):
+  """Returns the blob content assembled from its memcache chunks or None.
+
+  The first memcache entry is a tuple (number of chunks, first chunk), so small
+  blobs are fetched in one lookup.
+  """
+  ctx = ndb.get_context()
+  head = yield ctx.memcache_get(_blob_memcache_key(content_hash))
+  if not head:
+    raise ndb.Return(None)
+  count, chunk = head
+  chunks = [chunk]
+  if count > 1:
+    rest = yield [
+      ctx.memcache_get(_blob_memcache_key(content_hash, i))
+      for i in xrange(1, count)
+    ]
+    if any(c is None for c in rest):
+      # Some chunks were evicted.
+      raise ndb.Return(None)
+    chunks.extend(rest)
+  raise ndb.Return(''.join(chunks))
+
+
+@ndb.tasklet
+def _put_blob_to_memcache_async(content_hash, content):
+  size = BLOB_MEMCACHE_CHUNK_SIZE
+  chunks = [content[i:i+size] for i in xrange(0, len(content), size)] or ['']
+  ctx = ndb.get_context()
+  # The head is written last so it does not point to chunks not written yet.
+  yield [
+    ctx.memcache_set(_blob_memcache_key(content_hash, i), chunks[i])
+    for i in xrange(1, len(chunks))
+  ]
+  yield ctx.memcache_set(
+      _blob_memcache_key(content_hash), (len(chunks), chunks[0]))
+
+
 @ndb.tasklet
 def get_configs_by_hashes_async(content_hashes):
-  """Returns a mapping {hash: content}."""
+  """Returns a mapping {hash: content}.
+
+  Blobs are looked up in the in-process cache, then in memcache and then in the
+  datastore. Blobs larger than a memcache value are cached in chunks.
+  """
   assert isinstance(content_hashes, list)
   if not content_hashes:
     raise ndb.Return({})
   assert all(h for h in content_hashes)
   content_hashes = list(set(content_hashes))
-  blobs = yield ndb.get_multi_async(ndb.Key(Blob, h) for h in content_hashes)
-  raise ndb.Return({
-    h: b.content if b else None
-    for h, b in zip(content_hashes, blobs)
-  })
+
+  result = {h: _blob_cache.get(h) for h in content_hashes}
+  missing = [h for h, content in result.iteritems() if content is None]
+  if missing:
+    contents = yield [_get_blob_from_memcache_async(h) for h in missing]
+    result.update(zip(missing, contents))
+    missing = [h for h, content in zip(missing, contents) if content is None]
+  if missing:
+    # ndb would try to memcache the entities as a whole, which fails for large
+    # blobs.
+    blobs = yield ndb.get_multi_async(
+        (ndb.Key(Blob, h) for h in missing), use_memcache=False)
+    found = {h: b.content for h, b in zip(missing, blobs) if b}
+    result.update(found)
+    yield [_put_blob_to_memcache_async(h, c) for h, c in found.iteritems()]
+
+  for h, content in result.iteritems():
+    if content is not None:
+      _blob_cache.set(h, content)
+  raise ndb.Return(result)
 
 
 @ndb.tasklet
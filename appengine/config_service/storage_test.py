@@ -9,6 +9,8 @@ from test_env import future
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
+
 from test_support import test_case
 import mock
 
@@ -18,6 +20,9 @@ import storage
 
 
 class StorageTestCase(test_case.TestCase):
+  def setUp(self):
+    super(StorageTestCase, self).setUp()
+    storage._blob_cache.clear()
 
   def put_file(self, config_set, revision, path, content):
     confg_set_key = storage.ConfigSet(
@@ -87,6 +92,52 @@ class StorageTestCase(test_case.TestCase):
     actual = storage.get_configs_by_hashes_async(['deadbeef']).get_result()
     self.assertEqual(expected, actual)
 
+  def test_get_config_by_hash_cached(self):
+    storage.Blob(id='deadbeef', content='content').put()
+    expected = {'deadbeef': 'content'}
+    actual = storage.get_configs_by_hashes_async(['deadbeef']).get_result()
+    self.assertEqual(expected, actual)
+
+    # In-process cache.
+    storage.Blob.get_by_id('deadbeef').key.delete()
+    actual = storage.get_configs_by_hashes_async(['deadbeef']).get_result()
+    self.assertEqual(expected, actual)
+
+    # memcache.
+    storage._blob_cache.clear()
+    actual = storage.get_configs_by_hashes_async(['deadbeef']).get_result()
+    self.assertEqual(expected, actual)
+
+  def test_get_config_by_hash_chunked(self):
+    self.mock(storage, 'BLOB_MEMCACHE_CHUNK_SIZE', 3)
+    storage.Blob(id='deadbeef', content='large content').put()
+    storage.get_configs_by_hashes_async(['deadbeef']).get_result()
+    storage.Blob.get_by_id('deadbeef').key.delete()
+    storage._blob_cache.clear()
+    expected = {'deadbeef': 'large content'}
+    actual = storage.get_configs_by_hashes_async(['deadbeef']).get_result()
+    self.assertEqual(expected, actual)
+
+    # A chunk was evicted.
+    memcache.delete(storage._blob_memcache_key('deadbeef', 2))
+    storage._blob_cache.clear()
+    actual = storage.get_configs_by_hashes_async(['deadbeef']).get_result()
+    self.assertEqual({'deadbeef': None}, actual)
+
+  def test_blob_cache(self):
+    cache = storage._BlobCache(10)
+    cache.set('a', 'aaaa')
+    cache.set('b', 'bbbb')
+    self.assertEqual('aaaa', cache.get('a'))
+    # 'b' is the least recently used.
+    cache.set('c', 'cccc')
+    self.assertEqual(None, cache.get('b'))
+    self.assertEqual('aaaa', cache.get('a'))
+    self.assertEqual('cccc', cache.get('c'))
+    # Too large.
+    cache.set('d', 'd' * 11)
+    self.assertEqual(None, cache.get('d'))
+
   def test_compute_hash(self):
     content = 'some content\n'
     # echo some content | git hash-object --stdin
@@ -16,7 +16,6 @@ from components import machine_provider
 from components import net
 
 import instances
-import instance_group_managers
 import metrics
 import models
 import utilities
@@ -89,6 +88,7 @@ def set_cataloged(key):
 
   instance.cataloged = True
   instance.put()
+  instances.update_work(key, clear=[models.InstanceWork.CATALOG])
 
 
 def catalog(key):
@@ -153,21 +153,10 @@ def catalog(key):
 
 def schedule_catalog():
   """Enqueues tasks to catalog instances."""
-  # Only enqueue tasks for uncataloged instances not pending deletion which
-  # are part of active instance group managers which are part of active
-  # instance templates.
-  for instance_template in models.InstanceTemplate.query():
-    if instance_template.active:
-      instance_template_revision = instance_template.active.get()
-      if instance_template_revision:
-        for instance_group_manager_key in instance_template_revision.active:
-          instance_group_manager = instance_group_manager_key.get()
-          if instance_group_manager:
-            for instance_key in instance_group_manager.instances:
-              instance = instance_key.get()
-              if instance:
-                if not instance.cataloged and not instance.pending_deletion:
-                  utilities.enqueue_task('catalog-instance', instance.key)
+  # Tasks are enqueued when instances are created in active instance group
+  # managers, this retries cataloging those which aren't cataloged yet.
+  for key in instances.get_pending_work(models.InstanceWork.CATALOG):
+    utilities.enqueue_task('catalog-instance', key)
 
 
 def remove(key):
@@ -199,14 +188,12 @@ def remove(key):
 
 def schedule_removal():
   """Enqueues tasks to remove drained instances from the catalog."""
-  for instance_group_manager_key in (
-      instance_group_managers.get_drained_instance_group_managers()):
-    instance_group_manager = instance_group_manager_key.get()
-    if instance_group_manager:
-      for instance_key in instance_group_manager.instances:
-        instance = instance_key.get()
-        if instance and not instance.pending_deletion:
-          utilities.enqueue_task('remove-cataloged-instance', instance.key)
+  # Tasks are enqueued when instance group managers are found drained, this
+  # retries removing the instances which aren't pending deletion yet.
+  keys = instances.get_pending_work(models.InstanceWork.DRAINED)
+  for instance in ndb.get_multi(keys):
+    if instance and not instance.pending_deletion:
+      utilities.enqueue_task('remove-cataloged-instance', instance.key)
 
 
 def update_cataloged_instance(key):
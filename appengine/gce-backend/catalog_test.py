@@ -407,9 +407,14 @@ class SetCatalogedTest(test_case.TestCase):
         key=key,
         cataloged=False,
     ).put()
+    models.InstanceWork(
+        key=instances.get_work_key(key, models.InstanceWork.CATALOG),
+        state=models.InstanceWork.CATALOG,
+    ).put()
 
     catalog.set_cataloged(key)
     self.failUnless(key.get().cataloged)
+    self.failIf(models.InstanceWork.query(ancestor=key).get())
 
 
 class UpdateCatalogedEntryTest(test_case.TestCase):
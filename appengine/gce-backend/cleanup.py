@@ -13,6 +13,7 @@ from components import gce
 from components import net
 from components import utils
 
+import gce_batch
 import instance_group_managers
 import instance_templates
 import instances
@@ -64,6 +65,7 @@ def set_instance_deleted(key, drained):
     logging.info('Setting Instance as deleted: %s', key)
     instance.deleted = True
     instance.put()
+    instances.update_work(key, clear=models.InstanceWork.STATES)
 
 
 @ndb.transactional_tasklet
@@ -201,6 +203,93 @@ def cleanup_instance_templates(max_concurrent=50):
   )
 
 
+def _set_deleted(instance, drained, now):
+  """Sets the given Instance as deleted once its GCE instance is gone.
+
+  Args:
+    instance: models.Instance.
+    drained: Whether or not the Instance is being set as deleted
+      because it is drained.
+    now: datetime.datetime the GCE instance was found to be gone.
+  """
+  if instance.deletion_ts:
+    metrics.instance_deletion_time.add(
+        (now - instance.deletion_ts).total_seconds(),
+        fields={
+            'zone': instance.instance_group_manager.id(),
+        },
+    )
+  set_instance_deleted(instance.key, drained)
+  metrics.send_machine_event('DELETION_SUCCEEDED', instance.hostname)
+
+
+def _get_project(instance):
+  """Returns the project the given Instance was created in.
+
+  Args:
+    instance: models.Instance.
+
+  Returns:
+    The name of the project, or None if it can't be determined.
+  """
+  instance_template_revision = instance.instance_group_manager.parent().get()
+  if not instance_template_revision:
+    logging.warning(
+        'InstanceTemplateRevision does not exist: %s',
+        instance.instance_group_manager.parent(),
+    )
+    return None
+
+  if not instance_template_revision.project:
+    logging.warning(
+        'InstanceTemplateRevision project unspecified: %s',
+        instance_template_revision.key,
+    )
+    return None
+
+  return instance_template_revision.project
+
+
+def get_deleted(instances):
+  """Returns the Instances which refer to deleted GCE instances.
+
+  Existence is checked with one batch of GCE API calls per project instead of
+  one GCE API call per instance.
+
+  Args:
+    instances: List of models.Instance with URLs.
+
+  Returns:
+    A list of models.Instance whose GCE instances were not found. Instances
+    whose existence couldn't be determined are omitted.
+  """
+  by_project = {}
+  for instance in instances:
+    project = _get_project(instance)
+    if project:
+      by_project.setdefault(project, []).append(instance)
+
+  futures = []
+  for project, group in sorted(by_project.iteritems()):
+    batch = gce_batch.Batch(project)
+    for instance in group:
+      batch.add(instance.url)
+    futures.append((group, batch.execute_async()))
+
+  deleted = []
+  for group, future in futures:
+    for instance, result in zip(group, future.get_result()):
+      if result.status_code == 404:
+        deleted.append(instance)
+      elif not result.status_code or result.status_code >= 300:
+        logging.warning(
+            'Failed to check if instance exists: %s\n%s',
+            instance.url,
+            result.status_code,
+        )
+  return deleted
+
+
 def check_deleted_instance(key):
   """Marks the given Instance as deleted if it refers to a deleted GCE instance.
 
@@ -225,22 +314,44 @@ def check_deleted_instance(key):
   now = utils.utcnow()
   if not exists(instance.url):
     # When the instance isn't found, assume it's deleted.
-    if instance.deletion_ts:
-      metrics.instance_deletion_time.add(
-          (now - instance.deletion_ts).total_seconds(),
-          fields={
-              'zone': instance.instance_group_manager.id(),
-          },
-      )
-    set_instance_deleted(key, False)
-    metrics.send_machine_event('DELETION_SUCCEEDED', instance.hostname)
+    _set_deleted(instance, False, now)
+
+
+def check_deleted_instances(keys):
+  """Marks the given Instances as deleted if their GCE instances are gone.
+
+  Batched version of check_deleted_instance.
+
+  Args:
+    keys: List of ndb.Keys for models.Instance entities.
+  """
+  instances = []
+  for key, instance in zip(keys, ndb.get_multi(keys)):
+    if not instance or instance.deleted:
+      continue
+    if not instance.pending_deletion:
+      logging.warning('Instance not pending deletion: %s', key)
+      continue
+    if not instance.url:
+      logging.warning('Instance URL unspecified: %s', key)
+      continue
+    instances.append(instance)
+
+  now = utils.utcnow()
+  for instance in get_deleted(instances):
+    # When the instance isn't found, assume it's deleted.
+    _set_deleted(instance, False, now)
 
 
 def schedule_deleted_instance_check():
   """Enqueues tasks to check for deleted instances."""
-  for instance in models.Instance.query():
-    if instance.pending_deletion and not instance.deleted:
-      utilities.enqueue_task('check-deleted-instance', instance.key)
+  # Keys of instances in the same instance group manager sort together, so
+  # that each task checks as few projects as possible.
+  utilities.enqueue_batch_tasks(
+      'check-deleted-instance',
+      instances.get_pending_work(models.InstanceWork.PENDING_DELETION),
+      gce_batch.MAX_BATCH_SIZE,
+  )
 
 
 @ndb.transactional
@@ -259,7 +370,10 @@ def cleanup_deleted_instance(key):
     return
 
   logging.info('Deleting Instance entity: %s', key)
-  key.delete()
+  ndb.delete_multi([key] + [
+      instances.get_work_key(key, state)
+      for state in models.InstanceWork.STATES
+  ])
   metrics.send_machine_event('DELETED', instance.hostname)
 
 
@@ -281,6 +395,27 @@ def schedule_deleted_instance_cleanup():
       utilities.enqueue_task('cleanup-deleted-instance', instance.key)
 
 
+def _is_drained(instance):
+  """Returns whether the given Instance is drained or not.
+
+  Args:
+    instance: models.Instance.
+  """
+  instance_group_manager = instance.instance_group_manager.get()
+  if not instance_group_manager:
+    logging.warning(
+        'InstanceGroupManager does not exist: %s',
+        instance.instance_group_manager,
+    )
+    return False
+
+  if not instance_group_managers.is_drained(instance_group_manager.key):
+    logging.warning('Instance is not drained: %s', instance.key)
+    return False
+
+  return True
+
+
 def cleanup_drained_instance(key):
   """Deletes the given drained Instance.
 
@@ -298,56 +433,47 @@ def cleanup_drained_instance(key):
     logging.warning('Instance URL unspecified: %s', key)
     return
 
-  instance_group_manager = instance.instance_group_manager.get()
-  if not instance_group_manager:
-    logging.warning(
-        'InstanceGroupManager does not exist: %s',
-        instance.instance_group_manager,
-    )
+  if not _is_drained(instance):
     return
 
-  instance_template_revision = instance_group_manager.key.parent().get()
-  if not instance_template_revision:
-    logging.warning(
-        'InstanceTemplateRevision does not exist: %s',
-        instance_group_manager.key.parent(),
-    )
-    return
+  now = utils.utcnow()
+  if not exists(instance.url):
+    # When the instance isn't found, assume it's deleted.
+    _set_deleted(instance, True, now)
 
-  instance_template = instance_template_revision.key.parent().get()
-  if not instance_template:
-    logging.warning(
-        'InstanceTemplate does not exist: %s',
-        instance_template_revision.key.parent(),
-    )
-    return
 
-  if instance_group_manager.key not in instance_template_revision.drained:
-    if instance_template_revision.key not in instance_template.drained:
-      logging.warning('Instance is not drained: %s', key)
-      return
+def cleanup_drained_instances(keys):
+  """Deletes the given drained Instances.
+
+  Batched version of cleanup_drained_instance.
+
+  Args:
+    keys: List of ndb.Keys for models.Instance entities.
+  """
+  instances = []
+  for key, instance in zip(keys, ndb.get_multi(keys)):
+    if not instance or instance.deleted:
+      continue
+    if not instance.url:
+      logging.warning('Instance URL unspecified: %s', key)
+      continue
+    if _is_drained(instance):
+      instances.append(instance)
 
   now = utils.utcnow()
-  if not exists(instance.url):
+  for instance in get_deleted(instances):
     # When the instance isn't found, assume it's deleted.
-    if instance.deletion_ts:
-      metrics.instance_deletion_time.add(
-          (now - instance.deletion_ts).total_seconds(),
-          fields={
-              'zone': instance.instance_group_manager.id(),
-          },
-      )
-    set_instance_deleted(key, True)
-    metrics.send_machine_event('DELETION_SUCCEEDED', instance.hostname)
+    _set_deleted(instance, True, now)
 
 
 def schedule_drained_instance_cleanup():
   """Enqueues tasks to clean up drained instances."""
-  for instance_group_manager_key in (
-      instance_group_managers.get_drained_instance_group_managers()):
-    instance_group_manager = instance_group_manager_key.get()
-    if instance_group_manager:
-      for instance_key in instance_group_manager.instances:
-        instance = instance_key.get()
-        if instance and not instance.cataloged:
-          utilities.enqueue_task('cleanup-drained-instance', instance.key)
+  keys = instances.get_pending_work(models.InstanceWork.DRAINED)
+  utilities.enqueue_batch_tasks(
+      'cleanup-drained-instance',
+      [
+          instance.key for instance in ndb.get_multi(keys)
+          if instance and not instance.cataloged
+      ],
+      gce_batch.MAX_BATCH_SIZE,
+  )
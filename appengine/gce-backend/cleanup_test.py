@@ -111,6 +111,44 @@ class CheckDeletedInstanceTest(test_case.TestCase):
     self.failUnless(key.get().deleted)
 
 
+class CheckDeletedInstancesTest(test_case.TestCase):
+  """Tests for cleanup.check_deleted_instances."""
+
+  def test_deleted(self):
+    """Ensures only the entities of missing instances are marked deleted."""
+    def get_deleted(instances):
+      return [instance for instance in instances if instance.url == 'gone']
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(cleanup, 'get_deleted', get_deleted)
+    self.mock(cleanup.metrics, 'send_machine_event', send_machine_event)
+
+    keys = [
+        models.Instance(
+            key=instances.get_instance_key(
+                'base-name',
+                'revision',
+                'zone',
+                'instance-name-%d' % i,
+            ),
+            pending_deletion=pending_deletion,
+            url=url,
+        ).put()
+        for i, (pending_deletion, url) in enumerate([
+            (True, 'gone'),
+            (True, 'url'),
+            (False, 'gone'),
+            (True, None),
+        ])
+    ]
+    keys.append(ndb.Key(models.Instance, 'fake-key'))
+
+    cleanup.check_deleted_instances(keys)
+
+    self.assertEqual(
+        [True, False, False, False], [key.get().deleted for key in keys[:4]])
+
+
 class CleanupDeletedInstanceTest(test_case.TestCase):
   """Tests for cleanup.cleanup_deleted_instance."""
 
@@ -390,6 +428,51 @@ class CleanupDrainedInstanceTest(test_case.TestCase):
     self.failUnless(key.get().deleted)
 
 
+class CleanupDrainedInstancesTest(test_case.TestCase):
+  """Tests for cleanup.cleanup_drained_instances."""
+
+  def test_drained(self):
+    """Ensures only the entities of drained missing instances are deleted."""
+    def get_deleted(instances):
+      return instances
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(cleanup, 'get_deleted', get_deleted)
+    self.mock(cleanup.metrics, 'send_machine_event', send_machine_event)
+
+    keys = []
+    for zone in ('zone-1', 'zone-2'):
+      key = instances.get_instance_key(
+          'base-name',
+          'revision',
+          zone,
+          'instance-name',
+      )
+      keys.append(models.Instance(
+          key=key,
+          instance_group_manager=instances.get_instance_group_manager_key(key),
+          url='url',
+      ).put())
+      models.InstanceGroupManager(
+          key=instances.get_instance_group_manager_key(key),
+      ).put()
+    instance_group_manager_key = instances.get_instance_group_manager_key(
+        keys[0])
+    models.InstanceTemplateRevision(
+        key=instance_group_manager_key.parent(),
+        drained=[
+            instance_group_manager_key,
+        ],
+    ).put()
+    models.InstanceTemplate(
+        key=instance_group_manager_key.parent().parent(),
+    ).put()
+
+    cleanup.cleanup_drained_instances(keys)
+
+    self.assertEqual([True, False], [key.get().deleted for key in keys])
+
+
 class CleanupInstanceGroupManagersTest(test_case.TestCase):
   """Tests for cleanup.cleanup_instance_group_managers."""
 
@@ -1024,6 +1107,26 @@ class SetInstanceDeletedTest(test_case.TestCase):
 
     self.failUnless(key.get().deleted)
 
+  def test_clears_work(self):
+    """Ensures the work pending on the entity is cleared."""
+    key = models.Instance(
+      key=instances.get_instance_key(
+          'base-name',
+          'revision',
+          'zone',
+          'instance-name',
+      ),
+      pending_deletion=True,
+    ).put()
+    for state in models.InstanceWork.STATES:
+      models.InstanceWork(
+          key=instances.get_work_key(key, state), state=state).put()
+
+    cleanup.set_instance_deleted(key, True)
+
+    self.failUnless(key.get().deleted)
+    self.failIf(models.InstanceWork.query(ancestor=key).get())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,225 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Batching of GCE API calls.
+
+Calls to the GCE API of a single project are sent together in multipart/mixed
+HTTP requests to the batch endpoint instead of one HTTP request per call. See
+https://cloud.google.com/compute/docs/api/how-tos/batch.
+"""
+
+import collections
+import json
+import logging
+import re
+import urlparse
+import uuid
+
+from google.appengine.ext import ndb
+
+from components import gce
+from components import net
+
+
+# Endpoint accepting batch requests for the GCE API.
+BATCH_URL = 'https://www.googleapis.com/batch/compute/v1'
+
+# Maximum number of calls the batch endpoint accepts in a single request.
+MAX_BATCH_SIZE = 100
+
+# Maximum number of times a call failing with a transient error is sent.
+MAX_ATTEMPTS = 3
+
+# Result of a single call in a batch.
+#
+# status_code is the HTTP status code of the call, or None if the call didn't
+# get a response. response is the deserialized JSON response, or None.
+Result = collections.namedtuple('Result', ['status_code', 'response'])
+
+_CONTENT_ID_RE = re.compile(r'^content-id:\s*<response-(\d+)>\s*$', re.I | re.M)
+
+
+def is_transient(status_code):
+  """Returns True if a call which failed with the given status can be retried.
+
+  Args:
+    status_code: HTTP status code of the call, or None.
+  """
+  return status_code is None or status_code == 429 or status_code >= 500
+
+
+def encode(boundary, calls):
+  """Returns the body of a batch request.
+
+  Args:
+    boundary: Boundary separating the calls in the body.
+    calls: List of (method, path, payload) tuples. payload is a JSON-encodable
+      object or None.
+  """
+  parts = []
+  for i, (method, path, payload) in enumerate(calls):
+    lines = [
+        '--%s' % boundary,
+        'Content-Type: application/http',
+        'Content-ID: <%d>' % i,
+        '',
+        '%s %s HTTP/1.1' % (method, path),
+    ]
+    if payload is None:
+      lines.append('')
+    else:
+      lines.extend([
+          'Content-Type: application/json',
+          '',
+          json.dumps(payload, sort_keys=True),
+      ])
+    parts.append('\r\n'.join(lines) + '\r\n')
+  parts.append('--%s--\r\n' % boundary)
+  return ''.join(parts)
+
+
+def decode(content, count):
+  """Returns the results of a batch request from the body of its response.
+
+  Args:
+    content: Body of the batch response.
+    count: Number of calls in the batch request.
+
+  Returns:
+    A list of Result in the same order as the calls. Calls missing from the
+    response have a None status code.
+  """
+  results = [Result(None, None)] * count
+  content = content.replace('\r\n', '\n').lstrip()
+  boundary = content.split('\n', 1)[0].strip()
+  if not boundary.startswith('--'):
+    logging.warning('Unexpected batch response:\n%s', content[:1024])
+    return results
+
+  for part in content.split(boundary)[1:]:
+    if part.startswith('--'):
+      # Closing boundary.
+      break
+    headers, _, http = part.strip('\n').partition('\n\n')
+    match = _CONTENT_ID_RE.search(headers)
+    if not match or int(match.group(1)) >= count:
+      logging.warning('Unexpected batch response part:\n%s', part[:1024])
+      continue
+    status_line, _, rest = http.partition('\n')
+    try:
+      status_code = int(status_line.split()[1])
+    except (IndexError, ValueError):
+      logging.warning('Unexpected batch response status: %s', status_line)
+      continue
+    # The body follows the first empty line, rest may have no header at all.
+    body = ('\n' + rest).partition('\n\n')[2].strip()
+    response = None
+    if body:
+      try:
+        response = json.loads(body)
+      except ValueError:
+        logging.warning('Unexpected batch response body:\n%s', body[:1024])
+    results[int(match.group(1))] = Result(status_code, response)
+  return results
+
+
+class Batch(object):
+  """Accumulates GCE API calls to a project and sends them in batches."""
+
+  def __init__(
+      self, project, max_batch_size=MAX_BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+    """
+    Args:
+      project: Name of the project the calls are made to.
+      max_batch_size: Maximum number of calls to send in one batch request.
+      max_attempts: Maximum number of times a call failing with a transient
+        error is sent.
+    """
+    assert gce.is_valid_project_id(project), project
+    assert 0 < max_batch_size <= MAX_BATCH_SIZE, max_batch_size
+    self._project = project
+    self._max_batch_size = max_batch_size
+    self._max_attempts = max_attempts
+    # List of (method, path, payload) tuples.
+    self._calls = []
+
+  def __len__(self):
+    return len(self._calls)
+
+  def add(self, url, method='GET', payload=None):
+    """Adds a call to the batch.
+
+    Args:
+      url: URL of the GCE API resource, e.g. the URL of an instance.
+      method: HTTP method of the call.
+      payload: JSON-encodable body of the call, or None.
+
+    Returns:
+      The index of the result of the call in the list returned by execute.
+    """
+    parsed = urlparse.urlparse(url)
+    path = parsed.path
+    if parsed.query:
+      path += '?' + parsed.query
+    assert path.startswith('/compute/'), url
+    assert '/projects/%s/' % self._project in path, url
+    self._calls.append((method, path, payload))
+    return len(self._calls) - 1
+
+  @ndb.tasklet
+  def execute_async(self):
+    """Sends the calls added so far.
+
+    Batch requests are sent concurrently. Calls failing with a transient error
+    are sent again, up to max_attempts times.
+
+    Returns:
+      A list of Result in the same order as the calls were added.
+    """
+    calls, self._calls = self._calls, []
+    results = [Result(None, None)] * len(calls)
+    pending = range(len(calls))
+    attempt = 0
+    while pending and attempt < self._max_attempts:
+      if attempt:
+        logging.info('Retrying %d GCE API calls', len(pending))
+      attempt += 1
+      chunks = [
+          pending[i:i + self._max_batch_size]
+          for i in xrange(0, len(pending), self._max_batch_size)
+      ]
+      chunk_results = yield [
+          self._send_async([calls[i] for i in chunk]) for chunk in chunks]
+      pending = []
+      for chunk, chunk_result in zip(chunks, chunk_results):
+        for i, result in zip(chunk, chunk_result):
+          results[i] = result
+          if is_transient(result.status_code):
+            pending.append(i)
+    raise ndb.Return(results)
+
+  def execute(self):
+    """Blocking version of execute_async."""
+    return self.execute_async().get_result()
+
+  @ndb.tasklet
+  def _send_async(self, calls):
+    """Sends one batch request, returns the list of Result of its calls."""
+    boundary = 'batch_%s' % uuid.uuid4().hex
+    try:
+      content = yield net.request_async(
+          BATCH_URL,
+          method='POST',
+          payload=encode(boundary, calls),
+          headers={
+              'Content-Type': 'multipart/mixed; boundary=%s' % boundary,
+          },
+          scopes=gce.AUTH_SCOPES,
+          deadline=60,
+      )
+    except net.Error as e:
+      # The whole batch failed, report the error for each call.
+      logging.warning('GCE API batch request failed: %s', e)
+      raise ndb.Return([Result(e.status_code, None)] * len(calls))
+    raise ndb.Return(decode(content, len(calls)))
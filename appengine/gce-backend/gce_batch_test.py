@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Unit tests for gce_batch.py."""
+
+import json
+import re
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.ext import ndb
+
+from components import net
+from test_support import test_case
+
+import cleanup
+import gce_batch
+import instances
+import models
+
+
+class FakeGce(object):
+  """In-process fake of the GCE API batch endpoint.
+
+  Serves GET calls for instances kept in memory and records the number of
+  batch requests and calls it receives, so that tests can measure how many
+  HTTP requests an operation takes.
+  """
+
+  def __init__(self, test):
+    # Paths of the existing instances.
+    self.instances = set()
+    # Path -> number of transient errors to return before answering.
+    self.transient = {}
+    # Number of calls in each batch request received.
+    self.batches = []
+    test.mock(gce_batch.net, 'request_async', self.request_async)
+
+  @staticmethod
+  def url(project, zone, name):
+    return (
+        'https://www.googleapis.com/compute/v1/projects/%s/zones/%s/'
+        'instances/%s' % (project, zone, name))
+
+  def add_instance(self, project, zone, name):
+    url = self.url(project, zone, name)
+    self.instances.add(url[len('https://www.googleapis.com'):])
+    return url
+
+  def _call(self, method, path):
+    if self.transient.get(path):
+      self.transient[path] -= 1
+      return 503, {'error': {'code': 503}}
+    if method == 'GET' and path in self.instances:
+      return 200, {'name': path.rsplit('/', 1)[-1]}
+    return 404, {'error': {'code': 404}}
+
+  @ndb.tasklet
+  def request_async(self, url, method='GET', payload=None, headers=None, **_):
+    assert url == gce_batch.BATCH_URL, url
+    assert method == 'POST', method
+    boundary = headers['Content-Type'].split('boundary=', 1)[1]
+    parts = payload.split('--%s' % boundary)[1:-1]
+    self.batches.append(len(parts))
+    response = []
+    for part in parts:
+      part_headers, _, http = part.strip('\r\n').partition('\r\n\r\n')
+      content_id = re.search(r'Content-ID: <(\d+)>', part_headers).group(1)
+      call_method, path, _ = http.split('\r\n', 1)[0].split(' ')
+      status_code, body = self._call(call_method, path)
+      response.append(
+          '--batch_response\r\n'
+          'Content-Type: application/http\r\n'
+          'Content-ID: <response-%s>\r\n'
+          '\r\n'
+          'HTTP/1.1 %d Status\r\n'
+          'Content-Type: application/json; charset=UTF-8\r\n'
+          '\r\n'
+          '%s\r\n' % (content_id, status_code, json.dumps(body)))
+    response.append('--batch_response--\r\n')
+    raise ndb.Return(''.join(response))
+
+
+class EncodeDecodeTest(test_case.TestCase):
+  """Tests for gce_batch.encode and gce_batch.decode."""
+
+  def test_encode(self):
+    """Ensures calls are encoded with their index as Content-ID."""
+    expected = (
+        '--b\r\n'
+        'Content-Type: application/http\r\n'
+        'Content-ID: <0>\r\n'
+        '\r\n'
+        'GET /compute/v1/a HTTP/1.1\r\n'
+        '\r\n'
+        '--b\r\n'
+        'Content-Type: application/http\r\n'
+        'Content-ID: <1>\r\n'
+        '\r\n'
+        'POST /compute/v1/b HTTP/1.1\r\n'
+        'Content-Type: application/json\r\n'
+        '\r\n'
+        '{"x": 1}\r\n'
+        '--b--\r\n'
+    )
+    self.assertEqual(expected, gce_batch.encode('b', [
+        ('GET', '/compute/v1/a', None),
+        ('POST', '/compute/v1/b', {'x': 1}),
+    ]))
+
+  def test_decode(self):
+    """Ensures results are mapped back to calls regardless of their order."""
+    content = (
+        '--batch_abc\n'
+        'Content-Type: application/http\n'
+        'Content-ID: <response-2>\n'
+        '\n'
+        'HTTP/1.1 404 Not Found\n'
+        'Content-Type: application/json\n'
+        '\n'
+        '{"error": {}}\n'
+        '--batch_abc\n'
+        'Content-Type: application/http\n'
+        'Content-ID: <response-0>\n'
+        '\n'
+        'HTTP/1.1 204 No Content\n'
+        '\n'
+        '--batch_abc--\n'
+    )
+    self.assertEqual(
+        [(204, None), (None, None), (404, {'error': {}})],
+        gce_batch.decode(content, 3))
+
+  def test_decode_unexpected(self):
+    """Ensures unexpected responses result in missing results."""
+    self.assertEqual(
+        [(None, None)] * 2, gce_batch.decode('<html></html>', 2))
+
+
+class BatchTest(test_case.TestCase):
+  """Tests for gce_batch.Batch."""
+
+  def test_add_other_project(self):
+    """Ensures calls to another project are rejected."""
+    batch = gce_batch.Batch('project')
+    with self.assertRaises(AssertionError):
+      batch.add(FakeGce.url('other-project', 'zone', 'name'))
+
+  def test_execute(self):
+    """Ensures calls are split in batches and results are in order."""
+    fake = FakeGce(self)
+    batch = gce_batch.Batch('project', max_batch_size=2)
+    urls = [
+        fake.add_instance('project', 'zone', 'instance-1'),
+        FakeGce.url('project', 'zone', 'instance-2'),
+        fake.add_instance('project', 'zone', 'instance-3'),
+    ]
+    self.assertEqual([0, 1, 2], [batch.add(url) for url in urls])
+
+    results = batch.execute()
+
+    self.assertEqual([200, 404, 200], [r.status_code for r in results])
+    self.assertEqual('instance-3', results[2].response['name'])
+    self.assertEqual([2, 1], fake.batches)
+    self.assertEqual(0, len(batch))
+
+  def test_execute_transient(self):
+    """Ensures only the calls failing with transient errors are retried."""
+    fake = FakeGce(self)
+    batch = gce_batch.Batch('project')
+    url = fake.add_instance('project', 'zone', 'instance-1')
+    fake.transient[url[len('https://www.googleapis.com'):]] = 1
+    batch.add(url)
+    batch.add(FakeGce.url('project', 'zone', 'instance-2'))
+
+    results = batch.execute()
+
+    self.assertEqual([200, 404], [r.status_code for r in results])
+    self.assertEqual([2, 1], fake.batches)
+
+  def test_execute_transient_exhausted(self):
+    """Ensures calls are retried a limited number of times."""
+    fake = FakeGce(self)
+    batch = gce_batch.Batch('project', max_attempts=2)
+    url = fake.add_instance('project', 'zone', 'instance-1')
+    fake.transient[url[len('https://www.googleapis.com'):]] = 5
+    batch.add(url)
+
+    self.assertEqual([(503, {'error': {'code': 503}})], batch.execute())
+    self.assertEqual([1, 1], fake.batches)
+
+  def test_execute_error(self):
+    """Ensures a failed batch request fails each of its calls."""
+    @ndb.tasklet
+    def request_async(*_args, **_kwargs):
+      raise net.AuthError('403', 403, '403')
+    self.mock(gce_batch.net, 'request_async', request_async)
+    batch = gce_batch.Batch('project')
+    batch.add(FakeGce.url('project', 'zone', 'instance-1'))
+    batch.add(FakeGce.url('project', 'zone', 'instance-2'))
+
+    self.assertEqual([(403, None), (403, None)], batch.execute())
+
+
+class ThroughputTest(test_case.TestCase):
+  """Measures the number of HTTP requests of batched operations."""
+
+  def test_check_deleted_instances(self):
+    """Ensures deleted instances are checked in one request per 100."""
+    self.mock(cleanup.metrics, 'send_machine_event', lambda *_args: None)
+    fake = FakeGce(self)
+    models.InstanceTemplateRevision(
+        key=instances.get_instance_group_manager_key(
+            instances.get_instance_key(
+                'base-name', 'revision', 'zone', 'instance-name')).parent(),
+        project='project',
+    ).put()
+    keys = []
+    for i in xrange(250):
+      key = instances.get_instance_key(
+          'base-name', 'revision', 'zone', 'instance-%d' % i)
+      if i % 2:
+        url = fake.add_instance('project', 'zone', 'instance-%d' % i)
+      else:
+        url = FakeGce.url('project', 'zone', 'instance-%d' % i)
+      keys.append(models.Instance(
+          key=key,
+          instance_group_manager=instances.get_instance_group_manager_key(key),
+          pending_deletion=True,
+          url=url,
+      ).put())
+
+    cleanup.check_deleted_instances(keys)
+
+    self.assertEqual([100, 100, 50], fake.batches)
+    deleted = [key.get().deleted for key in keys]
+    self.assertEqual([i % 2 == 0 for i in xrange(250)], deleted)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -143,6 +143,14 @@ class InstanceTemplateDeletionHandler(webapp2.RequestHandler):
     instance_templates.schedule_deletion()
 
 
+class InstanceWorkReconciliationHandler(webapp2.RequestHandler):
+  """Worker for reconciling the work pending on instances."""
+
+  @decorators.require_cronjob
+  def get(self):
+    instances.reconcile_work()
+
+
 class MetadataTaskScheduleHandler(webapp2.RequestHandler):
   """Worker for scheduling metadata tasks."""
 
@@ -169,6 +177,8 @@ def create_cron_app():
       ('/internal/cron/fetch-instances', InstanceFetchHandler),
       ('/internal/cron/import-config', ConfigImportHandler),
       ('/internal/cron/process-config', ConfigProcessHandler),
+      ('/internal/cron/reconcile-instance-work',
+       InstanceWorkReconciliationHandler),
       ('/internal/cron/remove-cataloged-instances',
        CatalogedInstanceRemovalHandler),
       ('/internal/cron/resize-instance-groups', InstanceGroupResizeHandler),
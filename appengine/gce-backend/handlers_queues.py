@@ -20,6 +20,25 @@ import instances
 import metadata
 
 
+def _get_instance_keys(request):
+  """Returns the keys of the Instances a task should process.
+
+  Args:
+    request: webapp2.Request with a comma-separated list of URL-safe keys in
+      the 'keys' parameter, or a single URL-safe key in the 'key' parameter.
+
+  Returns:
+    A list of ndb.Keys for models.Instance entities.
+  """
+  keys = [
+      ndb.Key(urlsafe=urlsafe)
+      for urlsafe in (request.get('keys') or request.get('key')).split(',')
+  ]
+  for key in keys:
+    assert key.kind() == 'Instance', key
+  return keys
+
+
 class CatalogedInstanceRemovalHandler(webapp2.RequestHandler):
   """Worker for removing cataloged instances."""
 
@@ -55,14 +74,12 @@ class DeletedInstanceCheckHandler(webapp2.RequestHandler):
 
   @decorators.require_taskqueue('check-deleted-instance')
   def post(self):
-    """Checks whether an instance has been deleted.
+    """Checks whether instances have been deleted.
 
     Params:
-      key: URL-safe key for a models.Instance.
+      keys: Comma-separated URL-safe keys for models.Instances.
     """
-    key = ndb.Key(urlsafe=self.request.get('key'))
-    assert key.kind() == 'Instance', key
-    cleanup.check_deleted_instance(key)
+    cleanup.check_deleted_instances(_get_instance_keys(self.request))
 
 
 class DeletedInstanceCleanupHandler(webapp2.RequestHandler):
@@ -85,14 +102,12 @@ class DrainedInstanceCleanupHandler(webapp2.RequestHandler):
 
   @decorators.require_taskqueue('cleanup-drained-instance')
   def post(self):
-    """Removes a drained instance entity.
+    """Removes drained instance entities.
 
     Params:
-      key: URL-safe key for a models.Instance.
+      keys: Comma-separated URL-safe keys for models.Instances.
     """
-    key = ndb.Key(urlsafe=self.request.get('key'))
-    assert key.kind() == 'Instance', key
-    cleanup.cleanup_drained_instance(key)
+    cleanup.cleanup_drained_instances(_get_instance_keys(self.request))
 
 
 class InstanceCatalogHandler(webapp2.RequestHandler):
@@ -220,14 +235,12 @@ class InstancePendingDeletionDeletionHandler(webapp2.RequestHandler):
 
   @decorators.require_taskqueue('delete-instance-pending-deletion')
   def post(self):
-    """Deletes an instance pending deletion.
+    """Deletes instances pending deletion.
 
     Params:
-      key: URL-safe key for a models.Instance.
+      keys: Comma-separated URL-safe keys for models.Instances.
     """
-    key = ndb.Key(urlsafe=self.request.get('key'))
-    assert key.kind() == 'Instance', key
-    instances.delete_pending(key)
+    instances.delete_pending_instances(_get_instance_keys(self.request))
 
 
 class InstanceTemplateCreationHandler(webapp2.RequestHandler):
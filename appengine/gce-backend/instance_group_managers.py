@@ -276,6 +276,32 @@ def get_drained_instance_group_managers():
   return keys
 
 
+def is_drained(key):
+  """Returns whether the given InstanceGroupManager is drained or not.
+
+  Args:
+    key: ndb.Key for a models.InstanceGroupManager entity.
+  """
+  instance_template_revision = key.parent().get()
+  if not instance_template_revision:
+    logging.warning(
+        'InstanceTemplateRevision does not exist: %s', key.parent())
+    return False
+
+  instance_template = instance_template_revision.key.parent().get()
+  if not instance_template:
+    logging.warning(
+        'InstanceTemplate does not exist: %s',
+        instance_template_revision.key.parent(),
+    )
+    return False
+
+  # Also drained when its InstanceTemplateRevision is drained.
+  return (
+      key in instance_template_revision.drained or
+      instance_template_revision.key in instance_template.drained)
+
+
 def schedule_deletion():
   """Enqueues tasks to delete drained instance group managers."""
   for key in get_drained_instance_group_managers():
@@ -506,6 +506,82 @@ class GetInstanceGroupManagerToDeleteTest(test_case.TestCase):
     )
 
 
+class IsDrainedTest(test_case.TestCase):
+  """Tests for instance_group_managers.is_drained."""
+
+  def test_parent_doesnt_exist(self):
+    """Ensures an entity without parent isn't drained."""
+    key = instance_group_managers.get_instance_group_manager_key(
+        'base-name',
+        'revision',
+        'zone',
+    )
+
+    self.failIf(instance_group_managers.is_drained(key))
+
+  def test_active(self):
+    """Ensures an active entity isn't drained."""
+    key = instance_group_managers.get_instance_group_manager_key(
+        'base-name',
+        'revision',
+        'zone',
+    )
+    models.InstanceTemplateRevision(
+        key=key.parent(),
+        active=[
+            key,
+        ],
+    ).put()
+    models.InstanceTemplate(
+        key=key.parent().parent(),
+        active=key.parent(),
+    ).put()
+
+    self.failIf(instance_group_managers.is_drained(key))
+
+  def test_drained(self):
+    """Ensures a drained entity is drained."""
+    key = instance_group_managers.get_instance_group_manager_key(
+        'base-name',
+        'revision',
+        'zone',
+    )
+    models.InstanceTemplateRevision(
+        key=key.parent(),
+        drained=[
+            key,
+        ],
+    ).put()
+    models.InstanceTemplate(
+        key=key.parent().parent(),
+        active=key.parent(),
+    ).put()
+
+    self.failUnless(instance_group_managers.is_drained(key))
+
+  def test_implicitly_drained(self):
+    """Ensures an entity of a drained parent is drained."""
+    key = instance_group_managers.get_instance_group_manager_key(
+        'base-name',
+        'revision',
+        'zone',
+    )
+    models.InstanceTemplateRevision(
+        key=key.parent(),
+        active=[
+            key,
+        ],
+    ).put()
+    models.InstanceTemplate(
+        key=key.parent().parent(),
+        drained=[
+            key.parent(),
+        ],
+    ).put()
+
+    self.failUnless(instance_group_managers.is_drained(key))
+
+
 class ResizeTest(test_case.TestCase):
   """Tests for instance_group_managers.resize."""
 
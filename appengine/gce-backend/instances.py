@@ -4,6 +4,8 @@
 
 """Utilities for operating on instances."""
 
+import collections
+import datetime
 import json
 import logging
 
@@ -19,6 +21,26 @@ import models
 import utilities
 
 
+# Maximum number of instances to delete in a single task.
+MAX_DELETION_BATCH_SIZE = 100
+
+# Task queues performing the work pending on instances in each state.
+WORK_QUEUES = {
+    models.InstanceWork.CATALOG: ('catalog-instance',),
+    models.InstanceWork.DRAINED: (
+        'remove-cataloged-instance',
+        'cleanup-drained-instance',
+    ),
+    models.InstanceWork.PENDING_DELETION: (
+        'delete-instance-pending-deletion',
+        'check-deleted-instance',
+    ),
+}
+
+# Time work must be pending before cron jobs enqueue tasks for it again.
+WORK_RETRY_DELAY = datetime.timedelta(minutes=1)
+
+
 def get_instance_key(base_name, revision, zone, instance_name):
   """Returns a key for an Instance.
 
@@ -48,24 +70,215 @@ def get_instance_group_manager_key(key):
       *key.id().split()[:-1])
 
 
+def get_work_key(key, state):
+  """Returns a key for the InstanceWork of an Instance in the given state.
+
+  Args:
+    key: ndb.Key for a models.Instance.
+    state: One of models.InstanceWork.STATES.
+
+  Returns:
+    ndb.Key for a models.InstanceWork entity.
+  """
+  return ndb.Key(models.InstanceWork, state, parent=key)
+
+
+def get_work_states(instance, drained):
+  """Returns the states the given instance should have work pending in.
+
+  Args:
+    instance: models.Instance.
+    drained: Whether or not the instance belongs to a drained
+      models.InstanceGroupManager.
+
+  Returns:
+    A set of models.InstanceWork.STATES.
+  """
+  states = set()
+  if instance.deleted:
+    return states
+  if instance.pending_deletion:
+    states.add(models.InstanceWork.PENDING_DELETION)
+  elif not instance.cataloged and not drained:
+    states.add(models.InstanceWork.CATALOG)
+  if drained:
+    states.add(models.InstanceWork.DRAINED)
+  return states
+
+
+def update_work(key, add=(), clear=()):
+  """Updates the work pending on the given instance.
+
+  Must be called in a transaction on the instance, so that the work changes
+  along with the state of the instance.
+
+  Args:
+    key: ndb.Key for a models.Instance entity.
+    add: models.InstanceWork.STATES the instance enters.
+    clear: models.InstanceWork.STATES the instance leaves.
+  """
+  assert ndb.in_transaction()
+  ndb.put_multi([
+      models.InstanceWork(key=get_work_key(key, state), state=state)
+      for state in add
+  ])
+  ndb.delete_multi([get_work_key(key, state) for state in clear])
+
+
+@ndb.tasklet
+def enqueue_work_async(key, states):
+  """Enqueues tasks performing the work pending on the given instance.
+
+  Called once the instance entered the given states, so the work doesn't wait
+  for a cron job. If enqueuing fails, the next cron job enqueues the tasks.
+
+  Args:
+    key: ndb.Key for a models.Instance entity.
+    states: models.InstanceWork.STATES the instance entered.
+  """
+  yield [
+      utilities.enqueue_task_async(queue, key)
+      for state in states
+      for queue in WORK_QUEUES[state]
+  ]
+
+
+def get_pending_work(state):
+  """Returns the instances which have had work pending in the given state.
+
+  Args:
+    state: One of models.InstanceWork.STATES.
+
+  Returns:
+    A sorted list of ndb.Keys for models.Instance entities whose work has been
+    pending for at least WORK_RETRY_DELAY.
+  """
+  cutoff = utils.utcnow() - WORK_RETRY_DELAY
+  return sorted(
+      work.key.parent()
+      for work in models.InstanceWork.query(models.InstanceWork.state == state)
+      if work.created_ts <= cutoff
+  )
+
+
+@ndb.transactional_tasklet
+def _reconcile_work(key, drained):
+  """Updates the work pending on the given instance to match its state.
+
+  Args:
+    key: ndb.Key for a models.Instance entity.
+    drained: Whether or not the instance belongs to a drained
+      models.InstanceGroupManager.
+
+  Returns:
+    A list of models.InstanceWork.STATES the instance entered.
+  """
+  instance = yield key.get_async()
+  if not instance:
+    raise ndb.Return([])
+
+  works = yield ndb.get_multi_async(
+      [get_work_key(key, state) for state in models.InstanceWork.STATES])
+  current = set(work.state for work in works if work)
+  expected = get_work_states(instance, drained)
+  added = sorted(expected - current)
+  if added or current - expected:
+    logging.info(
+        'Updating work pending on Instance: %s\n%s -> %s',
+        key,
+        sorted(current),
+        sorted(expected),
+    )
+  yield ndb.put_multi_async([
+      models.InstanceWork(key=get_work_key(key, state), state=state)
+      for state in added
+  ]) + ndb.delete_multi_async(
+      [get_work_key(key, state) for state in current - expected])
+  raise ndb.Return(added)
+
+
+@ndb.tasklet
+def reconcile_work_async(key, drained):
+  """Updates the work pending on the given instance to match its state.
+
+  Enqueues tasks for the states the instance entered.
+
+  Args:
+    key: ndb.Key for a models.Instance entity.
+    drained: Whether or not the instance belongs to a drained
+      models.InstanceGroupManager.
+  """
+  added = yield _reconcile_work(key, drained)
+  yield enqueue_work_async(key, added)
+
+
+def reconcile_work(max_concurrent=50):
+  """Updates the work pending on every instance to match its state.
+
+  Work is updated with each state transition. This catches up with transitions
+  which didn't update it, e.g. for instances created before work was tracked.
+
+  Args:
+    max_concurrent: Maximum number of instances to update concurrently.
+  """
+  drained = set(instance_group_managers.get_drained_instance_group_managers())
+  states = collections.defaultdict(set)
+  for work in models.InstanceWork.query():
+    states[work.key.parent()].add(work.state)
+
+  outdated = {}
+  for instance in models.Instance.query():
+    is_drained = instance.instance_group_manager in drained
+    if states[instance.key] != get_work_states(instance, is_drained):
+      outdated[instance.key] = is_drained
+
+  utilities.batch_process_async(
+      outdated.keys(),
+      lambda key: reconcile_work_async(key, outdated[key]),
+      max_concurrent=max_concurrent,
+  )
+
+
 @ndb.transactional
-def mark_for_deletion(key):
+def _mark_for_deletion(key):
   """Marks the given instance for deletion.
 
   Args:
     key: ndb.Key for a models.Instance entity.
+
+  Returns:
+    True if the instance was marked for deletion, False otherwise.
   """
   instance = key.get()
   if not instance:
     logging.warning('Instance does not exist: %s', key)
-    return
+    return False
 
-  if not instance.pending_deletion:
-    logging.info('Marking Instance for deletion: %s', key)
-    instance.lease_expiration_ts = None
-    instance.pending_deletion = True
-    instance.put()
-    metrics.send_machine_event('DELETION_PROPOSED', instance.hostname)
+  if instance.pending_deletion:
+    return False
+
+  logging.info('Marking Instance for deletion: %s', key)
+  instance.lease_expiration_ts = None
+  instance.pending_deletion = True
+  instance.put()
+  update_work(
+      key,
+      add=[models.InstanceWork.PENDING_DELETION],
+      clear=[models.InstanceWork.CATALOG],
+  )
+  metrics.send_machine_event('DELETION_PROPOSED', instance.hostname)
+  return True
+
+
+def mark_for_deletion(key):
+  """Marks the given instance for deletion.
+
+  Args:
+    key: ndb.Key for a models.Instance entity.
+  """
+  if _mark_for_deletion(key):
+    enqueue_work_async(
+        key, [models.InstanceWork.PENDING_DELETION]).get_result()
 
 
 @ndb.transactional
@@ -142,7 +355,7 @@ def fetch(key):
 
 
 @ndb.transactional_tasklet
-def _ensure_entity_exists(key, url, instance_group_manager):
+def _ensure_entity_exists(key, url, instance_group_manager, drained=False):
   """Ensures an Instance entity exists.
 
   Args:
@@ -150,6 +363,7 @@ def _ensure_entity_exists(key, url, instance_group_manager):
     url: URL for the instance.
     instance_group_manager: ndb.Key for the models.InstanceGroupManager the
       instance was created from.
+    drained: Whether or not the models.InstanceGroupManager is drained.
 
   Returns:
     True if an entity was written to the datastore, False otherwise.
@@ -160,31 +374,48 @@ def _ensure_entity_exists(key, url, instance_group_manager):
     raise ndb.Return(False)
 
   logging.info('Creating Instance entity: %s', key)
-  yield models.Instance(
+  instance = models.Instance(
       key=key,
       instance_group_manager=instance_group_manager,
       url=url,
-  ).put_async()
+  )
+  yield ndb.put_multi_async([instance] + [
+      models.InstanceWork(key=get_work_key(key, state), state=state)
+      for state in get_work_states(instance, drained)
+  ])
   raise ndb.Return(True)
 
 
 @ndb.tasklet
-def ensure_entity_exists(key, url, instance_group_manager):
+def ensure_entity_exists(key, url, instance_group_manager, drained=False):
   """Ensures an Instance entity exists.
 
+  Also updates the work pending on an existing instance when its
+  models.InstanceGroupManager was drained or reactivated.
+
   Args:
     key: ndb.Key for a models.Instance entity.
     url: URL for the instance.
     instance_group_manager: ndb.Key for the models.InstanceGroupManager the
       instance was created from.
+    drained: Whether or not the models.InstanceGroupManager is drained.
   """
-  instance = yield key.get_async()
+  instance, drained_work = yield (
+      key.get_async(),
+      get_work_key(key, models.InstanceWork.DRAINED).get_async(),
+  )
   if instance:
+    if bool(drained_work) != (drained and not instance.deleted):
+      yield reconcile_work_async(key, drained)
     return
 
-  put = yield _ensure_entity_exists(key, url, instance_group_manager)
+  put = yield _ensure_entity_exists(
+      key, url, instance_group_manager, drained=drained)
   if put:
     metrics.send_machine_event('CREATED', gce.extract_instance_name(url))
+    yield enqueue_work_async(key, [
+        models.InstanceWork.DRAINED if drained else models.InstanceWork.CATALOG,
+    ])
 
 
 def ensure_entities_exist(key, max_concurrent=50):
@@ -209,9 +440,10 @@ def ensure_entities_exist(key, max_concurrent=50):
       for url in urls
   }
 
+  drained = instance_group_managers.is_drained(key)
   utilities.batch_process_async(
       urls,
-      lambda url: ensure_entity_exists(keys[url], url, key),
+      lambda url: ensure_entity_exists(keys[url], url, key, drained=drained),
       max_concurrent=max_concurrent,
   )
 
@@ -244,13 +476,13 @@ def set_deletion_time(key, ts):
   instance.put()
 
 
-def _delete(instance_template_revision, instance_group_manager, instance):
-  """Deletes the given instance.
+def _delete(instance_template_revision, instance_group_manager, instances):
+  """Deletes the given instances.
 
   Args:
     instance_template_revision: models.InstanceTemplateRevision.
     instance_group_manager: models.InstanceGroupManager.
-    instance: models.Instance
+    instances: List of models.Instance in the instance group manager.
   """
   # We don't check if there are any pending deletion calls because we don't
   # care. We just want the instance to be deleted, so we make repeated calls
@@ -263,7 +495,7 @@ def _delete(instance_template_revision, instance_group_manager, instance):
     result = api.delete_instances(
         instance_group_managers.get_name(instance_group_manager),
         instance_group_manager.key.id(),
-        [instance.url],
+        [instance.url for instance in instances],
     )
     if result['status'] != 'DONE':
       # This is not the status of the instance deletion, it's the status of
@@ -276,34 +508,46 @@ def _delete(instance_template_revision, instance_group_manager, instance):
           json.dumps(result, indent=2),
       )
     else:
-      if not instance.deletion_ts:
-        set_deletion_time(instance.key, now)
-        metrics.send_machine_event('DELETION_SCHEDULED', instance.hostname)
+      for instance in instances:
+        if not instance.deletion_ts:
+          set_deletion_time(instance.key, now)
+          metrics.send_machine_event('DELETION_SCHEDULED', instance.hostname)
   except net.Error as e:
     if e.status_code == 400:
-      if not instance.deletion_ts:
-        set_deletion_time(instance.key, now)
+      if len(instances) > 1:
+        # A single instance which is already gone fails the whole call, so
+        # find out which one by deleting them one at a time.
+        for instance in instances:
+          _delete(
+              instance_template_revision, instance_group_manager, [instance])
+        return
+      if not instances[0].deletion_ts:
+        set_deletion_time(instances[0].key, now)
     else:
       raise
 
 
-def delete_pending(key):
-  """Deletes the given instance pending deletion.
+def _get_pending_deletion(key):
+  """Returns the entities needed to delete the given instance.
 
   Args:
     key: ndb.Key for a models.Instance entity.
+
+  Returns:
+    A (models.InstanceTemplateRevision, models.InstanceGroupManager,
+    models.Instance) tuple, or None if the instance can't be deleted.
   """
   instance = key.get()
   if not instance:
-    return
+    return None
 
   if not instance.pending_deletion:
     logging.warning('Instance not pending deletion: %s', key)
-    return
+    return None
 
   if not instance.url:
     logging.warning('Instance URL unspecified: %s', key)
-    return
+    return None
 
   instance_group_manager = instance.instance_group_manager.get()
   if not instance_group_manager:
@@ -311,7 +555,7 @@ def delete_pending(key):
         'InstanceGroupManager does not exist: %s',
         instance.instance_group_manager,
     )
-    return
+    return None
 
   instance_template_revision = instance_group_manager.key.parent().get()
   if not instance_template_revision:
@@ -319,20 +563,77 @@ def delete_pending(key):
         'InstanceTemplateRevision does not exist: %s',
         instance_group_manager.key.parent(),
     )
-    return
+    return None
 
   if not instance_template_revision.project:
     logging.warning(
         'InstanceTemplateRevision project unspecified: %s',
         instance_template_revision.key,
     )
-    return
+    return None
 
-  _delete(instance_template_revision, instance_group_manager, instance)
+  return instance_template_revision, instance_group_manager, instance
+
+
+def delete_pending(key):
+  """Deletes the given instance pending deletion.
+
+  Args:
+    key: ndb.Key for a models.Instance entity.
+  """
+  entities = _get_pending_deletion(key)
+  if entities:
+    instance_template_revision, instance_group_manager, instance = entities
+    _delete(instance_template_revision, instance_group_manager, [instance])
+
+
+def delete_pending_instances(keys):
+  """Deletes the given instances pending deletion.
+
+  Instances in the same instance group manager are deleted with a single GCE
+  API call.
+
+  Args:
+    keys: List of ndb.Keys for models.Instance entities.
+
+  Raises:
+    net.Error: If GCE responds with an error for any instance group manager.
+  """
+  groups = collections.OrderedDict()
+  for key in keys:
+    entities = _get_pending_deletion(key)
+    if entities:
+      instance_template_revision, instance_group_manager, instance = entities
+      groups.setdefault(
+          instance_group_manager.key,
+          (instance_template_revision, instance_group_manager, []),
+      )[2].append(instance)
+
+  error = None
+  for instance_template_revision, instance_group_manager, group in (
+      groups.itervalues()):
+    try:
+      _delete(instance_template_revision, instance_group_manager, group)
+    except net.Error as e:
+      # Don't let one instance group manager prevent deleting the others.
+      logging.warning(
+          'Failed to delete instances from %s: %s',
+          instance_group_manager.key,
+          e,
+      )
+      error = error or e
+  if error:
+    raise error
 
 
 def schedule_pending_deletion():
   """Enqueues tasks to delete instances."""
-  for instance in models.Instance.query():
-    if instance.pending_deletion and not instance.deleted:
-      utilities.enqueue_task('delete-instance-pending-deletion', instance.key)
+  # Tasks are enqueued when instances are marked for deletion, this retries
+  # the deletion of those which aren't deleted yet. Keys of instances in the
+  # same instance group manager sort together, so that each task makes as few
+  # GCE API calls as possible.
+  utilities.enqueue_batch_tasks(
+      'delete-instance-pending-deletion',
+      get_pending_work(models.InstanceWork.PENDING_DELETION),
+      MAX_DELETION_BATCH_SIZE,
+  )
@@ -399,6 +399,98 @@ class DeletePendingTest(test_case.TestCase):
     self.assertRaises(net.Error, instances.delete_pending, key)
 
 
+class DeletePendingInstancesTest(test_case.TestCase):
+  """Tests for instances.delete_pending_instances."""
+
+  def _put_instances(self, zone, count):
+    keys = []
+    for i in xrange(count):
+      key = instances.get_instance_key(
+          'base-name',
+          'revision',
+          zone,
+          'instance-name-%d' % i,
+      )
+      keys.append(models.Instance(
+          key=key,
+          instance_group_manager=instances.get_instance_group_manager_key(key),
+          pending_deletion=True,
+          url='url-%s-%d' % (zone, i),
+      ).put())
+    models.InstanceGroupManager(
+        key=instances.get_instance_group_manager_key(keys[0]),
+    ).put()
+    models.InstanceTemplateRevision(
+        key=instances.get_instance_group_manager_key(keys[0]).parent(),
+        project='project',
+    ).put()
+    return keys
+
+  def test_one_call_per_instance_group_manager(self):
+    """Ensures instances are deleted with one call per group manager."""
+    calls = []
+    def json_request(url, *args, **kwargs):
+      calls.append((url, kwargs['payload']['instances']))
+      return {'status': 'DONE'}
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(instances.net, 'json_request', json_request)
+    self.mock(instances.metrics, 'send_machine_event', send_machine_event)
+    keys = self._put_instances('zone-1', 3) + self._put_instances('zone-2', 2)
+
+    instances.delete_pending_instances(keys)
+
+    self.assertEqual(
+        [
+            ['url-zone-1-0', 'url-zone-1-1', 'url-zone-1-2'],
+            ['url-zone-2-0', 'url-zone-2-1'],
+        ],
+        [urls for _, urls in calls],
+    )
+    self.failUnless(all(key.get().deletion_ts for key in keys))
+
+  def test_already_deleted(self):
+    """Ensures instances are deleted one by one when one is already gone."""
+    calls = []
+    def json_request(url, *args, **kwargs):
+      urls = kwargs['payload']['instances']
+      calls.append(urls)
+      if 'url-zone-0' in urls:
+        raise net.Error('400', 400, '400')
+      return {'status': 'DONE'}
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(instances.net, 'json_request', json_request)
+    self.mock(instances.metrics, 'send_machine_event', send_machine_event)
+    keys = self._put_instances('zone', 2)
+
+    instances.delete_pending_instances(keys)
+
+    self.assertEqual(
+        [['url-zone-0', 'url-zone-1'], ['url-zone-0'], ['url-zone-1']], calls)
+    self.failUnless(all(key.get().deletion_ts for key in keys))
+
+  def test_error_surfaced(self):
+    """Ensures errors are surfaced after all group managers are processed."""
+    calls = []
+    def json_request(url, *args, **kwargs):
+      urls = kwargs['payload']['instances']
+      calls.append(urls)
+      if 'url-zone-1-0' in urls:
+        raise net.Error('403', 403, '403')
+      return {'status': 'DONE'}
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(instances.net, 'json_request', json_request)
+    self.mock(instances.metrics, 'send_machine_event', send_machine_event)
+    keys = self._put_instances('zone-1', 1) + self._put_instances('zone-2', 1)
+
+    self.assertRaises(net.Error, instances.delete_pending_instances, keys)
+    self.assertEqual([['url-zone-1-0'], ['url-zone-2-0']], calls)
+    self.failIf(keys[0].get().deletion_ts)
+    self.failUnless(keys[1].get().deletion_ts)
+
+
 class GetInstanceGroupManagerKeyTest(test_case.TestCase):
   """Tests for instances.get_instance_group_manager_key."""
 
@@ -445,6 +537,65 @@ class EnsureEntityExistsTest(test_case.TestCase):
 
     self.assertEqual(key.get().url, expected_url)
 
+  def test_creates_work(self):
+    """Ensures work is added for a created entity and tasks are enqueued."""
+    enqueued = []
+    @ndb.tasklet
+    def enqueue_task_async(taskqueue, key):
+      enqueued.append(taskqueue)
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(instances.utilities, 'enqueue_task_async', enqueue_task_async)
+    self.mock(instances.metrics, 'send_machine_event', send_machine_event)
+
+    key = instances.get_instance_key(
+        'base-name',
+        'revision',
+        'zone',
+        'instance-name',
+    )
+
+    instances.ensure_entity_exists(
+        key, 'url', instances.get_instance_group_manager_key(key)).wait()
+
+    self.assertEqual(
+        ['catalog'],
+        [work.state for work in models.InstanceWork.query(ancestor=key)],
+    )
+    self.assertEqual(['catalog-instance'], enqueued)
+
+  def test_drained(self):
+    """Ensures work is updated when an existing entity is drained."""
+    enqueued = []
+    @ndb.tasklet
+    def enqueue_task_async(taskqueue, key):
+      enqueued.append(taskqueue)
+    self.mock(instances.utilities, 'enqueue_task_async', enqueue_task_async)
+
+    key = models.Instance(
+        key=instances.get_instance_key(
+            'base-name',
+            'revision',
+            'zone',
+            'instance-name',
+        ),
+        cataloged=True,
+    ).put()
+
+    instances.ensure_entity_exists(
+        key, 'url', instances.get_instance_group_manager_key(key),
+        drained=True).wait()
+    instances.ensure_entity_exists(
+        key, 'url', instances.get_instance_group_manager_key(key),
+        drained=True).wait()
+
+    self.assertEqual(
+        ['drained'],
+        [work.state for work in models.InstanceWork.query(ancestor=key)],
+    )
+    self.assertEqual(
+        ['remove-cataloged-instance', 'cleanup-drained-instance'], enqueued)
+
   def test_entity_exists(self):
     """Ensures nothing happens when the entity already exists."""
     key = models.Instance(
@@ -769,6 +920,162 @@ class MarkForDeletionTest(test_case.TestCase):
     self.failIf(key.get().lease_expiration_ts)
     self.failIf(key.get().leased)
 
+  def test_work(self):
+    """Ensures cataloging work is replaced with deletion work."""
+    enqueued = []
+    @ndb.tasklet
+    def enqueue_task_async(taskqueue, key):
+      enqueued.append(taskqueue)
+    def send_machine_event(*args, **kwargs):
+      pass
+    self.mock(instances.utilities, 'enqueue_task_async', enqueue_task_async)
+    self.mock(instances.metrics, 'send_machine_event', send_machine_event)
+
+    key = models.Instance(
+        key=instances.get_instance_key(
+            'base-name',
+            'revision',
+            'zone',
+            'instance-name',
+        ),
+    ).put()
+    models.InstanceWork(
+        key=instances.get_work_key(key, models.InstanceWork.CATALOG),
+        state=models.InstanceWork.CATALOG,
+    ).put()
+
+    instances.mark_for_deletion(key)
+    instances.mark_for_deletion(key)
+
+    self.assertEqual(
+        ['pending-deletion'],
+        [work.state for work in models.InstanceWork.query(ancestor=key)],
+    )
+    self.assertEqual(
+        ['delete-instance-pending-deletion', 'check-deleted-instance'],
+        enqueued,
+    )
+
+
+class GetWorkStatesTest(test_case.TestCase):
+  """Tests for instances.get_work_states."""
+
+  def test_states(self):
+    self.assertEqual(
+        {models.InstanceWork.CATALOG},
+        instances.get_work_states(models.Instance(), False))
+    self.assertEqual(
+        {models.InstanceWork.DRAINED},
+        instances.get_work_states(models.Instance(), True))
+    self.assertEqual(
+        set(),
+        instances.get_work_states(models.Instance(cataloged=True), False))
+    self.assertEqual(
+        {models.InstanceWork.DRAINED, models.InstanceWork.PENDING_DELETION},
+        instances.get_work_states(
+            models.Instance(cataloged=True, pending_deletion=True), True))
+    self.assertEqual(
+        set(),
+        instances.get_work_states(
+            models.Instance(deleted=True, pending_deletion=True), True))
+
+
+class GetPendingWorkTest(test_case.TestCase):
+  """Tests for instances.get_pending_work."""
+
+  def test_retry_delay(self):
+    """Ensures only work pending for a while is returned."""
+    now = utils.utcnow()
+    keys = []
+    for i, age in enumerate((0, 60, 120)):
+      key = instances.get_instance_key(
+          'base-name',
+          'revision',
+          'zone',
+          'instance-name-%d' % i,
+      )
+      keys.append(key)
+      self.mock_now(now, -age)
+      models.InstanceWork(
+          key=instances.get_work_key(key, models.InstanceWork.CATALOG),
+          state=models.InstanceWork.CATALOG,
+      ).put()
+    self.mock_now(now)
+
+    self.assertEqual(
+        keys[1:], instances.get_pending_work(models.InstanceWork.CATALOG))
+    self.assertEqual(
+        [], instances.get_pending_work(models.InstanceWork.DRAINED))
+
+
+class ReconcileWorkTest(test_case.TestCase):
+  """Tests for instances.reconcile_work."""
+
+  def test_reconciles(self):
+    """Ensures work is added and cleared to match the instances."""
+    enqueued = []
+    @ndb.tasklet
+    def enqueue_task_async(taskqueue, key):
+      enqueued.append((taskqueue, key.id().split()[-1]))
+    self.mock(instances.utilities, 'enqueue_task_async', enqueue_task_async)
+
+    def put_instance(name, **kwargs):
+      key = instances.get_instance_key('base-name', 'revision', 'zone', name)
+      return models.Instance(
+          key=key,
+          instance_group_manager=instances.get_instance_group_manager_key(key),
+          **kwargs
+      ).put()
+    uncataloged = put_instance('uncataloged')
+    cataloged = put_instance('cataloged', cataloged=True)
+    pending_deletion = put_instance(
+        'pending-deletion', cataloged=True, pending_deletion=True)
+    models.InstanceWork(
+        key=instances.get_work_key(cataloged, models.InstanceWork.CATALOG),
+        state=models.InstanceWork.CATALOG,
+    ).put()
+
+    instances.reconcile_work()
+
+    self.assertEqual(
+        [(uncataloged, 'catalog'), (pending_deletion, 'pending-deletion')],
+        sorted(
+            (work.key.parent(), work.state)
+            for work in models.InstanceWork.query()
+        ),
+    )
+    self.assertItemsEqual(
+        [
+            ('catalog-instance', 'uncataloged'),
+            ('delete-instance-pending-deletion', 'pending-deletion'),
+            ('check-deleted-instance', 'pending-deletion'),
+        ],
+        enqueued,
+    )
+
+    # Once the instance group manager is drained.
+    models.InstanceTemplateRevision(
+        key=instances.get_instance_group_manager_key(uncataloged).parent(),
+        drained=[instances.get_instance_group_manager_key(uncataloged)],
+    ).put()
+    del enqueued[:]
+
+    instances.reconcile_work()
+
+    self.assertEqual(
+        [
+            (cataloged, 'drained'),
+            (pending_deletion, 'drained'),
+            (pending_deletion, 'pending-deletion'),
+            (uncataloged, 'drained'),
+        ],
+        sorted(
+            (work.key.parent(), work.state)
+            for work in models.InstanceWork.query()
+        ),
+    )
+    self.assertEqual(6, len(enqueued))
+
 
 class SetDeletionTime(test_case.TestCase):
   """Tests for instances.set_deletion_time."""
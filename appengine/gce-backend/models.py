@@ -77,6 +77,32 @@ class Instance(ndb.Model):
   url = ndb.StringProperty(indexed=False)
 
 
+class InstanceWork(ndb.Model):
+  """Work pending on an Instance in a given state.
+
+  Tasks performing the work are enqueued when the Instance enters the state.
+  The entity is deleted when the Instance leaves the state, so cron jobs only
+  query these entities to retry work instead of scanning every Instance.
+
+  Key:
+    id: State of the Instance, one of STATES.
+    parent: Instance.
+  """
+  # The Instance should be added to the Machine Provider catalog.
+  CATALOG = 'catalog'
+  # The Instance belongs to a drained InstanceGroupManager and should be
+  # removed from the catalog.
+  DRAINED = 'drained'
+  # The Instance should be deleted.
+  PENDING_DELETION = 'pending-deletion'
+  STATES = (CATALOG, DRAINED, PENDING_DELETION)
+
+  # Time the Instance entered this state.
+  created_ts = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+  # State of the Instance, same as the key id.
+  state = ndb.StringProperty(indexed=True)
+
+
 class InstanceGroupManager(ndb.Model):
   """An instance group manager in the config.
 
@@ -44,10 +44,43 @@ def enqueue_task(taskqueue, key):
     taskqueue: Name of the task queue.
     key: ndb.Key to pass as a parameter to the task queue.
   """
-  utils.enqueue_task(
+  enqueue_task_async(taskqueue, key).get_result()
+
+
+def enqueue_task_async(taskqueue, key):
+  """Enqueues a task for the specified task queue to process the given key.
+
+  Args:
+    taskqueue: Name of the task queue.
+    key: ndb.Key to pass as a parameter to the task queue.
+
+  Returns:
+    ndb.Future for whether or not the task was enqueued.
+  """
+  return utils.enqueue_task_async(
       '/internal/queues/%s' % taskqueue,
       taskqueue,
       params={
           'key': key.urlsafe(),
       },
   )
+
+
+def enqueue_batch_tasks(taskqueue, keys, batch_size):
+  """Enqueues tasks for the specified task queue to process the given keys.
+
+  Each task processes up to batch_size keys.
+
+  Args:
+    taskqueue: Name of the task queue.
+    keys: List of ndb.Keys to pass as a parameter to the task queue.
+    batch_size: Maximum number of keys to pass to a single task.
+  """
+  for i in xrange(0, len(keys), batch_size):
+    utils.enqueue_task(
+        '/internal/queues/%s' % taskqueue,
+        taskqueue,
+        params={
+            'keys': ','.join(key.urlsafe() for key in keys[i:i + batch_size]),
+        },
+    )
@@ -4,6 +4,7 @@
 
 """Cron jobs for processing lease requests."""
 
+import collections
 import datetime
 import logging
 import time
@@ -21,6 +22,11 @@ import metrics
 import models
 
 
+# Maximum number of leases committed in a single transaction. Each lease adds
+# two entity groups and one transactional task, which is limited to 5.
+LEASE_BATCH_SIZE = 5
+
+
 class Error(Exception):
   pass
 
@@ -76,21 +82,25 @@ def get_dimension_filters(request):
   return filters
 
 
-@ndb.transactional(xg=True)
-def lease_machine(machine_key, lease):
-  """Attempts to lease the given machine.
+def get_dimension_signature(request):
+  """Returns a string identifying the dimensions requested by a LeaseRequest.
 
-  Args:
-    machine_key: ndb.Key for a model.CatalogMachineEntry instance.
-    lease: model.LeaseRequest instance.
+  LeaseRequests with the same signature can be fulfilled by the same
+  CatalogMachineEntries.
 
-  Returns:
-    True if the machine was leased, otherwise False.
+  Args:
+    request: An rpc_messages.LeaseRequest instance.
   """
-  machine = machine_key.get()
-  lease = lease.key.get()
-  logging.info('Attempting to lease matching CatalogMachineEntry:\n%s', machine)
+  return '\n'.join(
+      '%s=%s' % (dimension.name, value)
+      for dimension, value in (
+          (d, request.dimensions.get_assigned_value(d.name))
+          for d in rpc_messages.Dimensions.all_fields())
+      if value is not None)
 
+
+def _check_lease(machine, lease):
+  """Returns True if the given machine can be leased for the given lease."""
   if not can_fulfill(machine, lease.request):
     logging.warning('CatalogMachineEntry no longer matches:\n%s', machine)
     return False
@@ -100,7 +110,17 @@ def lease_machine(machine_key, lease):
   if lease.response.state != rpc_messages.LeaseRequestState.UNTRIAGED:
     logging.warning('LeaseRequest no longer untriaged:\n%s', lease)
     return False
+  return True
+
+
+def _lease(machine, lease):
+  """Leases the given machine for the given lease.
+
+  Must be called in a transaction, after _check_lease.
 
+  Raises:
+    TaskEnqueuingError: if the fulfill-lease-request task couldn't be enqueued.
+  """
   logging.info('Leasing CatalogMachineEntry:\n%s', machine)
   lease.leased_ts = utils.utcnow()
   if lease.request.lease_expiration_ts:
@@ -119,7 +139,6 @@ def lease_machine(machine_key, lease):
   machine.lease_id = lease.key.id()
   machine.lease_expiration_ts = lease_expiration_ts
   machine.state = models.CatalogMachineEntryStates.LEASED
-  ndb.put_multi([lease, machine])
   params = {
       'policies': protojson.encode_message(machine.policies),
       'request_json': protojson.encode_message(lease.request),
@@ -132,22 +151,119 @@ def lease_machine(machine_key, lease):
       transactional=True,
   ):
     raise TaskEnqueuingError('fulfill-lease-request')
+
+
+@ndb.transactional(xg=True)
+def lease_machine(machine_key, lease):
+  """Attempts to lease the given machine.
+
+  Args:
+    machine_key: ndb.Key for a model.CatalogMachineEntry instance.
+    lease: model.LeaseRequest instance.
+
+  Returns:
+    True if the machine was leased, otherwise False.
+  """
+  machine = machine_key.get()
+  lease = lease.key.get()
+  logging.info('Attempting to lease matching CatalogMachineEntry:\n%s', machine)
+
+  if not _check_lease(machine, lease):
+    return False
+  _lease(machine, lease)
+  ndb.put_multi([lease, machine])
   return True
 
 
+@ndb.transactional(xg=True)
+def lease_machines(pairs):
+  """Attempts to lease several machines in a single transaction.
+
+  Args:
+    pairs: list of (ndb.Key for a model.CatalogMachineEntry instance,
+      model.LeaseRequest instance) to lease. At most LEASE_BATCH_SIZE.
+
+  Returns:
+    List of the model.LeaseRequest instances which were leased.
+  """
+  assert len(pairs) <= LEASE_BATCH_SIZE, len(pairs)
+  entities = ndb.get_multi(
+      [machine_key for machine_key, _ in pairs] +
+      [lease.key for _, lease in pairs])
+  machines = entities[:len(pairs)]
+  leases = entities[len(pairs):]
+  leased = []
+  for machine, lease in zip(machines, leases):
+    if machine and lease and _check_lease(machine, lease):
+      _lease(machine, lease)
+      leased.extend((machine, lease))
+  ndb.put_multi(leased)
+  return leased[1::2]
+
+
+def process_lease_requests():
+  """Fulfills the untriaged LeaseRequests with available machines.
+
+  LeaseRequests are grouped by dimension signature, so the available machines
+  are queried once per signature and leased in batches of LEASE_BATCH_SIZE per
+  transaction, oldest requests first.
+
+  Returns:
+    Number of LeaseRequests fulfilled.
+  """
+  by_signature = collections.defaultdict(list)
+  for lease in models.LeaseRequest.query_untriaged():
+    by_signature[get_dimension_signature(lease.request)].append(lease)
+
+  # Machines already tried in this run. A machine matching several signatures
+  # is only tried once.
+  tried = set()
+  fulfilled = 0
+  for _signature, leases in sorted(by_signature.iteritems()):
+    leases.sort(key=lambda l: l.created_ts)
+    machines = (
+        machine_key for machine_key in
+        models.CatalogMachineEntry.query_available(
+            *get_dimension_filters(leases[0].request))
+        if machine_key not in tried)
+    while leases:
+      # Leases first so that no machine is consumed past the last lease.
+      pairs = [
+        (machine_key, lease)
+        for lease, machine_key in zip(leases[:LEASE_BATCH_SIZE], machines)
+      ]
+      if not pairs:
+        # No more available machines for this signature.
+        break
+      tried.update(machine_key for machine_key, _ in pairs)
+      leased = lease_machines(pairs)
+      now = utils.utcnow()
+      for lease in leased:
+        metrics.lease_requests_fulfilled.increment()
+        metrics.lease_requests_fulfilled_time.add(
+            (now - lease.created_ts).total_seconds())
+      fulfilled += len(leased)
+      # Retry the leases that were not fulfilled with the next machines. Only
+      # the ones still untriaged failed because of their machine, the others
+      # were triaged or deleted in the meantime and are discarded, otherwise
+      # they would be tried against every remaining machine.
+      leased_keys = set(lease.key for lease in leased)
+      failed = ndb.get_multi(
+          [lease.key for _, lease in pairs if lease.key not in leased_keys])
+      leases = [
+        lease for lease in failed
+        if lease and
+        lease.response.state == rpc_messages.LeaseRequestState.UNTRIAGED
+      ] + leases[len(pairs):]
+  return fulfilled
+
+
 class LeaseRequestProcessor(webapp2.RequestHandler):
   """Worker for processing lease requests."""
 
   @decorators.require_cronjob
   def get(self):
-    for lease in models.LeaseRequest.query_untriaged():
-      filters = get_dimension_filters(lease.request)
-      for machine_key in models.CatalogMachineEntry.query_available(*filters):
-        if lease_machine(machine_key, lease):
-          metrics.lease_requests_fulfilled.increment()
-          metrics.lease_requests_fulfilled_time.add(
-              (utils.utcnow() - lease.created_ts).total_seconds())
-          break
+    process_lease_requests()
 
 
 @ndb.transactional(xg=True)
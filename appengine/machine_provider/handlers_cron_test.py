@@ -408,6 +408,178 @@ class LeaseRequestProcessorTest(test_case.TestCase):
     self.assertEqual(key.get().response.lease_expiration_ts, ts)
 
 
+def _gen_lease_request(request_id, os_family):
+  request = rpc_messages.LeaseRequest(
+      dimensions=rpc_messages.Dimensions(os_family=os_family),
+      duration=1,
+      request_id=request_id,
+  )
+  return models.LeaseRequest(
+      deduplication_checksum=
+          models.LeaseRequest.compute_deduplication_checksum(request),
+      key=models.LeaseRequest.generate_key(
+          auth_testing.DEFAULT_MOCKED_IDENTITY.to_bytes(),
+          request,
+      ),
+      owner=auth_testing.DEFAULT_MOCKED_IDENTITY,
+      request=request,
+      response=rpc_messages.LeaseResponse(
+          client_request_id=request_id,
+          state=rpc_messages.LeaseRequestState.UNTRIAGED,
+      ),
+  ).put()
+
+
+def _gen_machine(hostname, os_family):
+  dimensions = rpc_messages.Dimensions(
+      backend=rpc_messages.Backend.DUMMY,
+      hostname=hostname,
+      os_family=os_family,
+  )
+  return models.CatalogMachineEntry(
+      key=models.CatalogMachineEntry.generate_key(dimensions),
+      dimensions=dimensions,
+      policies=rpc_messages.Policies(
+          machine_service_account='fake-service-account',
+      ),
+      state=models.CatalogMachineEntryStates.AVAILABLE,
+  ).put()
+
+
+class GetDimensionSignatureTest(test_case.TestCase):
+  """Tests for handlers_cron.get_dimension_signature."""
+
+  def test_signature(self):
+    request = rpc_messages.LeaseRequest(
+        dimensions=rpc_messages.Dimensions(
+            num_cpus=2,
+            os_family=rpc_messages.OSFamily.LINUX,
+        ),
+    )
+    same = rpc_messages.LeaseRequest(
+        dimensions=rpc_messages.Dimensions(
+            os_family=rpc_messages.OSFamily.LINUX,
+            num_cpus=2,
+        ),
+        duration=10,
+    )
+    other = rpc_messages.LeaseRequest(
+        dimensions=rpc_messages.Dimensions(
+            os_family=rpc_messages.OSFamily.LINUX,
+        ),
+    )
+    self.assertEqual(
+        handlers_cron.get_dimension_signature(request),
+        handlers_cron.get_dimension_signature(same),
+    )
+    self.assertNotEqual(
+        handlers_cron.get_dimension_signature(request),
+        handlers_cron.get_dimension_signature(other),
+    )
+
+
+class LeaseMachinesTest(test_case.TestCase):
+  """Tests for handlers_cron.lease_machines."""
+
+  def test_partial(self):
+    self.mock(utils, 'enqueue_task', lambda *args, **kwargs: True)
+    linux = rpc_messages.OSFamily.LINUX
+    lease_keys = [_gen_lease_request('id-%d' % i, linux) for i in xrange(3)]
+    machine_keys = [_gen_machine('host-%d' % i, linux) for i in xrange(3)]
+    machine = machine_keys[1].get()
+    machine.state = models.CatalogMachineEntryStates.LEASED
+    machine.put()
+
+    leased = handlers_cron.lease_machines(
+        zip(machine_keys, ndb.get_multi(lease_keys)))
+
+    self.assertEqual(
+        [lease_keys[0], lease_keys[2]], [lease.key for lease in leased])
+    self.assertEqual(machine_keys[0].id(), lease_keys[0].get().machine_id)
+    self.assertFalse(lease_keys[1].get().machine_id)
+    self.assertEqual(machine_keys[2].id(), lease_keys[2].get().machine_id)
+
+
+class ProcessLeaseRequestsTest(test_case.TestCase):
+  """Tests for handlers_cron.process_lease_requests."""
+
+  def test_batches(self):
+    self.mock(utils, 'enqueue_task', lambda *args, **kwargs: True)
+    calls = []
+    lease_machines = handlers_cron.lease_machines
+    def mocked_lease_machines(pairs):
+      calls.append(len(pairs))
+      return lease_machines(pairs)
+    self.mock(handlers_cron, 'lease_machines', mocked_lease_machines)
+
+    linux = rpc_messages.OSFamily.LINUX
+    windows = rpc_messages.OSFamily.WINDOWS
+    linux_keys = [_gen_lease_request('l-%d' % i, linux) for i in xrange(7)]
+    windows_keys = [_gen_lease_request('w-%d' % i, windows) for i in xrange(3)]
+    for i in xrange(6):
+      _gen_machine('linux-%d' % i, linux)
+    for i in xrange(2):
+      _gen_machine('windows-%d' % i, windows)
+
+    self.assertEqual(8, handlers_cron.process_lease_requests())
+    self.assertEqual([5, 1, 2], calls)
+    self.assertEqual(
+        6, len([k for k in linux_keys if k.get().machine_id]))
+    self.assertEqual(
+        2, len([k for k in windows_keys if k.get().machine_id]))
+    self.assertEqual(
+        [], list(models.CatalogMachineEntry.query_available()))
+
+  def test_stale_requests(self):
+    self.mock(utils, 'enqueue_task', lambda *args, **kwargs: True)
+    linux = rpc_messages.OSFamily.LINUX
+    lease_keys = [_gen_lease_request('l-%d' % i, linux) for i in xrange(4)]
+    for i in xrange(6):
+      _gen_machine('linux-%d' % i, linux)
+    calls = []
+    lease_machines = handlers_cron.lease_machines
+    def mocked_lease_machines(pairs):
+      if not calls:
+        # Triaged and deleted after the query for untriaged requests.
+        lease = lease_keys[0].get()
+        lease.response.state = rpc_messages.LeaseRequestState.DENIED
+        lease.put()
+        lease_keys[1].delete()
+      calls.append(len(pairs))
+      return lease_machines(pairs)
+    self.mock(handlers_cron, 'lease_machines', mocked_lease_machines)
+
+    self.assertEqual(2, handlers_cron.process_lease_requests())
+    # The stale requests are not retried with the remaining machines.
+    self.assertEqual([4], calls)
+    self.assertEqual(
+        4, len(list(models.CatalogMachineEntry.query_available())))
+    self.assertFalse(lease_keys[0].get().machine_id)
+
+  def test_machine_unavailable(self):
+    self.mock(utils, 'enqueue_task', lambda *args, **kwargs: True)
+    linux = rpc_messages.OSFamily.LINUX
+    lease_keys = [_gen_lease_request('l-%d' % i, linux) for i in xrange(2)]
+    for i in xrange(3):
+      _gen_machine('linux-%d' % i, linux)
+    calls = []
+    lease_machines = handlers_cron.lease_machines
+    def mocked_lease_machines(pairs):
+      if not calls:
+        # Leased after the query for available machines.
+        machine = pairs[0][0].get()
+        machine.state = models.CatalogMachineEntryStates.LEASED
+        machine.put()
+      calls.append(len(pairs))
+      return lease_machines(pairs)
+    self.mock(handlers_cron, 'lease_machines', mocked_lease_machines)
+
+    self.assertEqual(2, handlers_cron.process_lease_requests())
+    # The request is retried with the next machine.
+    self.assertEqual([2, 1], calls)
+    self.assertTrue(all(k.get().machine_id for k in lease_keys))
+
+
 class MachineReclamationProcessorTest(test_case.TestCase):
   """Tests for handlers_cron.MachineReclamationProcessor."""
 
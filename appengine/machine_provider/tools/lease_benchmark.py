@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Replays lease requests against the local datastore stub to compare the
+one-by-one lease processing with the batched one.
+
+The requests are spread over a few dimension signatures and all compete for
+the same pool of machines.
+"""
+
+import logging
+import optparse
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from components import auth
+from components import utils
+from components.machine_provider import rpc_messages
+
+import handlers_cron
+import models
+
+
+_OS_FAMILIES = (
+  rpc_messages.OSFamily.LINUX,
+  rpc_messages.OSFamily.OSX,
+  rpc_messages.OSFamily.WINDOWS,
+)
+
+
+def _populate(nb_requests, nb_machines):
+  """Stores untriaged LeaseRequests and available CatalogMachineEntries."""
+  entities = []
+  for i in xrange(nb_machines):
+    dimensions = rpc_messages.Dimensions(
+        backend=rpc_messages.Backend.DUMMY,
+        hostname='host-%d' % i,
+        num_cpus=(i / len(_OS_FAMILIES)) % 2 + 1,
+        os_family=_OS_FAMILIES[i % len(_OS_FAMILIES)],
+    )
+    entities.append(models.CatalogMachineEntry(
+        key=models.CatalogMachineEntry.generate_key(dimensions),
+        dimensions=dimensions,
+        policies=rpc_messages.Policies(
+            machine_service_account='service-account'),
+        state=models.CatalogMachineEntryStates.AVAILABLE,
+    ))
+  for i in xrange(nb_requests):
+    dimensions = rpc_messages.Dimensions(
+        os_family=_OS_FAMILIES[i % len(_OS_FAMILIES)])
+    if i % 2:
+      dimensions.num_cpus = (i / len(_OS_FAMILIES)) % 2 + 1
+    request = rpc_messages.LeaseRequest(
+        dimensions=dimensions, duration=3600, request_id='request-%d' % i)
+    entities.append(models.LeaseRequest(
+        deduplication_checksum=
+            models.LeaseRequest.compute_deduplication_checksum(request),
+        key=models.LeaseRequest.generate_key('user:bench@example.com', request),
+        owner=auth.Identity.from_bytes('user:bench@example.com'),
+        request=request,
+        response=rpc_messages.LeaseResponse(
+            client_request_id=request.request_id,
+            state=rpc_messages.LeaseRequestState.UNTRIAGED,
+        ),
+    ))
+  ndb.put_multi(entities)
+
+
+def _process_one_by_one():
+  """The lease processing before the batching, one transaction per lease."""
+  fulfilled = 0
+  for lease in models.LeaseRequest.query_untriaged():
+    filters = handlers_cron.get_dimension_filters(lease.request)
+    for machine_key in models.CatalogMachineEntry.query_available(*filters):
+      if handlers_cron.lease_machine(machine_key, lease):
+        fulfilled += 1
+        break
+  return fulfilled
+
+
+def _count_transactions(fn):
+  """Returns the number of transactions started while running fn()."""
+  count = [0]
+  original = ndb.Context.transaction
+  def transaction(self, *args, **kwargs):
+    count[0] += 1
+    return original(self, *args, **kwargs)
+  ndb.Context.transaction = transaction
+  try:
+    return fn(), count[0]
+  finally:
+    ndb.Context.transaction = original
+
+
+def _run(name, fn, nb_requests, nb_machines):
+  bed = testbed.Testbed()
+  bed.activate()
+  try:
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    _populate(nb_requests, nb_machines)
+    ndb.get_context().clear_cache()
+    start = time.time()
+    fulfilled, transactions = _count_transactions(fn)
+    duration = time.time() - start
+    print('%-12s %5d fulfilled %6d transactions %7.2fs' % (
+        name, fulfilled, transactions, duration))
+  finally:
+    bed.deactivate()
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '-r', '--requests', type='int', default=2000,
+      help='Number of lease requests, default: %default')
+  parser.add_option(
+      '-m', '--machines', type='int', default=1000,
+      help='Number of machines in the catalog, default: %default')
+  parser.add_option('-v', '--verbose', action='store_true')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown arguments: %s' % args)
+  logging.basicConfig(
+      level=logging.DEBUG if options.verbose else logging.ERROR)
+
+  # The fulfill-lease-request task is not relevant here.
+  utils.enqueue_task = lambda *_args, **_kwargs: True
+  _run('one-by-one', _process_one_by_one, options.requests, options.machines)
+  _run(
+      'batched', handlers_cron.process_lease_requests, options.requests,
+      options.machines)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -18,8 +18,10 @@ import mapreduce_jobs
 from components import decorators
 from components import datastore_utils
 from components import machine_provider
+from server import bot_code
 from server import bot_management
 from server import config
+from server import counters
 from server import lease_management
 from server import task_pack
 from server import task_queues
@@ -60,6 +62,46 @@ class CronTaskQueues(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class CronUpdateBotArchivesHandler(webapp2.RequestHandler):
+  """Precomputes swarming_bot.zip so bots do not wait on its generation."""
+
+  @decorators.require_cronjob
+  def get(self):
+    bot_code.cron_update_bot_archives()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronCountersFlushHandler(webapp2.RequestHandler):
+  """Applies the pending tasks and bots counters updates."""
+
+  @decorators.require_cronjob
+  def get(self):
+    counters.flush(deadline=utils.time_time() + 50)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronPubSubFlushHandler(webapp2.RequestHandler):
+  """Sends the PubSub notifications about task completion left behind."""
+
+  @decorators.require_cronjob
+  def get(self):
+    task_scheduler.cron_flush_pubsub(deadline=utils.time_time() + 50)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronTasksCountersReconcileHandler(webapp2.RequestHandler):
+  """Repairs the drift of the task counters of the last hours."""
+
+  @decorators.require_cronjob
+  def get(self):
+    counters.reconcile_tasks(3, deadline=utils.time_time() + 9*60)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class CronMachineProviderBotsUtilizationHandler(webapp2.RequestHandler):
   """Determines Machine Provider bot utilization."""
 
@@ -105,17 +147,23 @@ class CronMachineProviderManagementHandler(webapp2.RequestHandler):
 
 
 class CronBotsDimensionAggregationHandler(webapp2.RequestHandler):
-  """Aggregates all bots dimensions (except id) in the fleet."""
+  """Aggregates all bots dimensions (except id) in the fleet.
+
+  Also resets the bot counters, which repairs their drift.
+  """
 
   @decorators.require_cronjob
   def get(self):
     seen = {}
+    bot_counts = {}
     now = utils.utcnow()
     for b in bot_management.BotInfo.query():
       for i in b.dimensions_flat:
         k, v = i.split(':', 1)
         if k != 'id':
           seen.setdefault(k, set()).add(v)
+      for name in counters.bot_counters(b, now):
+        bot_counts[name] = bot_counts.get(name, 0) + 1
     dims = [
       bot_management.DimensionValues(dimension=k, values=sorted(values))
       for k, values in sorted(seen.iteritems())
@@ -126,6 +174,7 @@ class CronBotsDimensionAggregationHandler(webapp2.RequestHandler):
         key=bot_management.DimensionAggregation.KEY,
         dimensions=dims,
         ts=now).put()
+    counters.reset_bot_counters(bot_counts, now)
 
 
 class CronTasksTagsAggregationHandler(webapp2.RequestHandler):
@@ -211,6 +260,16 @@ class TaskSendPubSubMessage(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class TaskFlushPubSubMessages(webapp2.RequestHandler):
+  """Sends the batched PubSub notifications about task completion."""
+
+  @decorators.require_taskqueue('pubsub')
+  def post(self):
+    task_scheduler.task_flush_pubsub()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class TaskMachineProviderManagementHandler(webapp2.RequestHandler):
   """Manages a lease for a Machine Provider bot."""
 
@@ -257,6 +316,10 @@ def get_routes():
     ('/internal/cron/abort_expired_task_to_run',
         CronAbortExpiredShardToRunHandler),
     ('/internal/cron/task_queues_tidy', CronTaskQueues),
+    ('/internal/cron/update_bot_archives', CronUpdateBotArchivesHandler),
+    ('/internal/cron/counters_flush', CronCountersFlushHandler),
+    ('/internal/cron/counters_reconcile', CronTasksCountersReconcileHandler),
+    ('/internal/cron/pubsub_flush', CronPubSubFlushHandler),
 
     ('/internal/cron/aggregate_bots_dimensions',
         CronBotsDimensionAggregationHandler),
@@ -275,6 +338,7 @@ def get_routes():
     ('/internal/taskqueue/cancel-tasks', CancelTasksHandler),
     ('/internal/taskqueue/rebuild-task-cache', TaskDimensionsHandler),
     (r'/internal/taskqueue/pubsub/<task_id:[0-9a-f]+>', TaskSendPubSubMessage),
+    ('/internal/taskqueue/pubsub-flush', TaskFlushPubSubMessages),
     ('/internal/taskqueue/machine-provider-manage',
         TaskMachineProviderManagementHandler),
     (r'/internal/taskqueue/tsmon/<kind:[0-9A-Za-z_]+>', TaskGlobalMetrics),
@@ -201,6 +201,9 @@ class BotCodeHandler(_BotAuthenticatingHandler):
 
   Optionally specify the hash version to download. If so, the returned data is
   cacheable.
+
+  The archive is content addressed so the version is used as the ETag. Support
+  If-None-Match and single byte Range requests.
   """
 
   @auth.public  # auth inside check_bot_code_access()
@@ -208,8 +211,8 @@ class BotCodeHandler(_BotAuthenticatingHandler):
     server = self.get_bot_contact_server()
     self.check_bot_code_access(
         bot_id=self.request.get('bot_id'), generate_token=False)
+    expected, _ = bot_code.get_bot_version(server)
     if version:
-      expected, _ = bot_code.get_bot_version(server)
       if version != expected:
         # This can happen when the server is rapidly updated.
         logging.error('Requested Swarming bot %s, have %s', version, expected)
@@ -217,11 +220,29 @@ class BotCodeHandler(_BotAuthenticatingHandler):
       self.response.headers['Cache-Control'] = 'public, max-age=3600'
     else:
       self.response.headers['Cache-Control'] = 'no-cache, no-store'
+    self.response.headers['ETag'] = '"%s"' % expected
+    if expected in self.request.if_none_match:
+      self.response.status = 304
+      return
+    content = bot_code.get_swarming_bot_zip(server)
     self.response.headers['Content-Type'] = 'application/octet-stream'
     self.response.headers['Content-Disposition'] = (
         'attachment; filename="swarming_bot.zip"')
-    self.response.out.write(
-        bot_code.get_swarming_bot_zip(server))
+    self.response.headers['Accept-Ranges'] = 'bytes'
+    r = self.request.range
+    if_range = self.request.headers.get('If-Range')
+    if r and (not if_range or if_range.strip('"') == expected):
+      offsets = r.range_for_length(len(content))
+      if not offsets:
+        self.response.status = 416
+        self.response.headers['Content-Range'] = 'bytes */%d' % len(content)
+        return
+      start, end = offsets
+      self.response.status = 206
+      self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          start, end - 1, len(content))
+      content = content[start:end]
+    self.response.out.write(content)
 
 
 class _ProcessResult(object):
@@ -1127,6 +1127,20 @@ class BotApiTest(test_env_handlers.AppTestBase):
     with zipfile.ZipFile(StringIO.StringIO(code.body), 'r') as z:
       self.assertEqual(expected, set(z.namelist()))
 
+  def test_bot_code_etag(self):
+    code = self.app.get('/bot_code')
+    etag = code.headers['ETag']
+    self.app.get('/bot_code', headers={'If-None-Match': etag}, status=304)
+
+  def test_bot_code_range(self):
+    code = self.app.get('/bot_code')
+    partial = self.app.get(
+        '/bot_code', headers={'Range': 'bytes=10-'}, status=206)
+    self.assertEqual(code.body[10:], partial.body)
+    self.assertEqual(
+        'bytes 10-%d/%d' % (len(code.body) - 1, len(code.body)),
+        partial.headers['Content-Range'])
+
   def test_bot_code_without_token(self):
     self.set_as_anonymous()
     self.app.get('/bot_code', status=403)
@@ -4,8 +4,11 @@
 
 """This module defines Swarming Server endpoints handlers."""
 
+import base64
 import logging
 import os
+import time
+import zlib
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
@@ -30,6 +33,7 @@ from server import acl
 from server import bot_code
 from server import bot_management
 from server import config
+from server import counters
 from server import task_pack
 from server import task_queues
 from server import task_request
@@ -37,6 +41,20 @@ from server import task_result
 from server import task_scheduler
 
 
+# Maximum number of tasks tasks/wait accepts.
+_MAX_WAIT_TASKS = 1000
+
+# Maximum number of seconds tasks/wait blocks, well within the request
+# deadline.
+_MAX_WAIT_TIMEOUT = 30.
+
+# Initial and maximum number of seconds between two checks for task results
+# changes by tasks/wait. The interval grows by _WAIT_POLL_BACKOFF.
+_WAIT_POLL_INTERVAL = 1.
+_WAIT_MAX_POLL_INTERVAL = 5.
+_WAIT_POLL_BACKOFF = 1.5
+
+
 ### Helper Methods
 
 
@@ -71,6 +89,32 @@ def get_request_and_result(task_id):
     raise endpoints.BadRequestException('%s is an invalid key.' % task_id)
 
 
+def encode_states(states):
+  """Returns the tasks/wait cursor for a list of task states.
+
+  A missing task result has the state 0.
+  """
+  return base64.urlsafe_b64encode(zlib.compress(bytearray(states)))
+
+
+def decode_states(cursor, count):
+  """Returns the list of task states from a tasks/wait cursor.
+
+  Returns a list of None when there is no cursor.
+  """
+  if not cursor:
+    return [None] * count
+  try:
+    states = list(bytearray(zlib.decompress(base64.urlsafe_b64decode(
+        cursor.encode('ascii')))))
+  except (TypeError, UnicodeEncodeError, zlib.error):
+    raise endpoints.BadRequestException('Invalid cursor.')
+  if len(states) != count:
+    raise endpoints.BadRequestException(
+        'Cursor doesn\'t match the number of tasks.')
+  return states
+
+
 def get_or_raise(key):
   """Returns an entity or raises an endpoints exception if it does not exist."""
   result = key.get()
@@ -424,6 +468,92 @@ class SwarmingTasksService(remote.Service):
         ],
         now=now)
 
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      swarming_rpcs.TasksWaitRequest, swarming_rpcs.TasksWaitResponse,
+      http_method='POST')
+  @auth.require(acl.is_bot_or_user)
+  def wait(self, request):
+    """Waits for any of the given tasks to change state.
+
+    Returns as soon as the state of at least one task differs from the one
+    recorded in the cursor, or once the timeout expires. Pass back the returned
+    cursor to wait for the next change. Without cursor, all the tasks are
+    returned right away.
+
+    This replaces polling task/<id>/result and task/<id>/stdout for each task.
+    """
+    logging.debug('%s', request)
+    if not request.task_id:
+      raise endpoints.BadRequestException('task_id is required.')
+    if len(request.task_id) > _MAX_WAIT_TASKS:
+      raise endpoints.BadRequestException(
+          'At most %d tasks can be waited for.' % _MAX_WAIT_TASKS)
+    keys = []
+    for task_id in request.task_id:
+      try:
+        keys.append(task_pack.get_request_and_result_keys(task_id))
+      except ValueError:
+        raise endpoints.BadRequestException('%s is an invalid key.' % task_id)
+    known = decode_states(request.cursor, len(keys))
+
+    # Enforce the ACL once, the requests do not change.
+    is_bot = acl.is_bot()
+    requests = ndb.get_multi(request_key for request_key, _ in keys)
+    for task_id, request_obj in zip(request.task_id, requests):
+      if not request_obj:
+        raise endpoints.NotFoundException('%s not found.' % task_id)
+      if not is_bot and not request_obj.has_access:
+        raise endpoints.ForbiddenException('%s is not accessible.' % task_id)
+
+    result_keys = [result_key for _, result_key in keys]
+    deadline = utils.time_time() + min(
+        max(request.timeout or 0, 0), _MAX_WAIT_TIMEOUT)
+    interval = _WAIT_POLL_INTERVAL
+    # The markers are read before the entities, so a write in between is seen
+    # as a change on the next check.
+    markers = task_result.get_change_markers(result_keys)
+    # Skip the in-context cache, it would return the same entities forever.
+    results = ndb.get_multi(result_keys, use_cache=False)
+    while True:
+      states = [r.state if r else 0 for r in results]
+      changed = [i for i, state in enumerate(states) if state != known[i]]
+      remaining = deadline - utils.time_time()
+      if changed or remaining <= 0:
+        break
+      time.sleep(min(interval, remaining))
+      interval = min(interval * _WAIT_POLL_BACKOFF, _WAIT_MAX_POLL_INTERVAL)
+      # Only fetch the results which change marker was replaced.
+      new_markers = task_result.get_change_markers(result_keys)
+      moved = [
+        i for i, marker in enumerate(new_markers)
+        if marker is None or marker != markers[i]
+      ]
+      markers = new_markers
+      if moved:
+        for i, result in zip(moved, ndb.get_multi(
+            [result_keys[i] for i in moved], use_cache=False)):
+          results[i] = result
+
+    items = []
+    for i in changed:
+      result = results[i]
+      if not result:
+        # A run ID of a task which didn't start yet.
+        continue
+      output = None
+      if (request.include_output and
+          result.state in task_result.State.STATES_NOT_RUNNING):
+        output = result.get_output()
+        if output:
+          output = output.decode('utf-8', 'replace')
+      items.append(swarming_rpcs.TaskResultUpdate(
+          result=message_conversion.task_result_to_rpc(
+              result, request.include_performance_stats),
+          output=output))
+    return swarming_rpcs.TasksWaitResponse(
+        cursor=encode_states(states), items=items, now=utils.utcnow())
+
   @gae_ts_mon.instrument_endpoint()
   @auth.endpoints_method(
       swarming_rpcs.TasksRequest, swarming_rpcs.TaskRequests,
@@ -522,7 +652,12 @@ class SwarmingTasksService(remote.Service):
       return swarming_rpcs.TasksCount(count=count, now=now)
 
     try:
-      count = self._query_from_request(request, 'created_ts').count()
+      count = counters.count_tasks(
+          message_conversion.epoch_to_datetime(request.start),
+          message_conversion.epoch_to_datetime(request.end),
+          request.state.name.lower(), request.tags)
+      if count is None:
+        count = self._query_from_request(request, 'created_ts').count()
       memcache.add(mem_key, count, 24*60*60, namespace='tasks_count')
     except ValueError as e:
       raise endpoints.BadRequestException(
@@ -641,10 +776,14 @@ class SwarmingBotService(remote.Service):
     """
     logging.debug('%s', request)
     bot_key = bot_management.get_info_key(request.bot_id)
-    get_or_raise(bot_key)  # raises 404 if there is no such bot
+    # Fetched in the same datastore batch as the bot.
+    reset_ts_future = counters.get_bots_reset_ts_async()
+    bot = get_or_raise(bot_key)  # raises 404 if there is no such bot
     # TODO(maruel): If the bot was a MP, call lease_management.cleanup_bot()?
     task_queues.cleanup_after_bot(request.bot_id)
     bot_key.delete()
+    counters.enqueue_update(
+        counters.bot_counters(bot, reset_ts_future.get_result()), [])
     return swarming_rpcs.DeletedResponse(deleted=True)
 
   @gae_ts_mon.instrument_endpoint()
@@ -806,6 +945,15 @@ class SwarmingBotsService(remote.Service):
     except ValueError as e:
       raise endpoints.BadRequestException(str(e))
 
+    values = counters.count_bots(request.dimensions)
+    if values is not None:
+      return swarming_rpcs.BotsCount(
+          count=values['count'],
+          quarantined=values['quarantined'],
+          dead=values['dead'],
+          busy=values['busy'],
+          now=now)
+
     f_count = q.count_async()
     f_dead = (bot_management.filter_availability(q, None, True, now, None, None)
         .count_async())
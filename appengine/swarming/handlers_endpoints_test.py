@@ -38,6 +38,7 @@ from server import task_pack
 from server import task_queues
 from server import task_request
 from server import task_result
+from server import task_scheduler
 
 
 def message_to_dict(rpc_message):
@@ -1063,6 +1064,95 @@ class TasksApiTest(BaseTest):
     }
     self.assertEqual(expected, self.call_api('tags', body={}).json)
 
+  def test_wait_no_cursor(self):
+    """Asserts that all the tasks are returned right away without cursor."""
+    _, task_id_1 = self.client_create_task_raw(name='first')
+    _, task_id_2 = self.client_create_task_raw(name='second')
+    self.mock(handlers_endpoints.time, 'sleep', lambda _: self.fail())
+    response = self.call_api(
+        'wait', body={'task_id': [task_id_1, task_id_2]}).json
+    self.assertEqual(
+        [(task_id_1, u'PENDING'), (task_id_2, u'PENDING')],
+        [(i['result']['task_id'], i['result']['state'])
+         for i in response['items']])
+    self.assertEqual(
+        [task_result.State.PENDING] * 2,
+        handlers_endpoints.decode_states(response['cursor'], 2))
+
+  def test_wait_timeout(self):
+    """Asserts that nothing is returned if no task changed."""
+    _, task_id = self.client_create_task_raw()
+    cursor = handlers_endpoints.encode_states([task_result.State.PENDING])
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    sleeps = []
+    def sleep(duration):
+      sleeps.append(duration)
+      now[0] += duration
+    self.mock(handlers_endpoints.time, 'sleep', sleep)
+    fetched = []
+    get_multi = handlers_endpoints.ndb.get_multi
+    def get_multi_mock(keys, **kwargs):
+      keys = list(keys)
+      if kwargs.get('use_cache') is False:
+        fetched.append(len(keys))
+      return get_multi(keys, **kwargs)
+    self.mock(handlers_endpoints.ndb, 'get_multi', get_multi_mock)
+    response = self.call_api(
+        'wait', body={'task_id': [task_id], 'cursor': cursor, 'timeout': 3})
+    self.assertNotIn('items', response.json)
+    self.assertEqual(cursor, response.json['cursor'])
+    # The poll interval backs off and the result is only read once since it
+    # did not change.
+    self.assertEqual([1., 1.5, .5], sleeps)
+    self.assertEqual([1], fetched)
+
+  def test_wait_change(self):
+    """Asserts that the call returns as soon as a task changes state."""
+    _, task_id_1 = self.client_create_task_raw(name='first')
+    _, task_id_2 = self.client_create_task_raw(name='second')
+    cursor = self.call_api(
+        'wait', body={'task_id': [task_id_1, task_id_2]}).json['cursor']
+    def sleep(_duration):
+      request_key, result_key = task_pack.get_request_and_result_keys(
+          task_id_2)
+      task_scheduler.cancel_task(request_key.get(), result_key)
+    self.mock(handlers_endpoints.time, 'sleep', sleep)
+    response = self.call_api(
+        'wait',
+        body={'task_id': [task_id_1, task_id_2], 'cursor': cursor}).json
+    self.assertEqual(
+        [(task_id_2, u'CANCELED')],
+        [(i['result']['task_id'], i['result']['state'])
+         for i in response['items']])
+    self.assertEqual(
+        [task_result.State.PENDING, task_result.State.CANCELED],
+        handlers_endpoints.decode_states(response['cursor'], 2))
+
+  def test_wait_output(self):
+    """Asserts that the output of completed tasks is returned if requested."""
+    self.client_create_task_raw()
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+    self.set_as_user()
+    response = self.call_api(
+        'wait', body={'task_id': [task_id], 'include_output': True}).json
+    self.assertEqual(1, len(response['items']))
+    self.assertEqual(u'COMPLETED', response['items'][0]['result']['state'])
+    self.assertEqual(u'rÉsult string', response['items'][0]['output'])
+
+  def test_wait_bad_request(self):
+    """Asserts that invalid requests are rejected."""
+    _, task_id = self.client_create_task_raw()
+    self.call_api('wait', body={'task_id': []}, status=400)
+    self.call_api('wait', body={'task_id': ['invalid']}, status=400)
+    self.call_api(
+        'wait', body={'task_id': [task_id], 'cursor': 'invalid'}, status=400)
+    cursor = handlers_endpoints.encode_states([task_result.State.PENDING] * 2)
+    self.call_api(
+        'wait', body={'task_id': [task_id], 'cursor': cursor}, status=400)
+    self.call_api('wait', body={'task_id': ['12310']}, status=404)
+
   def _gen_two_tasks(self):
     # first request
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
@@ -1271,11 +1361,9 @@ class TaskApiTest(BaseTest):
     # notification has been sent.
     expected = [
       {
-        'payload': '{"auth_token":null,"task_id":"5cee488008810",'
-                   '"topic":"projects/abc/topics/def","userdata":"blah"}',
+        'countdown': 1,
         'queue_name': 'pubsub',
-        'transactional': True,
-        'url': '/internal/taskqueue/pubsub/5cee488008810',
+        'url': '/internal/taskqueue/pubsub-flush',
       },
     ]
 
@@ -325,6 +325,7 @@ class BackendTest(AppTestBase):
       ('cancel-tasks', '/internal/taskqueue/cancel-tasks', ''),
       ('machine-provider-manage',
        '/internal/taskqueue/machine-provider-manage', ''),
+      ('pubsub', '/internal/taskqueue/pubsub-flush', ''),
       ('pubsub', '/internal/taskqueue/pubsub/', 'abcabcabc'),
       ('rebuild-task-cache', '/internal/taskqueue/rebuild-task-cache', ''),
       ('tsmon', '/internal/taskqueue/tsmon/', 'executors'),
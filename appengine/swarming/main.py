@@ -34,6 +34,7 @@ from server import acl
 # pylint: disable=redefined-outer-name
 def create_application():
   ereporter2.register_formatter()
+  ereporter2.register_error_counter()
   utils.set_task_queue_module('backend')
   template.bootstrap()
 
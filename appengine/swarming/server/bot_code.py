@@ -10,6 +10,7 @@ bot_archive.py.
 
 import ast
 import collections
+import datetime
 import hashlib
 import logging
 import os.path
@@ -29,6 +30,19 @@ from server import config as local_config
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+# Maximum size of a BotArchiveChunk. Stays well below the 1MiB entity limit.
+_CHUNK_SIZE = 900*1024
+
+
+# Hosts that contacted the server for more than this long ago are not
+# precomputed anymore by cron_update_bot_archives().
+_HOST_EXPIRATION = datetime.timedelta(days=7)
+
+
+# BotArchiveVersion.last_seen_ts is refreshed at most this often.
+_HOST_LAST_SEEN_RESOLUTION = datetime.timedelta(days=1)
+
+
 ### Models.
 
 
@@ -68,6 +82,40 @@ class VersionedFile(ndb.Model):
     return ndb.Key(cls.ROOT_MODEL, name)
 
 
+class BotArchiveVersion(ndb.Model):
+  """Bot code version for a (app version, bot_config.py, host) tuple.
+
+  It is immutable besides last_seen_ts. id is the signature as returned by
+  _get_signature().
+  """
+  created_ts = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+  # Last time the version was requested for the host, used to select the hosts
+  # to precompute. Updated at most every _HOST_LAST_SEEN_RESOLUTION.
+  last_seen_ts = ndb.DateTimeProperty()
+  host = ndb.StringProperty(indexed=False)
+  # SHA256 of the bot code, as returned by bot_archive.
+  version = ndb.StringProperty(indexed=False)
+
+
+class BotArchive(ndb.Model):
+  """Content addressed swarming_bot.zip.
+
+  It is immutable. id is the bot version. The content is stored in
+  BotArchiveChunk child entities since it can be larger than an entity.
+  """
+  created_ts = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+  size = ndb.IntegerProperty(indexed=False)
+  chunks = ndb.IntegerProperty(indexed=False)
+
+
+class BotArchiveChunk(ndb.Model):
+  """Part of a swarming_bot.zip.
+
+  Parent is BotArchive. id is the chunk index, starting at 1.
+  """
+  data = ndb.BlobProperty()
+
+
 ### Public APIs.
 
 
@@ -186,47 +234,83 @@ def store_bot_config(host, content):
     raise ValueError('Invalid python')
   # The memcache entry will be cleared out automatically after 60s. Try a best
   # effort.
-  signature = _get_signature(host)
   v = VersionedFile(content=content).store('bot_config.py')
-  memcache.delete('version-' + signature, namespace='bot_code')
+  memcache.delete('version-' + _get_host_signature(host), namespace='bot_code')
+  # Precompute the new archive so the bots updating to it do not have to wait
+  # for the zip to be generated.
+  get_swarming_bot_zip(host)
   return v
 
-def get_bot_version(host):
+
+def get_bot_version(host, seen=True):
   """Retrieves the current bot version (SHA256) loaded on this server.
 
-  The memcache is first checked for the version, otherwise the value
-  is generated and then stored in the memcache.
+  The memcache is first checked for the version, then the datastore, otherwise
+  the value is generated and then stored in both.
+
+  Arguments:
+    host: server URL as seen by the bots.
+    seen: False when not called on behalf of a client of host, so the host is
+        not kept in cron_update_bot_archives() by this call.
 
   Returns:
     tuple(hash of the current bot version, dict of additional files).
   """
-  signature = _get_signature(host)
-  version = memcache.get('version-' + signature, namespace='bot_code')
+  host_signature = _get_host_signature(host)
+  version = memcache.get('version-' + host_signature, namespace='bot_code')
   if version:
     return version, None
 
-  # Need to calculate it.
   additionals = {'config/bot_config.py': get_bot_config().content}
-  bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
-  version = bot_archive.get_swarming_bot_version(
-      bot_dir, host, utils.get_app_version(), additionals,
-      local_config.settings().enable_ts_monitoring)
-  memcache.set('version-' + signature, version, namespace='bot_code', time=60)
+  signature = _get_signature(host, additionals)
+  obj = BotArchiveVersion.get_by_id(signature)
+  now = utils.utcnow()
+  if obj:
+    version = obj.version
+    if seen and (
+        not obj.last_seen_ts or
+        obj.last_seen_ts < now - _HOST_LAST_SEEN_RESOLUTION):
+      obj.last_seen_ts = now
+      obj.put()
+  else:
+    # Need to calculate it.
+    bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
+    version = bot_archive.get_swarming_bot_version(
+        bot_dir, host, utils.get_app_version(), additionals,
+        local_config.settings().enable_ts_monitoring)
+    BotArchiveVersion(
+        id=signature, host=host, version=version,
+        last_seen_ts=now if seen else None).put()
+  memcache.set(
+      'version-' + host_signature, version, namespace='bot_code', time=60)
   return version, additionals
 
 
-def get_swarming_bot_zip(host):
+def get_swarming_bot_zip(host, seen=True):
   """Returns a zipped file of all the files a bot needs to run.
 
+  The archive is looked up in memcache, then in the datastore, and only built
+  if missing from both.
+
+  Arguments:
+    host: server URL as seen by the bots.
+    seen: see get_bot_version().
+
   Returns:
     A string representing the zipped file's contents.
   """
-  version, additionals = get_bot_version(host)
+  version, additionals = get_bot_version(host, seen)
   content = memcache.get('code-' + version, namespace='bot_code')
   if content:
     logging.debug('memcached bot code %s; %d bytes', version, len(content))
     return content
 
+  content = _fetch_archive(version)
+  if content is not None:
+    logging.debug('stored bot code %s; %d bytes', version, len(content))
+    memcache.set('code-' + version, content, namespace='bot_code')
+    return content
+
   # Get the start bot script from the database, if present. Pass an empty
   # file if the files isn't present.
   additionals = additionals or {
@@ -236,12 +320,31 @@ def get_swarming_bot_zip(host):
   content, version = bot_archive.get_swarming_bot_zip(
       bot_dir, host, utils.get_app_version(), additionals,
       local_config.settings().enable_ts_monitoring)
+  _store_archive(version, content)
   # This is immutable so not no need to set expiration time.
   memcache.set('code-' + version, content, namespace='bot_code')
   logging.info('generated bot code %s; %d bytes', version, len(content))
   return content
 
 
+def cron_update_bot_archives():
+  """Precomputes swarming_bot.zip for all the hosts recently seen.
+
+  This is called after a deployment or a bot_config.py change so that the
+  archive is ready before the bots ask for it.
+
+  Returns:
+    Number of hosts processed.
+  """
+  cutoff = utils.utcnow() - _HOST_EXPIRATION
+  q = BotArchiveVersion.query(BotArchiveVersion.last_seen_ts > cutoff)
+  hosts = sorted(set(v.host for v in q if v.host))
+  for host in hosts:
+    get_swarming_bot_zip(host, seen=False)
+  logging.info('Updated bot archives for %d hosts', len(hosts))
+  return len(hosts)
+
+
 ### Bootstrap token.
 
 
@@ -299,9 +402,58 @@ def _validate_python(content):
   return True
 
 
-def _get_signature(host):
-  # CURRENT_VERSION_ID is unique per appcfg.py upload so it can be trusted.
-  return hashlib.sha256(host + os.environ['CURRENT_VERSION_ID']).hexdigest()
+def _get_host_signature(host):
+  # Use the major version only; the minor part of CURRENT_VERSION_ID differs
+  # between the modules, so the versions precomputed by the cron job on the
+  # backend module would never be looked up by the default module.
+  major = os.environ['CURRENT_VERSION_ID'].split('.', 1)[0]
+  return hashlib.sha256(host + major).hexdigest()
+
+
+def _get_signature(host, additionals):
+  """Returns the key of the BotArchiveVersion for this host and config."""
+  h = hashlib.sha256()
+  h.update(_get_host_signature(host))
+  for name, content in sorted(additionals.iteritems()):
+    h.update(name)
+    h.update(hashlib.sha256(content).hexdigest())
+  return h.hexdigest()
+
+
+def _fetch_archive(version):
+  """Returns the swarming_bot.zip content stored in the datastore or None."""
+  archive = BotArchive.get_by_id(version)
+  if not archive:
+    return None
+  chunks = ndb.get_multi(
+      ndb.Key(BotArchiveChunk, i, parent=archive.key)
+      for i in xrange(1, archive.chunks + 1))
+  if not all(chunks):
+    logging.error('Bot archive %s is missing chunks', version)
+    return None
+  content = ''.join(c.data for c in chunks)
+  if len(content) != archive.size:
+    logging.error(
+        'Bot archive %s has invalid size %d != %d',
+        version, len(content), archive.size)
+    return None
+  return content
+
+
+def _store_archive(version, content):
+  """Stores the swarming_bot.zip content in the datastore.
+
+  The archive entity is stored last so a partially stored archive is never
+  returned by _fetch_archive().
+  """
+  key = ndb.Key(BotArchive, version)
+  chunks = [
+    BotArchiveChunk(
+        id=i+1, parent=key, data=content[o:o+_CHUNK_SIZE])
+    for i, o in enumerate(xrange(0, len(content), _CHUNK_SIZE))
+  ]
+  ndb.put_multi(chunks)
+  BotArchive(key=key, size=len(content), chunks=len(chunks)).put()
 
 
 ## Config validators
@@ -4,6 +4,7 @@
 # that can be found in the LICENSE file.
 
 import StringIO
+import datetime
 import logging
 import os
 import re
@@ -120,6 +121,47 @@ class BotManagementTest(test_case.TestCase):
     finally:
       file_path.rmtree(temp_dir)
 
+  def test_get_swarming_bot_zip_stored(self):
+    zipped_code = bot_code.get_swarming_bot_zip('http://localhost')
+    version, _ = bot_code.get_bot_version('http://localhost')
+    self.assertEqual(1, bot_code.BotArchive.query().count())
+    self.assertEqual(1, bot_code.BotArchiveVersion.query().count())
+    # Simulate memcache eviction. The archive is not regenerated.
+    bot_code.memcache.flush_all()
+    self.mock(
+        bot_code.bot_archive, 'get_swarming_bot_zip',
+        lambda *_: self.fail('regenerated'))
+    self.mock(
+        bot_code.bot_archive, 'get_swarming_bot_version',
+        lambda *_: self.fail('recalculated'))
+    self.assertEqual(version, bot_code.get_bot_version('http://localhost')[0])
+    self.assertEqual(
+        zipped_code, bot_code.get_swarming_bot_zip('http://localhost'))
+
+  def test_store_archive_chunks(self):
+    self.mock(bot_code, '_CHUNK_SIZE', 3)
+    bot_code._store_archive('v1', 'abcdefgh')
+    self.assertEqual(3, bot_code.BotArchiveChunk.query().count())
+    self.assertEqual('abcdefgh', bot_code._fetch_archive('v1'))
+    self.assertEqual(None, bot_code._fetch_archive('v2'))
+
+  def test_cron_update_bot_archives(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    bot_code.get_bot_version('http://localhost')
+    bot_code.get_bot_version('http://localhost:8080')
+    self.assertEqual(2, bot_code.cron_update_bot_archives())
+    self.assertEqual(2, bot_code.BotArchive.query().count())
+
+    # Only the first host keeps asking for the same version. The cron job does
+    # not keep the second one alive.
+    for day in xrange(1, 9):
+      self.mock_now(now, day * 24 * 60 * 60)
+      bot_code.memcache.flush_all()
+      bot_code.get_bot_version('http://localhost')
+      bot_code.cron_update_bot_archives()
+    self.assertEqual(1, bot_code.cron_update_bot_archives())
+
   def test_bootstrap_token(self):
     tok = bot_code.generate_bootstrap_token()
     self.assertEqual(
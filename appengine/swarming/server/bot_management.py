@@ -66,6 +66,7 @@ from google.appengine.ext import ndb
 from components import datastore_utils
 from components import utils
 from server import config
+from server import counters
 from server import task_pack
 
 
@@ -392,7 +393,13 @@ def bot_event(
 
   # Retrieve the previous BotInfo and update it.
   info_key = get_info_key(bot_id)
-  bot_info = info_key.get()
+  bot_info_future = info_key.get_async()
+  reset_ts_future = counters.get_bots_reset_ts_async()
+  bot_info = bot_info_future.get_result()
+  # A bot coming back after being counted as dead by the last counters reset
+  # must be removed from the 'dead' counters.
+  orig_counters = counters.bot_counters(
+      bot_info, reset_ts_future.get_result())
   if not bot_info:
     bot_info = BotInfo(key=info_key)
   bot_info.last_seen_ts = utils.utcnow()
@@ -423,6 +430,7 @@ def bot_event(
     # keep first_seen_ts. It's not necessary to use a transaction here since no
     # BotEvent is being added, only last_seen_ts is really updated.
     bot_info.put()
+    counters.enqueue_update(orig_counters, counters.bot_counters(bot_info))
     return
 
   event = BotEvent(
@@ -442,6 +450,10 @@ def bot_event(
     bot_info.task_id = ''
 
   datastore_utils.store_new_version(event, BotRoot, [bot_info])
+  # The transaction is managed by store_new_version() so the counters are
+  # updated right after. A failure here is fixed by the next
+  # counters.reset_bot_counters().
+  counters.enqueue_update(orig_counters, counters.bot_counters(bot_info))
 
 
 def get_bot_reboot_period(bot_id, state):
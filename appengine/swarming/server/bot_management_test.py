@@ -17,6 +17,7 @@ from google.appengine.ext import ndb
 from test_support import test_case
 
 from server import bot_management
+from server import counters
 
 
 _VERSION = hashlib.sha256().hexdigest()
@@ -67,6 +68,45 @@ class BotManagementTest(test_case.TestCase):
     self.assertEqual(
         expected, bot_management.get_info_key('id1').get().to_dict())
 
+  def test_bot_event_dead_bot_counters(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    kwargs = {
+      'event_type': 'request_sleep',
+      'bot_id': 'id1',
+      'external_ip': '8.8.4.4',
+      'authenticated_as': 'bot:id1.domain',
+      'dimensions': {'id': ['id1']},
+      'state': {},
+      'version': _VERSION,
+      'quarantined': False,
+      'task_id': None,
+      'task_name': None,
+      'machine_type': 'mt',
+    }
+    bot_management.bot_event(**kwargs)
+    counters.flush()
+
+    # The bot is counted as dead by the reset.
+    later = now + datetime.timedelta(days=1)
+    self.mock_now(later)
+    bot = bot_management.get_info_key('id1').get()
+    counters.reset_bot_counters(
+        dict((n, 1) for n in counters.bot_counters(bot, later)), later)
+    self.assertEqual(
+        {'busy': 0, 'count': 1, 'dead': 1, 'quarantined': 0},
+        counters.count_bots([]))
+    self.assertEqual({'mt': (0, 0)}, counters.count_machine_types(['mt']))
+
+    # Then comes back.
+    self.mock_now(later, 1)
+    bot_management.bot_event(**kwargs)
+    counters.flush()
+    self.assertEqual(
+        {'busy': 0, 'count': 1, 'dead': 0, 'quarantined': 0},
+        counters.count_bots([]))
+    self.assertEqual({'mt': (0, 1)}, counters.count_machine_types(['mt']))
+
   def test_get_events_query(self):
     now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
     self.mock_now(now)
@@ -0,0 +1,555 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Pre-aggregated counters to answer tasks/count and bots/count in constant
+time.
+
+    +-------------------------+
+    |CounterShard             |
+    |id=<shard>:<counter name>|
+    +-------------------------+
+
+Counter names are:
+- 'tasks:h:<YYYYMMDDHH>:<state>:<tag>' and 'tasks:d:<YYYYMMDD>:<state>:<tag>'
+  for the tasks created in this hour or day, in the state as accepted by
+  task_result.get_result_summaries_query(). <tag> is empty for all tasks,
+  otherwise only the tags with a key in TAG_KEYS are counted.
+- 'bots:<field>:<dimension>' where field is one of 'busy', 'count', 'dead' or
+  'quarantined'. <dimension> is empty for all bots. The 'id' dimension is not
+  counted.
+- 'bots:mp_busy:<machine type>' and 'bots:mp_idle:<machine type>' for the
+  Machine Provider bots that are neither quarantined nor dead, used by
+  lease_management.compute_utilization().
+
+The state transitions of TaskResultSummary and BotInfo are converted to counter
+deltas by enqueue_update(), as pull tasks added along the entity update.
+flush() regularly applies them to a random CounterShard of each counter, so
+there is no write contention on the counters.
+
+The counters drift if a flush is interrupted. reconcile_tasks() and
+reset_bot_counters() rewrite them from the source entities and record the time
+of the reset in the shards; the deltas enqueued before it are already accounted
+for and are dropped by flush(). The 'dead' bot counters are only updated by
+reset_bot_counters() since bots do not tell when they die.
+"""
+
+import datetime
+import json
+import logging
+import random
+import time
+
+from google.appengine import runtime
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from components import utils
+from server import task_result
+
+
+# Pull queue where the counter deltas are enqueued.
+_QUEUE = 'counters-pull'
+
+
+# Number of CounterShard per counter.
+_SHARDS = 4
+
+
+# Maximum number of pull tasks aggregated together by flush().
+_FLUSH_BATCH_SIZE = 1000
+
+
+_HOUR = datetime.timedelta(hours=1)
+_DAY = datetime.timedelta(days=1)
+
+
+# Names of the states a task is counted in, besides the ones derived from the
+# COMPLETED state.
+_STATE_NAMES = {
+  task_result.State.RUNNING: ('running', 'pending_running'),
+  task_result.State.PENDING: ('pending', 'pending_running'),
+  task_result.State.EXPIRED: ('expired',),
+  task_result.State.TIMED_OUT: ('timed_out',),
+  task_result.State.BOT_DIED: ('bot_died',),
+  task_result.State.CANCELED: ('canceled',),
+}
+
+
+BOT_FIELDS = ('busy', 'count', 'dead', 'quarantined')
+
+
+# Keys of the tags the tasks are counted by. They have a bounded number of
+# values; other tags, like build numbers, are often unique per task and would
+# create counters never shared by two tasks. tasks/count falls back to a query
+# for them.
+TAG_KEYS = frozenset(('os', 'pool'))
+
+
+### Models.
+
+
+class CounterShard(ndb.Model):
+  """Partial value of a counter.
+
+  Key id is '<shard>:<counter name>'.
+  """
+  # The counter name without the state and tag or dimension, e.g.
+  # 'tasks:h:2017010203' or 'bots', used to list the counters to reconcile.
+  group = ndb.StringProperty()
+  value = ndb.IntegerProperty(default=0, indexed=False)
+  # Last time the counter was overwritten by _set_values(). Deltas enqueued
+  # before are not applied.
+  reset_ts = ndb.DateTimeProperty(indexed=False)
+
+
+class CountersInfo(ndb.Model):
+  """Tells since when the counters can be trusted."""
+  # Creation time of the first tasks tracked by the task counters. Earlier task
+  # counters may be missing the creation of the tasks.
+  tasks_since = ndb.DateTimeProperty(indexed=False)
+  # Last time the bot counters were reset by reset_bot_counters().
+  bots_ts = ndb.DateTimeProperty(indexed=False)
+
+  # We only store one of these entities. Use this key to refer to any instance.
+  KEY = ndb.Key('CountersInfo', 'info')
+
+
+### Private stuff.
+
+
+def _floor_hour(ts):
+  return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil_hour(ts):
+  out = _floor_hour(ts)
+  return out if out == ts else out + _HOUR
+
+
+def _hour_group(ts):
+  return ts.strftime('tasks:h:%Y%m%d%H')
+
+
+def _day_group(ts):
+  return ts.strftime('tasks:d:%Y%m%d')
+
+
+def _group(name):
+  """Returns the CounterShard.group of a counter."""
+  parts = name.split(':', 3)
+  if parts[0] == 'tasks':
+    return ':'.join(parts[:3])
+  return parts[0]
+
+
+def _shard_key(name, shard):
+  return ndb.Key(CounterShard, '%d:%s' % (shard, name))
+
+
+def _get_values(names):
+  """Returns the sum of the shards of each counter."""
+  names = list(names)
+  shards = ndb.get_multi(
+      _shard_key(n, i) for n in names for i in xrange(_SHARDS))
+  return {
+    n: sum(s.value for s in shards[i*_SHARDS:(i+1)*_SHARDS] if s)
+    for i, n in enumerate(names)
+  }
+
+
+def _get_group_values(group):
+  """Returns the value of all the counters in a group."""
+  out = {}
+  for shard in CounterShard.query(CounterShard.group == group):
+    name = shard.key.string_id().split(':', 1)[1]
+    out[name] = out.get(name, 0) + shard.value
+  return out
+
+
+def _set_values(values, group, reset_ts):
+  """Overwrites the counters in group with values.
+
+  Counters in the group not in values are reset to 0. Only the counters with a
+  different value are written to; all their shards are written so the deltas
+  enqueued before reset_ts are not applied anymore, even by a flush() in
+  progress.
+
+  Returns:
+    Number of counters updated.
+  """
+  current = _get_group_values(group)
+  changed = 0
+  to_put = []
+  for name in set(current) | set(values):
+    value = values.get(name, 0)
+    if current.get(name, 0) == value:
+      continue
+    changed += 1
+    to_put.extend(
+        CounterShard(
+            key=_shard_key(name, i), group=_group(name),
+            value=0 if i else value, reset_ts=reset_ts)
+        for i in xrange(_SHARDS))
+  futures = ndb.put_multi_async(to_put)
+  ndb.Future.wait_all(futures)
+  for f in futures:
+    f.check_success()
+  return changed
+
+
+@ndb.tasklet
+def _add_async(name, deltas):
+  """Adds deltas to a random shard of the counter.
+
+  Arguments:
+    name: counter name.
+    deltas: list of (enqueue time, delta). The deltas enqueued before the last
+        reset of the counter are skipped.
+  """
+  key = _shard_key(name, random.randint(0, _SHARDS - 1))
+  @ndb.tasklet
+  def run():
+    shard = yield key.get_async()
+    if not shard:
+      shard = CounterShard(key=key, group=_group(name))
+    delta = sum(
+        d for ts, d in deltas if not shard.reset_ts or ts >= shard.reset_ts)
+    if delta:
+      shard.value += delta
+      yield shard.put_async()
+  yield ndb.transaction_async(run)
+
+
+def _task_bucket_names(start, end):
+  """Returns the counter name prefixes to sum to cover [start, end).
+
+  start and end must be rounded to the hour. Whole days use the day counter.
+  """
+  out = []
+  ts = start
+  while ts < end:
+    if ts.hour == 0 and ts + _DAY <= end:
+      out.append(_day_group(ts))
+      ts += _DAY
+    else:
+      out.append(_hour_group(ts))
+      ts += _HOUR
+  return out
+
+
+def _is_counted_tag(tag):
+  return tag.split(':', 1)[0] in TAG_KEYS
+
+
+def _count_query_async(start, end, state, tags):
+  """Counts the tasks created in [start, end) with a datastore query."""
+  if start >= end:
+    f = ndb.Future()
+    f.set_result(0)
+    return f
+  # get_result_summaries_query() is inclusive on both ends.
+  return task_result.get_result_summaries_query(
+      start, end - datetime.timedelta(milliseconds=1), 'created_ts', state,
+      tags).count_async()
+
+
+### Public API.
+
+
+def task_counters(result_summary):
+  """Returns the counters a TaskResultSummary is counted in.
+
+  Returns an empty list if result_summary is None, e.g. a new task. Only the
+  tags with a key in TAG_KEYS are counted.
+  """
+  if not result_summary:
+    return []
+  state = result_summary.state
+  states = ['all']
+  if state == task_result.State.COMPLETED:
+    states.append('completed')
+    states.append(
+        'completed_failure' if result_summary.failure else 'completed_success')
+    if result_summary.try_number == 0:
+      states.append('deduped')
+  else:
+    states.extend(_STATE_NAMES[state])
+  tags = [''] + sorted(
+      t for t in set(result_summary.tags) if _is_counted_tag(t))
+  created_ts = result_summary.created_ts
+  return [
+    '%s:%s:%s' % (group, s, t)
+    for group in (_hour_group(created_ts), _day_group(created_ts))
+    for s in states
+    for t in tags
+  ]
+
+
+def bot_counters(bot_info, now=None):
+  """Returns the counters a BotInfo is counted in.
+
+  Returns an empty list if bot_info is None, e.g. a new or deleted bot. The
+  'dead' counters are only included when now is specified.
+  """
+  if not bot_info:
+    return []
+  fields = ['count']
+  if bot_info.task_id:
+    fields.append('busy')
+  if bot_info.quarantined:
+    fields.append('quarantined')
+  dead = bool(now and bot_info.is_dead(now))
+  if dead:
+    fields.append('dead')
+  dimensions = [''] + [
+    d for d in sorted(set(bot_info.dimensions_flat))
+    if not d.startswith('id:')
+  ]
+  out = ['bots:%s:%s' % (f, d) for f in fields for d in dimensions]
+  if bot_info.machine_type and not bot_info.quarantined and not dead:
+    out.append('bots:%s:%s' % (
+        'mp_busy' if bot_info.task_id else 'mp_idle', bot_info.machine_type))
+  return out
+
+
+@ndb.tasklet
+def get_bots_reset_ts_async():
+  """Returns a future to the time of the last reset_bot_counters() or None.
+
+  A BotInfo not updated since then is counted in
+  bot_counters(bot_info, <reset ts>), including the 'dead' counters. Started
+  along the BotInfo get, both are fetched in the same datastore batch.
+  """
+  info = yield CountersInfo.KEY.get_async()
+  raise ndb.Return(info.bots_ts if info else None)
+
+
+def enqueue_update(before, after, transactional=False):
+  """Enqueues the counter deltas when an entity counted in |before| becomes
+  counted in |after|.
+
+  Arguments:
+    before: list of counters returned by task_counters() or bot_counters()
+        before the update.
+    after: list of counters after the update.
+    transactional: True to enqueue the deltas as part of the transaction.
+
+  Returns:
+    True if the deltas were enqueued or there was nothing to update.
+  """
+  deltas = {}
+  for name in before:
+    deltas[name] = deltas.get(name, 0) - 1
+  for name in after:
+    deltas[name] = deltas.get(name, 0) + 1
+  deltas = {k: v for k, v in deltas.iteritems() if v}
+  if not deltas:
+    return True
+  payload = {
+    'deltas': deltas,
+    'ts': utils.datetime_to_timestamp(utils.utcnow()),
+  }
+  task = taskqueue.Task(method='PULL', payload=utils.encode_to_json(payload))
+  try:
+    taskqueue.Queue(_QUEUE).add(task, transactional=transactional)
+    return True
+  except (
+      taskqueue.Error,
+      runtime.DeadlineExceededError,
+      runtime.apiproxy_errors.CancelledError,
+      runtime.apiproxy_errors.DeadlineExceededError,
+      runtime.apiproxy_errors.OverQuotaError) as e:
+    logging.warning(
+        'Problem adding counters update (%s): %s', e.__class__.__name__, e)
+    return False
+
+
+def flush(lease_seconds=60, deadline=None):
+  """Applies the deltas enqueued by enqueue_update() to the counters.
+
+  Arguments:
+    lease_seconds: lease duration, effectively the delay before a retry.
+    deadline: optional time.time() value after which no new batch is leased.
+
+  Returns:
+    Number of deltas applied.
+  """
+  info = CountersInfo.KEY.get()
+  if not info or not info.tasks_since:
+    # Tasks created before now were not counted when created.
+    info = info or CountersInfo(key=CountersInfo.KEY)
+    info.tasks_since = _ceil_hour(utils.utcnow())
+    info.put()
+
+  queue = taskqueue.Queue(_QUEUE)
+  flushed = 0
+  while not deadline or time.time() < deadline:
+    tasks = queue.lease_tasks(lease_seconds, _FLUSH_BATCH_SIZE)
+    if not tasks:
+      break
+    # name -> [(enqueue time, delta)]
+    deltas = {}
+    for task in tasks:
+      payload = json.loads(task.payload)
+      ts = utils.timestamp_to_datetime(payload['ts'])
+      for name, delta in payload['deltas'].iteritems():
+        deltas.setdefault(name, []).append((ts, delta))
+    futures = [_add_async(n, d) for n, d in deltas.iteritems()]
+    ndb.Future.wait_all(futures)
+    # Raises if any failed. The tasks are retried once their lease expire, which
+    # may count some deltas twice until the next reconciliation.
+    for f in futures:
+      f.check_success()
+    queue.delete_tasks(tasks)
+    flushed += len(tasks)
+  return flushed
+
+
+def count_tasks(start, end, state, tags):
+  """Counts the tasks created in [start, end] in a state and with a tag.
+
+  The partial hours at both ends are counted with datastore queries.
+
+  Arguments:
+    start: earliest creation time.
+    end: latest creation time, defaults to now.
+    state: state as accepted by task_result.get_result_summaries_query().
+    tags: list of at most one tag.
+
+  Returns:
+    The count or None if the counters cannot answer, e.g. for more than one
+    tag, a tag not in TAG_KEYS or for tasks created before the counters were
+    enabled.
+  """
+  if len(tags) > 1 or not start or (tags and not _is_counted_tag(tags[0])):
+    return None
+  info = CountersInfo.KEY.get()
+  if not info or not info.tasks_since or start < info.tasks_since:
+    return None
+  end = end or utils.utcnow()
+  first = _ceil_hour(start)
+  last = _floor_hour(end)
+  if first >= last:
+    return None
+
+  before = _count_query_async(start, first, state, tags)
+  after = _count_query_async(
+      last, end + datetime.timedelta(milliseconds=1), state, tags)
+  tag = tags[0] if tags else ''
+  values = _get_values(
+      '%s:%s:%s' % (g, state, tag) for g in _task_bucket_names(first, last))
+  return sum(values.itervalues()) + before.get_result() + after.get_result()
+
+
+def count_bots(dimensions):
+  """Counts the bots having a dimension.
+
+  Arguments:
+    dimensions: list of at most one 'key:value' dimension.
+
+  Returns:
+    dict(field: count) for each of BOT_FIELDS or None if the counters cannot
+    answer, e.g. for more than one dimension or before reset_bot_counters() was
+    run.
+  """
+  if len(dimensions) > 1 or (dimensions and dimensions[0].startswith('id:')):
+    return None
+  info = CountersInfo.KEY.get()
+  if not info or not info.bots_ts:
+    return None
+  dimension = dimensions[0] if dimensions else ''
+  names = {f: 'bots:%s:%s' % (f, dimension) for f in BOT_FIELDS}
+  values = _get_values(names.itervalues())
+  return {f: max(0, values[n]) for f, n in names.iteritems()}
+
+
+def count_machine_types(machine_types):
+  """Counts the busy and idle Machine Provider bots per machine type.
+
+  Quarantined bots are not counted. Dead bots are only excluded as of the last
+  reset_bot_counters().
+
+  Arguments:
+    machine_types: list of machine type names.
+
+  Returns:
+    dict(machine type: (busy, idle)) or None before reset_bot_counters() was
+    run.
+  """
+  info = CountersInfo.KEY.get()
+  if not info or not info.bots_ts:
+    return None
+  names = [
+    'bots:%s:%s' % (f, m) for m in machine_types for f in ('mp_busy', 'mp_idle')
+  ]
+  values = _get_values(names)
+  return {
+    m: (max(0, values[names[2*i]]), max(0, values[names[2*i+1]]))
+    for i, m in enumerate(machine_types)
+  }
+
+
+def reset_bot_counters(values, now):
+  """Overwrites the bot counters with values computed from all the bots.
+
+  Arguments:
+    values: dict(counter name: count) computed with bot_counters(bot, now).
+    now: time at which 'dead' was evaluated, before the bots were read.
+
+  Returns:
+    Number of counters that had drifted.
+  """
+  drift = _set_values(values, 'bots', now)
+  info = CountersInfo.KEY.get() or CountersInfo(key=CountersInfo.KEY)
+  info.bots_ts = now
+  info.put()
+  return drift
+
+
+def reconcile_tasks(hours, deadline=None):
+  """Recomputes the task counters of the last hours from TaskResultSummary.
+
+  Arguments:
+    hours: number of hours to reconcile, including the current one.
+    deadline: optional time.time() value after which no hour is reconciled.
+
+  Returns:
+    Number of counters that had drifted.
+  """
+  info = CountersInfo.KEY.get()
+  if not info or not info.tasks_since:
+    return 0
+  now = utils.utcnow()
+  drift = 0
+  days = set()
+  for i in xrange(hours):
+    if deadline and time.time() >= deadline:
+      break
+    start = _floor_hour(now) - i * _HOUR
+    if start < info.tasks_since:
+      break
+    reset_ts = utils.utcnow()
+    values = {}
+    q = task_result.get_result_summaries_query(
+        start, start + _HOUR - datetime.timedelta(milliseconds=1),
+        'created_ts', 'all', None)
+    for result_summary in q:
+      for name in task_counters(result_summary):
+        if name.startswith('tasks:h:'):
+          values[name] = values.get(name, 0) + 1
+    drift += _set_values(values, _hour_group(start), reset_ts)
+    days.add(start.replace(hour=0))
+
+  for day in sorted(days):
+    # The day counters are the sum of the hour counters.
+    values = {}
+    for h in xrange(24):
+      for name, value in _get_group_values(
+          _hour_group(day + h * _HOUR)).iteritems():
+        name = _day_group(day) + name[len('tasks:h:YYYYMMDDHH'):]
+        values[name] = values.get(name, 0) + value
+    drift += _set_values(values, _day_group(day), now)
+  if drift:
+    logging.warning('Reconciled %d task counters', drift)
+  return drift
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import datetime
+import logging
+import random
+import sys
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+from test_support import test_case
+
+from server import bot_management
+from server import counters
+from server import task_pack
+from server import task_request
+from server import task_result
+
+
+# pylint: disable=W0212
+
+
+def _gen_summary(**kwargs):
+  """Returns a TaskResultSummary for a task created now."""
+  request_key = task_request.new_request_key()
+  now = task_request.request_key_to_datetime(request_key)
+  args = {
+    'key': task_pack.request_key_to_result_summary_key(request_key),
+    'created_ts': now,
+    'modified_ts': now,
+    'tags': [u'pool:a', u'user:joe'],
+  }
+  args.update(kwargs)
+  return task_result.TaskResultSummary(**args)
+
+
+class CountersTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  def setUp(self):
+    super(CountersTest, self).setUp()
+    self.now = datetime.datetime(2017, 1, 2, 3, 4, 5, 6)
+    self.mock_now(self.now)
+    self.mock(random, 'randint', lambda a, _b: a)
+
+  def _set_tasks_since(self, ts):
+    counters.CountersInfo(key=counters.CountersInfo.KEY, tasks_since=ts).put()
+
+  def test_all_apis_are_tested(self):
+    actual = frozenset(i[5:] for i in dir(self) if i.startswith('test_'))
+    # Contains the list of all public APIs.
+    expected = frozenset(
+        i for i in dir(counters)
+        if i[0] != '_' and hasattr(getattr(counters, i), 'func_name'))
+    missing = expected - actual
+    self.assertFalse(missing)
+
+  def test_task_counters(self):
+    self.assertEqual([], counters.task_counters(None))
+    summary = _gen_summary()
+    expected = [
+      'tasks:h:2017010203:all:',
+      'tasks:h:2017010203:all:pool:a',
+      'tasks:h:2017010203:pending:',
+      'tasks:h:2017010203:pending:pool:a',
+      'tasks:h:2017010203:pending_running:',
+      'tasks:h:2017010203:pending_running:pool:a',
+      'tasks:d:20170102:all:',
+      'tasks:d:20170102:all:pool:a',
+      'tasks:d:20170102:pending:',
+      'tasks:d:20170102:pending:pool:a',
+      'tasks:d:20170102:pending_running:',
+      'tasks:d:20170102:pending_running:pool:a',
+    ]
+    self.assertEqual(expected, counters.task_counters(summary))
+
+    summary.state = task_result.State.COMPLETED
+    summary.try_number = 0
+    summary.tags = []
+    expected = [
+      'tasks:h:2017010203:all:',
+      'tasks:h:2017010203:completed:',
+      'tasks:h:2017010203:completed_success:',
+      'tasks:h:2017010203:deduped:',
+      'tasks:d:20170102:all:',
+      'tasks:d:20170102:completed:',
+      'tasks:d:20170102:completed_success:',
+      'tasks:d:20170102:deduped:',
+    ]
+    self.assertEqual(expected, counters.task_counters(summary))
+
+  def test_bot_counters(self):
+    self.assertEqual([], counters.bot_counters(None))
+    bot = bot_management.BotInfo(
+        dimensions_flat=[u'id:bot1', u'os:Linux'], quarantined=True,
+        task_id=None, last_seen_ts=self.now)
+    expected = [
+      'bots:count:', 'bots:count:os:Linux',
+      'bots:quarantined:', 'bots:quarantined:os:Linux',
+    ]
+    self.assertEqual(expected, counters.bot_counters(bot))
+    later = self.now + datetime.timedelta(days=1)
+    self.assertEqual(
+        expected + ['bots:dead:', 'bots:dead:os:Linux'],
+        counters.bot_counters(bot, later))
+
+  def test_get_bots_reset_ts_async(self):
+    self.assertEqual(None, counters.get_bots_reset_ts_async().get_result())
+    counters.reset_bot_counters({}, self.now)
+    self.assertEqual(
+        self.now, counters.get_bots_reset_ts_async().get_result())
+
+  def test_enqueue_update(self):
+    self.assertTrue(counters.enqueue_update(['a'], ['a']))
+    self.assertEqual(0, counters.flush())
+    self.assertTrue(counters.enqueue_update([], ['a', 'b']))
+    self.assertTrue(counters.enqueue_update(['a'], ['c']))
+    self.assertEqual(2, counters.flush())
+    self.assertEqual(
+        {'a': 0, 'b': 1, 'c': 1}, counters._get_values(['a', 'b', 'c']))
+
+  def test_flush(self):
+    counters.flush()
+    self.assertEqual(
+        datetime.datetime(2017, 1, 2, 4),
+        counters.CountersInfo.KEY.get().tasks_since)
+
+    summary = _gen_summary()
+    before = counters.task_counters(summary)
+    self.assertTrue(counters.enqueue_update([], before))
+    summary.state = task_result.State.CANCELED
+    self.assertTrue(
+        counters.enqueue_update(before, counters.task_counters(summary)))
+    self.assertEqual(2, counters.flush())
+    values = counters._get_values([
+      'tasks:h:2017010203:all:', 'tasks:d:20170102:canceled:pool:a',
+      'tasks:h:2017010203:pending:'])
+    self.assertEqual(
+        {
+          'tasks:h:2017010203:all:': 1,
+          'tasks:d:20170102:canceled:pool:a': 1,
+          'tasks:h:2017010203:pending:': 0,
+        },
+        values)
+
+  def test_count_tasks(self):
+    start = datetime.datetime(2017, 1, 1, 22, 30)
+    # Not enabled yet.
+    self.assertEqual(None, counters.count_tasks(start, None, 'all', []))
+    self._set_tasks_since(datetime.datetime(2017, 1, 1))
+    # Multiple tags are not supported.
+    self.assertEqual(
+        None, counters.count_tasks(start, None, 'all', [u'pool:a', u'os:b']))
+    # Only the tags in TAG_KEYS are counted.
+    self.assertEqual(
+        None, counters.count_tasks(start, None, 'all', [u'user:joe']))
+
+    counters._set_values(
+        {'tasks:h:2017010123:all:pool:a': 2}, 'tasks:h:2017010123', self.now)
+    counters._set_values(
+        {'tasks:d:20170102:all:pool:a': 100}, 'tasks:d:20170102', self.now)
+    counters._set_values(
+        {'tasks:h:2017010200:all:pool:a': 3}, 'tasks:h:2017010200', self.now)
+    _gen_summary().put()
+    # The partial day uses the hour counters, the partial hours at both ends
+    # are counted with a query.
+    self.assertEqual(
+        [
+          'tasks:h:2017010123', 'tasks:h:2017010200', 'tasks:h:2017010201',
+          'tasks:h:2017010202',
+        ],
+        counters._task_bucket_names(
+            datetime.datetime(2017, 1, 1, 23),
+            datetime.datetime(2017, 1, 2, 3)))
+    self.assertEqual(
+        6, counters.count_tasks(start, None, 'all', [u'pool:a']))
+    self.assertEqual(
+        ['tasks:d:20170102'],
+        counters._task_bucket_names(
+            datetime.datetime(2017, 1, 2), datetime.datetime(2017, 1, 3)))
+
+  def test_count_bots(self):
+    self.assertEqual(None, counters.count_bots([]))
+    counters.reset_bot_counters(
+        {'bots:count:': 3, 'bots:busy:': 1, 'bots:count:os:Linux': 2}, self.now)
+    self.assertEqual(
+        {'busy': 1, 'count': 3, 'dead': 0, 'quarantined': 0},
+        counters.count_bots([]))
+    self.assertEqual(
+        {'busy': 0, 'count': 2, 'dead': 0, 'quarantined': 0},
+        counters.count_bots([u'os:Linux']))
+    self.assertEqual(None, counters.count_bots([u'id:bot1']))
+    self.assertEqual(None, counters.count_bots([u'os:Linux', u'pool:a']))
+
+  def test_count_machine_types(self):
+    self.assertEqual(None, counters.count_machine_types([u'mt']))
+    bots = [
+      bot_management.BotInfo(
+          machine_type=u'mt', task_id=u'1234', last_seen_ts=self.now),
+      bot_management.BotInfo(machine_type=u'mt', last_seen_ts=self.now),
+      bot_management.BotInfo(
+          machine_type=u'mt', quarantined=True, last_seen_ts=self.now),
+      bot_management.BotInfo(
+          machine_type=u'mt',
+          last_seen_ts=self.now - datetime.timedelta(days=1)),
+    ]
+    values = {}
+    for bot in bots:
+      for name in counters.bot_counters(bot, self.now):
+        values[name] = values.get(name, 0) + 1
+    counters.reset_bot_counters(values, self.now)
+    self.assertEqual(
+        {u'mt': (1, 1), u'other': (0, 0)},
+        counters.count_machine_types([u'mt', u'other']))
+
+    # The bot becomes idle.
+    counters.enqueue_update(
+        counters.bot_counters(bots[0]),
+        counters.bot_counters(bot_management.BotInfo(machine_type=u'mt')))
+    counters.flush()
+    self.assertEqual({u'mt': (0, 2)}, counters.count_machine_types([u'mt']))
+
+  def test_reset_bot_counters(self):
+    counters.enqueue_update([], ['bots:count:', 'bots:count:os:Linux'])
+    counters.enqueue_update([], ['bots:count:'])
+    counters.flush()
+    # 'bots:count:os:Linux' disappeared.
+    self.assertEqual(
+        1, counters.reset_bot_counters({'bots:count:': 2}, self.now))
+    self.assertEqual(
+        {'busy': 0, 'count': 2, 'dead': 0, 'quarantined': 0},
+        counters.count_bots([]))
+    self.assertEqual(
+        {'busy': 0, 'count': 0, 'dead': 0, 'quarantined': 0},
+        counters.count_bots([u'os:Linux']))
+
+  def test_reset_bot_counters_pending_deltas(self):
+    # A bot appears but the delta is not flushed before the reset.
+    counters.enqueue_update([], ['bots:count:'])
+    later = self.now + datetime.timedelta(seconds=1)
+    self.mock_now(later)
+    self.assertEqual(
+        1, counters.reset_bot_counters({'bots:count:': 1}, later))
+    # Another bot appears after the reset.
+    counters.enqueue_update([], ['bots:count:'])
+    # The delta already accounted for by the reset is dropped.
+    self.assertEqual(2, counters.flush())
+    self.assertEqual(
+        {'busy': 0, 'count': 2, 'dead': 0, 'quarantined': 0},
+        counters.count_bots([]))
+
+  def test_reconcile_tasks(self):
+    self.assertEqual(0, counters.reconcile_tasks(3))
+    self._set_tasks_since(datetime.datetime(2017, 1, 2))
+    _gen_summary().put()
+    # A drifted counter.
+    counters._set_values(
+        {'tasks:h:2017010203:running:': 1}, 'tasks:h:2017010203', self.now)
+    # 6 new hour counters, the drifted one and 6 day counters.
+    self.assertEqual(13, counters.reconcile_tasks(3))
+    self.assertEqual(0, counters.reconcile_tasks(3))
+    self.assertEqual(
+        {
+          'tasks:d:20170102:pending:pool:a': 1,
+          'tasks:h:2017010203:running:': 0,
+        },
+        counters._get_values(
+            ['tasks:d:20170102:pending:pool:a', 'tasks:h:2017010203:running:']))
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
@@ -51,6 +51,7 @@ from components import pubsub
 from components import utils
 from server import bot_groups_config
 from server import bot_management
+from server import counters
 from server import task_queues
 from server import task_request
 from server import task_result
@@ -1244,17 +1245,12 @@ def manage_lease(key):
   delete_machine_lease(key)
 
 
-def compute_utilization(batch_size=50):
-  """Computes bot utilization per machine type.
-
-  Args:
-    batch_size: Number of bots to query for at a time.
-  """
+def _scan_utilization(now, batch_size):
+  """Returns dict(machine type: (busy, idle)) by querying all the bots."""
   # A query that requires multiple batches may produce duplicate results. To
   # ensure each bot is only counted once, map machine types to [busy, idle]
   # sets of bots.
   machine_types = collections.defaultdict(lambda: [set(), set()])
-  now = utils.utcnow()
   q = bot_management.BotInfo.query()
   q = bot_management.filter_availability(q, False, False, now, None, True)
   cursor = ''
@@ -1268,10 +1264,32 @@ def compute_utilization(batch_size=50):
       else:
         machine_types[bot.machine_type][0].discard(bot_id)
         machine_types[bot.machine_type][1].add(bot_id)
+  return {
+    machine_type: (len(busy), len(idle))
+    for machine_type, (busy, idle) in machine_types.iteritems()
+  }
+
+
+def compute_utilization(batch_size=50):
+  """Computes bot utilization per machine type.
+
+  Reads the busy and idle counts kept up to date by bot_management.bot_event()
+  in the bot counters. The bots are only queried when the counters are not
+  initialized yet; their consistency is checked by the bots dimensions
+  aggregation cron job.
 
-  for machine_type, (busy, idle) in machine_types.iteritems():
-    busy = len(busy)
-    idle = len(idle)
+  Args:
+    batch_size: Number of bots to query for at a time.
+  """
+  now = utils.utcnow()
+  utilization = counters.count_machine_types(
+      [key.id() for key in MachineType.query().iter(keys_only=True)])
+  if utilization is None:
+    utilization = _scan_utilization(now, batch_size)
+
+  for machine_type, (busy, idle) in sorted(utilization.iteritems()):
+    if not busy and not idle:
+      continue
     logging.info('Utilization for %s: %s/%s', machine_type, busy, busy + idle)
     MachineTypeUtilization(
         id=machine_type,
@@ -22,6 +22,7 @@ from test_support import test_case
 
 import bot_management
 import lease_management
+from server import counters
 from proto import bots_pb2
 
 
@@ -278,6 +279,28 @@ class ComputeUtilizationTest(test_case.TestCase):
     self.failUnless(key3.get().last_updated_ts)
 
 
+  def test_counters(self):
+    lease_management.MachineType(id='machine-type-1', target_size=2).put()
+    lease_management.MachineType(id='machine-type-2', target_size=2).put()
+    counters.reset_bot_counters(
+        {
+          'bots:mp_busy:machine-type-1': 1,
+          'bots:mp_idle:machine-type-1': 3,
+        },
+        utils.utcnow())
+    def fetch_page(*_args, **_kwargs):
+      self.fail('Bots should not be queried')
+    self.mock(lease_management.datastore_utils, 'fetch_page', fetch_page)
+
+    lease_management.compute_utilization()
+
+    key1 = ndb.Key(lease_management.MachineTypeUtilization, 'machine-type-1')
+    self.assertEqual(key1.get().busy, 1)
+    self.assertEqual(key1.get().idle, 3)
+    key2 = ndb.Key(lease_management.MachineTypeUtilization, 'machine-type-2')
+    self.failIf(key2.get())
+
+
 class DrainExcessTest(test_case.TestCase):
   """Tests for lease_management.drain_excess."""
 
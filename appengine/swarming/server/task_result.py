@@ -67,10 +67,12 @@ Graph of schema:
 import collections
 import datetime
 import logging
+import os
 import random
 import re
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
@@ -89,6 +91,15 @@ import cipd
 BOT_PING_TOLERANCE = datetime.timedelta(seconds=2*60)
 
 
+# Memcache namespace of the markers replaced on each write of a result entity,
+# so the writes can be detected without fetching the entities.
+_CHANGE_MARKER_NAMESPACE = 'task_result_change'
+
+# Lifetime of a change marker in memcache. A marker is recreated on demand by
+# get_change_markers().
+_CHANGE_MARKER_EXPIRATION = 24*60*60
+
+
 class State(object):
   """States in which a task can be.
 
@@ -653,6 +664,13 @@ class _TaskResultCommon(ndb.Model):
     self.children_task_ids = sorted(
         set(self.children_task_ids), key=lambda x: int(x, 16))
 
+  def _post_put_hook(self, future):
+    super(_TaskResultCommon, self)._post_put_hook(future)
+    # Only once the entity is visible, otherwise tasks/wait could read the old
+    # version along the new marker and then miss the write.
+    key = self.key
+    ndb.get_context().call_on_commit(lambda: _replace_change_marker(key))
+
   @classmethod
   def _properties_fixed(cls):
     """Returns all properties with their member name, excluding computed
@@ -930,6 +948,29 @@ class TagAggregation(ndb.Model):
 ### Private stuff.
 
 
+def _result_key_to_change_marker_id(result_key):
+  """Returns the memcache key of the change marker of a result entity."""
+  if result_key.kind() == 'TaskRunResult':
+    return task_pack.pack_run_result_key(result_key)
+  return task_pack.pack_result_summary_key(result_key)
+
+
+def _new_change_marker():
+  # Not random.getrandbits(), it is used to generate the task ids.
+  return os.urandom(8).encode('hex')
+
+
+def _replace_change_marker(result_key):
+  """Sets a new change marker for a result entity that was just written."""
+  marker_id = _result_key_to_change_marker_id(result_key)
+  if not memcache.set(
+      marker_id, _new_change_marker(), time=_CHANGE_MARKER_EXPIRATION,
+      namespace=_CHANGE_MARKER_NAMESPACE):
+    # Fallback to removing it, a missing marker is recreated by the next reader
+    # as a change.
+    memcache.delete(marker_id, namespace=_CHANGE_MARKER_NAMESPACE)
+
+
 def _run_result_key_to_output_key(run_result_key):
   """Returns a ndb.key to a TaskOutput."""
   assert run_result_key.kind() == 'TaskRunResult', run_result_key
@@ -1180,6 +1221,26 @@ def new_run_result(request, try_number, bot_id, bot_version, bot_dimensions):
       server_versions=[utils.get_app_version()])
 
 
+def get_change_markers(result_keys):
+  """Returns the change markers of TaskResultSummary or TaskRunResult keys.
+
+  A marker is replaced on every write of the entity, so comparing the markers
+  tells which entities may have changed without fetching them. The markers are
+  read from memcache; a missing one is recreated and returned as None, which
+  must be considered a change.
+  """
+  ids = [_result_key_to_change_marker_id(k) for k in result_keys]
+  markers = memcache.get_multi(ids, namespace=_CHANGE_MARKER_NAMESPACE)
+  missing = dict(
+      (i, _new_change_marker()) for i in ids if markers.get(i) is None)
+  if missing:
+    # Do not overwrite a marker set concurrently by a write.
+    memcache.add_multi(
+        missing, time=_CHANGE_MARKER_EXPIRATION,
+        namespace=_CHANGE_MARKER_NAMESPACE)
+  return [markers.get(i) for i in ids]
+
+
 def yield_run_result_keys_with_dead_bot():
   """Yields all the TaskRunResult ndb.Key where the bot died recently.
 
@@ -413,6 +413,39 @@ class TaskResultApiTest(TestCase):
         run_result.task_id)
     self.assertEqual(complete_ts, run_result.ended_ts)
 
+  def test_get_change_markers(self):
+    request = mkreq(_gen_request())
+    result_summary = task_result.new_result_summary(request)
+    result_summary.modified_ts = self.now
+    result_summary.put()
+    run_result = task_result.new_run_result(request, 1, 'localhost', 'abc', {})
+    run_result.modified_ts = self.now
+    run_result.started_ts = self.now
+    run_result.put()
+    keys = [result_summary.key, run_result.key]
+    markers = task_result.get_change_markers(keys)
+    self.assertTrue(all(markers))
+    self.assertEqual(markers, task_result.get_change_markers(keys))
+
+    # Only the marker of the written entity is replaced.
+    run_result.put()
+    new_markers = task_result.get_change_markers(keys)
+    self.assertEqual(markers[0], new_markers[0])
+    self.assertNotEqual(markers[1], new_markers[1])
+
+    # Not written within a transaction that is rolled back.
+    def tx():
+      result_summary.put()
+      raise ndb.Rollback()
+    ndb.transaction(tx)
+    self.assertEqual(new_markers, task_result.get_change_markers(keys))
+
+    # A missing marker is recreated and reported as a change.
+    task_result.memcache.flush_all()
+    self.assertEqual([None, None], task_result.get_change_markers(keys))
+    markers = task_result.get_change_markers(keys)
+    self.assertTrue(all(markers))
+
   def test_yield_run_result_keys_with_dead_bot(self):
     request = mkreq(_gen_request())
     result_summary = task_result.new_result_summary(request)
@@ -13,6 +13,7 @@ import math
 import random
 import time
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import auth
@@ -25,6 +26,7 @@ import ts_mon_metrics
 
 from server import acl
 from server import config
+from server import counters
 from server import task_pack
 from server import task_queues
 from server import task_request
@@ -37,6 +39,10 @@ from server import task_to_run
 
 _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 
+# Memcache key counting the PubSub messages enqueued since the last flush
+# started, see _enqueue_pubsub_flush().
+_PUBSUB_FLUSH_KEY = 'pubsub-flush-pending'
+
 
 def _secs_to_ms(value):
   """Converts a seconds value in float to the number of ms as an integer."""
@@ -70,6 +76,7 @@ def _expire_task(to_run_key, request):
 
     to_run.queue_number = None
     result_summary = result_summary_future.get_result()
+    orig_counters = counters.task_counters(result_summary)
     if result_summary.try_number:
       # It's a retry that is being expired. Keep the old state. That requires an
       # additional pipelined GET but that shouldn't be the common case.
@@ -82,6 +89,7 @@ def _expire_task(to_run_key, request):
 
     futures = ndb.put_multi_async((to_run, result_summary))
     _maybe_pubsub_notify_via_tq(result_summary, request)
+    _update_counters_via_tq(orig_counters, result_summary)
     for f in futures:
       f.check_success()
 
@@ -130,6 +138,7 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request):
     to_run = to_run_future.get_result()
     result_summary = result_summary_future.get_result()
     orig_summary_state = result_summary.state
+    orig_counters = counters.task_counters(result_summary)
     secret_bytes = None
     if request.properties.has_secret_bytes:
       secret_bytes = secret_bytes_future.get_result()
@@ -160,6 +169,7 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request):
     ndb.put_multi([to_run, run_result, result_summary])
     if result_summary.state != orig_summary_state:
       _maybe_pubsub_notify_via_tq(result_summary, request)
+    _update_counters_via_tq(orig_counters, result_summary)
     return run_result, secret_bytes
 
   # Add it to the negative cache *before* running the transaction. This will
@@ -232,6 +242,7 @@ def _handle_dead_bot(run_result_key):
     run_result.modified_ts = now
 
     orig_summary_state = result_summary.state
+    orig_counters = counters.task_counters(result_summary)
     if result_summary.try_number != run_result.try_number:
       # Not updating correct run_result, cancel it without touching
       # result_summary.
@@ -274,6 +285,7 @@ def _handle_dead_bot(run_result_key):
     # if result_summary.state != orig_summary_state:
     if orig_summary_state != result_summary.state:
       _maybe_pubsub_notify_via_tq(result_summary, request)
+    _update_counters_via_tq(orig_counters, result_summary)
     for f in futures:
       f.check_success()
 
@@ -308,60 +320,70 @@ def _copy_summary(src, dst, skip_list):
   dst.populate(**kwargs)
 
 
-def _maybe_pubsub_notify_now(result_summary, request):
-  """Examines result_summary and sends task completion PubSub message.
+def _maybe_pubsub_notify_via_tq(result_summary, request):
+  """Examines result_summary and enqueues a PubSub message to send.
+
+  The message is added to the 'pubsub-pull' pull queue. Once the transaction is
+  committed, a task is enqueued to flush it unless one is already pending, so
+  messages sent around the same time are published together.
 
-  Does it only if result_summary indicates a task in some finished state and
-  the request is specifying pubsub topic.
+  Must be called within a transaction.
 
-  Returns False to trigger the retry (on transient errors), or True if retry is
-  not needed (e.g. messages was sent successfully or fatal error happened).
+  Raises CommitError on errors (to abort the transaction).
   """
-  assert not ndb.in_transaction()
+  assert ndb.in_transaction()
   assert isinstance(
       result_summary, task_result.TaskResultSummary), result_summary
   assert isinstance(request, task_request.TaskRequest), request
-  if (result_summary.state in task_result.State.STATES_NOT_RUNNING and
-      request.pubsub_topic):
+  if request.pubsub_topic:
     task_id = task_pack.pack_result_summary_key(result_summary.key)
-    try:
-      _pubsub_notify(
-          task_id, request.pubsub_topic,
-          request.pubsub_auth_token, request.pubsub_userdata)
-    except pubsub.TransientError:
-      logging.exception('Transient error when sending PubSub notification')
-      return False
-    except pubsub.Error:
-      logging.exception('Fatal error when sending PubSub notification')
-      return True # do not retry it
-  return True
+    msg = {'task_id': task_id}
+    if request.pubsub_userdata:
+      msg['userdata'] = request.pubsub_userdata
+    auth_token = request.pubsub_auth_token
+    ok = pubsub.enqueue_publish(
+        'pubsub-pull', request.pubsub_topic, utils.encode_to_json(msg),
+        {'auth_token': auth_token} if auth_token else None,
+        transactional=True)
+    if not ok:
+      raise datastore_utils.CommitError('Failed to enqueue task')
+    ndb.get_context().call_on_commit(_enqueue_pubsub_flush)
 
 
-def _maybe_pubsub_notify_via_tq(result_summary, request):
-  """Examines result_summary and enqueues a task to send PubSub message.
+def _enqueue_pubsub_flush():
+  """Enqueues a task to flush the 'pubsub-pull' pull queue if none is pending.
+
+  The number of messages enqueued since the last flush started is counted in
+  memcache; only the first one enqueues a task. When memcache is unavailable,
+  a task is enqueued anyway. If the enqueue fails, the message is published by
+  cron_flush_pubsub() instead.
+  """
+  pending = memcache.incr(_PUBSUB_FLUSH_KEY, initial_value=0)
+  if pending is not None and pending > 1:
+    return
+  # The countdown gives a chance to other messages to be batched along.
+  if not utils.enqueue_task(
+      url='/internal/taskqueue/pubsub-flush',
+      queue_name='pubsub',
+      countdown=1):
+    memcache.delete(_PUBSUB_FLUSH_KEY)
+
+
+def _update_counters_via_tq(orig_counters, result_summary):
+  """Enqueues the update of the task counters for result_summary.
+
+  orig_counters is the value of counters.task_counters() before result_summary
+  was modified.
 
   Must be called within a transaction.
 
   Raises CommitError on errors (to abort the transaction).
   """
   assert ndb.in_transaction()
-  assert isinstance(
-      result_summary, task_result.TaskResultSummary), result_summary
-  assert isinstance(request, task_request.TaskRequest), request
-  if request.pubsub_topic:
-    task_id = task_pack.pack_result_summary_key(result_summary.key)
-    ok = utils.enqueue_task(
-        url='/internal/taskqueue/pubsub/%s' % task_id,
-        queue_name='pubsub',
-        transactional=True,
-        payload=utils.encode_to_json({
-          'task_id': task_id,
-          'topic': request.pubsub_topic,
-          'auth_token': request.pubsub_auth_token,
-          'userdata': request.pubsub_userdata,
-        }))
-    if not ok:
-      raise datastore_utils.CommitError('Failed to enqueue task')
+  if not counters.enqueue_update(
+      orig_counters, counters.task_counters(result_summary),
+      transactional=True):
+    raise datastore_utils.CommitError('Failed to enqueue task')
 
 
 def _pubsub_notify(task_id, topic, auth_token, userdata):
@@ -578,6 +600,11 @@ def schedule_request(request, secret_bytes, check_acls=True):
         extra=filter(bool, [task, result_summary, secret_bytes]))
     logging.debug('New request %s', result_summary.task_id)
 
+  # The insertion transaction is managed by datastore_utils.insert() so the
+  # counters are updated right after. A failure here is fixed by the next
+  # counters.reconcile_tasks().
+  counters.enqueue_update([], counters.task_counters(result_summary))
+
   # Get parent task details if applicable.
   if request.parent_task_id:
     parent_run_key = task_pack.unpack_run_result_key(request.parent_task_id)
@@ -750,7 +777,8 @@ def bot_update_task(
     if cipd_pins:
       run_result.cipd_pins = cipd_pins
 
-    if run_result.state in task_result.State.STATES_RUNNING:
+    was_running = run_result.state in task_result.State.STATES_RUNNING
+    if was_running:
       if hard_timeout or io_timeout:
         run_result.state = task_result.State.TIMED_OUT
         run_result.completed_ts = now
@@ -773,6 +801,7 @@ def bot_update_task(
     run_result.modified_ts = now
 
     result_summary = result_summary_future.get_result()
+    orig_counters = counters.task_counters(result_summary)
     if (result_summary.try_number and
         result_summary.try_number > run_result.try_number):
       # The situation where a shard is retried but the bot running the previous
@@ -785,7 +814,14 @@ def bot_update_task(
 
     result_summary.validate(request)
     to_put.append(result_summary)
-    ndb.put_multi(to_put)
+    futures = ndb.put_multi_async(to_put)
+    if (was_running and
+        run_result.state in task_result.State.STATES_NOT_RUNNING and
+        result_summary.state in task_result.State.STATES_NOT_RUNNING):
+      _maybe_pubsub_notify_via_tq(result_summary, request)
+    _update_counters_via_tq(orig_counters, result_summary)
+    for f in futures:
+      f.check_success()
 
     return result_summary, run_result, None
 
@@ -799,10 +835,7 @@ def bot_update_task(
   if error:
     logging.error('Task %s %s', packed, error)
     return None
-  # Caller must retry if PubSub enqueue fails.
   task_completed = run_result.state != task_result.State.RUNNING
-  if not _maybe_pubsub_notify_now(smry, request):
-    return None
   if task_completed:
     event_mon_metrics.send_task_event(smry)
     ts_mon_metrics.update_jobs_completed_metrics(smry)
@@ -839,10 +872,12 @@ def bot_kill_task(run_result_key, bot_id):
     run_result.internal_failure = True
     run_result.abandoned_ts = now
     run_result.modified_ts = now
+    orig_counters = counters.task_counters(result_summary)
     result_summary.set_from_run_result(run_result, None)
 
     futures = ndb.put_multi_async((run_result, result_summary))
     _maybe_pubsub_notify_via_tq(result_summary, request)
+    _update_counters_via_tq(orig_counters, result_summary)
     for f in futures:
       f.check_success()
 
@@ -876,12 +911,14 @@ def cancel_task(request, result_key):
     if not result_summary.can_be_canceled:
       return False, was_running
     to_run.queue_number = None
+    orig_counters = counters.task_counters(result_summary)
     result_summary.state = task_result.State.CANCELED
     result_summary.abandoned_ts = now
     result_summary.modified_ts = now
 
     futures = ndb.put_multi_async((to_run, result_summary))
     _maybe_pubsub_notify_via_tq(result_summary, request)
+    _update_counters_via_tq(orig_counters, result_summary)
     for f in futures:
       f.check_success()
 
@@ -985,8 +1022,35 @@ def cron_handle_bot_died(host):
 ## Task queue tasks.
 
 
+def task_flush_pubsub():
+  """Publishes the PubSub messages enqueued by _maybe_pubsub_notify_via_tq.
+
+  Raises pubsub.TransientError on transient errors to trigger a task queue task
+  retry.
+  """
+  # Reset first, so the messages enqueued from now on, which may not be leased
+  # below, enqueue a new task.
+  memcache.delete(_PUBSUB_FLUSH_KEY)
+  pubsub.flush_publish_queue('pubsub-pull')
+
+
+def cron_flush_pubsub(deadline=None):
+  """Publishes the PubSub messages left in the 'pubsub-pull' pull queue.
+
+  Catches the messages whose flush task failed to be enqueued or gave up.
+  """
+  try:
+    pubsub.flush_publish_queue('pubsub-pull', deadline=deadline)
+  except pubsub.TransientError:
+    logging.warning('Transient error when flushing PubSub messages')
+
+
 def task_handle_pubsub_task(payload):
-  """Handles task enqueued by _maybe_pubsub_notify_via_tq."""
+  """Handles task enqueued by _maybe_pubsub_notify_via_tq.
+
+  Only used for tasks enqueued before messages were batched via the
+  'pubsub-pull' pull queue.
+  """
   # Do not catch errors to trigger task queue task retry. Errors should not
   # happen in normal case.
   _pubsub_notify(
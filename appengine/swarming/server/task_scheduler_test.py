@@ -101,11 +101,14 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertFalse(self._pub_sub_mocked)
     self._pub_sub_mocked = True
     calls = []
-    def pubsub_publish(**kwargs):
+    def pubsub_publish_multi(topic, messages):
       if not self.publish_successful:
         raise pubsub.TransientError('Fail')
-      calls.append(('directly', kwargs))
-    self.mock(pubsub, 'publish', pubsub_publish)
+      for message, attributes in messages:
+        calls.append(
+            ('batched',
+              {'topic': topic, 'message': message, 'attributes': attributes}))
+    self.mock(pubsub, 'publish_multi', pubsub_publish_multi)
     return calls
 
   def _gen_request(self, properties=None, **kwargs):
@@ -834,27 +837,13 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.bot_dimensions, 'abc', None)
     self.assertEqual('localhost', run_result.bot_id)
 
-    # Attempt to terminate the task with success, but make PubSub call fail.
+    # The PENDING -> RUNNING notification fails to be published. It is left
+    # in the pull queue until it is retried.
     self.publish_successful = False
-    self.assertEqual(
-        None,
-        task_scheduler.bot_update_task(
-            run_result_key=run_result.key,
-            bot_id='localhost',
-            cipd_pins=None,
-            output='Foo1',
-            output_chunk_start=0,
-            exit_code=0,
-            duration=0.1,
-            hard_timeout=False,
-            io_timeout=False,
-            cost_usd=0.1,
-            outputs_ref=None,
-            performance_stats=None))
     self.assertEqual(1, self.execute_tasks(status=500))
 
-    # Bot retries bot_update, now PubSub works and notification is sent.
-    self.publish_successful = True
+    # PubSub failures do not fail the update, the notification is sent
+    # asynchronously.
     self.assertEqual(
         task_result.State.COMPLETED,
         task_scheduler.bot_update_task(
@@ -870,8 +859,39 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
             cost_usd=0.1,
             outputs_ref=None,
             performance_stats=None))
-    self.assertEqual(0, self.execute_tasks())
-    self.assertEqual(1, len(pub_sub_calls)) # notification is sent
+    self.assertEqual(0, len(pub_sub_calls))
+
+    # Both the retried PENDING -> RUNNING and the completion notifications are
+    # sent by the same task.
+    self.publish_successful = True
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(2, len(pub_sub_calls))
+    self.assertEqual([], self._taskqueue_stub.GetTasks('pubsub-pull'))
+
+  def test_pubsub_flush_batched(self):
+    pub_sub_calls = self.mock_pub_sub()
+    for _ in xrange(3):
+      request = self._gen_request(pubsub_topic='projects/abc/topics/def')
+      task_request.init_new_request(request, True, None)
+      result_summary = task_scheduler.schedule_request(request, None)
+      task_scheduler.cancel_task(request, result_summary.key)
+    # A single flush task for the 3 notifications.
+    self.assertEqual(1, len(self._taskqueue_stub.GetTasks('pubsub')))
+    self.execute_tasks()
+    self.assertEqual(3, len(pub_sub_calls))
+
+  def test_cron_flush_pubsub(self):
+    pub_sub_calls = self.mock_pub_sub()
+    # Simulates a failure to enqueue the flush task.
+    self.mock(task_scheduler, '_enqueue_pubsub_flush', lambda: None)
+    request = self._gen_request(pubsub_topic='projects/abc/topics/def')
+    task_request.init_new_request(request, True, None)
+    result_summary = task_scheduler.schedule_request(request, None)
+    task_scheduler.cancel_task(request, result_summary.key)
+    self.assertEqual(0, len(pub_sub_calls))
+    # The message whose flush task was lost is sent by the cron job.
+    task_scheduler.cron_flush_pubsub()
+    self.assertEqual(1, len(pub_sub_calls))
 
   def _bot_update_timeouts(self, hard, io):
     request = self._gen_request()
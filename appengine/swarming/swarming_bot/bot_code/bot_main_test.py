@@ -854,13 +854,14 @@ class TestBotMain(TestBotBase):
     new_zip = os.path.join(self.root_dir, 'swarming_bot.2.zip')
     # This is necessary otherwise zipfile will crash.
     self.mock(time, 'time', lambda: 1400000000)
-    def url_retrieve(f, url, headers=None, timeout=None):
+    def url_retrieve(f, url, headers=None, timeout=None, coalesce=False):
       self.assertEqual(
           'https://localhost:1/swarming/api/v1/bot/bot_code'
           '/123?bot_id=localhost', url)
       self.assertEqual(new_zip, f)
       self.assertEqual({}, headers)
       self.assertEqual(remote_client.NET_CONNECTION_TIMEOUT_SEC, timeout)
+      self.assertTrue(coalesce)
       # Create a valid zip that runs properly.
       with zipfile.ZipFile(f, 'w') as z:
         z.writestr('__main__.py', 'print("hi")')
@@ -160,12 +160,17 @@ class RemoteClientNative(object):
         follow_redirects=False)
 
   def _url_retrieve(self, filepath, url_path):
-    """Fetches the file from the given URL path on the server."""
+    """Fetches the file from the given URL path on the server.
+
+    The URL must be content addressed; identical requests in flight are sent
+    once.
+    """
     return net.url_retrieve(
         filepath,
         self._server + url_path,
         headers=self.get_authentication_headers(),
-        timeout=NET_CONNECTION_TIMEOUT_SEC)
+        timeout=NET_CONNECTION_TIMEOUT_SEC,
+        coalesce=True)
 
   def post_bot_event(self, event_type, message, attributes):
     """Logs bot-specific info to the server"""
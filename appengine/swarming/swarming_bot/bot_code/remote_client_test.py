@@ -3,8 +3,11 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import StringIO
 import logging
+import os
 import sys
+import tempfile
 import threading
 import time
 import unittest
@@ -13,6 +16,9 @@ import test_env_bot_code
 test_env_bot_code.setup_test_env()
 
 from depot_tools import auto_stub
+from depot_tools import fix_encoding
+from utils import file_path
+from utils import net
 
 import remote_client
 
@@ -77,8 +83,48 @@ class TestRemoteClient(auto_stub.TestCase):
     self.mock(time, 'time', lambda: 103500)
     self.assertEqual({'Now': '103500'}, c.get_authentication_headers())
 
+  def test_get_bot_code_coalesced(self):
+    # Concurrent downloads of the same bot code are sent once.
+    service = net.HttpService('http://localhost:1', None)
+    requests = []
+    in_flight = threading.Event()
+    done = threading.Event()
+    def request(urlpath, *_args):
+      requests.append(urlpath)
+      in_flight.set()
+      done.wait()
+      return net.HttpResponse(StringIO.StringIO('bot code'), urlpath, {})
+    self.mock(service, '_request', request)
+    self.mock(net, 'get_http_service', lambda *_args, **_kwargs: service)
+    c = remote_client.RemoteClientNative(
+        'http://localhost:1', lambda: ({}, None))
+    tempdir = tempfile.mkdtemp(prefix='remote_client')
+    try:
+      paths = [os.path.join(tempdir, 'bot%d.zip' % i) for i in xrange(2)]
+      threads = [
+        threading.Thread(target=c.get_bot_code, args=(p, '123', 'bot1'))
+        for p in paths
+      ]
+      threads[0].start()
+      in_flight.wait()
+      threads[1].start()
+      # pylint: disable=protected-access
+      while not service._in_flight.values()[0].followers:
+        threading.Event().wait(0.01)
+      done.set()
+      for t in threads:
+        t.join()
+      self.assertEqual(['/swarming/api/v1/bot/bot_code/123?bot_id=bot1'],
+                       requests)
+      for p in paths:
+        with open(p, 'rb') as f:
+          self.assertEqual('bot code', f.read())
+    finally:
+      file_path.rmtree(tempdir)
+
 
 if __name__ == '__main__':
+  fix_encoding.fix_encoding()
   logging.basicConfig(
       level=logging.DEBUG if '-v' in sys.argv else logging.CRITICAL)
   unittest.main()
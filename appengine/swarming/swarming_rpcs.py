@@ -348,6 +348,21 @@ class TasksCountRequest(messages.Message):
   tags = messages.StringField(6, repeated=True)
 
 
+class TasksWaitRequest(messages.Message):
+  """Request to wait for any of a set of tasks to change state."""
+  # Task IDs, either summary IDs (ending with '0') or run IDs.
+  task_id = messages.StringField(1, repeated=True)
+  # Cursor returned by the previous call for the same task IDs. Only the tasks
+  # whose state changed since are returned. If unset, all the tasks are
+  # returned right away.
+  cursor = messages.StringField(2)
+  # Maximum number of seconds to wait for a change. It is capped server side.
+  timeout = messages.FloatField(3, default=30.)
+  # Returns the output of the tasks that are not running anymore.
+  include_output = messages.BooleanField(4, default=False)
+  include_performance_stats = messages.BooleanField(5, default=False)
+
+
 ### Task-Related Responses
 
 
@@ -468,6 +483,22 @@ class TaskList(messages.Message):
   now = message_types.DateTimeField(3)
 
 
+class TaskResultUpdate(messages.Message):
+  """A task which state changed, as returned by tasks/wait."""
+  result = messages.MessageField(TaskResult, 1)
+  # Only set when requested and the task is not running anymore.
+  output = messages.StringField(2)
+
+
+class TasksWaitResponse(messages.Message):
+  """Tasks which state changed since the cursor of a TasksWaitRequest."""
+  # To pass back to wait for the next change.
+  cursor = messages.StringField(1)
+  # Empty when the request timed out.
+  items = messages.MessageField(TaskResultUpdate, 2, repeated=True)
+  now = message_types.DateTimeField(3)
+
+
 class TaskRequests(messages.Message):
   """Wraps a list of TaskRequest."""
   cursor = messages.StringField(1)
@@ -28,6 +28,9 @@ import isolateserver
 # .exe on Windows.
 EXECUTABLE_SUFFIX = '.exe' if sys.platform == 'win32' else ''
 
+# Maximum number of extracted package instances kept by InstanceCache.
+MAX_CACHED_INSTANCES = 50
+
 
 if sys.platform == 'win32':
   def _ensure_batfile(client_path):
@@ -141,7 +144,8 @@ class CipdClient(object):
     self.service_url = service_url
 
   def ensure(
-      self, site_root, packages, cache_dir=None, tmp_dir=None, timeout=None):
+      self, site_root, packages, cache_dir=None, tmp_dir=None, timeout=None,
+      instance_cache=None):
     """Ensures that packages installed in |site_root| equals |packages| set.
 
     Blocking call.
@@ -153,6 +157,8 @@ class CipdClient(object):
         Typically contains packages and tags.
       tmp_dir (str): if not None, dir for temp files.
       timeout (int): if not None, timeout in seconds for this function to run.
+      instance_cache (InstanceCache): if set, packages with an immutable
+        version are extracted in this cache and hardlinked in |site_root|.
 
     Returns:
       Pinned packages in the form of {subdir: [(package_name, package_id)]},
@@ -163,7 +169,77 @@ class CipdClient(object):
     """
     timeoutfn = tools.sliding_timeout(timeout)
     logging.info('Installing packages %r into %s', packages, site_root)
-
+    if not instance_cache:
+      return self._ensure(
+          site_root, packages, cache_dir, tmp_dir, timeout, timeoutfn)
+
+    # subdir -> list of (package_name, instance_id), filled below.
+    pins = {subdir: [None] * len(pkgs) for subdir, pkgs in packages.iteritems()}
+    # (subdir, index) of the packages to hardlink from instance_cache.
+    cached = []
+    # List of (subdir, index, package_name, version) to add to instance_cache.
+    missing = []
+    # subdir -> list of (index, package_name, version) to install directly,
+    # since their version is a ref.
+    refs = {}
+    for subdir, pkgs in packages.iteritems():
+      for i, (pkg, version) in enumerate(pkgs):
+        package_name = render_package_name_template(pkg)
+        instance_id = instance_cache.get_pin(package_name, version)
+        if instance_id and instance_cache.has(instance_id):
+          pins[subdir][i] = (package_name, instance_id)
+          cached.append((subdir, i))
+        elif is_immutable_version(version):
+          missing.append((subdir, i, package_name, version))
+        else:
+          refs.setdefault(subdir, []).append((i, package_name, version))
+    logging.info(
+        '%d packages in the instance cache, %d to fetch, %d refs',
+        len(cached), len(missing), sum(len(r) for r in refs.itervalues()))
+
+    if refs:
+      result = self._ensure(
+          site_root,
+          {
+            subdir: [(name, version) for _, name, version in items]
+            for subdir, items in refs.iteritems()
+          },
+          cache_dir, tmp_dir, timeout, timeoutfn)
+      for subdir, items in refs.iteritems():
+        for (i, _, _), pin in zip(items, result[subdir]):
+          pins[subdir][i] = pin
+
+    if missing:
+      # Extract each package in its own subdir, next to the cache so they can
+      # be moved into it.
+      staging = instance_cache.make_staging_dir()
+      try:
+        result = self._ensure(
+            staging,
+            {
+              unicode(j): [(name, version)]
+              for j, (_, _, name, version) in enumerate(missing)
+            },
+            cache_dir, tmp_dir, timeout, timeoutfn)
+        for j, (subdir, i, name, version) in enumerate(missing):
+          pin = result[unicode(j)][0]
+          instance_cache.add(pin[1], os.path.join(staging, unicode(j)))
+          instance_cache.add_pin(name, version, pin[1])
+          pins[subdir][i] = pin
+          cached.append((subdir, i))
+      finally:
+        file_path.rmtree(staging)
+
+    for subdir, i in cached:
+      instance_cache.install(
+          pins[subdir][i][1], os.path.join(site_root, subdir))
+    instance_cache.trim()
+    instance_cache.save()
+    return pins
+
+  def _ensure(
+      self, site_root, packages, cache_dir, tmp_dir, timeout, timeoutfn):
+    """Runs 'cipd ensure', see ensure() for the arguments."""
     ensure_file_handle, ensure_file_path = tempfile.mkstemp(
         dir=tmp_dir, prefix=u'cipd-ensure-file-', suffix='.txt')
     json_out_file_handle, json_file_path = tempfile.mkstemp(
@@ -230,6 +306,168 @@ class CipdClient(object):
       fs.remove(json_file_path)
 
 
+def is_immutable_version(version):
+  """Returns True if |version| is an instance id or a tag.
+
+  Unlike refs, they always resolve to the same instance.
+  """
+  return (
+      isolated_format.is_valid_hash(version, hashlib.sha1) or ':' in version)
+
+
+def _resolve_external_links(root):
+  """Replaces the symlinks in |root| pointing outside of it with their target.
+
+  The targets are moved, not copied, so they must not be used afterward.
+  Symlinks within |root|, e.g. the ones shipped in a package, are kept.
+  """
+  prefix = os.path.realpath(root) + os.path.sep
+  for dirpath, dirnames, filenames in fs.walk(root):
+    for name in dirnames + filenames:
+      path = os.path.join(dirpath, name)
+      if not fs.islink(path):
+        continue
+      target = os.path.realpath(path)
+      if target.startswith(prefix) or not fs.exists(target):
+        continue
+      fs.remove(path)
+      # A directory is still walked since it is now a real directory.
+      fs.rename(target, path)
+
+
+class InstanceCache(object):
+  """Cache of extracted package instances, keyed by instance_id.
+
+  Packages are installed by hardlinking their files from the cache, so a
+  package installed before doesn't need to be fetched nor extracted again.
+  The instance_id of the immutable versions is remembered, so installing
+  packages already in the cache doesn't need the cipd client at all.
+
+  Layout:
+    <root>/pins.json: {"<package_name> <version>": instance_id}.
+    <root>/<instance_id>/: extracted package instance.
+  """
+
+  PINS_FILE = u'pins.json'
+
+  def __init__(self, root, max_instances=MAX_CACHED_INSTANCES):
+    """
+    Args:
+      root (unicode): directory of the cache, created if needed.
+      max_instances (int): maximum number of instances to keep.
+    """
+    assert isinstance(root, unicode), root
+    self.root = root
+    self._max_instances = max_instances
+    self._pins = None
+
+  def get_pin(self, package_name, version):
+    """Returns the instance_id of a package version, or None if unknown."""
+    if isolated_format.is_valid_hash(version, hashlib.sha1):
+      return version
+    return self._get_pins().get('%s %s' % (package_name, version))
+
+  def add_pin(self, package_name, version, instance_id):
+    """Remembers the instance_id of an immutable package version."""
+    if ':' in version:
+      self._get_pins()['%s %s' % (package_name, version)] = instance_id
+
+  def has(self, instance_id):
+    return fs.isdir(self._path(instance_id))
+
+  def make_staging_dir(self):
+    """Returns a new temporary directory on the same file system as the cache.
+    """
+    file_path.ensure_tree(self.root)
+    return unicode(tempfile.mkdtemp(prefix=u'staging-', dir=self.root))
+
+  def add(self, instance_id, src):
+    """Moves the extracted instance |src| into the cache.
+
+    In its default 'symlink' install mode, the cipd client extracts the files
+    in <site_root>/.cipd/pkgs and symlinks them into the subdir. These links
+    are replaced with the files they point to, since only the subdir is moved
+    into the cache.
+    """
+    dst = self._path(instance_id)
+    if fs.isdir(dst):
+      return
+    _resolve_external_links(src)
+    fs.rename(src, dst)
+    file_path.make_tree_read_only(dst)
+
+  def install(self, instance_id, dst):
+    """Hardlinks the files of a cached instance into |dst|.
+
+    Files already in |dst| are replaced.
+    """
+    src = self._path(instance_id)
+    # Mark the instance as recently used.
+    fs.utime(src, None)
+    for dirpath, dirnames, filenames in fs.walk(src):
+      rel = os.path.relpath(dirpath, src)
+      outdir = os.path.normpath(os.path.join(dst, rel))
+      file_path.ensure_tree(outdir)
+      for name in dirnames[:]:
+        if fs.islink(os.path.join(dirpath, name)):
+          # Symlinks to directories are not followed, see below.
+          dirnames.remove(name)
+          filenames.append(name)
+      for name in filenames:
+        infile = os.path.join(dirpath, name)
+        outfile = os.path.join(outdir, name)
+        if fs.lexists(outfile):
+          file_path.remove(outfile)
+        if fs.islink(infile):
+          fs.symlink(os.readlink(infile), outfile)
+        else:
+          file_path.link_file(
+              outfile, infile, file_path.HARDLINK_WITH_FALLBACK)
+
+  def trim(self):
+    """Deletes the least recently used instances in excess."""
+    if not fs.isdir(self.root):
+      return
+    instances = []
+    for name in fs.listdir(self.root):
+      path = os.path.join(self.root, name)
+      if isolated_format.is_valid_hash(name, hashlib.sha1):
+        instances.append((fs.stat(path).st_mtime, name))
+      elif name.startswith(u'staging-'):
+        # Left over by a crash.
+        file_path.rmtree(path)
+    instances.sort()
+    while len(instances) > self._max_instances:
+      _, name = instances.pop(0)
+      logging.info('Evicting CIPD package instance %s', name)
+      file_path.rmtree(self._path(name))
+
+  def save(self):
+    """Saves the pins of the instances still in the cache."""
+    if self._pins is None:
+      return
+    self._pins = {k: v for k, v in self._pins.iteritems() if self.has(v)}
+    file_path.ensure_tree(self.root)
+    file_path.atomic_replace(
+        os.path.join(self.root, self.PINS_FILE),
+        json.dumps(self._pins, sort_keys=True))
+
+  def _get_pins(self):
+    if self._pins is None:
+      self._pins = {}
+      path = os.path.join(self.root, self.PINS_FILE)
+      if fs.isfile(path):
+        try:
+          with fs.open(path, 'rb') as f:
+            self._pins = json.load(f)
+        except (IOError, ValueError) as e:
+          logging.error('Failed to load %s: %s', path, e)
+    return self._pins
+
+  def _path(self, instance_id):
+    return os.path.join(self.root, instance_id)
+
+
 def get_platform():
   """Returns ${platform} parameter value.
 
@@ -334,7 +572,9 @@ def get_client_fetch_url(service_url, package_name, instance_id, timeout=None):
     'package_name': package_name,
     'instance_id': instance_id,
   }))
-  res = net.url_read_json(url, timeout=timeout)
+  # The response only depends on the instance id, so the identical requests of
+  # concurrent threads are sent once.
+  res = net.url_read_json(url, timeout=timeout, coalesce=True)
   _check_response(
       res, 'Could not fetch CIPD client %s:%s',package_name, instance_id)
   fetch_url = res.get('client_binary', {}).get('fetch_url')
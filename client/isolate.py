@@ -567,25 +567,37 @@ class CompleteState(object):
     self.saved_state.update_isolated(command, infiles, read_only, relative_cwd)
     logging.debug(self)
 
-  def files_to_metadata(self, subdir, collapse_symlinks):
+  def files_to_metadata(self, subdir, collapse_symlinks, metadata_cache=None):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
     file is tainted.
 
+    If |metadata_cache| is specified, it is a dict shared by the CompleteState
+    instances processed in the same run. Files it already contains are not
+    stat'ed nor hashed again.
+
     See isolated_format.file_to_metadata() for more information.
     """
     for infile in sorted(self.saved_state.files):
       if subdir and not infile.startswith(subdir):
         self.saved_state.files.pop(infile)
-      else:
-        filepath = os.path.join(self.root_dir, infile)
-        self.saved_state.files[infile] = isolated_format.file_to_metadata(
+        continue
+      filepath = os.path.join(self.root_dir, infile)
+      key = (
+          filepath, self.saved_state.read_only, self.saved_state.algo,
+          collapse_symlinks)
+      metadata = metadata_cache.get(key) if metadata_cache is not None else None
+      if metadata is None:
+        metadata = isolated_format.file_to_metadata(
             filepath,
             self.saved_state.files[infile],
             self.saved_state.read_only,
             self.saved_state.algo,
             collapse_symlinks)
+        if metadata_cache is not None:
+          metadata_cache[key] = metadata
+      self.saved_state.files[infile] = metadata.copy()
 
   def save_files(self):
     """Saves self.saved_state and creates a .isolated file."""
@@ -620,7 +632,8 @@ class CompleteState(object):
     return out
 
 
-def load_complete_state(options, cwd, subdir, skip_update):
+def load_complete_state(
+    options, cwd, subdir, skip_update, metadata_cache=None):
   """Loads a CompleteState.
 
   This includes data from .isolate and .isolated.state files. Never reads the
@@ -635,6 +648,9 @@ def load_complete_state(options, cwd, subdir, skip_update):
             to CompleteState.root_dir.
     skip_update: Skip trying to load the .isolate file and processing the
                  dependencies. It is useful when not needed, like when tracing.
+    metadata_cache: optional dict shared across calls so files common to
+                    multiple .isolate files are hashed once. See
+                    CompleteState.files_to_metadata().
   """
   assert not options.isolate or os.path.isabs(options.isolate)
   assert not options.isolated or os.path.isabs(options.isolated)
@@ -695,7 +711,8 @@ def load_complete_state(options, cwd, subdir, skip_update):
     subdir = subdir.replace('/', os.path.sep)
 
   if not skip_update:
-    complete_state.files_to_metadata(subdir, options.collapse_symlinks)
+    complete_state.files_to_metadata(
+        subdir, options.collapse_symlinks, metadata_cache)
   return complete_state
 
 
@@ -731,10 +748,13 @@ def create_isolate_tree(outdir, root_dir, files, relative_cwd, read_only):
 
 
 @tools.profile
-def prepare_for_archival(options, cwd):
-  """Loads the isolated file and create 'infiles' for archival."""
+def prepare_for_archival(options, cwd, metadata_cache=None):
+  """Loads the isolated file and create 'infiles' for archival.
+
+  See load_complete_state() for |metadata_cache|.
+  """
   complete_state = load_complete_state(
-      options, cwd, options.subdir, False)
+      options, cwd, options.subdir, False, metadata_cache)
   # Make sure that complete_state isn't modified until save_files() is
   # called, because any changes made to it here will propagate to the files
   # created (which is probably not intended).
@@ -795,13 +815,20 @@ def isolate_and_archive(trees, isolate_server, namespace):
   # hashing. The result is a list of generators that produce files to upload
   # and the mapping {target name -> hash of *.isolated file} to return from
   # this function.
+  #
+  # Trees usually share most of their files, e.g. shared libraries and test
+  # data, so the files' metadata is shared across trees: each unique file is
+  # stat'ed and hashed once. upload_tree() then deduplicates the files and
+  # looks them up on the server in a single pass.
   files_generators = []
   isolated_hashes = {}
+  metadata_cache = {}
   with tools.Profiler('Isolate'):
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
-        complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
+        complete_state, files, isolated_hash = prepare_for_archival(
+            opts, cwd, metadata_cache)
         files_generators.append(emit_files(complete_state.root_dir, files))
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
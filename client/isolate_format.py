@@ -13,6 +13,7 @@ See more information at
 """
 
 import ast
+import hashlib
 import itertools
 import logging
 import os
@@ -26,6 +27,19 @@ from utils import fs
 # Valid variable name.
 VALID_VARIABLE = '[A-Za-z_][A-Za-z_0-9]*'
 
+_VARIABLE_RE = re.compile(r'<\((' + VALID_VARIABLE + r')\)')
+_SPLIT_VARIABLES_RE = re.compile(r'(<\(' + VALID_VARIABLE + r'\))')
+
+
+# Conditions compiled by compile_condition(), keyed by expression.
+_COMPILED_CONDITIONS = {}
+
+# .isolate files parsed by load_isolate_content(), without their includes.
+# Keyed by (isolate_dir, SHA-1 of the content), values are (Configs, includes).
+# Targets archived in the same process usually share most of their includes,
+# each is parsed and evaluated once.
+_PARSED_ISOLATES = {}
+
 
 class IsolateError(ValueError):
   """Generic failure to load a .isolate file."""
@@ -56,7 +70,7 @@ def determine_root_dir(relative_root, infiles):
 
 
 def replace_variable(part, variables):
-  m = re.match(r'<\((' + VALID_VARIABLE + ')\)', part)
+  m = _VARIABLE_RE.match(part)
   if m:
     if m.group(1) not in variables:
       raise IsolateError(
@@ -71,9 +85,10 @@ def eval_variables(item, variables):
 
   Note that the .isolate format is a subset of the .gyp dialect.
   """
+  if '<(' not in item:
+    return item
   return ''.join(
-      replace_variable(p, variables)
-      for p in re.split(r'(<\(' + VALID_VARIABLE + '\))', item))
+      replace_variable(p, variables) for p in _SPLIT_VARIABLES_RE.split(item))
 
 
 def pretty_print(variables, stdout):
@@ -183,6 +198,15 @@ def eval_content(content):
   return value
 
 
+def compile_condition(expr):
+  """Returns the code object of a GYP condition, compiled once per process."""
+  code = _COMPILED_CONDITIONS.get(expr)
+  if code is None:
+    code = compile(expr, '<condition>', 'eval')
+    _COMPILED_CONDITIONS[expr] = code
+  return code
+
+
 def match_configs(expr, config_variables, all_configs):
   """Returns the list of values from |values| that match the condition |expr|.
 
@@ -211,6 +235,7 @@ def match_configs(expr, config_variables, all_configs):
             for line in all_configs)
         ))
 
+  code = compile_condition(expr)
   out = []
   for variables, configs in combinations:
     # Strip variables and see if expr can still be evaluated.
@@ -218,7 +243,7 @@ def match_configs(expr, config_variables, all_configs):
       globs = {'__builtins__': None}
       globs.update(zip(variables, (v for v in values if v is not None)))
       try:
-        assertion = eval(expr, globs, {})
+        assertion = eval(code, globs, {})
       except NameError:
         continue
       if not isinstance(assertion, bool):
@@ -529,6 +554,20 @@ class Configs(object):
       out.set_config(key, l.union(r) if (l and r) else (l or r))
     return out
 
+  def strip_command(self):
+    """Returns a new Configs instance without any command.
+
+    The ConfigSettings are immutable and may be shared with other Configs, so
+    new ones are created.
+    """
+    out = Configs(self.file_comment, self._config_variables)
+    for k, v in self._by_config.iteritems():
+      if v.command:
+        v = ConfigSettings(
+            {'files': v.files, 'read_only': v.read_only}, v.isolate_dir)
+      out._by_config[k] = v
+    return out
+
   def flatten(self):
     """Returns a flat dictionary representation of the configuration.
     """
@@ -551,10 +590,24 @@ def load_included_isolate(isolate_dir, isolate_path):
       raise IsolateError(
           'Can\'t reference a .isolate file from another drive')
   with fs.open(included_isolate, 'r') as f:
-    return load_isolate_as_config(
-        os.path.dirname(included_isolate),
-        eval_content(f.read()),
-        None)
+    return load_isolate_content(os.path.dirname(included_isolate), f.read())
+
+
+def load_isolate_content(isolate_dir, content):
+  """Parses the content of one .isolate file and returns a Configs() instance.
+
+  Same as load_isolate_as_config() but the file is only evaluated the first
+  time it is seen in this process; its includes are still read every time so
+  modified includes are taken in account.
+  """
+  key = (isolate_dir, hashlib.sha1(content).digest())
+  parsed = _PARSED_ISOLATES.get(key)
+  if parsed is None:
+    value = eval_content(content)
+    parsed = (
+        _load_conditions(isolate_dir, value, None), value.get('includes', []))
+    _PARSED_ISOLATES[key] = parsed
+  return _load_includes(isolate_dir, parsed[0], parsed[1])
 
 
 def load_isolate_as_config(isolate_dir, value, file_comment):
@@ -591,6 +644,15 @@ def load_isolate_as_config(isolate_dir, value, file_comment):
     },
   }
   """
+  isolate = _load_conditions(isolate_dir, value, file_comment)
+  return _load_includes(isolate_dir, isolate, value.get('includes', []))
+
+
+def _load_conditions(isolate_dir, value, file_comment):
+  """Returns a Configs() instance for a .isolate file, ignoring its includes.
+
+  See load_isolate_as_config() for the arguments.
+  """
   assert os.path.isabs(isolate_dir), isolate_dir
   if any(len(cond) == 3 for cond in value.get('conditions', [])):
     raise IsolateError('Using \'else\' is not supported anymore.')
@@ -618,19 +680,22 @@ def load_isolate_as_config(isolate_dir, value, file_comment):
     for config in configs:
       new.set_config(config, ConfigSettings(then['variables'], isolate_dir))
     isolate = isolate.union(new)
+  return isolate
+
 
+def _load_includes(isolate_dir, isolate, includes):
+  """Returns the union of the Configs() instance isolate and its includes."""
   # If the .isolate contains command, ignore any command in child .isolate.
   root_has_command = any(c.command for c in isolate._by_config.itervalues())
 
   # Load the includes. Process them in reverse so the last one take precedence.
-  for include in reversed(value.get('includes', [])):
+  for include in reversed(includes):
     included = load_included_isolate(isolate_dir, include)
     if root_has_command:
       # Strip any command in the imported isolate. It is because the chosen
       # command is not related to the one in the top-most .isolate, since the
       # configuration is flattened.
-      for c in included._by_config.itervalues():
-        c.command = []
+      included = included.strip_command()
     isolate = isolate.union(included)
 
   return isolate
@@ -646,7 +711,7 @@ def load_isolate_for_config(isolate_dir, content, config_variables):
   """
   # Load the .isolate file, process its conditions, retrieve the command and
   # dependencies.
-  isolate = load_isolate_as_config(isolate_dir, eval_content(content), None)
+  isolate = load_isolate_content(isolate_dir, content)
   try:
     config_name = tuple(
         config_variables[var] for var in isolate.config_variables)
@@ -660,4 +725,5 @@ def load_isolate_for_config(isolate_dir, content, config_variables):
   # variables.
   config = isolate.get_config(config_name)
   dependencies = [f.replace('/', os.path.sep) for f in config.files]
-  return config.command, dependencies, config.read_only, config.isolate_dir
+  return (
+      config.command[:], dependencies, config.read_only, config.isolate_dir)
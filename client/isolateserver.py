@@ -1719,14 +1719,21 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
-  """Returns the FileItem list and .isolated metadata for a directory."""
+def directory_to_metadata(root, algo, blacklist, prevdict=None):
+  """Returns the FileItem list and .isolated metadata for a directory.
+
+  prevdict is an optional dict {absolute path: metadata} of files processed
+  earlier by isolated_format.file_to_metadata(). The hash of the files whose
+  size and timestamp didn't change since is reused.
+  """
   root = file_path.get_native_path_case(root)
   paths = isolated_format.expand_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
+  prevdict = prevdict or {}
   metadata = {
     relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo, False)
+        os.path.join(root, relpath),
+        prevdict.get(os.path.join(root, relpath), {}), 0, algo, False)
     for relpath in paths
   }
   for v in metadata.itervalues():
@@ -1742,7 +1749,7 @@ def directory_to_metadata(root, algo, blacklist):
   return items, metadata
 
 
-def archive_files_to_storage(storage, files, blacklist):
+def archive_files_to_storage(storage, files, blacklist, prevdict=None):
   """Stores every entries and returns the relevant data.
 
   Arguments:
@@ -1750,6 +1757,8 @@ def archive_files_to_storage(storage, files, blacklist):
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    prevdict: optional metadata of files in the directories hashed earlier,
+           see directory_to_metadata().
 
   Returns:
     tuple(list(tuple(hash, path)), list(FileItem cold), list(FileItem hot)).
@@ -1772,7 +1781,7 @@ def archive_files_to_storage(storage, files, blacklist):
         if fs.isdir(filepath):
           # Uploading a whole directory.
           items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+              filepath, storage.hash_algo, blacklist, prevdict)
 
           # Create the .isolated file.
           if not tempdir:
@@ -25,6 +25,14 @@ _StreamParamsBase = collections.namedtuple('_StreamParamsBase',
 BUTLER_MAGIC = 'BTLR1\x1e'
 
 
+# Default number of bytes buffered by a stream before they are sent to the
+# Butler in a single write.
+DEFAULT_FLUSH_SIZE = 64 * 1024
+
+# Default maximum number of seconds data stays buffered before being sent.
+DEFAULT_FLUSH_LATENCY = 0.1
+
+
 class StreamParams(_StreamParamsBase):
   """Defines the set of parameters to apply to a new stream."""
 
@@ -143,6 +151,99 @@ _default_registry = StreamProtocolRegistry()
 create = _default_registry.create
 
 
+class _BufferedWriter(object):
+  """Buffers writes to a file-like object and sends them in batches.
+
+  Buffered data is written once it reaches flush_size bytes, or flush_latency
+  seconds after the first buffered write, whichever comes first. The timed
+  flush happens on a background thread.
+
+  The caller writing the batch blocks until the underlying object accepted it.
+  This means a slow Butler slows down the writer instead of letting the buffer
+  grow without bound.
+  """
+
+  def __init__(self, fd, flush_size, flush_latency):
+    """
+    Args:
+      fd (file): The file-like object to write to.
+      flush_size (int): Number of buffered bytes triggering a write.
+      flush_latency (float or None): Maximum number of seconds data stays
+          buffered. If None, data is only written when flush_size is reached,
+          on flush() and on close().
+    """
+    self._fd = fd
+    self._flush_size = flush_size
+    self._flush_latency = flush_latency
+    # Protects the members below.
+    self._lock = threading.Lock()
+    self._buf = []
+    self._buf_size = 0
+    self._timer = None
+    # Exception raised by a timed flush, reraised to the writer.
+    self._error = None
+    self._closed = False
+    # Serializes writes to fd.
+    self._write_lock = threading.Lock()
+
+  def write(self, data):
+    with self._lock:
+      self._check()
+      self._buf.append(data)
+      self._buf_size += len(data)
+      full = self._buf_size >= self._flush_size
+      if (not full and self._timer is None and
+          self._flush_latency is not None):
+        self._timer = threading.Timer(self._flush_latency, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+    if full:
+      self.flush()
+
+  def flush(self):
+    """Writes the buffered data to the underlying object."""
+    with self._write_lock:
+      with self._lock:
+        self._check()
+        data = ''.join(self._buf)
+        self._buf = []
+        self._buf_size = 0
+      if data:
+        self._fd.write(data)
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      with self._lock:
+        self._closed = True
+        if self._timer:
+          self._timer.cancel()
+          self._timer = None
+      self._fd.close()
+
+  def _check(self):
+    """Raises the error of a previous timed flush, if any."""
+    if self._closed:
+      raise ValueError('Write to a closed stream')
+    if self._error:
+      error, self._error = self._error, None
+      raise error
+
+  def _on_timer(self):
+    # The timer is not cancelled when flush_size is reached, so there's at
+    # most one timer per flush_latency period, not one per flush.
+    with self._lock:
+      self._timer = None
+      if self._closed:
+        return
+    try:
+      self.flush()
+    except Exception as e:
+      with self._lock:
+        self._error = self._error or e
+
+
 class StreamClient(object):
   """Abstract base class for a streamserver client.
   """
@@ -194,6 +295,11 @@ class StreamClient(object):
     def write(self, data):
       return self._fd.write(data)
 
+    def flush(self):
+      """Sends the buffered data, if the stream is buffered."""
+      if hasattr(self._fd, 'flush'):
+        self._fd.flush()
+
     def close(self):
       return self._fd.close()
 
@@ -206,14 +312,22 @@ class StreamClient(object):
       self._fd = fd
 
     def send(self, data):
+      # Buffered datagrams are batched together in a single write.
       varint.write_uvarint(self._fd, len(data))
       self._fd.write(data)
 
+    def flush(self):
+      """Sends the buffered datagrams, if the stream is buffered."""
+      if hasattr(self._fd, 'flush'):
+        self._fd.flush()
+
     def close(self):
       return self._fd.close()
 
 
-  def __init__(self, project=None, prefix=None, coordinator_host=None):
+  def __init__(self, project=None, prefix=None, coordinator_host=None,
+               flush_size=DEFAULT_FLUSH_SIZE,
+               flush_latency=DEFAULT_FLUSH_LATENCY):
     """Constructs a new base StreamClient instance.
 
     Args:
@@ -222,10 +336,17 @@ class StreamClient(object):
       coordinator_host (str or None): If not None, the name of the Coordinator
           host that this stream client is bound to. This will be used to
           construct viewer URLs for generated streams.
+      flush_size (int): Number of bytes buffered by the streams before they
+          are sent to the Butler. If 0, writes are not buffered.
+      flush_latency (float or None): Maximum number of seconds data stays
+          buffered in the streams. If None, buffered data is sent only once
+          flush_size is reached or when the stream is flushed or closed.
     """
     self._project = project
     self._prefix = prefix
     self._coordinator_host = coordinator_host
+    self._flush_size = flush_size
+    self._flush_latency = flush_latency
 
     self._name_lock = threading.Lock()
     self._names = set()
@@ -352,6 +473,17 @@ class StreamClient(object):
     fd.write(params_json)
     return fd
 
+  def _new_stream_fd(self, params):
+    """Returns (file): A new configured stream, buffered as configured.
+
+    Args:
+      params (StreamParams): The parameters to use with the new connection.
+    """
+    fd = self.new_connection(params)
+    if self._flush_size:
+      fd = _BufferedWriter(fd, self._flush_size, self._flush_latency)
+    return fd
+
   @contextlib.contextmanager
   def text(self, name, **kwargs):
     """Context manager to create, use, and teardown a TEXT stream.
@@ -403,7 +535,7 @@ class StreamClient(object):
         tags=tags,
         tee=tee,
         binary_file_extension=binary_file_extension)
-    return self._BasicStream(self, params, self.new_connection(params))
+    return self._BasicStream(self, params, self._new_stream_fd(params))
 
   @contextlib.contextmanager
   def binary(self, name, **kwargs):
@@ -456,7 +588,7 @@ class StreamClient(object):
         tags=tags,
         tee=tee,
         binary_file_extension=binary_file_extension)
-    return self._BasicStream(self, params, self.new_connection(params))
+    return self._BasicStream(self, params, self._new_stream_fd(params))
 
   @contextlib.contextmanager
   def datagram(self, name, **kwargs):
@@ -507,7 +639,7 @@ class StreamClient(object):
         tags=tags,
         tee=tee,
         binary_file_extension=binary_file_extension)
-    return self._DatagramStream(self, params, self.new_connection(params))
+    return self._DatagramStream(self, params, self._new_stream_fd(params))
 
 
 class _NamedPipeStreamClient(StreamClient):
@@ -544,7 +676,7 @@ class _UnixDomainSocketStreamClient(StreamClient):
       self._fd = fd
 
     def write(self, data):
-      self._fd.send(data)
+      self._fd.sendall(data)
 
     def close(self):
       self._fd.close()
@@ -4,8 +4,14 @@
 # that can be found in the LICENSE file.
 
 import json
+import logging
 import os
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
 import StringIO
 
@@ -69,6 +75,7 @@ class StreamClientTestCase(unittest.TestCase):
     def __init__(self):
       self.buffer = StringIO.StringIO()
       self.closed = False
+      self.writes = 0
 
     def _assert_not_closed(self):
       if self.closed:
@@ -77,6 +84,7 @@ class StreamClientTestCase(unittest.TestCase):
     def write(self, v):
       self._assert_not_closed()
       self.buffer.write(v)
+      self.writes += 1
 
     def close(self):
       self._assert_not_closed()
@@ -267,6 +275,163 @@ class StreamClientTestCase(unittest.TestCase):
     self.assertEqual(header, {'name': 'mystream', 'type': 'text'})
     self.assertEqual(data, 'Using a text stream.')
 
+  def testBufferedTextStream(self):
+    client = self._registry.create(
+        'test:value', flush_size=10, flush_latency=None)
+    with client.text('mystream') as fd:
+      conn = client.last_conn
+      header_writes = conn.writes
+      for _ in xrange(4):
+        fd.write('abc')
+      # The 4th write reached flush_size.
+      self.assertEqual(header_writes + 1, conn.writes)
+      fd.write('d')
+      fd.flush()
+      self.assertEqual(header_writes + 2, conn.writes)
+      fd.write('e')
+
+    self.assertTrue(conn.closed)
+    self.assertEqual(header_writes + 3, conn.writes)
+    _, data = conn.interpret()
+    self.assertEqual(data, 'abcabcabcabcde')
+
+  def testBufferedStreamLatency(self):
+    client = self._registry.create(
+        'test:value', flush_size=1024, flush_latency=0.01)
+    with client.binary('mystream') as fd:
+      conn = client.last_conn
+      fd.write('abc')
+      fd.write('def')
+      deadline = time.time() + 5
+      while not conn.buffer.getvalue().endswith('abcdef'):
+        self.assertLess(time.time(), deadline)
+        time.sleep(0.01)
+    _, data = conn.interpret()
+    self.assertEqual(data, 'abcdef')
+
+  def testBufferedDatagramStream(self):
+    client = self._registry.create(
+        'test:value', flush_size=1024, flush_latency=None)
+    with client.datagram('mystream') as fd:
+      conn = client.last_conn
+      header_writes = conn.writes
+      for i in xrange(100):
+        fd.send('dg%d' % i)
+
+    # All the datagrams were sent in one write.
+    self.assertEqual(header_writes + 1, conn.writes)
+    _, data = conn.interpret()
+    self.assertEqual(list(self._split_datagrams(data)),
+        ['dg%d' % i for i in xrange(100)])
+
+  def testUnbufferedStream(self):
+    client = self._registry.create('test:value', flush_size=0)
+    with client.text('mystream') as fd:
+      conn = client.last_conn
+      header_writes = conn.writes
+      fd.write('a')
+      fd.write('b')
+      self.assertEqual(header_writes + 2, conn.writes)
+
+
+class FakeButler(object):
+  """Local UNIX domain socket stream server accepting a single stream.
+
+  Reads and discards the stream content, recording the number of bytes and
+  the number of reads. Reading starts when 'reading' is set.
+  """
+
+  def __init__(self):
+    self.tempdir = tempfile.mkdtemp(prefix='stream_test')
+    self.path = os.path.join(self.tempdir, 'butler.sock')
+    self.reading = threading.Event()
+    self.received = 0
+    self.reads = 0
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.bind(self.path)
+    self._sock.listen(1)
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    conn, _ = self._sock.accept()
+    self.reading.wait()
+    while True:
+      data = conn.recv(1024 * 1024)
+      if not data:
+        break
+      self.received += len(data)
+      self.reads += 1
+    conn.close()
+
+  def join(self):
+    self._thread.join()
+    self._sock.close()
+    shutil.rmtree(self.tempdir)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires UNIX sockets')
+class StreamThroughputTestCase(unittest.TestCase):
+
+  @staticmethod
+  def write_lines(butler, count, **kwargs):
+    """Writes count short lines to a text stream, returns the duration."""
+    client = stream.create('unix:%s' % butler.path, **kwargs)
+    start = time.time()
+    with client.text('mystream') as fd:
+      for i in xrange(count):
+        fd.write('line %d\n' % i)
+    return time.time() - start
+
+  def run_butler(self, count, **kwargs):
+    butler = FakeButler()
+    butler.reading.set()
+    try:
+      duration = self.write_lines(butler, count, **kwargs)
+    finally:
+      butler.join()
+    return butler, duration
+
+  def testThroughput(self):
+    unbuffered, unbuffered_duration = self.run_butler(20000, flush_size=0)
+    buffered, buffered_duration = self.run_butler(20000)
+    logging.info(
+        'Unbuffered: %d reads, %.3fs; buffered: %d reads, %.3fs',
+        unbuffered.reads, unbuffered_duration,
+        buffered.reads, buffered_duration)
+    self.assertEqual(unbuffered.received, buffered.received)
+    self.assertLess(buffered.reads, 20)
+    self.assertLess(buffered_duration, unbuffered_duration)
+
+  def testBackpressure(self):
+    # The Butler doesn't read, the writer ends up blocked instead of buffering
+    # everything in memory.
+    butler = FakeButler()
+    written = []
+    def write():
+      client = stream.create('unix:%s' % butler.path, flush_size=1024)
+      with client.binary('mystream') as fd:
+        for _ in xrange(64 * 1024):
+          fd.write('x' * 256)
+          written.append(256)
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    try:
+      time.sleep(0.2)
+      self.assertTrue(writer.is_alive())
+      # At most the socket buffers plus one flush are pending.
+      self.assertLess(sum(written), 8 * 1024 * 1024)
+    finally:
+      butler.reading.set()
+      writer.join(10)
+      butler.join()
+    self.assertFalse(writer.is_alive())
+    self.assertEqual(64 * 1024 * 256, sum(written))
+
 
 if __name__ == '__main__':
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
   unittest.main()
@@ -5,12 +5,15 @@
 """This file implements Named Caches."""
 
 import contextlib
+import json
 import logging
 import optparse
 import os
 import random
 import re
 import string
+import sys
+import threading
 
 from utils import lru
 from utils import file_path
@@ -22,6 +25,14 @@ from utils import threading_utils
 CACHE_NAME_RE = re.compile(ur'^[a-z0-9_]{1,4096}$')
 MAX_CACHE_SIZE = 50
 
+# Directory in root_dir where evicted caches are moved to until they are
+# deleted by CacheManager.cleanup().
+TRASH_DIR = u'trash'
+
+# File in root_dir keeping the size in bytes of the cache directories, keyed by
+# their path relative to root_dir.
+SIZES_FILE = u'sizes.json'
+
 
 class Error(Exception):
   """Named cache specific error."""
@@ -51,6 +62,12 @@ class CacheManager(object):
     # LRU {cache_name -> cache_location}
     # It is saved to |root_dir|/state.json.
     self._lru = None
+    # {relative path -> size in bytes} of cache and trash directories, loaded
+    # lazily. It is saved to |root_dir|/sizes.json. It is shared with
+    # cleanup(), which may run in another thread, so it is guarded by its own
+    # lock instead of self._lock.
+    self._sizes = None
+    self._sizes_lock = threading.Lock()
 
   @contextlib.contextmanager
   def open(self, time_fn=None):
@@ -74,6 +91,8 @@ class CacheManager(object):
           logging.exception('failed to load named cache state file')
           logging.warning('deleting named caches')
           file_path.rmtree(self.root_dir)
+          with self._sizes_lock:
+            self._sizes = {}
       self._lru = self._lru or lru.LRUDict()
       if time_fn:
         self._lru.time_fn = time_fn
@@ -82,6 +101,13 @@ class CacheManager(object):
       finally:
         file_path.ensure_tree(self.root_dir)
         self._lru.save(state_path)
+        with self._sizes_lock:
+          sizes = self._load_sizes()
+          known = set(self._lru.itervalues())
+          for rel_path in sizes.keys():
+            if rel_path not in known and not _is_trash(rel_path):
+              del sizes[rel_path]
+          self._save_sizes()
         self._lru = None
 
   def __len__(self):
@@ -188,6 +214,8 @@ class CacheManager(object):
       file_path.ensure_tree(os.path.dirname(abs_cache))
       fs.rename(path, abs_cache)
       self._lru.add(name, rel_cache)
+      # The task likely modified the cache, cleanup() measures it again.
+      self._set_size(rel_cache, None)
 
       if create_named_link:
         # Create symlink <root_dir>/<named>/<name> -> <root_dir>/<short name>
@@ -212,6 +240,11 @@ class CacheManager(object):
 
     If min_free_space is None, disk free space is not checked.
 
+    Caches of known size are moved to the trash directory and only deleted
+    by cleanup(), unless the free disk space is still below min_free_space
+    afterward; in that case just enough of the trash is deleted right away.
+    Caches of unknown size are deleted right away.
+
     NamedCache must be open.
 
     Returns:
@@ -224,7 +257,7 @@ class CacheManager(object):
     total = 0
     free_space = 0
     if min_free_space:
-      free_space = file_path.get_free_space(self.root_dir)
+      free_space = self._get_projected_free_space()
     while ((min_free_space and free_space < min_free_space)
            or len(self._lru) > MAX_CACHE_SIZE):
       logging.info(
@@ -235,12 +268,87 @@ class CacheManager(object):
       except KeyError:
         return total
       logging.info('Removing named cache %r', name)
-      self._remove(name)
+      self._remove(name, evict=True)
       if min_free_space:
-        free_space = file_path.get_free_space(self.root_dir)
+        free_space = self._get_projected_free_space()
       total += 1
+
+    if min_free_space:
+      has_space = lambda: (
+          file_path.get_free_space(self.root_dir) >= min_free_space)
+      if not has_space():
+        logging.info('Deleting trash to make space for named cache')
+        self._empty_trash(has_space)
     return total
 
+  def cleanup(self, stop=None):
+    """Deletes evicted caches and measures the caches of unknown size.
+
+    The cache manager does not need to be open, this function is meant to run
+    in a background thread while the caches are in use. Items are processed
+    one at a time and the sizes file is updated after each of them, so the
+    work left when stop is set or when the process is killed is resumed by the
+    next call.
+
+    Arguments:
+      stop: optional threading.Event, the function returns soon after it is
+          set.
+
+    Returns:
+      True if all the work was done.
+    """
+    should_stop = lambda: bool(stop and stop.is_set())
+    if not self._empty_trash(should_stop):
+      return False
+
+    if not fs.isdir(self.root_dir):
+      return True
+    for rel_path in sorted(fs.listdir(self.root_dir)):
+      if should_stop():
+        return False
+      abs_path = os.path.join(self.root_dir, rel_path)
+      if rel_path in (u'named', TRASH_DIR) or not fs.isdir(abs_path):
+        continue
+      with self._sizes_lock:
+        if rel_path in self._load_sizes():
+          continue
+      size = _get_tree_size(abs_path, should_stop)
+      # The directory may have been installed in the meantime.
+      if size is not None and fs.isdir(abs_path):
+        self._set_size(rel_path, size)
+    return True
+
+  def _empty_trash(self, should_stop):
+    """Deletes the trash directory one file at a time.
+
+    Returns:
+      True if the trash was emptied, False if should_stop() returned True.
+    """
+    trash_dir = os.path.join(self.root_dir, TRASH_DIR)
+    if not fs.isdir(trash_dir):
+      return True
+    for name in sorted(fs.listdir(trash_dir)):
+      if should_stop():
+        return False
+      rel_path = os.path.join(TRASH_DIR, name)
+      abs_path = os.path.join(self.root_dir, rel_path)
+      deleted = _delete_tree(abs_path, should_stop)
+      with self._sizes_lock:
+        sizes = self._load_sizes()
+        if fs.exists(abs_path):
+          # Interrupted, only account for what is left.
+          if rel_path in sizes:
+            sizes[rel_path] = max(0, sizes[rel_path] - deleted)
+        else:
+          sizes.pop(rel_path, None)
+        self._save_sizes()
+    try:
+      fs.rmdir(trash_dir)
+    except OSError:
+      # Not empty anymore or interrupted.
+      pass
+    return not should_stop()
+
   _DIR_ALPHABET = string.ascii_letters + string.digits
 
   def _allocate_dir(self):
@@ -262,13 +370,13 @@ class CacheManager(object):
       tried.add(rel_path)
     raise Error('could not allocate a new cache dir, too many cache dirs')
 
-  def _remove(self, name):
+  def _remove(self, name, evict=False):
     """Removes a cache directory and entry.
 
-    NamedCache must be open.
+    If evict is True and the size of the cache is known, the directory is
+    moved to the trash directory instead of being deleted.
 
-    Returns:
-      Number of caches deleted.
+    NamedCache must be open.
     """
     self._lock.assert_locked()
     rel_path = self._lru.get(name)
@@ -280,10 +388,94 @@ class CacheManager(object):
       fs.unlink(named_dir)
 
     abs_path = os.path.join(self.root_dir, rel_path)
+    size = self._set_size(rel_path, None)
     if os.path.isdir(abs_path):
-      file_path.rmtree(abs_path)
+      if not evict or size is None or not self._move_to_trash(rel_path, size):
+        file_path.rmtree(abs_path)
     self._lru.pop(name)
 
+  def _move_to_trash(self, rel_path, size):
+    """Moves a cache directory to the trash directory.
+
+    Returns:
+      True on success.
+    """
+    trash_dir = os.path.join(self.root_dir, TRASH_DIR)
+    i = 0
+    while fs.exists(os.path.join(trash_dir, u'%s_%d' % (rel_path, i))):
+      i += 1
+    rel_trash = os.path.join(TRASH_DIR, u'%s_%d' % (rel_path, i))
+    try:
+      file_path.ensure_tree(trash_dir)
+      fs.rename(
+          os.path.join(self.root_dir, rel_path),
+          os.path.join(self.root_dir, rel_trash))
+    except OSError as e:
+      logging.warning('Failed to move %r to trash: %s', rel_path, e)
+      return False
+    logging.info('Moved %r (%d bytes) to trash', rel_path, size)
+    self._set_size(rel_trash, size)
+    return True
+
+  def _get_projected_free_space(self):
+    """Returns free disk space once the trash directory is deleted."""
+    with self._sizes_lock:
+      pending = sum(
+          size for rel_path, size in self._load_sizes().iteritems()
+          if _is_trash(rel_path))
+    return file_path.get_free_space(self.root_dir) + pending
+
+  def _set_size(self, rel_path, size):
+    """Sets the size of a directory, or forgets it if size is None.
+
+    Returns:
+      The previous size, or None if it was unknown.
+    """
+    with self._sizes_lock:
+      sizes = self._load_sizes()
+      previous = sizes.pop(rel_path, None)
+      if size is not None:
+        sizes[rel_path] = size
+      if previous != size:
+        self._save_sizes()
+      return previous
+
+  def _load_sizes(self):
+    """Returns self._sizes, loading it from disk if needed.
+
+    self._sizes_lock must be held.
+    """
+    if self._sizes is None:
+      self._sizes = {}
+      sizes_path = os.path.join(self.root_dir, SIZES_FILE)
+      try:
+        with fs.open(sizes_path, 'rb') as f:
+          sizes = json.load(f)
+        self._sizes = {
+          unicode(k): int(v) for k, v in sizes.iteritems() if v >= 0
+        }
+      except (IOError, OSError):
+        pass
+      except (AttributeError, TypeError, ValueError):
+        logging.warning('Ignoring corrupted %s', sizes_path)
+    return self._sizes
+
+  def _save_sizes(self):
+    """Saves self._sizes to disk.
+
+    self._sizes_lock must be held.
+    """
+    sizes_path = os.path.join(self.root_dir, SIZES_FILE)
+    try:
+      if self._sizes:
+        file_path.ensure_tree(self.root_dir)
+        file_path.atomic_replace(
+            sizes_path, json.dumps(self._sizes, sort_keys=True))
+      elif fs.exists(sizes_path):
+        fs.remove(sizes_path)
+    except (IOError, OSError) as e:
+      logging.warning('Failed to save %s: %s', sizes_path, e)
+
   def _get_named_path(self, name):
     return os.path.join(self.root_dir, 'named', name)
 
@@ -322,6 +514,74 @@ def process_named_cache_options(parser, options):
   return None
 
 
+def _is_trash(rel_path):
+  return rel_path.startswith(TRASH_DIR + os.sep)
+
+
+def _get_tree_size(root, should_stop):
+  """Returns the size in bytes of the files in a directory tree.
+
+  Returns None if the tree could not be measured or if should_stop() returned
+  True.
+  """
+  total = 0
+  try:
+    for dirpath, dirnames, filenames in fs.walk(root, onerror=_raise):
+      if should_stop():
+        return None
+      for name in dirnames + filenames:
+        total += fs.lstat(os.path.join(dirpath, name)).st_size
+  except OSError as e:
+    logging.warning('Failed to measure %r: %s', root, e)
+    return None
+  return total
+
+
+def _delete_tree(root, should_stop):
+  """Deletes a directory tree one file at a time.
+
+  Entries that cannot be deleted, e.g. files in use on Windows, are skipped so
+  the deletion can always be interrupted; the next call retries them.
+
+  Returns:
+    Number of bytes deleted, the directory still exists if should_stop()
+    returned True or if an entry could not be deleted.
+  """
+  deleted = 0
+  for dirpath, dirnames, filenames in fs.walk(root, topdown=False):
+    if sys.platform != 'win32':
+      # Deleting a directory fails if its parent directory is read-only.
+      file_path.set_read_only_swallow(dirpath, False)
+    for name in filenames:
+      if should_stop():
+        return deleted
+      path = os.path.join(dirpath, name)
+      try:
+        size = fs.lstat(path).st_size
+        file_path.remove(path)
+        deleted += size
+      except OSError as e:
+        logging.warning('Failed to delete %r: %s', path, e)
+    for name in dirnames:
+      path = os.path.join(dirpath, name)
+      try:
+        if fs.islink(path):
+          fs.unlink(path)
+        else:
+          fs.rmdir(path)
+      except OSError as e:
+        logging.warning('Failed to delete %r: %s', path, e)
+  try:
+    fs.rmdir(root)
+  except OSError as e:
+    logging.warning('Failed to delete %r: %s', root, e)
+  return deleted
+
+
+def _raise(e):
+  raise e
+
+
 def _check_abs(path):
   if not isinstance(path, unicode):
     raise Error('named cache installation path must be unicode')
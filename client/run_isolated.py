@@ -39,6 +39,7 @@ import optparse
 import os
 import sys
 import tempfile
+import threading
 import time
 
 from third_party.depot_tools import fix_encoding
@@ -54,6 +55,7 @@ from utils import zip_package
 
 import auth
 import cipd
+import isolated_format
 import isolateserver
 import named_cache
 
@@ -104,6 +106,14 @@ ISOLATED_RUN_DIR = u'ir'
 ISOLATED_OUT_DIR = u'io'
 ISOLATED_TMP_DIR = u'it'
 
+# Interval in seconds at which out_dir is scanned for new files while the task
+# runs, so they can be hashed before the task completes.
+OUTPUT_SCAN_INTERVAL = 5.
+
+# Minimum age in seconds of an output file before it is hashed while the task
+# runs. Hashing a file that is still being written is wasted work.
+OUTPUT_SETTLE_TIME = 2.
+
 
 OUTLIVING_ZOMBIE_MSG = """\
 *** Swarming tried multiple times to delete the %s directory and failed ***
@@ -378,9 +388,12 @@ def link_outputs_to_outdir(run_dir, out_dir, outputs):
       logging.info("Couldn't collect output file %s: %s", o, e)
 
 
-def delete_and_upload(storage, out_dir, leak_temp_dir):
+def delete_and_upload(storage, out_dir, leak_temp_dir, prevdict=None):
   """Deletes the temporary run directory and uploads results back.
 
+  prevdict is the metadata of the files in out_dir hashed earlier, see
+  OutputUploader.
+
   Returns:
     tuple(outputs_ref, success, stats)
     - outputs_ref: a dict referring to the results archived back to the isolated
@@ -401,7 +414,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
     with tools.Profiler('ArchiveOutput'):
       try:
         results, f_cold, f_hot = isolateserver.archive_files_to_storage(
-            storage, [out_dir], None)
+            storage, [out_dir], None, prevdict)
         outputs_ref = {
           'isolated': results[0][0],
           'isolatedserver': storage.location,
@@ -438,6 +451,90 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
   return outputs_ref, success, stats
 
 
+class OutputUploader(object):
+  """Hashes the files in out_dir while the task runs and uploads them after.
+
+  The upload runs in a background thread once started, so the run and temp
+  directories and the named caches can be cleaned up meanwhile.
+  """
+
+  def __init__(self, storage, out_dir, leak_temp_dir):
+    self._storage = storage
+    self._out_dir = out_dir
+    self._leak_temp_dir = leak_temp_dir
+    # {absolute path: metadata} of the files hashed so far.
+    self._prevdict = {}
+    self._stop = threading.Event()
+    self._scanner = None
+    self._uploader = None
+    # Result or sys.exc_info() of delete_and_upload().
+    self._result = None
+    self._exc_info = None
+
+  @property
+  def started(self):
+    return bool(self._uploader)
+
+  def scan(self):
+    """Starts hashing the files written to out_dir in a background thread."""
+    assert not self._scanner and not self._uploader
+    self._scanner = threading.Thread(target=self._run_scan, name='scan_outputs')
+    self._scanner.daemon = True
+    self._scanner.start()
+
+  def start(self):
+    """Starts the upload in a background thread.
+
+    The files in out_dir must not be modified anymore.
+    """
+    if self._uploader:
+      return
+    self._stop.set()
+    if self._scanner:
+      self._scanner.join()
+    self._uploader = threading.Thread(
+        target=self._run_upload, name='upload_outputs')
+    self._uploader.daemon = True
+    self._uploader.start()
+
+  def join(self):
+    """Waits for the upload and returns the result of delete_and_upload()."""
+    self.start()
+    self._uploader.join()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def _run_scan(self):
+    while not self._stop.wait(OUTPUT_SCAN_INTERVAL):
+      try:
+        self._hash_settled_files()
+      except (IOError, OSError, isolated_format.MappingError) as e:
+        # The task is modifying the directory, try again later.
+        logging.info('Failed to scan %s: %s', self._out_dir, e)
+
+  def _hash_settled_files(self):
+    now = time.time()
+    for root, _dirs, files in fs.walk(self._out_dir):
+      for name in files:
+        if self._stop.is_set():
+          return
+        path = os.path.join(root, name)
+        st = fs.lstat(path)
+        if now - st.st_mtime < OUTPUT_SETTLE_TIME:
+          continue
+        self._prevdict[path] = isolated_format.file_to_metadata(
+            path, self._prevdict.get(path, {}), 0, self._storage.hash_algo,
+            False)
+
+  def _run_upload(self):
+    try:
+      self._result = delete_and_upload(
+          self._storage, self._out_dir, self._leak_temp_dir, self._prevdict)
+    except Exception:
+      self._exc_info = sys.exc_info()
+
+
 def map_and_run(
     command, isolated_hash, storage, isolate_cache, outputs,
     install_named_caches, leak_temp_dir, root_dir, hard_timeout, grace_period,
@@ -504,6 +601,8 @@ def map_and_run(
   # storage should be normally set but don't crash if it is not. This can happen
   # as Swarming task can run without an isolate server.
   out_dir = make_temp_dir(ISOLATED_OUT_DIR, root_dir) if storage else None
+  uploader = (
+      OutputUploader(storage, out_dir, leak_temp_dir) if out_dir else None)
   tmp_dir = make_temp_dir(ISOLATED_TMP_DIR, root_dir)
   cwd = run_dir
 
@@ -546,6 +645,8 @@ def map_and_run(
 
       with install_named_caches(run_dir):
         sys.stdout.flush()
+        if uploader:
+          uploader.scan()
         start = time.time()
         try:
           result['exit_code'], result['had_hard_timeout'] = run_command(
@@ -553,6 +654,12 @@ def map_and_run(
               hard_timeout, grace_period)
         finally:
           result['duration'] = max(time.time() - start, 0)
+        # Upload the outputs while the named caches and the run directory are
+        # cleaned up. On Windows, the outputs may only be examined once
+        # run_dir is deleted, see below.
+        if uploader and sys.platform != 'win32':
+          link_outputs_to_outdir(run_dir, out_dir, outputs)
+          uploader.start()
   except Exception as e:
     # An internal error occurred. Report accordingly so the swarming task will
     # be retried automatically.
@@ -564,7 +671,7 @@ def map_and_run(
   finally:
     try:
       # Try to link files to the output directory, if specified.
-      if out_dir:
+      if uploader and not uploader.started:
         link_outputs_to_outdir(run_dir, out_dir, outputs)
 
       success = False
@@ -600,10 +707,10 @@ def map_and_run(
               result['exit_code'] = 1
 
       # This deletes out_dir if leak_temp_dir is not set.
-      if out_dir:
+      if uploader:
         isolated_stats = result['stats'].setdefault('isolated', {})
         result['outputs_ref'], success, isolated_stats['upload'] = (
-            delete_and_upload(storage, out_dir, leak_temp_dir))
+            uploader.join())
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
     except Exception as e:
@@ -718,7 +825,8 @@ def noop_install_packages(_run_dir):
   yield None
 
 
-def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout):
+def _install_packages(
+    run_dir, cipd_cache_dir, client, packages, timeout, instance_cache=None):
   """Calls 'cipd ensure' for packages.
 
   Args:
@@ -727,6 +835,7 @@ def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout):
     client (CipdClient): the cipd client to use
     packages: packages to install, list [(path, package_name, version), ...].
     timeout: max duration in seconds that this function can take.
+    instance_cache (cipd.InstanceCache): if set, cache of extracted packages.
 
   Returns: list of pinned packages.  Looks like [
     {
@@ -761,6 +870,7 @@ def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout):
     },
     cache_dir=cipd_cache_dir,
     timeout=timeout,
+    instance_cache=instance_cache,
   )
 
   for subdir, pin_list in sorted(pins.iteritems()):
@@ -830,8 +940,12 @@ def install_client_and_packages(
 
     package_pins = []
     if packages:
+      # Extracted package instances, hardlinked into run_dir.
+      instance_cache = cipd.InstanceCache(
+          unicode(os.path.join(cache_dir, 'instances')))
       package_pins = _install_packages(
-        run_dir, cipd_cache_dir, client, packages, timeoutfn())
+        run_dir, cipd_cache_dir, client, packages, timeoutfn(),
+        instance_cache=instance_cache)
 
     file_path.make_tree_files_read_only(run_dir)
 
@@ -1006,6 +1120,7 @@ def main(args):
     if options.named_caches:
       parser.error('Can\t use --named-cache with --clean.')
     clean_caches(options, isolate_cache, named_cache_manager)
+    named_cache_manager.cleanup()
     return 0
 
   if not options.no_clean:
@@ -1050,9 +1165,19 @@ def main(args):
     with named_cache_manager.open():
       for path, name in caches:
         named_cache_manager.install(path, name)
+    # Delete the caches evicted by clean_caches() while the task runs. The work
+    # left when the task completes is resumed by the next run.
+    stop = threading.Event()
+    cleanup = threading.Thread(
+        target=named_cache_manager.cleanup, args=(stop,),
+        name='named_cache_cleanup')
+    cleanup.daemon = True
+    cleanup.start()
     try:
       yield
     finally:
+      stop.set()
+      cleanup.join()
       with named_cache_manager.open():
         for path, name in caches:
           named_cache_manager.uninstall(path, name)
@@ -284,6 +284,22 @@ def mint_service_account_token(service_account):
 # How often to print status updates to stdout in 'collect'.
 STATUS_UPDATE_INTERVAL = 15 * 60.
 
+# Maximum number of tasks in a tasks/wait request. Keep in sync with
+# appengine/swarming/handlers_endpoints.py.
+WAIT_MAX_TASKS = 1000
+
+# Maximum number of seconds the server blocks on a tasks/wait request.
+WAIT_TIMEOUT = 30.
+
+# Number of consecutive failed tasks/wait requests after which each task is
+# polled instead.
+WAIT_MAX_ERRORS = 3
+
+# Maximum number of tasks in a tasks/wait request returning the output of the
+# completed tasks. The output of the tasks of larger groups is fetched per task
+# to keep the responses small.
+WAIT_OUTPUT_MAX_TASKS = 10
+
 
 class State(object):
   """States in which a task can be.
@@ -492,7 +508,6 @@ def retrieve_results(
   result_url = '%s/api/swarming/v1/task/%s/result' % (base_url, task_id)
   if include_perf:
     result_url += '?include_performance_stats=true'
-  output_url = '%s/api/swarming/v1/task/%s/stdout' % (base_url, task_id)
   started = now()
   deadline = started + timeout if timeout else None
   attempt = 0
@@ -542,19 +557,114 @@ def retrieve_results(
 
     if result['state'] in State.STATES_NOT_RUNNING:
       # TODO(maruel): Not always fetch stdout?
-      out = net.url_read_json(output_url)
-      result['output'] = out.get('output') if out else out
-      # Record the result, try to fetch attached output files (if any).
-      if output_collector:
-        # TODO(vadimsh): Respect |should_stop| and |deadline| when fetching.
-        output_collector.process_shard_result(shard_index, result)
-      if result.get('internal_failure'):
-        logging.error('Internal error!')
-      elif result['state'] == 'BOT_DIED':
-        logging.error('Bot died!')
+      result['output'] = _fetch_output(base_url, task_id)
+      process_result(shard_index, result, output_collector)
       return result
 
 
+def _fetch_output(base_url, task_id):
+  """Returns the output of a completed task, or None on failure."""
+  out = net.url_read_json(
+      '%s/api/swarming/v1/task/%s/stdout' % (base_url, task_id))
+  return out.get('output') if out else out
+
+
+def process_result(shard_index, result, output_collector):
+  """Records the result of a completed task.
+
+  Fetches the output files of the task, if any, with output_collector.
+  """
+  if output_collector:
+    # TODO(vadimsh): Respect |should_stop| and |deadline| when fetching.
+    output_collector.process_shard_result(shard_index, result)
+  if result.get('internal_failure'):
+    logging.error('Internal error!')
+  elif result['state'] == 'BOT_DIED':
+    logging.error('Bot died!')
+
+
+def wait_results(
+    base_url, shards, timeout, should_stop, include_perf, on_result):
+  """Waits for a group of tasks to complete over a single connection.
+
+  Uses tasks/wait, which blocks server side until any of the tasks changes
+  state, instead of polling the result and the output of each task. The output
+  is only included in the result dict for groups of at most
+  WAIT_OUTPUT_MAX_TASKS tasks.
+
+  Arguments:
+    shards: list of tuple(shard_index, task_id), at most WAIT_MAX_TASKS.
+    on_result: called with (shard_index, <result dict>) as soon as a task
+        completes, and with (shard_index, None) for the tasks which didn't
+        complete before the timeout or should_stop is set.
+
+  Returns:
+    False if the server doesn't support tasks/wait or if it failed
+    WAIT_MAX_ERRORS times in a row. on_result was not called for the tasks
+    still pending in this case.
+  """
+  assert timeout is None or isinstance(timeout, float), timeout
+  assert len(shards) <= WAIT_MAX_TASKS, len(shards)
+  url = '%s/api/swarming/v1/tasks/wait' % base_url
+  task_ids = [task_id for _, task_id in shards]
+  # Task ID -> shard indexes.
+  pending = {}
+  for shard_index, task_id in shards:
+    pending.setdefault(task_id, []).append(shard_index)
+  deadline = now() + timeout if timeout else None
+  include_output = len(shards) <= WAIT_OUTPUT_MAX_TASKS
+  cursor = None
+  errors = 0
+
+  while pending and not should_stop.is_set():
+    wait = WAIT_TIMEOUT
+    if deadline:
+      wait = min(wait, deadline - now())
+      if wait <= 0:
+        logging.error('wait_results(%s) timed out', base_url)
+        break
+
+    data = {
+      'include_output': include_output,
+      'include_performance_stats': include_perf,
+      'task_id': task_ids,
+      'timeout': wait,
+    }
+    if cursor:
+      data['cursor'] = cursor
+    result = net.url_read_json(url, data=data)
+    if not result:
+      if not cursor:
+        # The first request failed, assume an older server.
+        logging.warning('tasks/wait is not supported by %s', base_url)
+        return False
+      errors += 1
+      if errors >= WAIT_MAX_ERRORS:
+        logging.warning(
+            'tasks/wait failed %d times on %s, polling each task instead',
+            errors, base_url)
+        return False
+      # Transient errors are already retried by net, back off a bit more.
+      should_stop.wait(1.)
+      continue
+
+    errors = 0
+    cursor = result['cursor']
+    for item in result.get('items', []):
+      task_result = item['result']
+      if task_result['state'] not in State.STATES_NOT_RUNNING:
+        continue
+      if include_output:
+        task_result['output'] = item.get('output')
+      for shard_index in pending.pop(task_result['task_id'], []):
+        on_result(shard_index, task_result.copy())
+
+  for shard_indexes in pending.itervalues():
+    for shard_index in shard_indexes:
+      on_result(shard_index, None)
+  return True
+
+
 def convert_to_old_format(result):
   """Converts the task result data from Endpoints API format to old API format
   for compatibility.
@@ -622,12 +732,14 @@ def yield_results(
     (index, result). In particular, 'result' is defined as the
     GetRunnerResults() function in services/swarming/server/test_runner.py.
   """
-  number_threads = (
-      min(max_threads, len(task_ids)) if max_threads else len(task_ids))
+  number_threads = min(
+      max_threads or len(task_ids), len(task_ids), WAIT_MAX_TASKS)
   should_stop = threading.Event()
   results_channel = threading_utils.TaskChannel()
 
-  with threading_utils.ThreadPool(number_threads, number_threads, 0) as pool:
+  # Threads are started as needed. With tasks/wait, they are only used to
+  # fetch the output files of completed tasks.
+  with threading_utils.ThreadPool(0, number_threads, 0) as pool:
     try:
       # Adds a task to the thread pool to call 'retrieve_results' and return
       # the results together with shard_index that produced them (as a tuple).
@@ -637,9 +749,48 @@ def yield_results(
             0, results_channel.wrap_task(task_fn), swarm_base_url, shard_index,
             task_id, timeout, should_stop, output_collector, include_perf)
 
-      # Enqueue 'retrieve_results' calls for each shard key to run in parallel.
-      for shard_index, task_id in enumerate(task_ids):
-        enqueue_retrieve_results(shard_index, task_id)
+      # Adds a task to the thread pool to process a result received from
+      # 'wait_results'. result is None if the shard timed out.
+      def enqueue_result(shard_index, result):
+        def task_fn():
+          if result:
+            if 'output' not in result:
+              result['output'] = _fetch_output(
+                  swarm_base_url, result['task_id'])
+            process_result(shard_index, result, output_collector)
+          return shard_index, result
+        pool.add_task(0, results_channel.wrap_task(task_fn))
+
+      # Waits for a group of shards with a single connection, or falls back to
+      # polling each shard in parallel.
+      def wait_group(shards):
+        reported = set()
+        def on_result(shard_index, result):
+          reported.add(shard_index)
+          enqueue_result(shard_index, result)
+        try:
+          if not wait_results(
+              swarm_base_url, shards, timeout, should_stop, include_perf,
+              on_result):
+            for shard_index, task_id in shards:
+              if shard_index not in reported:
+                enqueue_retrieve_results(shard_index, task_id)
+        except threading_utils.ThreadPoolClosed:
+          # Aborted.
+          pass
+        except Exception:
+          logging.exception('Unexpected exception in wait_results')
+          for shard_index, _ in shards:
+            if shard_index not in reported:
+              enqueue_result(shard_index, None)
+
+      shards = list(enumerate(task_ids))
+      for i in xrange(0, len(shards), WAIT_MAX_TASKS):
+        thread = threading.Thread(
+            target=wait_group, args=(shards[i:i+WAIT_MAX_TASKS],),
+            name='wait_results')
+        thread.daemon = True
+        thread.start()
 
       # Wait for all of them to finish.
       shards_remaining = range(len(task_ids))
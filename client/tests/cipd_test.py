@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import StringIO
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
+
+from depot_tools import auto_stub
+from depot_tools import fix_encoding
+from utils import file_path
+from utils import fs
+from utils import net
+import cipd
+
+
+# Fake cipd client. Each package is extracted as a single file named after the
+# package, refs resolve to the version 'resolved'. Invocations are logged.
+FAKE_CIPD = r'''#!%(python)s
+import hashlib, json, os, sys
+
+with open(%(log)r, 'a') as f:
+  f.write(json.dumps(sys.argv[1:]) + '\n')
+def arg(name):
+  return sys.argv[sys.argv.index(name) + 1]
+root = arg('-root')
+result = {}
+subdir = None
+with open(arg('-ensure-file')) as f:
+  for line in f:
+    line = line.rstrip('\n')
+    if line.startswith('@Subdir'):
+      subdir = line[len('@Subdir '):]
+      result[subdir] = []
+      continue
+    package, version = line.split(' ')
+    if len(version) != 40 and ':' not in version:
+      version = 'resolved'
+    instance_id = (
+        version if len(version) == 40 else
+        hashlib.sha1('%%s %%s' %% (package, version)).hexdigest())
+    # Like the real client in its default 'symlink' install mode, the files
+    # are extracted in .cipd/pkgs and symlinked in the subdir.
+    name = package.replace('/', '_')
+    pkgdir = os.path.join(root, '.cipd', 'pkgs', name, '_current')
+    if not os.path.isdir(pkgdir):
+      os.makedirs(pkgdir)
+    with open(os.path.join(pkgdir, name), 'w') as f:
+      f.write(instance_id)
+    outdir = os.path.join(root, subdir)
+    if not os.path.isdir(outdir):
+      os.makedirs(outdir)
+    outfile = os.path.join(outdir, name)
+    if os.path.lexists(outfile):
+      os.remove(outfile)
+    os.symlink(
+        os.path.relpath(os.path.join(pkgdir, name), outdir), outfile)
+    result[subdir].append({'package': package, 'instance_id': instance_id})
+with open(arg('-json-output'), 'w') as f:
+  json.dump({'result': result}, f)
+'''
+
+
+def read_file(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake cipd client is a script')
+class CipdClientTest(unittest.TestCase):
+  def setUp(self):
+    super(CipdClientTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'cipd_test')
+    self.log = os.path.join(self.tempdir, 'log')
+    binary = os.path.join(self.tempdir, 'cipd')
+    with open(binary, 'w') as f:
+      f.write(FAKE_CIPD % {'python': sys.executable, 'log': self.log})
+    os.chmod(binary, 0700)
+    self.client = cipd.CipdClient(binary, 'infra/tools/cipd', 'a' * 40, None)
+    self.instance_cache = cipd.InstanceCache(
+        os.path.join(self.tempdir, u'instances'))
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(CipdClientTest, self).tearDown()
+
+  def ensure(self, site_root, packages):
+    return self.client.ensure(
+        os.path.join(self.tempdir, site_root), packages,
+        instance_cache=self.instance_cache)
+
+  def invocations(self):
+    if not os.path.isfile(self.log):
+      return 0
+    return len(read_file(self.log).splitlines())
+
+  def test_ensure_without_cache(self):
+    pins = self.client.ensure(
+        os.path.join(self.tempdir, u'site'), {'': [('a/b', 'git:1')]})
+    self.assertEqual(
+        {'': [('a/b', hashlib.sha1('a/b git:1').hexdigest())]}, pins)
+    self.assertEqual(1, self.invocations())
+    self.assertFalse(fs.isdir(self.instance_cache.root))
+
+  def test_ensure_cached(self):
+    packages = {
+      '': [('a/b', 'git:1'), ('c/d', 'c' * 40)],
+      'bin': [('e/f', 'git:2')],
+    }
+    expected = {
+      '': [('a/b', hashlib.sha1('a/b git:1').hexdigest()), ('c/d', 'c' * 40)],
+      'bin': [('e/f', hashlib.sha1('e/f git:2').hexdigest())],
+    }
+    self.assertEqual(expected, self.ensure(u'site1', packages))
+    self.assertEqual(1, self.invocations())
+    self.assertEqual(
+        sorted(['a_b', 'c_d', 'bin']),
+        sorted(os.listdir(os.path.join(self.tempdir, u'site1'))))
+
+    # A new InstanceCache reloads the pins.
+    self.instance_cache = cipd.InstanceCache(self.instance_cache.root)
+    self.assertEqual(expected, self.ensure(u'site2', packages))
+    # The cipd client wasn't run.
+    self.assertEqual(1, self.invocations())
+    for rel in ('a_b', 'c_d', os.path.join('bin', 'e_f')):
+      site1 = os.path.join(self.tempdir, 'site1', rel)
+      site2 = os.path.join(self.tempdir, 'site2', rel)
+      # The symlinks created by the cipd client were resolved before caching.
+      self.assertFalse(os.path.islink(site1))
+      self.assertFalse(os.path.islink(site2))
+      # Hardlinked from the cache.
+      self.assertEqual(os.stat(site1).st_ino, os.stat(site2).st_ino)
+    self.assertEqual(
+        'c' * 40, read_file(os.path.join(self.tempdir, 'site2', 'c_d')))
+
+  def test_ensure_refs(self):
+    # Refs may point to another instance at any time, they are always resolved
+    # by the cipd client.
+    packages = {'': [('a/b', 'latest'), ('c/d', 'git:1')]}
+    expected = {
+      '': [
+        ('a/b', hashlib.sha1('a/b resolved').hexdigest()),
+        ('c/d', hashlib.sha1('c/d git:1').hexdigest()),
+      ],
+    }
+    self.assertEqual(expected, self.ensure(u'site1', packages))
+    self.assertEqual(2, self.invocations())
+    self.assertEqual(expected, self.ensure(u'site2', packages))
+    self.assertEqual(3, self.invocations())
+    self.assertEqual(
+        sorted(['.cipd', 'a_b', 'c_d']),
+        sorted(os.listdir(os.path.join(self.tempdir, u'site2'))))
+
+  def test_trim(self):
+    self.instance_cache = cipd.InstanceCache(
+        self.instance_cache.root, max_instances=1)
+    self.ensure(u'site1', {'': [('a/b', 'git:1')]})
+    self.ensure(u'site2', {'': [('c/d', 'git:1')]})
+    self.assertEqual(
+        sorted([hashlib.sha1('c/d git:1').hexdigest(), u'pins.json']),
+        sorted(os.listdir(self.instance_cache.root)))
+    self.assertEqual(
+        {'c/d git:1': hashlib.sha1('c/d git:1').hexdigest()},
+        json.loads(read_file(
+            os.path.join(self.instance_cache.root, u'pins.json'))))
+    # The evicted instance is fetched again.
+    self.ensure(u'site3', {'': [('a/b', 'git:1')]})
+    self.assertEqual(3, self.invocations())
+
+
+class CipdApiTest(auto_stub.TestCase):
+  def test_get_client_fetch_url_coalesced(self):
+    # Concurrent requests for the same client instance are sent once.
+    service = net.HttpService('https://cipd.example.com', None)
+    requests = []
+    in_flight = threading.Event()
+    done = threading.Event()
+    def request(urlpath, *_args):
+      requests.append(urlpath)
+      in_flight.set()
+      done.wait()
+      content = json.dumps({
+        'status': 'SUCCESS',
+        'client_binary': {'fetch_url': 'https://fetch/cipd'},
+      })
+      return net.HttpResponse(StringIO.StringIO(content), urlpath, {})
+    self.mock(service, '_request', request)
+    self.mock(net, 'get_http_service', lambda *_args, **_kwargs: service)
+    results = []
+    def fetch():
+      results.append(cipd.get_client_fetch_url(
+          'https://cipd.example.com', 'infra/tools/cipd', 'a' * 40))
+    threads = [threading.Thread(target=fetch) for _ in xrange(2)]
+    threads[0].start()
+    in_flight.wait()
+    threads[1].start()
+    # pylint: disable=protected-access
+    while not service._in_flight.values()[0].followers:
+      threading.Event().wait(0.01)
+    done.set()
+    for t in threads:
+      t.join()
+    self.assertEqual(1, len(requests))
+    self.assertEqual(['https://fetch/cipd'] * 2, results)
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  VERBOSE = '-v' in sys.argv
+  logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
+  unittest.main()
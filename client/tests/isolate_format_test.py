@@ -8,6 +8,7 @@ import logging
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
@@ -995,6 +996,111 @@ class IsolateFormatTmpDirTest(unittest.TestCase):
     self.assertEqual(expected, actual.flatten())
 
 
+class IsolateFormatCacheTest(auto_stub.TestCase):
+  def setUp(self):
+    super(IsolateFormatCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolate_')
+    self.evaluated = []
+    eval_content = isolate_format.eval_content
+    def eval_content_hook(content):
+      self.evaluated.append(content)
+      return eval_content(content)
+    self.mock(isolate_format, 'eval_content', eval_content_hook)
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(IsolateFormatCacheTest, self).tearDown()
+
+  def write_isolate(self, name, value):
+    with open(os.path.join(self.tempdir, name), 'wb') as f:
+      isolate_format.pretty_print(value, f)
+
+  def load(self, value, config_variables):
+    out = cStringIO.StringIO()
+    isolate_format.pretty_print(value, out)
+    return isolate_format.load_isolate_for_config(
+        self.tempdir, out.getvalue(), config_variables)
+
+  def test_includes_parsed_once(self):
+    self.write_isolate('common.isolate', {
+      'conditions': [
+        ['OS=="linux"', {'variables': {'files': ['file_linux']}}],
+        ['OS=="mac"', {'variables': {'files': ['file_mac']}}],
+      ],
+    })
+    for i in xrange(3):
+      actual = self.load(
+          {
+            'includes': ['common.isolate'],
+            'variables': {'files': ['file_%d' % i]},
+          },
+          {'OS': 'linux'})
+      self.assertEqual(
+          ([], ['file_%d' % i, 'file_linux'], None, self.tempdir), actual)
+    # Each target was evaluated, the include only once.
+    self.assertEqual(4, len(self.evaluated))
+
+  def test_modified_include(self):
+    self.write_isolate('common.isolate', {'variables': {'files': ['a']}})
+    value = {'includes': ['common.isolate']}
+    self.assertEqual(['a'], self.load(value, {})[1])
+    self.write_isolate('common.isolate', {'variables': {'files': ['b']}})
+    self.assertEqual(['b'], self.load(value, {})[1])
+
+  def test_stripped_command_not_cached(self):
+    # The command of an include is ignored when the including .isolate has a
+    # command, it must not leak into the cached include.
+    self.write_isolate('common.isolate', {
+      'variables': {'command': ['included'], 'files': ['a']},
+    })
+    with_command = {
+      'includes': ['common.isolate'],
+      'variables': {'command': ['root']},
+    }
+    without_command = {'includes': ['common.isolate']}
+    self.assertEqual(['included'], self.load(without_command, {})[0])
+    self.assertEqual(['root'], self.load(with_command, {})[0])
+    self.assertEqual(['included'], self.load(without_command, {})[0])
+
+  def test_benchmark_shared_includes(self):
+    # Many targets sharing the same includes, like a batcharchive of all the
+    # tests of a build.
+    for i in xrange(20):
+      self.write_isolate('common_%d.isolate' % i, {
+        'conditions': [
+          ['OS=="%s" and component=="%s"' % (os_name, component), {
+            'variables': {
+              'files': ['lib_%d_%s_%s.so' % (i, os_name, component)],
+            },
+          }]
+          for os_name in ('android', 'linux', 'mac', 'win')
+          for component in ('shared_library', 'static_library')
+        ],
+      })
+    targets = [
+      {
+        'includes': ['common_%d.isolate' % i for i in xrange(20)],
+        'variables': {'command': ['test_%d' % j]},
+      }
+      for j in xrange(20)
+    ]
+    config = {'OS': 'linux', 'component': 'shared_library'}
+    def run(cached):
+      start = time.time()
+      for target in targets:
+        if not cached:
+          isolate_format._PARSED_ISOLATES.clear()
+          isolate_format._COMPILED_CONDITIONS.clear()
+        self.load(target, config)
+      return time.time() - start
+    uncached = run(False)
+    cached = run(True)
+    logging.info('Uncached: %.3fs; cached: %.3fs', uncached, cached)
+    self.assertLess(cached, uncached)
+
+
 if __name__ == '__main__':
   fix_encoding.fix_encoding()
   logging.basicConfig(
@@ -1427,6 +1427,60 @@ class IsolateCommand(IsolateBase):
     }
     self.assertEqual(expected_json, tools.read_json('json_output.json'))
 
+  def test_CMDbatcharchive_shared_files(self):
+    # Files shared by multiple targets are hashed once.
+    uploaded = []
+    self.mock(
+        isolateserver, 'upload_tree',
+        lambda base_url, infiles, namespace: uploaded.extend(infiles))
+    hashed = []
+    file_to_metadata = isolated_format.file_to_metadata
+    def mocked_file_to_metadata(filepath, *args):
+      hashed.append(filepath)
+      return file_to_metadata(filepath, *args)
+    self.mock(isolated_format, 'file_to_metadata', mocked_file_to_metadata)
+
+    def join(*path):
+      return os.path.join(self.cwd, *path)
+
+    for name in ('shared', 'x', 'y', 'z'):
+      with open(join(name), 'wb') as f:
+        f.write(name)
+    cmd = [
+      '--isolate-server', 'http://localhost:1',
+      '--dump-json', 'json_output.json',
+    ]
+    for name in ('x', 'y', 'z'):
+      with open(join('%s.isolate' % name), 'wb') as f:
+        f.write(
+            '{\'variables\': {\'files\': [\'shared\', \'%s\']}}' % name)
+      with open(join('%s.isolated.gen.json' % name), 'wb') as f:
+        json.dump({
+          'args': [
+            '-i', join('%s.isolate' % name),
+            '-s', join('%s.isolated' % name),
+          ],
+          'dir': self.cwd,
+          'version': 1,
+        }, f)
+      cmd.append(join('%s.isolated.gen.json' % name))
+
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    self.assertEqual(
+        0,
+        isolate.CMDbatcharchive(logging_utils.OptionParserWithLogging(), cmd))
+    self.assertEqual(
+        sorted(join(name) for name in ('shared', 'x', 'y', 'z')),
+        sorted(hashed))
+    shared = [meta for path, meta in uploaded if path == join('shared')]
+    self.assertEqual(3, len(shared))
+    self.assertEqual(
+        [isolated_format.hash_file(join('shared'), ALGO)] * 3,
+        [meta['h'] for meta in shared])
+    for name in ('x', 'y', 'z'):
+      isolated = tools.read_json(join('%s.isolated' % name))
+      self.assertEqual(['shared', name], sorted(isolated['files']))
+
   def test_CMDcheck_empty(self):
     isolate_file = os.path.join(self.cwd, 'x.isolate')
     isolated_file = os.path.join(self.cwd, 'x.isolated')
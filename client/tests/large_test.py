@@ -3,11 +3,14 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import itertools
 import logging
 import os
 import random
 import sys
+import time
 import unittest
+import zlib
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
     __file__.decode(sys.getfilesystemencoding()))))
@@ -16,6 +19,47 @@ sys.path.insert(0, ROOT_DIR)
 from utils import large
 
 
+def pack_bytewise(values):
+  """Reference implementation, encodes one byte at a time."""
+  out = ''
+  last = 0
+  for value in values:
+    delta = value - last
+    last = value
+    while delta > 127:
+      out += chr((1 << 7) | (delta & 0x7F))
+      delta >>= 7
+    out += chr(delta)
+  return zlib.compress(out) if values else ''
+
+
+def unpack_bytewise(data):
+  """Reference implementation, decodes one byte at a time."""
+  out = []
+  value = 0
+  base = 1
+  last = 0
+  for d in zlib.decompress(data) if data else '':
+    val_byte = ord(d)
+    value += (val_byte & 0x7F) * base
+    if val_byte & 0x80:
+      base <<= 7
+    else:
+      out.append(value + last)
+      last += value
+      value = 0
+      base = 1
+  return out
+
+
+def item_sizes(count):
+  """Returns sorted file sizes, distributed like the items of an isolated
+  tree: mostly small files with a long tail of large ones.
+  """
+  random.seed(0)
+  return sorted(int(random.lognormvariate(9, 3)) for _ in xrange(count))
+
+
 class LargeTest(unittest.TestCase):
   def test_1m_1(self):
     array = range(1000000)
@@ -40,6 +84,81 @@ class LargeTest(unittest.TestCase):
   def test_empty(self):
     self.assertEqual('', large.pack([]))
     self.assertEqual([], large.unpack(''))
+    self.assertEqual([], large.unpack(None))
+    self.assertEqual([], list(large.iter_unpack('')))
+    self.assertEqual('', large.Packer().finish())
+
+  def test_large_values(self):
+    array = [0, 127, 128, 2**14, 2**32, 2**63-1]
+    data = large.pack(array)
+    self.assertEqual(pack_bytewise(array), data)
+    self.assertEqual(array, large.unpack(data))
+    self.assertEqual(array, list(large.iter_unpack(data)))
+
+  def test_unsorted(self):
+    with self.assertRaises(AssertionError):
+      large.pack([2, 1])
+    with self.assertRaises(AssertionError):
+      large.pack([2**63])
+    with self.assertRaises(AssertionError):
+      large.Packer().extend([-1])
+
+  def test_compatible(self):
+    # The format must not change, the server decodes buffers packed by bots
+    # running older versions.
+    array = item_sizes(10000)
+    data = large.pack(array)
+    self.assertEqual(pack_bytewise(array), data)
+    self.assertEqual(array, unpack_bytewise(data))
+    self.assertEqual(array, large.unpack(pack_bytewise(array)))
+
+  def test_packer(self):
+    array = [i*1000 for i in xrange(100000)]
+    packer = large.Packer()
+    packer.add(array[0])
+    packer.extend(array[1:50000])
+    # Generators are accepted.
+    packer.extend(i for i in array[50000:])
+    data = packer.finish()
+    self.assertEqual(array, large.unpack(data))
+
+  def test_iter_unpack(self):
+    # The decompressed buffer spans multiple chunks and varints are split
+    # across chunk boundaries.
+    array = [i*1000 for i in xrange(100000)]
+    data = large.pack(array)
+    self.assertGreater(len(zlib.decompress(data)), 2 * large.CHUNK_SIZE)
+    self.assertEqual(array, list(large.iter_unpack(data)))
+    self.assertEqual(
+        array[1000:1010],
+        list(itertools.islice(large.iter_unpack(data), 1000, 1010)))
+
+
+class LargeBenchmarkTest(unittest.TestCase):
+  def benchmark(self, name, array):
+    start = time.time()
+    data = pack_bytewise(array)
+    pack_ref = time.time() - start
+    start = time.time()
+    self.assertEqual(data, large.pack(array))
+    pack = time.time() - start
+    start = time.time()
+    unpack_bytewise(data)
+    unpack_ref = time.time() - start
+    start = time.time()
+    self.assertEqual(array, large.unpack(data))
+    unpack = time.time() - start
+    logging.info(
+        '%s: pack %.3fs -> %.3fs; unpack %.3fs -> %.3fs',
+        name, pack_ref, pack, unpack_ref, unpack)
+
+  # The timings depend on the machine load and are only printed for reference
+  # with -v.
+  def test_benchmark_item_sizes(self):
+    self.benchmark('item sizes', item_sizes(300000))
+
+  def test_benchmark_dense(self):
+    self.benchmark('dense', range(1000000))
 
 
 if __name__ == '__main__':
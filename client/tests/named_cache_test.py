@@ -147,6 +147,85 @@ class CacheManagerTest(unittest.TestCase):
           set(map(str, xrange(10, 10 + named_cache.MAX_CACHE_SIZE))),
           set(os.listdir(os.path.join(self.tempdir, 'named'))))
 
+  def test_trim_to_trash(self):
+    # The free space grows as the caches are deleted.
+    def get_free_space(_):
+      used = 0
+      for dirpath, _, filenames in fs.walk(self.tempdir):
+        for name in filenames:
+          if dirpath != self.tempdir:
+            used += fs.lstat(os.path.join(dirpath, name)).st_size
+      return 1200 - used
+    old_get_free_space = file_path.get_free_space
+    file_path.get_free_space = get_free_space
+    try:
+      with self.manager.open():
+        self.make_caches([u'a', u'b'])
+        for name in (u'a', u'b'):
+          path = os.path.join(self.tempdir, self.manager._lru[name], u'f')
+          write_file(path, 'x' * 100)
+      self.assertTrue(self.manager.cleanup())
+      self.assertEqual(2, len(self.manager._sizes))
+      self.assertEqual(1000, file_path.get_free_space(self.tempdir))
+
+      with self.manager.open():
+        # Enough space is already available, nothing is evicted.
+        self.assertEqual(0, self.manager.trim(1000))
+        # The oldest cache is moved to trash, then deleted right away since
+        # the space is needed now.
+        self.assertEqual(1, self.manager.trim(1050))
+        self.assertEqual({u'b'}, self.manager.available)
+      self.assertEqual(1100, file_path.get_free_space(self.tempdir))
+      self.assertFalse(
+          os.path.exists(os.path.join(self.tempdir, named_cache.TRASH_DIR)))
+      self.assertEqual(1, len(self.manager._sizes))
+    finally:
+      file_path.get_free_space = old_get_free_space
+
+  def test_cleanup_resume(self):
+    with self.manager.open():
+      self.make_caches([u'a'])
+      path = os.path.join(self.tempdir, self.manager._lru[u'a'])
+      for i in xrange(3):
+        write_file(os.path.join(path, unicode(i)), 'x' * 10)
+    self.assertTrue(self.manager.cleanup())
+    with self.manager.open():
+      self.manager._remove(u'a', evict=True)
+    self.assertEqual(
+        {os.path.join(named_cache.TRASH_DIR, os.path.basename(path) + u'_0'):
+          30},
+        self.manager._sizes)
+
+    # Interrupted after the first file.
+    calls = []
+    class Stop(object):
+      def is_set(self):
+        calls.append(1)
+        return len(calls) > 2
+    self.assertFalse(self.manager.cleanup(Stop()))
+    self.assertEqual([20], self.manager._sizes.values())
+
+    # A new manager resumes from the sizes file.
+    manager = named_cache.CacheManager(self.tempdir)
+    self.assertTrue(manager.cleanup())
+    self.assertEqual({}, manager._sizes)
+    self.assertEqual(['named', 'state.json'], sorted(os.listdir(self.tempdir)))
+
+  def test_uninstall_forgets_size(self):
+    dest_dir = tempfile.mkdtemp(prefix=u'named_cache_test')
+    try:
+      with self.manager.open():
+        self.make_caches([u'a'])
+      self.assertTrue(self.manager.cleanup())
+      self.assertEqual(1, len(self.manager._sizes))
+      with self.manager.open():
+        path = os.path.join(dest_dir, u'a')
+        self.manager.install(path, u'a')
+        self.manager.uninstall(path, u'a')
+      self.assertEqual({}, self.manager._sizes)
+    finally:
+      file_path.rmtree(dest_dir)
+
   def test_corrupted(self):
     with open(os.path.join(self.tempdir, u'state.json'), 'w') as f:
       f.write('}}}}')
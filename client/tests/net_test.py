@@ -9,9 +9,12 @@ import StringIO
 import __builtin__
 import contextlib
 import logging
+import json
 import math
 import os
 import sys
+import threading
+import time
 import unittest
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
@@ -22,6 +25,7 @@ sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
 from depot_tools import auto_stub
 from utils import authenticators
 from utils import net
+import httpserver_mock
 import net_utils
 
 
@@ -360,6 +364,149 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(['filepath'], removed)
 
 
+class StubServerHandler(httpserver_mock.MockHandler):
+  """Counts the requests, answers slowly so that they are in flight together."""
+
+  def _count(self):
+    with self.server.lock:
+      self.server.requests.append((self.command, self.path))
+
+  def do_GET(self):
+    if self.path in ('/on/load', '/on/quit'):
+      self._octet_stream('')
+      return
+    self._count()
+    time.sleep(0.2)
+    if self.path == '/missing':
+      self.send_response(404)
+      self.end_headers()
+      return
+    self._octet_stream('content of %s' % self.path)
+
+  def do_POST(self):
+    self._count()
+    items = json.loads(self._read_body())
+    if self.path == '/batch':
+      self._json([i * 2 for i in items])
+    else:
+      self._json(items)
+
+
+class StubServer(httpserver_mock.MockServer):
+  _HANDLER_CLS = StubServerHandler
+
+  def __init__(self):
+    super(StubServer, self).__init__()
+    self._server.lock = threading.Lock()
+    self._server.requests = []
+
+  @property
+  def requests(self):
+    return self._server.requests
+
+
+class HttpServiceStubServerTest(unittest.TestCase):
+  """Tests request coalescing and batching against a local HTTP server."""
+
+  def setUp(self):
+    super(HttpServiceStubServerTest, self).setUp()
+    self.server = StubServer()
+    self.service = net.HttpService(
+        self.server.url, engine=net.RequestsLibEngine())
+
+  def tearDown(self):
+    self.server.close()
+    super(HttpServiceStubServerTest, self).tearDown()
+
+  def call_concurrently(self, count, fn):
+    """Calls fn(index) from |count| threads, returns the results in order."""
+    results = [None] * count
+    def run(i):
+      results[i] = fn(i)
+    threads = [threading.Thread(target=run, args=(i,)) for i in xrange(count)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return results
+
+  def test_coalesce_get(self):
+    def read(_i):
+      response = self.service.request('/file', stream=False, coalesce=True)
+      return response.read(), response.get_header('Content-Type')
+    results = self.call_concurrently(5, read)
+    self.assertEqual(
+        [('content of /file', 'application/octet-stream')] * 5, results)
+    self.assertEqual([('GET', '/file')], self.server.requests)
+
+  def test_coalesce_failure(self):
+    results = self.call_concurrently(
+        5, lambda _i: self.service.request(
+            '/missing', stream=False, coalesce=True))
+    self.assertEqual([None] * 5, results)
+    self.assertEqual([('GET', '/missing')], self.server.requests)
+
+  def test_coalesce_different(self):
+    results = self.call_concurrently(
+        3, lambda i: self.service.request(
+            '/%d' % i, stream=False, coalesce=True).read())
+    self.assertEqual(['content of /0', 'content of /1', 'content of /2'],
+                     results)
+    self.assertEqual(3, len(self.server.requests))
+
+  def test_coalesce_different_timeout(self):
+    # The retry policy is part of the request.
+    self.call_concurrently(
+        2, lambda i: self.service.request(
+            '/file', stream=False, coalesce=True, timeout=10 + i).read())
+    self.assertEqual([('GET', '/file')] * 2, self.server.requests)
+
+  def test_coalesce_follower_timeout(self):
+    in_flight = net._InFlightRequest()
+    # The follower gives up after its own timeout.
+    self.assertIsNone(in_flight.wait(0.01))
+    in_flight.set_response(None)
+    self.assertIsNone(in_flight.wait(None))
+
+  def test_no_coalesce(self):
+    # Coalescing is opt-in, streamed responses can't be shared, POST is not
+    # idempotent.
+    self.call_concurrently(
+        2, lambda _i: self.service.request(
+            '/file', stream=True, coalesce=True).read())
+    self.call_concurrently(
+        2, lambda _i: self.service.request('/file', stream=False).read())
+    self.call_concurrently(
+        2, lambda _i: self.service.json_request('/echo', data=[1]))
+    self.assertEqual(
+        [('GET', '/file')] * 4 + [('POST', '/echo')] * 2,
+        sorted(self.server.requests))
+
+  def test_batcher(self):
+    sizes = []
+    def batch_fn(items):
+      sizes.append(len(items))
+      return self.service.json_request('/batch', data=items)
+    batcher = net.Batcher(batch_fn, max_batch_size=4, max_delay=0.5)
+    results = self.call_concurrently(10, batcher.call)
+    self.assertEqual([i * 2 for i in xrange(10)], results)
+    self.assertEqual(10, sum(sizes))
+    self.assertTrue(all(s <= 4 for s in sizes), sizes)
+    self.assertEqual(len(sizes), len(self.server.requests))
+    self.assertLess(len(sizes), 10)
+
+  def test_batcher_error(self):
+    def batch_fn(items):
+      raise ValueError('Oops %d' % len(items))
+    batcher = net.Batcher(batch_fn, max_batch_size=2, max_delay=1.)
+    def call(i):
+      try:
+        batcher.call(i)
+      except ValueError as e:
+        return str(e)
+    self.assertEqual(['Oops 2', 'Oops 2'], self.call_concurrently(2, call))
+
+
 class TestNetFunctions(auto_stub.TestCase):
   def test_fix_url(self):
     data = [
@@ -15,6 +15,7 @@ import logging
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
@@ -893,6 +894,46 @@ class RunIsolatedTestOutputFiles(RunIsolatedTestBase):
     self._run_test(isolated, ['foo', 'foodir/foo2'])
 
 
+class OutputUploaderTest(RunIsolatedTestBase):
+  def test_hash_while_running(self):
+    self.mock(run_isolated, 'OUTPUT_SCAN_INTERVAL', 0.01)
+    self.mock(run_isolated, 'OUTPUT_SETTLE_TIME', 0)
+    out_dir = os.path.join(self.tempdir, u'io')
+    os.mkdir(out_dir)
+    foo = os.path.join(out_dir, u'foo')
+    write_content(foo, 'foo')
+    uploader = run_isolated.OutputUploader(StorageFake({}), out_dir, False)
+    uploader.scan()
+    for _ in xrange(500):
+      if foo in uploader._prevdict:
+        break
+      time.sleep(0.01)
+    self.assertIn(foo, uploader._prevdict)
+
+    # The file hashed while the task ran is not hashed again.
+    hashed = []
+    old_hash_file = self.mock(
+        isolated_format, 'hash_file',
+        lambda path, algo: hashed.append(path) or old_hash_file(path, algo))
+    self.assertFalse(uploader.started)
+    uploader.start()
+    outputs_ref, success, stats = uploader.join()
+    self.assertTrue(success)
+    self.assertEqual('default-gzip', outputs_ref['namespace'])
+    self.assertNotIn(foo, hashed)
+    self.assertEqual([3], large.unpack(base64.b64decode(stats['items_hot'])))
+    self.assertFalse(os.path.exists(out_dir))
+
+  def test_upload_error(self):
+    def delete_and_upload(*_args):
+      raise isolateserver.Aborted()
+    self.mock(run_isolated, 'delete_and_upload', delete_and_upload)
+    uploader = run_isolated.OutputUploader(
+        StorageFake({}), os.path.join(self.tempdir, u'io'), False)
+    with self.assertRaises(isolateserver.Aborted):
+      uploader.join()
+
+
 class RunIsolatedJsonTest(RunIsolatedTestBase):
   # Similar to RunIsolatedTest but adds the hacks to process ISOLATED_OUTDIR to
   # generate a json result file.
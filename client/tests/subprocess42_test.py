@@ -689,6 +689,97 @@ class Subprocess42Test(unittest.TestCase):
       proc.kill()
       proc.wait()
 
+  @unittest.skipIf(sys.platform == 'win32', 'posix only')
+  def test_yield_any_registers_once(self):
+    calls = []
+    old_register = subprocess42.Poller.register
+    def register(poller, conn):
+      calls.append(conn.fileno())
+      return old_register(poller, conn)
+    subprocess42.Poller.register = register
+    try:
+      cmd = [
+        sys.executable, '-u', '-c',
+        'import sys\nfor i in xrange(100): sys.stdout.write("%d\\n" % i)',
+      ]
+      proc = subprocess42.Popen(cmd, stdout=subprocess42.PIPE)
+      fd = proc.stdout.fileno()
+      actual = ''.join(data for _, data in proc.yield_any())
+    finally:
+      subprocess42.Poller.register = old_register
+    self.assertEqual(''.join('%d\n' % i for i in xrange(100)), actual)
+    self.assertEqual(set([fd]), set(calls))
+    self.assertIsNone(proc._poller)
+
+  @unittest.skipIf(sys.platform == 'win32', 'posix only')
+  def test_poller_high_fd(self):
+    # Ensures pipes with file descriptors above FD_SETSIZE can be polled.
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < 1100:
+      self.skipTest('RLIMIT_NOFILE is too low')
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1100), hard))
+    fds = []
+    try:
+      while not fds or fds[-1] < 1050:
+        fds.extend(os.pipe())
+      r = os.fdopen(fds.pop(-2), 'rb', 0)
+      os.write(fds[-1], 'a')
+      poller = subprocess42.Poller()
+      poller.register(r)
+      self.assertEqual(
+          (0, 'a', False), subprocess42.recv_multi_impl([r], None, 1, poller))
+      self.assertEqual(
+          (None, None, False),
+          subprocess42.recv_multi_impl([r], None, 0, poller))
+      poller.unregister(r)
+      poller.close()
+      r.close()
+    finally:
+      for fd in fds:
+        os.close(fd)
+      resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+  @unittest.skipIf(sys.platform == 'win32', 'posix only')
+  def test_recv_out_restores_blocking(self):
+    import fcntl
+    cmd = [
+      sys.executable, '-u', '-c',
+      'import sys\nsys.stdout.write("a")\nsys.stderr.write("b")',
+    ]
+    proc = subprocess42.Popen(
+        cmd, stdout=subprocess42.PIPE, stderr=subprocess42.PIPE)
+    is_blocking = lambda conn: not (
+        fcntl.fcntl(conn.fileno(), fcntl.F_GETFL) & os.O_NONBLOCK)
+    try:
+      self.assertEqual('a', proc.recv_out(timeout=60))
+      # Reading stdout alone doesn't touch stderr.
+      self.assertFalse(is_blocking(proc.stdout))
+      self.assertTrue(is_blocking(proc.stderr))
+      self.assertEqual([proc.stdout], proc._poller.conns())
+      self.assertEqual('b', proc.recv_err(timeout=60))
+      self.assertTrue(is_blocking(proc.stdout))
+      self.assertEqual([proc.stderr], proc._poller.conns())
+      # A blocking read works once the pipe is not polled anymore.
+      self.assertEqual('', proc.stdout.read())
+    finally:
+      proc.wait()
+
+  @unittest.skipIf(sys.platform == 'win32', 'posix only')
+  def test_recv_multi_impl_restores_blocking(self):
+    import fcntl
+    r, w = os.pipe()
+    try:
+      os.write(w, 'a')
+      conn = os.fdopen(r, 'rb', 0)
+      self.assertEqual(
+          (0, 'a', False), subprocess42.recv_multi_impl([conn], None, 1))
+      self.assertFalse(
+          fcntl.fcntl(conn.fileno(), fcntl.F_GETFL) & os.O_NONBLOCK)
+      conn.close()
+    finally:
+      os.close(w)
+
   def test_split(self):
     data = [
       ('stdout', 'o1\no2\no3\n'),
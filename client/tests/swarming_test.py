@@ -153,6 +153,35 @@ def gen_result_response(**kwargs):
   return out
 
 
+def gen_wait_request(test, task_ids, cursor=None, include_output=True):
+  """Returns a callable checking the arguments of a tasks/wait request."""
+  def check(kwargs):
+    data = kwargs['data'].copy()
+    # The timeout depends on the time left.
+    test.assertTrue(0 < data.pop('timeout') <= swarming.WAIT_TIMEOUT)
+    expected = {
+      'include_output': include_output,
+      'include_performance_stats': False,
+      'task_id': task_ids,
+    }
+    if cursor:
+      expected['cursor'] = cursor
+    test.assertEqual({'data': expected}, dict(kwargs, data=data))
+  return check
+
+
+def gen_wait_response(results, outputs, cursor='cursor'):
+  """Returns a tasks/wait response for the results that changed."""
+  return {
+    u'cursor': cursor,
+    u'items': [
+      {u'result': result, u'output': output}
+      for result, output in zip(results, outputs)
+    ],
+    u'now': u'2014-09-24T13:49:20.012345',
+  }
+
+
 # Silence pylint 'Access to a protected member _Event of a client class'.
 class NonBlockingEvent(threading._Event):  # pylint: disable=W0212
   """Just like threading.Event, but a class and ignores timeout in 'wait'.
@@ -543,6 +572,80 @@ class TestSwarmingCollection(NetTestCase):
   def test_success(self):
     self.expected_requests(
         [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100']),
+            gen_wait_response([gen_result_response()], [OUTPUT]),
+          ),
+        ])
+    expected = [gen_yielded_data(0, output=OUTPUT)]
+    self.assertEqual(expected, get_results(['10100']))
+
+  def test_failure(self):
+    self.expected_requests(
+        [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100']),
+            gen_wait_response([gen_result_response(exit_code=1)], [OUTPUT]),
+          ),
+        ])
+    expected = [gen_yielded_data(0, output=OUTPUT, exit_code=1)]
+    self.assertEqual(expected, get_results(['10100']))
+
+  def test_no_ids(self):
+    actual = get_results([])
+    self.assertEqual([], actual)
+
+  def test_pending(self):
+    # The cursor returned by the server is sent back until the task completes.
+    self.expected_requests(
+        [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100']),
+            gen_wait_response(
+                [gen_result_response(state='PENDING')], [None], cursor='c1'),
+          ),
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100'], cursor='c1'),
+            gen_wait_response([], [], cursor='c1'),
+          ),
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100'], cursor='c1'),
+            gen_wait_response([gen_result_response()], [OUTPUT], cursor='c2'),
+          ),
+        ])
+    expected = [gen_yielded_data(0, output=OUTPUT)]
+    self.assertEqual(expected, get_results(['10100']))
+
+  def test_same_task(self):
+    # The same task may be collected for multiple shards.
+    self.expected_requests(
+        [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100', '10100']),
+            gen_wait_response([gen_result_response()], [OUTPUT]),
+          ),
+        ])
+    expected = [
+      gen_yielded_data(0, output=OUTPUT),
+      gen_yielded_data(1, output=OUTPUT),
+    ]
+    self.assertEqual(expected, sorted(get_results(['10100', '10100'])))
+
+  def test_wait_unsupported(self):
+    # Older servers don't support tasks/wait, each task is polled instead.
+    self.expected_requests(
+        [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100']),
+            None,
+          ),
           (
             'https://host:9001/api/swarming/v1/task/10100/result',
             {'retry_50x': False},
@@ -557,13 +660,28 @@ class TestSwarmingCollection(NetTestCase):
     expected = [gen_yielded_data(0, output=OUTPUT)]
     self.assertEqual(expected, get_results(['10100']))
 
-  def test_failure(self):
+  def test_wait_errors(self):
+    # tasks/wait keeps failing, each task is polled instead.
+    self.mock(logging, 'warning', lambda *_, **__: None)
     self.expected_requests(
         [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100']),
+            gen_wait_response(
+                [gen_result_response(state='PENDING')], [None], cursor='c1'),
+          ),
+        ] + swarming.WAIT_MAX_ERRORS * [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100'], cursor='c1'),
+            None,
+          ),
+        ] + [
           (
             'https://host:9001/api/swarming/v1/task/10100/result',
             {'retry_50x': False},
-            gen_result_response(exit_code=1),
+            gen_result_response(),
           ),
           (
             'https://host:9001/api/swarming/v1/task/10100/stdout',
@@ -571,15 +689,12 @@ class TestSwarmingCollection(NetTestCase):
             {'output': OUTPUT},
           ),
         ])
-    expected = [gen_yielded_data(0, output=OUTPUT, exit_code=1)]
+    expected = [gen_yielded_data(0, output=OUTPUT)]
     self.assertEqual(expected, get_results(['10100']))
 
-  def test_no_ids(self):
-    actual = get_results([])
-    self.assertEqual([], actual)
-
   def test_url_errors(self):
     self.mock(logging, 'error', lambda *_, **__: None)
+    self.mock(logging, 'warning', lambda *_, **__: None)
     # NOTE: get_results() hardcodes timeout=10.
     now = {}
     lock = threading.Lock()
@@ -592,7 +707,13 @@ class TestSwarmingCollection(NetTestCase):
     # The actual number of requests here depends on 'now' progressing to 10
     # seconds. It's called once per loop. Loop makes 9 iterations.
     self.expected_requests(
-        9 * [
+        [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100']),
+            None,
+          ),
+        ] + 9 * [
           (
             'https://host:9001/api/swarming/v1/task/10100/result',
             {'retry_50x': False},
@@ -601,83 +722,108 @@ class TestSwarmingCollection(NetTestCase):
         ])
     actual = get_results(['10100'])
     self.assertEqual([], actual)
-    self.assertTrue(all(not v for v in now.itervalues()), now)
+    # Ignore the thread calling tasks/wait, which gave up right away.
+    self.assertTrue(
+        all(not v for t, v in now.iteritems() if t.name != 'wait_results'),
+        now)
 
   def test_many_shards(self):
     self.expected_requests(
         [
           (
-            'https://host:9001/api/swarming/v1/task/10100/result',
-            {'retry_50x': False},
-            gen_result_response(),
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10100/stdout',
-            {},
-            {'output': SHARD_OUTPUT_1},
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10200/result',
-            {'retry_50x': False},
-            gen_result_response(),
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10200/stdout',
-            {},
-            {'output': SHARD_OUTPUT_2},
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10300/result',
-            {'retry_50x': False},
-            gen_result_response(),
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10300/stdout',
-            {},
-            {'output': SHARD_OUTPUT_3},
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100', '10200', '10300']),
+            gen_wait_response(
+                [
+                  gen_result_response(),
+                  gen_result_response(task_id=u'10200'),
+                  gen_result_response(task_id=u'10300'),
+                ],
+                [SHARD_OUTPUT_1, SHARD_OUTPUT_2, SHARD_OUTPUT_3]),
           ),
         ])
     expected = [
       gen_yielded_data(0, output=SHARD_OUTPUT_1),
-      gen_yielded_data(1, output=SHARD_OUTPUT_2),
-      gen_yielded_data(2, output=SHARD_OUTPUT_3),
+      gen_yielded_data(1, output=SHARD_OUTPUT_2, task_id=u'10200'),
+      gen_yielded_data(2, output=SHARD_OUTPUT_3, task_id=u'10300'),
     ]
     actual = get_results(['10100', '10200', '10300'])
     self.assertEqual(expected, sorted(actual))
 
-  def test_output_collector_called(self):
-    # Three shards, one failed. All results are passed to output collector.
+  def test_many_shards_output_per_task(self):
+    # The output of large groups is fetched per task.
+    self.mock(swarming, 'WAIT_OUTPUT_MAX_TASKS', 1)
     self.expected_requests(
         [
           (
-            'https://host:9001/api/swarming/v1/task/10100/result',
-            {'retry_50x': False},
-            gen_result_response(),
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100', '10200'], include_output=False),
+            gen_wait_response(
+                [
+                  gen_result_response(),
+                  gen_result_response(task_id=u'10200'),
+                ],
+                [None, None]),
           ),
           (
             'https://host:9001/api/swarming/v1/task/10100/stdout',
             {},
             {'output': SHARD_OUTPUT_1},
           ),
-          (
-            'https://host:9001/api/swarming/v1/task/10200/result',
-            {'retry_50x': False},
-            gen_result_response(),
-          ),
           (
             'https://host:9001/api/swarming/v1/task/10200/stdout',
             {},
             {'output': SHARD_OUTPUT_2},
           ),
+        ])
+    expected = [
+      gen_yielded_data(0, output=SHARD_OUTPUT_1),
+      gen_yielded_data(1, output=SHARD_OUTPUT_2, task_id=u'10200'),
+    ]
+    actual = get_results(['10100', '10200'])
+    self.assertEqual(expected, sorted(actual))
+
+  def test_many_shards_groups(self):
+    # Each group of WAIT_MAX_TASKS shards is waited on separately.
+    self.mock(swarming, 'WAIT_MAX_TASKS', 2)
+    outputs = {
+      u'10100': SHARD_OUTPUT_1,
+      u'10200': SHARD_OUTPUT_2,
+      u'10300': SHARD_OUTPUT_3,
+    }
+    groups = []
+    lock = threading.Lock()
+    def url_read_json(url, data):
+      self.assertEqual('https://host:9001/api/swarming/v1/tasks/wait', url)
+      with lock:
+        groups.append(data['task_id'])
+      return gen_wait_response(
+          [gen_result_response(task_id=t) for t in data['task_id']],
+          [outputs[t] for t in data['task_id']])
+    self.mock(swarming.net, 'url_read_json', url_read_json)
+    expected = [
+      gen_yielded_data(0, output=SHARD_OUTPUT_1),
+      gen_yielded_data(1, output=SHARD_OUTPUT_2, task_id=u'10200'),
+      gen_yielded_data(2, output=SHARD_OUTPUT_3, task_id=u'10300'),
+    ]
+    actual = get_results([u'10100', u'10200', u'10300'])
+    self.assertEqual(expected, sorted(actual))
+    self.assertEqual([[u'10100', u'10200'], [u'10300']], sorted(groups))
+
+  def test_output_collector_called(self):
+    # Three shards, one failed. All results are passed to output collector.
+    self.expected_requests(
+        [
           (
-            'https://host:9001/api/swarming/v1/task/10300/result',
-            {'retry_50x': False},
-            gen_result_response(exit_code=1),
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10300/stdout',
-            {},
-            {'output': SHARD_OUTPUT_3},
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            gen_wait_request(self, ['10100', '10200', '10300']),
+            gen_wait_response(
+                [
+                  gen_result_response(),
+                  gen_result_response(task_id=u'10200'),
+                  gen_result_response(task_id=u'10300', exit_code=1),
+                ],
+                [SHARD_OUTPUT_1, SHARD_OUTPUT_2, SHARD_OUTPUT_3]),
           ),
         ])
 
@@ -695,8 +841,9 @@ class TestSwarmingCollection(NetTestCase):
 
     expected = [
       gen_yielded_data(0, output=SHARD_OUTPUT_1),
-      gen_yielded_data(1, output=SHARD_OUTPUT_2),
-      gen_yielded_data(2, output=SHARD_OUTPUT_3, exit_code=1),
+      gen_yielded_data(1, output=SHARD_OUTPUT_2, task_id=u'10200'),
+      gen_yielded_data(
+          2, output=SHARD_OUTPUT_3, task_id=u'10300', exit_code=1),
     ]
     self.assertEqual(sorted(expected), sorted(output_collector.results))
 
@@ -297,6 +297,119 @@ class ThreadPoolTest(unittest.TestCase):
     self.assertEqual(range(12), sorted(results))
 
 
+class AdaptiveThreadPoolTest(unittest.TestCase):
+  @staticmethod
+  def run_small_tasks(max_queue_latency):
+    """Runs many small tasks, returns the duration and the number of threads."""
+    start = time.time()
+    with threading_utils.ThreadPool(0, 32, 0) as pool:
+      pool.MAX_QUEUE_LATENCY = max_queue_latency
+      for i in xrange(5000):
+        pool.add_task(0, lambda x: x * 2, i)
+      results = pool.join()
+      assert len(results) == 5000, len(results)
+    return time.time() - start, pool.spawned
+
+  @timeout(60)
+  def test_benchmark_small_tasks(self):
+    # Not a strict check, the numbers depend on the machine load and are
+    # printed for reference with -v. Small tasks are faster to run than to hand
+    # over to another thread, a thread per core or more is wasted.
+    eager_duration, eager_threads = self.run_small_tasks(0)
+    duration, threads = self.run_small_tasks(
+        threading_utils.ThreadPool.MAX_QUEUE_LATENCY)
+    logging.info(
+        'Eager: %.3fs with %d threads; adaptive: %.3fs with %d threads',
+        eager_duration, eager_threads, duration, threads)
+
+  def test_should_grow(self):
+    # The growth policy for known task durations, measured with a mocked
+    # clock.
+    clock = [0.]
+    class FakeTime(object):
+      @staticmethod
+      def time():
+        return clock[0]
+    def task(duration):
+      clock[0] += duration
+      return duration
+    old_time = threading_utils.time
+    threading_utils.time = FakeTime
+    try:
+      with threading_utils.ThreadPool(1, 2, 0) as pool:
+        # pylint: disable=protected-access
+        pool.MAX_QUEUE_LATENCY = 0.05
+        pool.add_task(0, task, 0.001)
+        pool.join()
+        self.assertEqual(0.001, pool._run_time)
+        with pool._lock:
+          pool._ready -= 1
+          # The busy worker starts 10 fast tasks within MAX_QUEUE_LATENCY.
+          self.assertFalse(pool._should_grow(10))
+          self.assertTrue(pool._should_grow(100))
+          pool._ready += 1
+
+        pool.add_task(0, task, 1.)
+        pool.join()
+        self.assertAlmostEqual(0.2008, pool._run_time)
+        with pool._lock:
+          # An idle worker is available.
+          self.assertFalse(pool._should_grow(1))
+          pool._ready -= 1
+          # The tasks are now too slow for a single worker.
+          self.assertTrue(pool._should_grow(1))
+          # Unless all the threads are started already.
+          pool._max_threads = 1
+          self.assertFalse(pool._should_grow(1))
+          pool._max_threads = 2
+          pool._ready += 1
+    finally:
+      threading_utils.time = old_time
+
+  @timeout(10)
+  def test_grows_for_slow_tasks(self):
+    with threading_utils.ThreadPool(0, 8, 0) as pool:
+      for i in xrange(8):
+        pool.add_task(0, ThreadPoolTest.sleep_task(0.5), i)
+      self.assertEqual(range(8), sorted(pool.join()))
+      self.assertGreater(pool.spawned, 2)
+
+  @timeout(10)
+  def test_grows_for_blocked_tasks(self):
+    # The first task waits for the second one, the measured duration of the
+    # previous tasks is not representative.
+    with threading_utils.ThreadPool(0, 2, 0) as pool:
+      for i in xrange(100):
+        pool.add_task(0, lambda x: x, i)
+      pool.join()
+      event = threading.Event()
+      pool.add_task(0, lambda: event.wait(5) and 'waited')
+      pool.add_task(0, lambda: event.set())
+      self.assertEqual(['waited'], pool.join())
+
+  @timeout(10)
+  def test_shrinks(self):
+    with threading_utils.ThreadPool(1, 8, 0) as pool:
+      pool.IDLE_TIMEOUT = 0.1
+      for i in xrange(8):
+        pool.add_task(0, ThreadPoolTest.sleep_task(0.5), i)
+      self.assertEqual(range(8), sorted(pool.join()))
+      spawned = pool.spawned
+      self.assertGreater(spawned, 2)
+      time.sleep(0.2)
+      # Idle threads exit once they run a task and find nothing else to do.
+      for i in xrange(20):
+        pool.add_task(0, lambda x: x, i)
+        pool.join()
+      # pylint: disable=protected-access
+      self.assertEqual(1, sum(w.is_alive() for w in pool._workers))
+      # The pool grows again as needed.
+      for i in xrange(4):
+        pool.add_task(0, ThreadPoolTest.sleep_task(0.5), i)
+      self.assertEqual(range(4), sorted(pool.join()))
+      self.assertGreater(pool.spawned, spawned)
+
+
 class AutoRetryThreadPoolTest(unittest.TestCase):
   def test_bad_class(self):
     exceptions = [AutoRetryThreadPoolTest]
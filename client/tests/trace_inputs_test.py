@@ -5,9 +5,14 @@
 # that can be found in the LICENSE file.
 
 import StringIO
+import json
 import logging
 import os
+import shutil
+import struct
 import sys
+import tempfile
+import time
 import unittest
 
 BASE_DIR = os.path.dirname(os.path.abspath(
@@ -683,6 +688,183 @@ if sys.platform != 'win32':
       self.assertContext(lines, ROOT_DIR, expected, False)
 
 
+  class StraceParseLog(unittest.TestCase):
+    # Recorded lines of a process tree, in the format of strace -ff.
+    _LINES = {
+      27: [
+        'execve("../out/unittests", '
+          '["../out/unittests"...], [/* 44 vars */])         = 0',
+        'open("out/unittests.log", O_WRONLY|O_CREAT|O_APPEND <unfinished ...>',
+        '--- SIGCHLD (Child exited) @ 0 (0) ---',
+        '<... open resumed> )              = 3',
+        'stat(0x941e60, {st_mode=S_IFREG|0644, st_size=25769, ...}) = 0',
+        'futex(0x6972610, FUTEX_WAKE_PRIVATE, 1) = 0',
+        'clone(child_stack=0, flags=CLONE_CHILD_CLEARTID'
+          '|CLONE_CHILD_SETTID|SIGCHLD, child_tidptr=0x7f5350f829d0) = 24',
+        'chdir("/home_foo_bar_user/path2") = 0',
+        'exit_group(0)                     = ?',
+        '+++ exited with 0 +++',
+      ],
+      24: [
+        'chdir("/home_foo_bar_user/path1") = 0',
+        'open("random.txt", O_RDONLY)       = 76',
+        'readlink(0x941e60, 0x7fff7a632d60, 4096) = 9',
+        ')                                       = ? <unavailable>',
+        '+++ killed by SIGKILL +++',
+      ],
+    }
+
+    def setUp(self):
+      super(StraceParseLog, self).setUp()
+      self.tempdir = tempfile.mkdtemp(prefix=u'trace_inputs')
+      self.logname = os.path.join(self.tempdir, 'log.json')
+      self.cwd = u'/home_foo_bar_user/src'
+
+    def tearDown(self):
+      try:
+        shutil.rmtree(self.tempdir)
+      finally:
+        super(StraceParseLog, self).tearDown()
+
+    def _write_logs(self, lines, repeat=1):
+      with open(self.logname, 'wb') as f:
+        json.dump({
+          'traces': [
+            {
+              'cmd': ['../out/unittests'],
+              'cwd': self.cwd,
+              'output': '',
+              'pid': None,
+              'trace': 'default',
+            },
+          ],
+        }, f)
+      for pid, pid_lines in lines.iteritems():
+        with open('%s.default.%d' % (self.logname, pid), 'wb') as f:
+          for _ in xrange(repeat):
+            f.write(''.join(l + '\n' for l in pid_lines))
+
+    def _parse_log(self):
+      out = trace_inputs.Strace.parse_log(
+          self.logname, lambda _: False, None)
+      self.assertEqual(1, len(out))
+      if 'exception' in out[0]:
+        raise out[0]['exception'][1]
+      return out[0]['results'].flatten()
+
+    def _parse_lines(self, lines):
+      # The reference: each line is processed by Context.on_line().
+      context = trace_inputs.Strace.Context(lambda _: False, None, self.cwd)
+      for pid, pid_lines in sorted(lines.iteritems()):
+        for line in pid_lines:
+          context.on_line(pid, line)
+      return context.to_results().flatten()
+
+    def test_parse_log(self):
+      self._write_logs(self._LINES)
+      expected = self._parse_lines(self._LINES)
+      self.assertEqual(24, expected['root']['children'][0]['pid'])
+      self.assertEqual(expected, self._parse_log())
+      self.assertTrue(os.path.isfile(self.logname + '.default.parsed'))
+
+    def test_parse_log_parallel(self):
+      self._write_logs(self._LINES)
+      old = trace_inputs.Strace.PARALLEL_PARSE_MIN_SIZE
+      trace_inputs.Strace.PARALLEL_PARSE_MIN_SIZE = 0
+      try:
+        actual = self._parse_log()
+      finally:
+        trace_inputs.Strace.PARALLEL_PARSE_MIN_SIZE = old
+      self.assertEqual(self._parse_lines(self._LINES), actual)
+
+    def test_parse_log_cached(self):
+      self._write_logs(self._LINES)
+      expected = self._parse_log()
+      old = trace_inputs._strace_parse_pid_log
+      trace_inputs._strace_parse_pid_log = lambda _: self.fail()
+      try:
+        self.assertEqual(expected, self._parse_log())
+      finally:
+        trace_inputs._strace_parse_pid_log = old
+
+      # A modified log is parsed again.
+      lines = self._LINES.copy()
+      lines[24] = ['open("other.txt", O_RDONLY) = 76'] + lines[24]
+      self._write_logs(lines)
+      pidfile = self.logname + '.default.24'
+      os.utime(pidfile, (time.time() + 10, time.time() + 10))
+      self.assertEqual(self._parse_lines(lines), self._parse_log())
+
+      trace_inputs.Strace.clean_trace(self.logname)
+      self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_parse_log_corrupted(self):
+      lines = self._LINES.copy()
+      lines[24] = ['<... open resumed> ) = 3']
+      self._write_logs(lines)
+      with self.assertRaises(trace_inputs.TracingFailure) as cm:
+        self._parse_log()
+      self.assertEqual(24, cm.exception.pid)
+      self.assertEqual(1, cm.exception.line_number)
+      self.assertEqual('<... open resumed> ) = 3', cm.exception.line)
+      # The failed log is not cached, it fails again.
+      with self.assertRaises(trace_inputs.TracingFailure):
+        self._parse_log()
+
+    def test_parse_log_corrupted_cache(self):
+      self._write_logs(self._LINES)
+      expected = self._parse_lines(self._LINES)
+      self.assertEqual(expected, self._parse_log())
+      cache_path = self.logname + '.default.parsed'
+      with open(cache_path, 'rb') as f:
+        content = f.read()
+      corrupted = [
+        # Truncated.
+        content[:len(content) / 2],
+        # Unpickling fails to import a module.
+        struct.pack('<QQ', 17, 0) + 'cmissing\nfoo\np0\n.',
+        'garbage',
+      ]
+      for data in corrupted:
+        with open(cache_path, 'wb') as f:
+          f.write(data)
+        self.assertEqual(expected, self._parse_log())
+        # The cache was rewritten, without leaving a temporary file.
+        with open(cache_path, 'rb') as f:
+          self.assertEqual(content, f.read())
+        self.assertEqual(
+            sorted(
+                ['log.json', 'log.json.default.parsed'] +
+                ['log.json.default.%d' % pid for pid in self._LINES]),
+            sorted(os.listdir(self.tempdir)))
+
+    def test_benchmark(self):
+      # Not a strict check, the numbers are printed for reference with -v.
+      # Makes the lines of a single process parseable more than once.
+      repeated = {
+        27: [
+          l for l in self._LINES[27]
+          if not l.startswith(('+++', 'exit', 'clone'))
+        ],
+      }
+      self._write_logs(repeated, repeat=5000)
+      start = time.time()
+      context = trace_inputs.Strace.Context(lambda _: False, None, self.cwd)
+      with open(self.logname + '.default.27', 'rb') as f:
+        for line in f:
+          context.on_line(27, line)
+      on_line = time.time() - start
+      start = time.time()
+      self._parse_log()
+      first = time.time() - start
+      start = time.time()
+      self._parse_log()
+      cached = time.time() - start
+      logging.info(
+          'on_line: %.3fs; parse_log: %.3fs; cached: %.3fs',
+          on_line, first, cached)
+
+
 if __name__ == '__main__':
   logging.basicConfig(
       level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
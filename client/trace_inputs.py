@@ -19,14 +19,17 @@ from the log.
 """
 
 import codecs
+import cPickle
 import csv
 import errno
 import getpass
 import glob
 import logging
+import multiprocessing
 import os
 import re
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
@@ -794,6 +797,9 @@ class Strace(ApiBase):
     """Parses a filename in a log."""
     # TODO(maruel): Be compatible with strace -x.
     assert isinstance(filename, str)
+    if '\\' not in filename:
+      # Fast path, most filenames do not contain escaped characters.
+      return filename.decode('utf-8')
     out = ''
     i = 0
     while i < len(filename):
@@ -825,10 +831,16 @@ class Strace(ApiBase):
     processes in order. With that, it should be possible to not use RelativePath
     anymore. This would significantly simplify the code!
     """
-    class Process(ApiBase.Context.Process):
-      """Represents the state of a process.
+    class LineParser(object):
+      """Converts the lines of the log of a single process into syscall
+      records.
 
-      Contains all the information retrieved from the pid-specific log.
+      A record is a (line_number, function, args, result) tuple. function is
+      None when the line is corrupted, no line can be processed afterward.
+
+      The parsing only depends on the log of the process, so the logs of
+      multiple processes can be parsed independently, then replayed in any
+      order with Process.on_record().
       """
       # Function names are using ([a-z_0-9]+)
       # This is the most common format. function(args) = result
@@ -853,6 +865,124 @@ class Strace(ApiBase):
       # Happens when strace fails to even get the function name.
       UNNAMED_FUNCTION = '????'
 
+      def __init__(self):
+        # The dict key is the function name of the pending call, like 'open'
+        # or 'execve'.
+        self._pending_calls = {}
+        self.line_number = 0
+        self.done = False
+
+      def parse(self, line):
+        """Returns the record for a stripped line or None if the line is
+        ignored.
+
+        Most lines are plain function calls. The other regexps are only tried
+        when the line starts or ends with their marker, instead of trying all
+        of them in turn on each line.
+
+        Raises:
+          TracingFailure with line_number and line set.
+        """
+        self.line_number += 1
+        try:
+          if self.done:
+            raise TracingFailure(
+                'Found a trace for a terminated process or corrupted log',
+                None, None, None)
+
+          if line.startswith('--- SIG') and self.RE_SIGNAL.match(line):
+            # Ignore signals.
+            return None
+
+          if line.endswith('+++'):
+            match = self.RE_KILLED.match(line)
+            if match:
+              # Converts a '+++ killed by Foo +++' trace into an exit_group().
+              return (self.line_number, 'exit_group', match.group(1), None)
+
+          if line.startswith('+++ exited with '):
+            match = self.RE_PROCESS_EXITED.match(line)
+            if match:
+              # Converts a '+++ exited with 1 +++' trace into an exit_group()
+              return (self.line_number, 'exit_group', match.group(1), None)
+
+          if line.endswith(' <unfinished ...>'):
+            match = self.RE_UNFINISHED.match(line)
+            if match:
+              if match.group(1) in self._pending_calls:
+                raise TracingFailure(
+                    'Found two unfinished calls for the same function',
+                    None, None, None,
+                    self._pending_calls)
+              self._pending_calls[match.group(1)] = (
+                  match.group(1) + match.group(2))
+              return None
+
+          if (line.endswith('<unavailable>') and
+              self.RE_UNAVAILABLE.match(line)):
+            # This usually means a process was killed and a pending call was
+            # canceled.
+            # TODO(maruel): Look up the last exit_group() trace just above and
+            # make sure any self._pending_calls[anything] is properly flushed.
+            return None
+
+          if (line.endswith('<ptrace(SYSCALL):No such process>') and
+              self.RE_PTRACE.match(line)):
+            # Not sure what this means. Anyhow, the process died.
+            # TODO(maruel): Add note that only RE_PROCESS_EXITED is valid
+            # afterward.
+            return None
+
+          if line.startswith('<... '):
+            match = self.RE_RESUMED.match(line)
+            if match:
+              if match.group(1) not in self._pending_calls:
+                raise TracingFailure(
+                    'Found a resumed call that was not logged as unfinished',
+                    None, None, None,
+                    self._pending_calls)
+              pending = self._pending_calls.pop(match.group(1))
+              # Reconstruct the line.
+              line = pending + match.group(2)
+
+          match = self.RE_HEADER.match(line)
+          if not match:
+            # The line is corrupted. It happens occasionally when a process is
+            # killed forcibly with activity going on. Assume the process died.
+            # No other line can be processed afterward.
+            self.done = True
+            return (self.line_number, None, line, None)
+
+          if match.group(1) == self.UNNAMED_FUNCTION:
+            return None
+          return (self.line_number,) + match.groups()
+        except TracingFailure as e:
+          e.line = line
+          e.line_number = self.line_number
+          raise
+
+      def parse_file(self, filepath):
+        """Returns the list of records of a pid-specific log file."""
+        records = []
+        found_line = False
+        with open(filepath, 'rb') as f:
+          for line in f:
+            found_line = True
+            record = self.parse(line.strip())
+            if record:
+              records.append(record)
+        if not found_line:
+          # Ensures that a completely empty trace still creates the
+          # corresponding Process instance by logging a dummy line.
+          records.append(self.parse(''))
+        return records
+
+    class Process(ApiBase.Context.Process):
+      """Represents the state of a process.
+
+      Contains all the information retrieved from the pid-specific log.
+      """
+
       # Corner-case in python, a class member function decorator must not be
       # @staticmethod.
       def parse_args(regexp, expect_zero):  # pylint: disable=E0213
@@ -869,6 +999,7 @@ class Strace(ApiBase):
             same reason than with True.
           - None: ignore result.
         """
+        compiled = re.compile(regexp)
         def meta_hook(function):
           assert function.__name__.startswith('handle_')
           def hook(self, args, result):
@@ -876,7 +1007,7 @@ class Strace(ApiBase):
               return
             if expect_zero is False and result.startswith(('?', '-1')):
               return
-            match = re.match(regexp, args)
+            match = compiled.match(args)
             if not match:
               raise TracingFailure(
                   'Failed to parse %s(%s) = %s' %
@@ -924,10 +1055,8 @@ class Strace(ApiBase):
         super(Strace.Context.Process, self).__init__(root.blacklist, pid, None)
         assert isinstance(root, ApiBase.Context)
         self._root = weakref.ref(root)
-        # The dict key is the function name of the pending call, like 'open'
-        # or 'execve'.
-        self._pending_calls = {}
-        self._line_number = 0
+        # Parses the lines received via on_line().
+        self._parser = Strace.Context.LineParser()
         # Current directory when the process started.
         if isinstance(self._root(), unicode):
           self.initial_cwd = self._root()
@@ -952,88 +1081,39 @@ class Strace(ApiBase):
 
       def on_line(self, line):
         assert isinstance(line, str)
-        self._line_number += 1
+        try:
+          record = self._parser.parse(line)
+        except TracingFailure as e:
+          e.pid = self.pid
+          raise
+        if record:
+          self.on_record(record)
+
+      def on_record(self, record):
+        """Handles a record generated by LineParser."""
+        line_number, function, args, result = record
         try:
           if self._done:
             raise TracingFailure(
                 'Found a trace for a terminated process or corrupted log',
                 None, None, None)
 
-          if self.RE_SIGNAL.match(line):
-            # Ignore signals.
-            return
-
-          match = self.RE_KILLED.match(line)
-          if match:
-            # Converts a '+++ killed by Foo +++' trace into an exit_group().
-            self.handle_exit_group(match.group(1), None)
-            return
-
-          match = self.RE_PROCESS_EXITED.match(line)
-          if match:
-            # Converts a '+++ exited with 1 +++' trace into an exit_group()
-            self.handle_exit_group(match.group(1), None)
-            return
-
-          match = self.RE_UNFINISHED.match(line)
-          if match:
-            if match.group(1) in self._pending_calls:
-              raise TracingFailure(
-                  'Found two unfinished calls for the same function',
-                  None, None, None,
-                  self._pending_calls)
-            self._pending_calls[match.group(1)] = (
-                match.group(1) + match.group(2))
-            return
-
-          match = self.RE_UNAVAILABLE.match(line)
-          if match:
-            # This usually means a process was killed and a pending call was
-            # canceled.
-            # TODO(maruel): Look up the last exit_group() trace just above and
-            # make sure any self._pending_calls[anything] is properly flushed.
-            return
-
-          match = self.RE_PTRACE.match(line)
-          if match:
-            # Not sure what this means. Anyhow, the process died.
-            # TODO(maruel): Add note that only RE_PROCESS_EXITED is valid
-            # afterward.
-            return
-
-          match = self.RE_RESUMED.match(line)
-          if match:
-            if match.group(1) not in self._pending_calls:
-              raise TracingFailure(
-                  'Found a resumed call that was not logged as unfinished',
-                  None, None, None,
-                  self._pending_calls)
-            pending = self._pending_calls.pop(match.group(1))
-            # Reconstruct the line.
-            line = pending + match.group(2)
-
-          match = self.RE_HEADER.match(line)
-          if not match:
-            # The line is corrupted. It happens occasionally when a process is
-            # killed forcibly with activity going on. Assume the process died.
-            # No other line can be processed afterward.
-            logging.debug('%d is done: %s', self.pid, line)
+          if function is None:
+            # The line is corrupted, see LineParser.parse().
+            logging.debug('%d is done: %s', self.pid, args)
             self._done = True
             return
 
-          if match.group(1) == self.UNNAMED_FUNCTION:
-            return
-
           # It's a valid line, handle it.
-          handler = getattr(self, 'handle_%s' % match.group(1), None)
+          handler = getattr(self, 'handle_%s' % function, None)
           if not handler:
-            self._handle_unknown(match.group(1), match.group(2), match.group(3))
-          return handler(match.group(2), match.group(3))
+            self._handle_unknown(function, args, result)
+          return handler(args, result)
         except TracingFailure, e:
           # Hack in the values since the handler could be a static function.
           e.pid = self.pid
-          e.line = line
-          e.line_number = self._line_number
+          e.line = self._render_record(record)
+          e.line_number = line_number
           # Re-raise the modified exception.
           raise
         except (KeyError, NotImplementedError, ValueError), e:
@@ -1041,10 +1121,18 @@ class Strace(ApiBase):
               'Trace generated a %s exception: %s' % (
                   e.__class__.__name__, str(e)),
               self.pid,
-              self._line_number,
-              line,
+              line_number,
+              self._render_record(record),
               e)
 
+      @staticmethod
+      def _render_record(record):
+        """Returns an approximation of the original line for error messages."""
+        _, function, args, result = record
+        if function is None:
+          return args
+        return '%s(%s) = %s' % (function, args, result)
+
       @parse_args(r'^\"(.+?)\", [FKORWX_|]+$', True)
       def handle_access(self, args, _result):
         self._handle_file(args[0], Results.File.TOUCHED)
@@ -1323,6 +1411,14 @@ class Strace(ApiBase):
       """Transfers control into the Process.on_line() function."""
       self.get_or_set_proc(pid).on_line(line.strip())
 
+    def on_records(self, pid, records):
+      """Transfers the records generated by LineParser for a process into the
+      Process.on_record() function.
+      """
+      proc = self.get_or_set_proc(pid)
+      for record in records:
+        proc.on_record(record)
+
     def to_results(self):
       """If necessary, finds back the root process and verify consistency."""
       if not self.root_pid:
@@ -1527,15 +1623,148 @@ class Strace(ApiBase):
   def get_tracer(self, logname):
     return self.Tracer(logname, self.use_sudo)
 
+  # Total size of the pid specific logs of a trace above which they are parsed
+  # in parallel. Below, the cost of starting the worker processes dominates.
+  PARALLEL_PARSE_MIN_SIZE = 4*1024*1024
+
   @staticmethod
   def clean_trace(logname):
     if fs.isfile(logname):
       fs.remove(logname)
-    # Also delete any pid specific file from previous traces.
+    # Also delete any pid specific file and parsed cache from previous traces.
     for i in glob.iglob(logname + '.*'):
-      if i.rsplit('.', 1)[1].isdigit():
+      suffix = i.rsplit('.', 1)[1]
+      if suffix.isdigit() or suffix == 'parsed':
         fs.remove(i)
 
+  @classmethod
+  def _parse_pid_logs(cls, logname, trace, on_records):
+    """Calls on_records(pid, records) for each pid specific log of a trace, in
+    pid order.
+
+    The records are cached in the file logname.<trace>.parsed, so the logs of a
+    trace are only parsed once even if parse_log() is called many times, e.g.
+    once per trace_name. An entry is reused only if its log wasn't modified
+    since it was parsed. The cache is rewritten atomically.
+
+    The logs are independent from each other so they are parsed concurrently
+    when they are large enough. The records are streamed to on_records() as
+    they are parsed or loaded from the cache instead of being all kept in
+    memory.
+
+    Raises:
+      TracingFailure if a log can't be parsed.
+    """
+    cache_path = '%s.%s.parsed' % (logname, trace)
+    stats = {}
+    for pidfile in glob.iglob('%s.%s.*' % (logname, trace)):
+      suffix = pidfile.rsplit('.', 1)[1]
+      if suffix.isdigit():
+        s = os.stat(pidfile)
+        stats[int(suffix)] = (pidfile, s.st_size, s.st_mtime)
+      elif suffix != 'parsed':
+        logging.warning('Found unexpected file %s', pidfile)
+    pids = sorted(stats)
+
+    cache = None
+    index = {}
+    if os.path.isfile(cache_path):
+      try:
+        cache = open(cache_path, 'rb')
+        index = _strace_read_cache_index(cache)
+      except _PARSE_CACHE_ERRORS as e:
+        logging.warning('Ignoring corrupted cache %s: %s', cache_path, e)
+        index = {}
+    is_cached = lambda pid: index.get(pid, (None, None))[:2] == stats[pid][1:]
+    to_parse = [pid for pid in pids if not is_cached(pid)]
+
+    writer = None
+    tmp_path = None
+    if to_parse or sorted(index) != pids:
+      try:
+        # The suffix is ignored by the glob above and removed by clean_trace().
+        handle, tmp_path = tempfile.mkstemp(
+            prefix='%s.%s.' % (os.path.basename(logname), trace),
+            suffix='.parsed', dir=os.path.dirname(logname))
+        writer = os.fdopen(handle, 'wb')
+      except (IOError, OSError) as e:
+        logging.warning('Failed to write %s: %s', cache_path, e)
+
+    pool = None
+    failed = None
+    cache_ok = True
+    completed = False
+    try:
+      pidfiles = [stats[pid][0] for pid in to_parse]
+      if (len(pidfiles) > 1 and
+          sum(stats[pid][1] for pid in to_parse) >=
+              cls.PARALLEL_PARSE_MIN_SIZE):
+        pool = multiprocessing.Pool(
+            min(len(pidfiles), multiprocessing.cpu_count()))
+        parsed = pool.imap(_strace_parse_pid_log, pidfiles)
+      else:
+        parsed = (_strace_parse_pid_log(pidfile) for pidfile in pidfiles)
+
+      for pid in pids:
+        data = None
+        if not is_cached(pid):
+          records = next(parsed)
+        else:
+          try:
+            data = _strace_read_cache_entry(cache, index[pid])
+            records = cPickle.loads(data)
+          except _PARSE_CACHE_ERRORS as e:
+            logging.warning('Ignoring corrupted cache %s: %s', cache_path, e)
+            cache_ok = False
+            data = None
+            records = _strace_parse_pid_log(stats[pid][0])
+        if records is None:
+          # Parsed again below to get the exception. The records of the other
+          # logs are still cached.
+          if failed is None:
+            failed = pid
+          continue
+        if failed is None:
+          on_records(pid, records)
+        if writer:
+          if data is None:
+            data = cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
+          del records
+          try:
+            _strace_write_cache_entry(writer, pid, stats[pid][1:], data)
+          except (IOError, OSError) as e:
+            logging.warning('Failed to write %s: %s', cache_path, e)
+            writer.close()
+            writer = None
+            os.remove(tmp_path)
+      completed = True
+    finally:
+      if pool:
+        pool.terminate()
+      if cache:
+        cache.close()
+      if writer and not completed:
+        writer.close()
+        os.remove(tmp_path)
+
+    if writer:
+      writer.close()
+      try:
+        os.rename(tmp_path, cache_path)
+      except OSError as e:
+        logging.warning('Failed to write %s: %s', cache_path, e)
+        os.remove(tmp_path)
+    elif not cache_ok:
+      # Rebuilt on the next call.
+      os.remove(cache_path)
+
+    if failed is not None:
+      try:
+        cls.Context.LineParser().parse_file(stats[failed][0])
+      except TracingFailure as e:
+        e.pid = failed
+        raise
+
   @classmethod
   def parse_log(cls, logname, blacklist, trace_name):
     logging.info('parse_log(%s, ..., %s)', logname, trace_name)
@@ -1551,21 +1780,9 @@ class Strace(ApiBase):
       }
       try:
         context = cls.Context(blacklist, item['pid'], item['cwd'])
-        for pidfile in glob.iglob('%s.%s.*' % (logname, item['trace'])):
-          logging.debug('Reading %s', pidfile)
-          pid = pidfile.rsplit('.', 1)[1]
-          if pid.isdigit():
-            pid = int(pid)
-            found_line = False
-            for line in open(pidfile, 'rb'):
-              context.on_line(pid, line)
-              found_line = True
-            if not found_line:
-              # Ensures that a completely empty trace still creates the
-              # corresponding Process instance by logging a dummy line.
-              context.on_line(pid, '')
-          else:
-            logging.warning('Found unexpected file %s', pidfile)
+        # The processes are linked together by late-bound cwds, so the records
+        # are replayed serially.
+        cls._parse_pid_logs(logname, item['trace'], context.on_records)
         result['results'] = context.to_results()
       except TracingFailure:
         result['exception'] = sys.exc_info()
@@ -1573,6 +1790,65 @@ class Strace(ApiBase):
     return out
 
 
+# Errors raised when loading a corrupted or incompatible parse cache.
+_PARSE_CACHE_ERRORS = (
+    AttributeError, EOFError, ImportError, IndexError, IOError, KeyError,
+    OSError, TypeError, ValueError, cPickle.UnpicklingError, struct.error)
+
+
+def _strace_read_cache_index(f):
+  """Returns {pid: (size, mtime, offset, length)} of the entries of a parse
+  cache, without loading the records.
+
+  Each entry is the lengths of the header and of the records, the pickled
+  header (pid, size, mtime) and the pickled records.
+  """
+  file_size = os.fstat(f.fileno()).st_size
+  index = {}
+  while True:
+    lengths = f.read(16)
+    if not lengths:
+      return index
+    header_length, length = struct.unpack('<QQ', lengths)
+    pid, size, mtime = cPickle.loads(f.read(header_length))
+    if f.tell() + length > file_size:
+      raise EOFError('Truncated entry')
+    index[pid] = (size, mtime, f.tell(), length)
+    f.seek(length, os.SEEK_CUR)
+
+
+def _strace_read_cache_entry(f, entry):
+  """Returns the pickled records of a parse cache entry."""
+  f.seek(entry[2])
+  data = f.read(entry[3])
+  if len(data) != entry[3]:
+    raise EOFError('Truncated entry')
+  return data
+
+
+def _strace_write_cache_entry(f, pid, log_stat, data):
+  """Appends the pickled records of a pid log to a parse cache.
+
+  log_stat is (size, mtime) of the log.
+  """
+  header = cPickle.dumps((pid,) + tuple(log_stat), cPickle.HIGHEST_PROTOCOL)
+  f.write(struct.pack('<QQ', len(header), len(data)))
+  f.write(header)
+  f.write(data)
+
+
+def _strace_parse_pid_log(pidfile):
+  """Returns the records of a strace pid specific log or None on failure.
+
+  It is a module level function so it can be used with multiprocessing.
+  """
+  logging.debug('Reading %s', pidfile)
+  try:
+    return Strace.Context.LineParser().parse_file(pidfile)
+  except TracingFailure:
+    return None
+
+
 class Dtrace(ApiBase):
   """Uses DTrace framework through dtrace. Requires root access.
 
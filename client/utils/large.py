@@ -9,12 +9,131 @@ The algorithm is intentionally simple.
 
 This only works with sorted list of integers. The resulting compression level
 can be very high for monotonically increasing sets.
+
+pack() and unpack() work on whole lists. Packer and iter_unpack() are their
+streaming counterparts, they never hold more than CHUNK_SIZE bytes of
+uncompressed data in memory. All of them generate and accept the same format.
 """
 
-import cStringIO
+import array
 import zlib
 
 
+# Amount of uncompressed data buffered by Packer and iter_unpack().
+CHUNK_SIZE = 64*1024
+
+# Values must be in [0, MAX_VALUE).
+MAX_VALUE = 2L**63
+
+
+def _encode(values, last, out):
+  """Appends the delta encoded varints of values to the bytearray out.
+
+  Arguments:
+    values: sorted iterable of int.
+    last: value preceding values[0], 0 for the first value of the set.
+    out: bytearray to append to.
+
+  Returns:
+    the last value encoded.
+  """
+  append = out.append
+  for value in values:
+    delta = value - last
+    if 0 <= delta < 0x80:
+      # Fast path, dense sets are mostly composed of single byte deltas.
+      append(delta)
+    else:
+      assert delta >= 0, 'List must be sorted ascending'
+      assert value < MAX_VALUE, 'Values must be between 0 and 2**63'
+      while delta > 0x7F:
+        append(0x80 | (delta & 0x7F))
+        delta >>= 7
+      append(delta)
+    last = value
+  return last
+
+
+class _Decoder(object):
+  """Decodes delta encoded varints, possibly split across multiple chunks."""
+
+  def __init__(self):
+    self._last = 0
+    # Partially decoded varint spanning a chunk boundary.
+    self._value = 0
+    self._shift = 0
+
+  def decode(self, chunk):
+    """Returns the list of values fully decoded from chunk, a str."""
+    out = []
+    append = out.append
+    last = self._last
+    value = self._value
+    shift = self._shift
+    for byte in array.array('B', chunk):
+      if byte < 0x80:
+        if shift:
+          last += value | (byte << shift)
+          value = 0
+          shift = 0
+        else:
+          last += byte
+        append(last)
+      else:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+    self._last = last
+    self._value = value
+    self._shift = shift
+    return out
+
+
+class Packer(object):
+  """Streaming version of pack().
+
+  Values are added in ascending order with add() or extend(), then finish()
+  returns the same buffer as pack() would have returned for all the values.
+  """
+
+  def __init__(self):
+    self._compressor = zlib.compressobj()
+    self._buf = bytearray()
+    # Compressed data generated so far.
+    self._out = []
+    self._last = 0
+    self._empty = True
+
+  def add(self, value):
+    """Adds a single value, must not be lower than the previous one."""
+    self.extend((value,))
+
+  def extend(self, values):
+    """Adds a sorted iterable of values."""
+    if self._empty:
+      # Materializes generators, it must not be consumed twice.
+      values = list(values)
+      if not values:
+        return
+      assert values[0] >= 0, 'Values must be between 0 and 2**63'
+      self._empty = False
+    self._last = _encode(values, self._last, self._buf)
+    if len(self._buf) >= CHUNK_SIZE:
+      self._out.append(self._compressor.compress(str(self._buf)))
+      self._buf = bytearray()
+
+  def finish(self):
+    """Returns the compressed buffer as a str.
+
+    The Packer cannot be used afterward.
+    """
+    if self._empty:
+      return ''
+    self._out.append(self._compressor.compress(str(self._buf)))
+    self._out.append(self._compressor.flush())
+    self._buf = None
+    return ''.join(self._out)
+
+
 def pack(values):
   """Returns a deflate'd buffer of delta encoded varints.
 
@@ -24,23 +143,13 @@ def pack(values):
   Returns:
     compressed buffer as a str.
   """
-  out = ''
   if not values:
     return ''
-  last = 0
-  max_value = 2L**63
-  assert 0 <= values[0] < max_value, 'Values must be between 0 and 2**63'
-  assert 0 <= values[-1] < max_value, 'Values must be between 0 and 2**63'
-  for value in values:
-    v = value
-    value -= last
-    assert value >= 0, 'List must be sorted ascending'
-    last = v
-    while value > 127:
-      out += chr((1 << 7) | (value & 0x7F))
-      value >>=  7
-    out += chr(value)
-  return zlib.compress(out)
+  assert 0 <= values[0] < MAX_VALUE, 'Values must be between 0 and 2**63'
+  assert 0 <= values[-1] < MAX_VALUE, 'Values must be between 0 and 2**63'
+  out = bytearray()
+  _encode(values, 0, out)
+  return zlib.compress(str(out))
 
 
 def unpack(data):
@@ -52,20 +161,28 @@ def unpack(data):
   Returns:
     values: sorted list of int.
   """
-  out = []
-  if data == '':
-    return out
-  value = 0
-  base = 1
-  last = 0
-  for d in zlib.decompress(data):
-    val_byte = ord(d)
-    value += (val_byte & 0x7F) * base
-    if val_byte & 0x80:
-      base <<= 7
-    else:
-      out.append(value + last)
-      last += value
-      value = 0
-      base = 1
-  return out
+  if not data:
+    return []
+  return _Decoder().decode(zlib.decompress(data))
+
+
+def iter_unpack(data):
+  """Yields the values of a buffer returned by pack() one at a time.
+
+  Unlike unpack(), the whole list is never materialized so it is suitable to
+  count or slice (with itertools.islice) very large sets.
+
+  Arguments:
+    compressed buffer as a str. Accepts None to simplify call sites.
+  """
+  if not data:
+    return
+  decompressor = zlib.decompressobj()
+  decoder = _Decoder()
+  while data:
+    chunk = decompressor.decompress(data, CHUNK_SIZE)
+    data = decompressor.unconsumed_tail
+    for value in decoder.decode(chunk):
+      yield value
+  for value in decoder.decode(decompressor.flush()):
+    yield value
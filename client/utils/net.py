@@ -15,6 +15,8 @@ import random
 import re
 import socket
 import ssl
+import StringIO
+import sys
 import threading
 import time
 import urllib
@@ -301,6 +303,10 @@ class HttpService(object):
     self.urlhost = urlhost
     self.engine = engine
     self.authenticator = authenticator
+    # Key of a request -> _InFlightRequest, for the requests which can be
+    # coalesced, see request().
+    self._in_flight = {}
+    self._in_flight_lock = threading.Lock()
 
   @staticmethod
   def is_transient_http_error(code, retry_404, retry_50x, suburl, content_type):
@@ -372,7 +378,8 @@ class HttpService(object):
       stream=True,
       method=None,
       headers=None,
-      follow_redirects=True):
+      follow_redirects=True,
+      coalesce=False):
     """Attempts to open the given url multiple times.
 
     |urlpath| is relative to the server root, i.e. '/some/request?param=1'.
@@ -408,13 +415,64 @@ class HttpService(object):
     operation so once you pass non-None |read_timeout| be prepared to handle
     these exceptions in subsequent reads from the stream.
 
+    If |coalesce| is True, a GET request with |stream| False is merged with an
+    identical request already in flight from another thread: a single request
+    is sent and its response is returned to both. Only use it for requests
+    whose response doesn't depend on when they are sent, e.g. content
+    addressed GETs. A thread waiting for the request in flight gives up after
+    its own |timeout|.
+
     Returns a file-like object, where the response may be read from, or None
     if it was unable to connect. If |stream| is False will read whole response
     into memory buffer before returning file-like object that reads from this
     memory buffer.
     """
     assert urlpath and urlpath[0] == '/', urlpath
+    args = (
+        urlpath, data, content_type, max_attempts, retry_404, retry_50x,
+        timeout, read_timeout, stream, method, headers, follow_redirects)
+    if coalesce and data is None and method in (None, 'GET') and not stream:
+      # Only the parameters which affect the outcome are part of the key.
+      key = (
+          urlpath, tuple(sorted((headers or {}).iteritems())), max_attempts,
+          retry_404, retry_50x, timeout, read_timeout, follow_redirects)
+      return self._coalesced_request(key, args, timeout)
+    return self._request(*args)
+
+  def _coalesced_request(self, key, args, timeout):
+    """Sends the request or waits up to |timeout| for the identical request in
+    flight.
+
+    Returns an HttpResponse or None, like request().
+    """
+    with self._in_flight_lock:
+      in_flight = self._in_flight.get(key)
+      leader = not in_flight
+      if in_flight:
+        in_flight.followers += 1
+      else:
+        in_flight = self._in_flight[key] = _InFlightRequest()
+    if not leader:
+      logging.debug('Waiting for the identical request in flight: %s', key[0])
+      return in_flight.wait(timeout)
 
+    response = None
+    try:
+      response = self._request(*args)
+    finally:
+      with self._in_flight_lock:
+        # No follower can be added anymore.
+        del self._in_flight[key]
+      if in_flight.followers:
+        response = in_flight.set_response(response)
+      else:
+        in_flight.set_response(None)
+    return response
+
+  def _request(
+      self, urlpath, data, content_type, max_attempts, retry_404, retry_50x,
+      timeout, read_timeout, stream, method, headers, follow_redirects):
+    """Implements request()."""
     if data is not None:
       assert method in (None, 'DELETE', 'POST', 'PUT')
       method = method or 'POST'
@@ -571,6 +629,153 @@ class HttpService(object):
     return exc.verbose_info
 
 
+class _InFlightRequest(object):
+  """Response of a request in flight shared with the threads waiting for it."""
+
+  def __init__(self):
+    # Number of threads waiting for the response, only modified with
+    # HttpService._in_flight_lock held.
+    self.followers = 0
+    self._done = threading.Event()
+    # Tuple(content, url, headers) or None if the request failed.
+    self._result = None
+
+  def set_response(self, response):
+    """Buffers the response for the followers and wakes them up.
+
+    Returns a new HttpResponse to be used instead of |response|, since it was
+    read.
+    """
+    try:
+      if response:
+        try:
+          self._result = (
+              response.read(), response._url,  # pylint: disable=W0212
+              response._headers)  # pylint: disable=W0212
+        except TimeoutError:
+          pass
+    finally:
+      self._done.set()
+    return self._make_response()
+
+  def wait(self, timeout):
+    """Waits up to |timeout| seconds for the leader to get the response.
+
+    If |timeout| is None or 0, waits indefinitely.
+
+    Returns an HttpResponse or None.
+    """
+    deadline = time.time() + timeout if timeout else None
+    # Use non-None timeout so that process reacts to Ctrl+C and other signals,
+    # see http://bugs.python.org/issue8844.
+    while not self._done.wait(
+        1 if deadline is None else max(0, min(1, deadline - time.time()))):
+      if deadline is not None and time.time() >= deadline:
+        logging.warning('Timed out waiting for the request in flight')
+        return None
+    return self._make_response()
+
+  def _make_response(self):
+    if not self._result:
+      return None
+    content, url, headers = self._result
+    return HttpResponse(StringIO.StringIO(content), url, headers)
+
+
+class Batcher(object):
+  """Combines calls made concurrently by multiple threads into batches.
+
+  It's a micro-batching helper for services which accept many small requests
+  in one batch RPC. The first thread calling an idle Batcher waits up to
+  |max_delay| for other threads to join, then calls |batch_fn| on behalf of
+  all of them.
+
+  Usage:
+    def batch_fn(items):
+      return service.json_request('/batch', data=items)['results']
+    batcher = Batcher(batch_fn)
+    # From any thread.
+    result = batcher.call(item)
+  """
+
+  def __init__(self, batch_fn, max_batch_size=100, max_delay=0.01):
+    """
+    Arguments:
+      batch_fn: function taking a list of items and returning the list of
+          their results, in the same order.
+      max_batch_size: maximum number of items in a call to batch_fn.
+      max_delay: maximum time in seconds to wait for a batch to fill up.
+    """
+    assert max_batch_size > 0, max_batch_size
+    self._batch_fn = batch_fn
+    self._max_batch_size = max_batch_size
+    self._max_delay = max_delay
+    self._lock = threading.Lock()
+    # Notified when the pending batch is full.
+    self._full = threading.Condition(self._lock)
+    # _PendingBatch still accepting items.
+    self._pending = None
+
+  def call(self, item):
+    """Adds an item to a batch and returns its result once sent.
+
+    Raises the exception raised by batch_fn, if any.
+    """
+    with self._lock:
+      batch = self._pending
+      leader = not batch
+      if leader:
+        batch = self._pending = _PendingBatch()
+      index = len(batch.items)
+      batch.items.append(item)
+      if len(batch.items) >= self._max_batch_size:
+        # Stop accepting items.
+        self._pending = None
+        self._full.notify_all()
+
+    if leader:
+      deadline = time.time() + self._max_delay
+      with self._lock:
+        while self._pending is batch:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            self._pending = None
+            break
+          self._full.wait(remaining)
+      batch.run(self._batch_fn)
+    return batch.get(index)
+
+
+class _PendingBatch(object):
+  """Items of a batch and their results once sent."""
+
+  def __init__(self):
+    self.items = []
+    self._done = threading.Event()
+    self._results = None
+    self._exc_info = None
+
+  def run(self, batch_fn):
+    try:
+      results = batch_fn(self.items[:])
+      if len(results) != len(self.items):
+        raise ValueError(
+            'Expected %d results, got %d' % (len(self.items), len(results)))
+      self._results = results
+    except Exception:
+      self._exc_info = sys.exc_info()
+    finally:
+      self._done.set()
+
+  def get(self, index):
+    # Use non-None timeout so that process reacts to Ctrl+C and other signals.
+    while not self._done.wait(1):
+      pass
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._results[index]
+
+
 class HttpRequest(object):
   """Request to HttpService."""
 
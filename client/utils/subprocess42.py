@@ -30,6 +30,7 @@ TODO(maruel): Add VOID support like subprocess2.
 import collections
 import contextlib
 import errno
+import math
 import os
 import signal
 import sys
@@ -83,7 +84,7 @@ if subprocess.mswindows:
       raise OSError(wintypes.GetLastError())
     return c_avail.value
 
-  def recv_multi_impl(conns, maxsize, timeout):
+  def recv_multi_impl(conns, maxsize, timeout, poller=None):
     """Reads from the first available pipe.
 
     It will immediately return on a closed connection, independent of timeout.
@@ -92,6 +93,7 @@ if subprocess.mswindows:
     - maxsize: Maximum number of bytes to return. Defaults to MAX_SIZE.
     - timeout: If None, it is blocking. If 0 or above, will return None if no
           data is available within |timeout| seconds.
+    - poller: Unused on Windows.
 
     Returns:
       tuple(int(index), str(data), bool(closed)).
@@ -136,7 +138,112 @@ else:
   STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
 
 
-  def recv_multi_impl(conns, maxsize, timeout):
+  class Poller(object):
+    """Waits for pipes to become readable.
+
+    Uses epoll when available, poll otherwise. select is only used as a last
+    resort, as it can't handle file descriptors above FD_SETSIZE (usually
+    1024).
+
+    Registered pipes are made non-blocking once and stay so until they are
+    unregistered.
+    """
+
+    def __init__(self):
+      # {fd: (conn, original file status flags)}
+      self._conns = {}
+      if hasattr(select, 'epoll'):
+        self._epoll = select.epoll()
+        flags = fcntl.fcntl(self._epoll.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(
+            self._epoll.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self._poll = None
+      elif hasattr(select, 'poll'):
+        self._epoll = None
+        self._poll = select.poll()
+      else:
+        self._epoll = None
+        self._poll = None
+
+    def __contains__(self, conn):
+      return conn.fileno() in self._conns
+
+    def conns(self):
+      """Returns the registered pipes."""
+      return [conn for conn, _ in self._conns.itervalues()]
+
+    def register(self, conn):
+      """Makes conn non-blocking and starts watching it."""
+      fd = conn.fileno()
+      if fd in self._conns:
+        return
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      if not flags & os.O_NONBLOCK:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+      if self._epoll:
+        self._epoll.register(
+            fd, select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR |
+            select.EPOLLHUP)
+      elif self._poll:
+        self._poll.register(
+            fd, select.POLLIN | select.POLLPRI | select.POLLERR |
+            select.POLLHUP)
+      self._conns[fd] = (conn, flags)
+
+    def unregister(self, conn):
+      """Stops watching conn and restores its blocking mode.
+
+      It must be called before conn is closed.
+      """
+      fd = conn.fileno()
+      item = self._conns.pop(fd, None)
+      if item is None:
+        return
+      if self._epoll:
+        self._epoll.unregister(fd)
+      elif self._poll:
+        self._poll.unregister(fd)
+      if not item[1] & os.O_NONBLOCK:
+        fcntl.fcntl(
+            fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+
+    def close(self):
+      """Unregisters all the pipes still open and releases the poller."""
+      for conn in self.conns():
+        if not conn.closed:
+          self.unregister(conn)
+      self._conns.clear()
+      if self._epoll:
+        self._epoll.close()
+
+    def poll(self, timeout):
+      """Returns the list of readable, or closed, registered file descriptors.
+
+      Arguments:
+      - timeout: If None, it is blocking. Otherwise returns an empty list if
+            no pipe is readable within |timeout| seconds.
+      """
+      # Like select(), wait at least 1ms so data written by a child process
+      # right before it exits is seen by a caller polling with timeout=0.
+      if timeout is not None:
+        timeout = max(timeout, 0.001)
+      try:
+        if self._epoll:
+          return [
+            fd for fd, _ in self._epoll.poll(-1 if timeout is None else timeout)
+          ]
+        if self._poll:
+          return [
+            fd for fd, _ in self._poll.poll(
+                None if timeout is None else int(math.ceil(timeout * 1000)))
+          ]
+        return select.select(list(self._conns), [], [], timeout)[0]
+      except (IOError, OSError, select.error):
+        # Interrupted by a signal.
+        return []
+
+
+  def recv_multi_impl(conns, maxsize, timeout, poller=None):
     """Reads from the first available pipe.
 
     It will immediately return on a closed connection, independent of timeout.
@@ -145,6 +252,8 @@ else:
     - maxsize: Maximum number of bytes to return. Defaults to MAX_SIZE.
     - timeout: If None, it is blocking. If 0 or above, will return None if no
           data is available within |timeout| seconds.
+    - poller: Poller watching exactly |conns|. If None, a temporary one is
+          used and the pipes are restored to blocking mode on return.
 
     Returns:
       tuple(int(index), str(data), bool(closed)).
@@ -153,41 +262,37 @@ else:
     assert timeout is None or isinstance(timeout, (int, float)), timeout
     maxsize = max(maxsize or MAX_SIZE, 1)
 
-    # select(timeout=0) will block, it has to be a value > 0.
-    if timeout == 0:
-      timeout = 0.001
-    try:
-      r, _, _ = select.select(conns, [], [], timeout)
-    except select.error:
-      r = None
-    if not r:
+    if not poller:
+      poller = Poller()
+      try:
+        for conn in conns:
+          poller.register(conn)
+        return recv_multi_impl(conns, maxsize, timeout, poller)
+      finally:
+        poller.close()
+
+    ready = poller.poll(timeout)
+    if not ready:
       return None, None, False
 
-    conn = r[0]
-    # Temporarily make it non-blocking.
-    # TODO(maruel): This is not very efficient when the caller is doing this in
-    # a loop. Add a mechanism to have the caller handle this.
-    flags = fcntl.fcntl(conn, fcntl.F_GETFL)
-    if not conn.closed:
-      # pylint: disable=E1101
-      fcntl.fcntl(conn, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    fds = [c.fileno() for c in conns]
+    indexes = [fds.index(fd) for fd in ready if fd in fds]
+    if not indexes:
+      return None, None, False
+    index = min(indexes)
     try:
-      try:
-        data = conn.read(maxsize)
-      except IOError as e:
-        # On posix, this means the read would block.
-        if e.errno == errno.EAGAIN:
-          return conns.index(conn), None, False
-        raise e
+      data = os.read(fds[index], maxsize)
+    except OSError as e:
+      # The pipe is non-blocking, this means the read would block.
+      if e.errno == errno.EAGAIN:
+        return index, None, False
+      raise
 
-      if not data:
-        # On posix, this means the channel closed.
-        return conns.index(conn), None, True
+    if not data:
+      # On posix, this means the channel closed.
+      return index, None, True
 
-      return conns.index(conn), data, False
-    finally:
-      if not conn.closed:
-        fcntl.fcntl(conn, fcntl.F_SETFL, flags)
+    return index, data, False
 
 
 class TimeoutExpired(Exception):
@@ -243,6 +348,8 @@ class Popen(subprocess.Popen):
     self.start = time.time()
     self.end = None
     self.gid = None
+    # Poller watching stdout and stderr, created on first use by recv_any().
+    self._poller = None
     self.detached = kwargs.pop('detached', False)
     if self.detached:
       if subprocess.mswindows:
@@ -482,7 +589,8 @@ class Popen(subprocess.Popen):
         return None, None
       start = time.time()
       conns, names = zip(*pipes)
-      index, data, closed = recv_multi_impl(conns, maxsize, timeout)
+      index, data, closed = recv_multi_impl(
+          conns, maxsize, timeout, self._get_poller(conns))
       if index is None:
         return index, data
       if closed:
@@ -545,17 +653,43 @@ class Popen(subprocess.Popen):
         return False
     return True
 
+  def _get_poller(self, conns):
+    """Returns the Poller watching exactly conns, None on Windows.
+
+    Pipes are registered once for the lifetime of the process instead of on
+    every read, which matters when yield_any() is called in a loop. A pipe is
+    only unregistered when a read is done on the other pipe alone.
+    """
+    if subprocess.mswindows:
+      return None
+    if not self._poller:
+      self._poller = Poller()
+    for conn in self._poller.conns():
+      if conn not in conns:
+        self._poller.unregister(conn)
+    for conn in conns:
+      self._poller.register(conn)
+    return self._poller
+
   def _close(self, which):
     """Closes either stdout or stderr."""
-    getattr(self, which).close()
+    conn = getattr(self, which)
+    if self._poller and not conn.closed:
+      self._poller.unregister(conn)
+    conn.close()
     setattr(self, which, None)
+    if self._poller and not self.stdout and not self.stderr:
+      # It was the last pipe.
+      self._poller.close()
+      self._poller = None
 
   def _recv(self, which, maxsize, timeout):
     """Reads from one of stdout or stderr synchronously with timeout."""
     conn = getattr(self, which)
     if conn is None:
       return None
-    _, data, closed = recv_multi_impl([conn], maxsize, timeout)
+    _, data, closed = recv_multi_impl(
+        [conn], maxsize, timeout, self._get_poller([conn]))
     if closed:
       self._close(which)
     if self.universal_newlines and data:
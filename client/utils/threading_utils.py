@@ -6,6 +6,7 @@
 
 import functools
 import inspect
+import itertools
 import logging
 import os
 import Queue
@@ -63,8 +64,22 @@ class ThreadPool(object):
   """Multithreaded worker pool with priority support.
 
   When the priority of tasks match, it works in strict FIFO mode.
+
+  The number of threads adapts to the load. A new thread is started only when
+  the queued tasks can't be started within MAX_QUEUE_LATENCY by the current
+  threads, based on the measured duration of the tasks, or when tasks are still
+  queued after MAX_QUEUE_LATENCY. Threads in excess of initial_threads exit
+  when they find nothing to do while another thread is already waiting, if all
+  the threads weren't busy for IDLE_TIMEOUT.
   """
   QUEUE_CLASS = Queue.PriorityQueue
+  # Maximum time in seconds a task is expected to wait in the queue before a
+  # worker picks it up. 0 starts a new thread whenever all of them are busy.
+  MAX_QUEUE_LATENCY = 0.05
+  # Weight of the latest task in the moving average of the task durations.
+  RUN_TIME_WEIGHT = 0.2
+  # Time in seconds after which the threads in excess can exit.
+  IDLE_TIMEOUT = 1.
 
   def __init__(self, initial_threads, max_threads, queue_size, prefix=None):
     """Immediately starts |initial_threads| threads.
@@ -88,12 +103,12 @@ class ThreadPool(object):
     assert max_threads <= 1024
 
     self.tasks = self.QUEUE_CLASS(queue_size)
+    self._min_threads = initial_threads
     self._max_threads = max_threads
     self._prefix = prefix
 
-    # Used to assign indexes to tasks.
-    self._num_of_added_tasks_lock = threading.Lock()
-    self._num_of_added_tasks = 0
+    # Used to assign indexes to tasks. next() on it is atomic.
+    self._task_index = itertools.count(1)
 
     # Lock that protected everything below (including conditional variable).
     self._lock = threading.Lock()
@@ -108,24 +123,39 @@ class ThreadPool(object):
 
     # List of threads.
     self._workers = []
+    # Number of threads started so far.
+    self._spawned = 0
     # Number of threads that are waiting for new tasks.
     self._ready = 0
     # Number of threads already added to _workers, but not yet running the loop.
     self._starting = 0
+    # Moving average of the duration of the tasks in seconds, None until a
+    # task completes.
+    self._run_time = None
+    # threading.Timer checking whether queued tasks are still waiting.
+    self._latency_timer = None
+    # Last time all the threads were busy.
+    self._last_busy = time.time()
     # True if close was called. Forbids adding new tasks.
     self._is_closed = False
 
     for _ in range(initial_threads):
       self._add_worker()
 
+  @property
+  def spawned(self):
+    """Number of threads started so far."""
+    return self._spawned
+
   def _add_worker(self):
     """Adds one worker thread if there isn't too many. Thread-safe."""
     with self._lock:
       if len(self._workers) >= self._max_threads or self._is_closed:
         return False
       worker = threading.Thread(
-        name='%s-%d' % (self._prefix, len(self._workers)), target=self._run)
+        name='%s-%d' % (self._prefix, self._spawned), target=self._run)
       self._workers.append(worker)
+      self._spawned += 1
       self._starting += 1
     logging.debug('Starting worker thread %s', worker.name)
     worker.daemon = True
@@ -154,23 +184,71 @@ class ThreadPool(object):
     with self._lock:
       if self._is_closed:
         raise ThreadPoolClosed('Can not add a task to a closed ThreadPool')
-      start_new_worker = (
-        # Pending task count plus new task > number of available workers.
-        self.tasks.qsize() + 1 > self._ready + self._starting and
-        # Enough slots.
-        len(self._workers) < self._max_threads
-      )
+      # Pending task count plus new task.
+      queued = self.tasks.qsize() + 1
+      start_new_worker = self._should_grow(queued)
+      if (not start_new_worker and queued > self._ready + self._starting and
+          len(self._workers) < self._max_threads):
+        self._start_latency_timer()
       self._pending_count += 1
-    with self._num_of_added_tasks_lock:
-      self._num_of_added_tasks += 1
-      index = self._num_of_added_tasks
+    index = next(self._task_index)
     self.tasks.put((priority, index, func, args, kwargs))
     if start_new_worker:
       self._add_worker()
     return index
 
+  def _should_grow(self, queued):
+    """Returns True if a worker should be started to run |queued| tasks.
+
+    Must be called with self._lock held.
+    """
+    if queued <= self._ready + self._starting:
+      # Enough available workers.
+      return False
+    if len(self._workers) >= self._max_threads:
+      # No more slots.
+      return False
+    if not self._workers or not self.MAX_QUEUE_LATENCY:
+      return True
+    if self._run_time is None:
+      # The duration of the tasks is unknown, start one worker at a time.
+      return not self._starting
+    # Time needed by the current workers to start the queued tasks.
+    return (
+        queued * self._run_time > self.MAX_QUEUE_LATENCY * len(self._workers))
+
+  def _start_latency_timer(self):
+    """Checks the queue again in MAX_QUEUE_LATENCY, unless already scheduled.
+
+    It ensures queued tasks get a worker even if the running tasks are slower
+    than expected, e.g. because they wait for a queued task.
+
+    Must be called with self._lock held.
+    """
+    if self._latency_timer or self._is_closed:
+      return
+    self._latency_timer = threading.Timer(
+        self.MAX_QUEUE_LATENCY, self._on_latency_timer)
+    self._latency_timer.daemon = True
+    self._latency_timer.start()
+
+  def _on_latency_timer(self):
+    """Starts a worker if tasks are still waiting for one."""
+    with self._lock:
+      self._latency_timer = None
+      if (self._is_closed or
+          self.tasks.qsize() <= self._ready + self._starting or
+          len(self._workers) >= self._max_threads):
+        return
+    self._add_worker()
+    with self._lock:
+      if self.tasks.qsize() > self._ready + self._starting:
+        self._start_latency_timer()
+
   def _run(self):
-    """Worker thread loop. Runs until a None task is queued."""
+    """Worker thread loop. Runs until a None task is queued or the worker is
+    not needed anymore.
+    """
     # Thread has started, adjust counters.
     with self._lock:
       self._starting -= 1
@@ -181,6 +259,10 @@ class ThreadPool(object):
       finally:
         with self._lock:
           self._ready -= 1
+          if not self._ready:
+            self._last_busy = time.time()
+      retire = False
+      start = time.time()
       try:
         if task is None:
           # We're done.
@@ -205,8 +287,25 @@ class ThreadPool(object):
           # waking up threads waiting on self.tasks.join(). Otherwise they might
           # find ThreadPool still 'busy' and perform unnecessary wait on CV.
           with self._outputs_exceptions_cond:
-            self._ready += 1
-            self._pending_count -= 1
+            if task is not None:
+              run_time = time.time() - start
+              if self._run_time is None:
+                self._run_time = run_time
+              else:
+                self._run_time += (
+                    (run_time - self._run_time) * self.RUN_TIME_WEIGHT)
+              self._pending_count -= 1
+              # Exit if there's nothing to do, another worker is already
+              # waiting for tasks and this one wasn't needed for a while.
+              retire = (
+                  not self._is_closed and self._ready and
+                  not self.tasks.qsize() and
+                  len(self._workers) > self._min_threads and
+                  time.time() - self._last_busy > self.IDLE_TIMEOUT)
+              if retire:
+                self._workers.remove(threading.current_thread())
+              else:
+                self._ready += 1
             if self._pending_count == 0:
               self._outputs_exceptions_cond.notifyAll()
           self.tasks.task_done()
@@ -215,6 +314,8 @@ class ThreadPool(object):
           # function for the thread, nothing higher will catch the error.
           logging.exception('Caught exception while marking task as done: %s',
                             e)
+      if retire:
+        return
 
   def _output_append(self, out):
     if out is not None:
@@ -285,6 +386,9 @@ class ThreadPool(object):
       if self._is_closed:
         raise ThreadPoolClosed('Can not close already closed ThreadPool')
       self._is_closed = True
+      if self._latency_timer:
+        self._latency_timer.cancel()
+        self._latency_timer = None
     for _ in range(len(self._workers)):
       # Enqueueing None causes the worker to stop.
       self.tasks.put(None)
@@ -294,7 +398,7 @@ class ThreadPool(object):
         t.join(30)
     logging.debug(
       'Thread pool \'%s\' closed: spawned %d threads total',
-      self._prefix, len(self._workers))
+      self._prefix, self._spawned)
 
   def abort(self):
     """Empties the queue.